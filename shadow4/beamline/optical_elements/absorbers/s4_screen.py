@@ -275,8 +275,7 @@ class S4ScreenElement(S4BeamlineElement):
 
                 if oe._file_abs != "":
                     try:
-                        pr = PreRefl()
-                        pr.read_preprocessor_file(oe._file_abs)
+                        pr = PreRefl.initialize_from_preprocessor_file(oe._file_abs)
                         print(pr.info())
                     except:
                         raise Exception("Failed to load preprocessor (prerefl) file %s " % oe._file_abs)
@@ -5,9 +5,10 @@ from shadow4.beam.s4_beam import S4Beam
 from shadow4.beamline.optical_elements.crystals.s4_crystal import S4CrystalElement, S4Crystal
 from shadow4.beamline.optical_elements.crystals.s4_numerical_mesh_crystal import S4NumericalMeshCrystal
 from shadow4.beamline.s4_beamline_element_movements import S4BeamlineElementMovements
+from shadow4.beamline.s4_optical_element_decorators import S4AdditionalNumericalMeshOpticalElementDecorator
 
 
-class S4AdditionalNumericalMeshCrystal(S4NumericalMeshCrystal):
+class S4AdditionalNumericalMeshCrystal(S4NumericalMeshCrystal, S4AdditionalNumericalMeshOpticalElementDecorator):
     """
     Constructor.
 
@@ -20,6 +21,10 @@ class S4AdditionalNumericalMeshCrystal(S4NumericalMeshCrystal):
         The numerical mesh to be added to the ideal crystal.
     name : str, optional
         The name of the crystal.
+    f_intercept : int, optional
+        The method to calculate the intercept with the surface:
+            - 0=numerical solution on the mesh resulting of adding the ideal surface to the numerical mesh,
+            - 1=exact intercept with the ideal surface plus correction iterations with the numerical mesh heights.
 
     Returns
     -------
@@ -28,7 +33,9 @@ class S4AdditionalNumericalMeshCrystal(S4NumericalMeshCrystal):
     def __init__(self,
                  ideal_crystal : S4Crystal = None,
                  numerical_mesh_crystal : S4NumericalMeshCrystal = None,
-                 name="Crystal with Additional Numerical Mesh"):
+                 name="Crystal with Additional Numerical Mesh",
+                 f_intercept=0, # 0=numerical solution on ideal+mesh, 1=ideal surface solution + mesh corrections
+                 ):
         S4NumericalMeshCrystal.__init__(self, name=name,
                  boundary_shape=None if ideal_crystal is None else ideal_crystal.get_boundary_shape(),
                  xx=None if numerical_mesh_crystal is None else numerical_mesh_crystal._curved_surface_shape._xx,
@@ -56,8 +63,11 @@ class S4AdditionalNumericalMeshCrystal(S4NumericalMeshCrystal):
         self.__ideal_crystal         = ideal_crystal
         self.__numerical_mesh_crystal = numerical_mesh_crystal
 
+        self._f_intercept = f_intercept
+
         self.__inputs = {
             "name": name,
+            "f_intercept": f_intercept,
             "ideal_crystal": ideal_crystal,
             "numerical_mesh_crystal": numerical_mesh_crystal,
         }
@@ -106,11 +116,12 @@ class S4AdditionalNumericalMeshCrystal(S4NumericalMeshCrystal):
         txt_pre = """
 
 from shadow4.beamline.optical_elements.crystals.s4_additional_numerical_mesh_crystal import S4AdditionalNumericalMeshCrystal
-optical_element = S4AdditionalNumericalMeshCrystal(name='{name:s}', ideal_crystal=ideal_crystal, numerical_mesh_crystal=numerical_mesh_crystal)
+optical_element = S4AdditionalNumericalMeshCrystal(name='{name:s}', ideal_crystal=ideal_crystal, numerical_mesh_crystal=numerical_mesh_crystal, f_intercept={f_intercept:d})
     """
         txt += txt_pre.format(**self.__inputs)
         return txt
 
+
 class S4AdditionalNumericalMeshCrystalElement(S4CrystalElement):
     """
     Constructor.
@@ -1,3 +1,4 @@
+import os
 import numpy
 
 from syned.beamline.element_coordinates import ElementCoordinates
@@ -7,7 +8,7 @@ from syned.beamline.shape import Rectangle, Ellipse
 from shadow4.beam.s4_beam import S4Beam
 from shadow4.beamline.s4_beamline_element import S4BeamlineElement
 from shadow4.beamline.s4_beamline_element_movements import S4BeamlineElementMovements
-from shadow4.tools.arrayofvectors import vector_modulus, vector_dot, vector_cross, vector_norm
+from shadow4.tools.arrayofvectors import vector_modulus, vector_dot, vector_cross, vector_norm, vector_cross_norm
 from shadow4.tools.arrayofvectors import vector_multiply_scalar, vector_diff
 
 from crystalpy.diffraction.DiffractionSetupXraylib import DiffractionSetupXraylib
@@ -23,6 +24,8 @@ from crystalpy.diffraction.PerfectCrystalDiffraction import PerfectCrystalDiffra
 from dabax.dabax_xraylib import DabaxXraylib
 
 from shadow4.optical_surfaces.s4_mesh import S4Mesh
+from shadow4.physical_models.crystal.crystal_reflectivity_table import CrystalReflectivityTable
+from shadow4.physical_models.crystal.diffraction_setup_cache import DIFFRACTION_SETUP_CACHE
 from shadow4.optical_surfaces.s4_toroid import S4Toroid
 
 from shadow4.tools.logger import is_verbose, is_debug
@@ -294,16 +297,25 @@ class S4CrystalElement(S4BeamlineElement):
         self._crystalpy_diffraction_setup = None
 
 
-    def set_crystalpy_diffraction_setup(self):
+    def set_crystalpy_diffraction_setup(self, use_cache=True):
         """
-        Returns the crystalpy DiffractionSetup.
+        Sets the crystalpy DiffractionSetup.
 
-        Returns
-        -------
-        instance of crystalpy DiffractionSetupAbstract
+        Parameters
+        ----------
+        use_cache : boolean, optional
+            If True, the setup is taken from the process-wide cache of diffraction setups
+            (shadow4.physical_models.crystal.diffraction_setup_cache), shared by all the crystal elements with the
+            same crystal parameters, and with memoized structure factors. If False, a new setup is created.
         """
+        if use_cache:
+            self._crystalpy_diffraction_setup = DIFFRACTION_SETUP_CACHE.get(self._get_diffraction_setup_key(),
+                                                                            self._create_crystalpy_diffraction_setup)
+        else:
+            self._crystalpy_diffraction_setup = self._create_crystalpy_diffraction_setup()
+
+    def _create_crystalpy_diffraction_setup(self):
         oe = self.get_optical_element()
-        coor = self.get_coordinates()
         geo = oe.get_diffraction_geometry()
         if geo == DiffractionGeometry.BRAGG:
             geo_type = BraggDiffraction()
@@ -360,7 +372,7 @@ class S4CrystalElement(S4BeamlineElement):
         else:
             raise NotImplementedError
 
-        self._crystalpy_diffraction_setup = diffraction_setup
+        return diffraction_setup
 
     def align_crystal(self):
         """
@@ -378,8 +390,10 @@ class S4CrystalElement(S4BeamlineElement):
             else:
                 energy = codata.h * codata.c / codata.e * 1e2 / (oe._phot_cent * 1e-8)
 
-            setting_angle = self._crystalpy_diffraction_setup.angleBraggCorrected(energy)
-            if isinstance(setting_angle, (list, tuple, numpy.ndarray)): setting_angle = setting_angle[0]
+            # alignment angles, shared by the elements with the same crystal setup
+            setting_angle, theta_out = DIFFRACTION_SETUP_CACHE.get_value(self._get_diffraction_setup_key(),
+                                                                         ("alignment", float(energy)),
+                                                                         lambda: self._calculate_alignment_angles(energy))
 
             theta_in_grazing  = setting_angle + oe._asymmetry_angle
 
@@ -394,10 +408,6 @@ class S4CrystalElement(S4BeamlineElement):
                 print("    align_crystal: (normal) Reflection angle [LAUE EQUATION] [deg]",  numpy.degrees(numpy.pi/2 - (theta_out_grazing) ))
                 print("    align_crystal: grazing output angle [LAUE EQUATION] [deg]: ", numpy.degrees(theta_out_grazing))
 
-            KIN = self._crystalpy_diffraction_setup.vectorKscattered(energy=energy)
-            theta_out = KIN.angle(self._crystalpy_diffraction_setup.vectorNormalSurface())
-            if isinstance(theta_out, (list, tuple, numpy.ndarray)): theta_out = theta_out[0]
-
             if is_verbose(): print("    align_crystal: (normal) Reflection angle [SCATTERING EQUATION] [deg]: ", numpy.degrees(theta_out))
             _, _, angle_azimuthal = coor.get_angles()
 
@@ -409,6 +419,17 @@ class S4CrystalElement(S4BeamlineElement):
 
         if is_verbose(): print(coor.info())
 
+    def _calculate_alignment_angles(self, energy):
+        # returns the Bragg angle corrected for refraction and the angle of the scattered beam with the surface normal
+        setting_angle = self._crystalpy_diffraction_setup.angleBraggCorrected(energy)
+        if isinstance(setting_angle, (list, tuple, numpy.ndarray)): setting_angle = setting_angle[0]
+
+        KIN = self._crystalpy_diffraction_setup.vectorKscattered(energy=energy)
+        theta_out = KIN.angle(self._crystalpy_diffraction_setup.vectorNormalSurface())
+        if isinstance(theta_out, (list, tuple, numpy.ndarray)): theta_out = theta_out[0]
+
+        return setting_angle, theta_out
+
     def trace_beam(self, **params):
         """
         Runs (ray tracing) the input beam through the element.
@@ -420,6 +441,25 @@ class S4CrystalElement(S4BeamlineElement):
         flag_lost_value: float
             numeric value to set in the flag column when ray is lost.
 
+        precull: boolean
+            for toroids and meshes, discard the rays clearly missing the element before the intercept calculation
+            (default=False). The discarded rays are flagged as lost and left at z=0 with the incident direction (they
+            are not reflected as without the pre-cull): only the good rays are the same.
+
+        reflectivity_table : boolean, optional
+            if True, the complex reflectivities are interpolated in a table (energy x deviation angle from the Bragg
+            angle) calculated with crystalpy and cached for the next runs. If False (default), crystalpy is called
+            for every ray (exact calculation, use it for validation).
+
+        reflectivity_table_tolerance : float, optional
+            for reflectivity_table=True, the maximum interpolation error in the amplitudes (default=1e-3).
+
+        reflectivity_table_interpolation : int, optional
+            for reflectivity_table=True, the interpolation order: 1=bilinear (default), 3=bicubic.
+
+        reflectivity_table_cache_dir : str, optional
+            for reflectivity_table=True, a directory to store and reuse the tables between runs (default=None).
+
         Returns
         -------
         tuple
@@ -428,6 +468,7 @@ class S4CrystalElement(S4BeamlineElement):
 
         if not isinstance(self.get_optical_element(), Crystal): raise Exception("Undefined Crystal")
         flag_lost_value = params.get("flag_lost_value", -1)
+        precull = params.get("precull", False)
         change_reference_system_in = params.get("change_reference_system_in", True)
         change_reference_system_out = params.get("change_reference_system_out", True)
         print(">>>>>> change_reference_system: ", change_reference_system_in, change_reference_system_out)
@@ -488,7 +529,10 @@ class S4CrystalElement(S4BeamlineElement):
         #
         # crystal diffraction
         #
-        footprint, normal = self._apply_crystal_diffraction(input_beam)
+        footprint, normal = self._apply_with_precull(lambda beam: self._apply_crystal_diffraction(beam, **params),
+                                                     input_beam,
+                                                     soe.get_optical_surface_instance(), soe.get_boundary_shape(),
+                                                     flag_lost_value=flag_lost_value, precull=precull)
 
         #
         # apply crystal movements (backwards) and boundaries
@@ -519,7 +563,7 @@ class S4CrystalElement(S4BeamlineElement):
 
         return output_beam, footprint
 
-    def _apply_crystal_diffraction(self, input_beam):
+    def _apply_crystal_diffraction(self, input_beam, **params):
         #
         # geometric and physics for the scattering process:
         # reflect beam in the crystal and apply crystal reflectivity
@@ -533,7 +577,7 @@ class S4CrystalElement(S4BeamlineElement):
                 print("    >>>>>> vout: ", footprint.get_columns([4, 5, 6])[:, 0])
                 print("    >>>>>> normal: ", normal.shape, normal[:, 0])
 
-            vIn, vOut, r_SS, r_PP = self._calculate_perfect_crystal_scattering(footprint, normal)
+            vIn, vOut, r_SS, r_PP = self._calculate_perfect_crystal_scattering(footprint, normal, **params)
             jv_out_0, jv_out_1, ee_S, ee_P = self._calculate_jones_and_efield_directions(footprint, normal,
                                                                                             vIn, vOut, r_SS, r_PP)
             # update beam array with the new direction
@@ -564,7 +608,7 @@ class S4CrystalElement(S4BeamlineElement):
 
         return footprint, normal
 
-    def _calculate_perfect_crystal_scattering(self, footprint1, normal):
+    def _calculate_perfect_crystal_scattering(self, footprint1, normal, **params):
         """
         Compute the scattering by the crystal beamline element.
 
@@ -583,6 +627,10 @@ class S4CrystalElement(S4BeamlineElement):
         normal : numpy array
             The array with the normal to the surface for all rays.
 
+        **params
+            The trace_beam parameters (reflectivity_table=True selects the interpolation of the reflectivities in
+            a table, see trace_beam).
+
         Returns
         -------
         tuple
@@ -647,6 +695,20 @@ class S4CrystalElement(S4BeamlineElement):
         # phi = self._crystalpy_diffraction_setup.azimuthalAngle()
         # bragg_normal = temp_normal_bragg.rotateAroundAxis(temp_normal_bragg, phi)
 
+        if params.get("reflectivity_table", False):
+            # directions from the scattering equation (as crystalpy does), reflectivities interpolated in the table
+            setup = self._crystalpy_diffraction_setup
+            use_sign_of = -1 if setup.geometryType() in [LaueDiffraction(), LaueTransmission()] else +1
+            k_out = photons_in.wavevector().scatteringOnSurface(surface_normal, bragg_normal, use_sign_of=use_sign_of)
+            r_S, r_P = self._get_reflectivity_amplitudes_from_table(energies, v1, bragg_normal.components(), **params)
+
+            if is_verbose():
+                print(">> r_S (table): ", r_S[0], numpy.abs(r_S[0]) ** 2)
+                print(">> r_P (table): ", r_P[0], numpy.abs(r_P[0]) ** 2)
+            vOut = k_out.getNormalizedVector().components().T  # shape (npoints, 3)
+            vIn = v1.T
+            return vIn, vOut, r_S, r_P
+
         perfect_crystal = PerfectCrystalDiffraction.initializeFromDiffractionSetupAndEnergy(
             self._crystalpy_diffraction_setup,
             energies,
@@ -678,6 +740,48 @@ class S4CrystalElement(S4BeamlineElement):
         vIn = v1.T
         return vIn, vOut, r_S, r_P
 
+    def _get_reflectivity_amplitudes_from_table(self, photon_energy_ev, directions, bragg_normals, **params):
+        soe = self.get_optical_element()
+        setup = self._crystalpy_diffraction_setup
+
+        deviations = CrystalReflectivityTable.get_deviation_angles(setup, photon_energy_ev, directions, bragg_normals)
+        good = numpy.isfinite(photon_energy_ev) & numpy.isfinite(deviations)
+        if not numpy.any(good): return numpy.zeros_like(photon_energy_ev, dtype=complex), \
+                                       numpy.zeros_like(photon_energy_ev, dtype=complex)
+
+        table = CrystalReflectivityTable.initialize_from_diffraction_setup(
+            setup,
+            calculation_method=soe.dynamic_theory,
+            is_thick=soe._is_thick,
+            setup_key=self._get_diffraction_setup_key(),
+            tolerance=params.get("reflectivity_table_tolerance", 1e-3),
+            interpolation=params.get("reflectivity_table_interpolation", 1),
+            energy_range=[photon_energy_ev[good].min(), photon_energy_ev[good].max()],
+            deviation_range=[deviations[good].min(), deviations[good].max()],
+            cache_dir=params.get("reflectivity_table_cache_dir", None),
+        )
+
+        rs = numpy.zeros_like(photon_energy_ev, dtype=complex)
+        rp = numpy.zeros_like(photon_energy_ev, dtype=complex)
+        rs[good], rp[good] = table.reflectivity_amplitudes(photon_energy_ev[good], deviations[good])
+        return rs, rp
+
+    def _get_diffraction_setup_key(self):
+        # the parameters of the optical element defining the crystalpy diffraction setup (including the
+        # modification time of the preprocessor file, if used)
+        oe = self.get_optical_element()
+        if oe._material_constants_library_flag == 1:
+            try:    library = "dabax:%s:%s" % (oe._dabax.get_file_f0(), oe._dabax.get_file_Crystals())
+            except: library = "dabax"
+        elif oe._material_constants_library_flag in [2, 3]:
+            try:    library = "file:%s:%d" % (os.path.abspath(oe._file_refl), os.stat(oe._file_refl).st_mtime_ns)
+            except: library = "file:%s" % oe._file_refl
+        else:
+            library = "xraylib"
+        return (library, int(oe._material_constants_library_flag), str(oe._material),
+                int(oe._miller_index_h), int(oe._miller_index_k), int(oe._miller_index_l),
+                float(oe._asymmetry_angle), float(oe._thickness), str(oe.get_diffraction_geometry()))
+
     def _calculate_jones_and_efield_directions(self, footprint, normal, vIn, vOut, r_SS, r_PP):
         """
         Calculates the Jones vector after crystal diffraction. It also returns the directions of the
@@ -726,13 +830,13 @@ class S4CrystalElement(S4BeamlineElement):
             ee_P = e_P
             axis = e_S  # Dummy assignment, not used
         else:
-            axis = vector_norm(vector_cross(vIn, vOut))
+            axis = vector_cross_norm(vIn, vOut)
 
             es_S = axis  # \hat{u}_{\sigma,i} in Eq. 12
-            es_P = vector_norm(vector_cross(es_S, vIn))  # \hat{u}_{\pi,i} in Eq. 12
+            es_P = vector_cross_norm(es_S, vIn)  # \hat{u}_{\pi,i} in Eq. 12
 
             ee_S = axis  # \hat{u}_{\sigma,f} in Eq. 13
-            ee_P = vector_norm(vector_cross(ee_S, vOut))  # \hat{u}_{\pi,f} in Eq. 13
+            ee_P = vector_cross_norm(ee_S, vOut)  # \hat{u}_{\pi,f} in Eq. 13
 
         if is_verbose():
             print(">>>>> e_S, perp vIn: ", e_S[0], vector_dot(e_S, vIn)[0])
@@ -1062,18 +1166,11 @@ class S4CrystalElement(S4BeamlineElement):
                 v_S[mask, 1] = E_diffracted_P[mask, 1]
                 v_S[mask, 2] = E_diffracted_P[mask, 2]
 
-        v_P = vector_cross(v_S, vOut) # AP_TEMP
-
-        uS = vector_norm(v_S)
-        uP = vector_norm(v_P)
-
-        E_diffracted_S[:, 0] = uS[:, 0] * aS
-        E_diffracted_S[:, 1] = uS[:, 1] * aS
-        E_diffracted_S[:, 2] = uS[:, 2] * aS
+        uP = vector_cross_norm(v_S, vOut) # AP_TEMP normalized
+        uS = vector_norm(v_S, out=v_S)
 
-        E_diffracted_P[:, 0] = uP[:, 0] * aP
-        E_diffracted_P[:, 1] = uP[:, 1] * aP
-        E_diffracted_P[:, 2] = uP[:, 2] * aP
+        vector_multiply_scalar(uS, aS, out=E_diffracted_S)
+        vector_multiply_scalar(uP, aP, out=E_diffracted_P)
 
         # END STEP 3
 
@@ -5,9 +5,10 @@ from shadow4.beam.s4_beam import S4Beam
 from shadow4.beamline.optical_elements.gratings.s4_grating import S4GratingElement, S4Grating
 from shadow4.beamline.optical_elements.gratings.s4_numerical_mesh_grating import S4NumericalMeshGrating
 from shadow4.beamline.s4_beamline_element_movements import S4BeamlineElementMovements
+from shadow4.beamline.s4_optical_element_decorators import S4AdditionalNumericalMeshOpticalElementDecorator
 
 
-class S4AdditionalNumericalMeshGrating(S4NumericalMeshGrating):
+class S4AdditionalNumericalMeshGrating(S4NumericalMeshGrating, S4AdditionalNumericalMeshOpticalElementDecorator):
     """
     Constructor.
 
@@ -20,6 +21,10 @@ class S4AdditionalNumericalMeshGrating(S4NumericalMeshGrating):
         The numerical mesh to be added to the ideal grating.
     name : str, optional
         The name of the grating.
+    f_intercept : int, optional
+        The method to calculate the intercept with the surface:
+            - 0=numerical solution on the mesh resulting of adding the ideal surface to the numerical mesh,
+            - 1=exact intercept with the ideal surface plus correction iterations with the numerical mesh heights.
 
     Returns
     -------
@@ -28,7 +33,9 @@ class S4AdditionalNumericalMeshGrating(S4NumericalMeshGrating):
     def __init__(self,
                  ideal_grating : S4Grating = None,
                  numerical_mesh_grating : S4NumericalMeshGrating = None,
-                 name="Grating with Additional Numerical Mesh"):
+                 name="Grating with Additional Numerical Mesh",
+                 f_intercept=0, # 0=numerical solution on ideal+mesh, 1=ideal surface solution + mesh corrections
+                 ):
 
         if ideal_grating is not None:
             oe = ideal_grating
@@ -54,8 +61,11 @@ class S4AdditionalNumericalMeshGrating(S4NumericalMeshGrating):
         self.__ideal_grating         = ideal_grating
         self.__numerical_mesh_grating = numerical_mesh_grating
 
+        self._f_intercept = f_intercept
+
         self.__inputs = {
             "name": name,
+            "f_intercept": f_intercept,
             "ideal_grating": ideal_grating,
             "numerical_mesh_grating": numerical_mesh_grating,
         }
@@ -104,11 +114,12 @@ class S4AdditionalNumericalMeshGrating(S4NumericalMeshGrating):
         txt_pre = """
 
 from shadow4.beamline.optical_elements.gratings.s4_additional_numerical_mesh_grating import S4AdditionalNumericalMeshGrating
-optical_element = S4AdditionalNumericalMeshGrating(name='{name:s}', ideal_grating=ideal_grating, numerical_mesh_grating=numerical_mesh_grating)
+optical_element = S4AdditionalNumericalMeshGrating(name='{name:s}', ideal_grating=ideal_grating, numerical_mesh_grating=numerical_mesh_grating, f_intercept={f_intercept:d})
     """
         txt += txt_pre.format(**self.__inputs)
         return txt
 
+
 class S4AdditionalNumericalMeshGratingElement(S4GratingElement):
     """
     Constructor.
@@ -225,7 +225,13 @@ class S4GratingElement(S4BeamlineElement):
 
         Parameters
         ----------
-        **params
+        **params : generic parameters can be passed, in particular:
+        flag_lost_value : float, optional
+            value to flag lost rays (default=-1).
+        precull : boolean, optional
+            for toroids and meshes, discard the rays clearly missing the element before the intercept calculation
+            (default=False). The discarded rays are flagged as lost and left at z=0 with the incident direction (they
+            are not reflected as without the pre-cull): only the good rays are the same.
 
         Returns
         -------
@@ -233,6 +239,7 @@ class S4GratingElement(S4BeamlineElement):
             (output_beam, footprint) instances of S4Beam.
         """
         flag_lost_value = params.get("flag_lost_value", -1)
+        precull = params.get("precull", False)
 
         p = self.get_coordinates().p()
         q = self.get_coordinates().q()
@@ -265,7 +272,9 @@ class S4GratingElement(S4BeamlineElement):
         #
         soe = self.get_optical_element()
 
-        footprint, normal = self._apply_grating_diffraction(input_beam)
+        footprint, normal = self._apply_with_precull(self._apply_grating_diffraction, input_beam,
+                                                     soe.get_optical_surface_instance(), soe.get_boundary_shape(),
+                                                     flag_lost_value=flag_lost_value, precull=precull)
 
         if movements is not None:
             if movements.f_move:
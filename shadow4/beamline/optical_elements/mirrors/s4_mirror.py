@@ -8,6 +8,7 @@ from syned.beamline.optical_elements.mirrors.mirror import Mirror
 from dabax.dabax_xraylib import DabaxXraylib
 
 from shadow4.physical_models.prerefl.prerefl import PreRefl
+from shadow4.physical_models.prerefl.reflectivity_table import CoatingReflectivityTable, UserReflectivityTable
 from shadow4.beamline.s4_beamline_element import S4BeamlineElement
 from shadow4.beam.s4_beam import S4Beam
 from shadow4.beamline.s4_beamline_element_movements import S4BeamlineElementMovements
@@ -256,6 +257,19 @@ class S4MirrorElement(S4BeamlineElement):
             indicates if the input beam is converted to local o.e. frame (default=True).
         change_reference_system_out : boolean, optional
             indicates if the outgoing beam is converted image o.e. frame (default=True).
+        precull : boolean, optional
+            for toroids and meshes, discard the rays clearly missing the element before the intercept calculation
+            (default=False). The discarded rays are flagged as lost and left at z=0 with the incident direction (they
+            are not reflected as without the pre-cull): only the good rays are the same.
+        reflectivity_table : boolean, optional
+            for f_refl=5,6 (xraylib, dabax), interpolate the reflectivity amplitudes in a (cached) table instead of
+            calculating them for every ray (default=False).
+        reflectivity_table_tolerance : float, optional
+            for reflectivity_table=True, the maximum interpolation error in the amplitudes (default=1e-4).
+        reflectivity_table_interpolation : int, optional
+            for reflectivity_table=True, the interpolation order: 1=bilinear (default), 3=bicubic.
+        reflectivity_table_cache_dir : str, optional
+            for reflectivity_table=True, a directory to store and reuse the tables between runs (default=None).
 
         Returns
         -------
@@ -263,6 +277,8 @@ class S4MirrorElement(S4BeamlineElement):
             (output_beam, footprint) instances of S4Beam.
         """
         flag_lost_value = params.get("flag_lost_value", -1)
+        precull = params.get("precull", False)
+        reflectivity_table = params.get("reflectivity_table", False)
         change_reference_system_in = params.get("change_reference_system_in", True)
         change_reference_system_out = params.get("change_reference_system_out", True)
 
@@ -307,7 +323,9 @@ class S4MirrorElement(S4BeamlineElement):
 
         v_in = input_beam.get_columns([4,5,6])
 
-        footprint, normal = self.get_optical_element()._apply_mirror_reflection(input_beam)
+        footprint, normal = self._apply_with_precull(soe._apply_mirror_reflection, input_beam,
+                                                     soe.get_optical_surface_instance(), soe.get_boundary_shape(),
+                                                     flag_lost_value=flag_lost_value, precull=precull)
 
         if movements is not None:
             if movements.f_move:
@@ -347,8 +365,7 @@ class S4MirrorElement(S4BeamlineElement):
 
             if soe._f_refl == 0: # prerefl
                 prerefl_file = soe._file_refl
-                pr = PreRefl()
-                pr.read_preprocessor_file(prerefl_file)
+                pr = PreRefl.initialize_from_preprocessor_file(prerefl_file)
                 if is_verbose(): print(pr.info())
 
                 rs, rp = pr.reflectivity_amplitudes_fresnel(grazing_angle_mrad=grazing_angle_mrad,
@@ -370,77 +387,15 @@ class S4MirrorElement(S4BeamlineElement):
                     method=0,
                     )
 
-            elif soe._f_refl == 2:  # user angle, mrad ref
-                values = numpy.loadtxt(soe._file_refl)
+            elif soe._f_refl in [2, 3, 4]:  # user file: 2=angle (mrad), 3=energy (eV), 4=2D energy (eV), angle (mrad)
+                table = UserReflectivityTable.initialize_from_file(soe._file_refl,
+                                                    kind={2: "angle", 3: "energy", 4: "energy_angle"}[soe._f_refl])
+                rs, rp = table.reflectivity_amplitudes(photon_energy_ev=input_beam.get_photon_energy_eV(),
+                                                       grazing_angle_mrad=grazing_angle_mrad) # the phase is not managed!
 
-                mirror_grazing_angles = values[:, 0]
-                mirror_reflectivities = values[:, 1]
-
-                if mirror_grazing_angles[-1] < mirror_grazing_angles[0]: # XOPPY MLayer gives angles in descendent order
-                    mirror_grazing_angles = values[:, 0][::-1]
-                    mirror_reflectivities = values[:, 1][::-1]
-
-                Rs = numpy.interp(grazing_angle_mrad,
-                                  mirror_grazing_angles,
-                                  mirror_reflectivities,
-                                  left=mirror_reflectivities[0],
-                                  right=mirror_reflectivities[-1])
-                Rp = Rs
-                rs, rp = numpy.sqrt(Rs), numpy.sqrt(Rp) # the phase is not managed!
-
-            elif soe._f_refl == 3:  # user energy
-
-                beam_energies = input_beam.get_photon_energy_eV()
-
-                values = numpy.loadtxt(soe._file_refl)
-
-                mirror_energies = values[:, 0]
-                mirror_reflectivities = values[:, 1]
-
-                Rs = numpy.interp(beam_energies,
-                                  mirror_energies,
-                                  mirror_reflectivities,
-                                  left=mirror_reflectivities[0],
-                                  right=mirror_reflectivities[-1])
-                Rp = Rs
-                rs, rp = numpy.sqrt(Rs), numpy.sqrt(Rp) # the phase is not managed!
-
-            elif soe._f_refl == 4:  # user 2D
-                values = numpy.loadtxt(soe._file_refl)
-
-                beam_energies = input_beam.get_photon_energy_eV()
-
-                mirror_energies       = values[:, 0]
-                mirror_grazing_angles = values[:, 1]
-                mirror_energies         = numpy.unique(mirror_energies)
-                mirror_grazing_angles   = numpy.unique(mirror_grazing_angles)
-
-                def get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities):
-                    mirror_reflectivities = numpy.reshape(mirror_reflectivities, (mirror_energies.shape[0], mirror_grazing_angles.shape[0]))
-                    from scipy.interpolate import  RectBivariateSpline
-                    interpolator = RectBivariateSpline(mirror_energies, mirror_grazing_angles, mirror_reflectivities, kx=2, ky=2)
-
-                    interpolated_weight = numpy.zeros(beam_energies.shape[0])
-                    for energy, angle, i in zip(beam_energies, grazing_angle_mrad, range(interpolated_weight.shape[0])):
-                        interpolated_weight[i] = interpolator(energy, angle)
-                    interpolated_weight[numpy.where(numpy.isnan(interpolated_weight))] = 0.0
-
-                    return interpolated_weight
-
-                if values.shape[1] == 3:
-                    mirror_reflectivities = values[:, 2]
-
-                    Rs = get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities)
-                    Rp = Rs
-
-                elif values.shape[1] == 4:
-                    mirror_reflectivities_s = values[:, 2]
-                    mirror_reflectivities_p = values[:, 3]
-
-                    Rs = get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities_s)
-                    Rp = get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities_p)
-
-                rs, rp = numpy.sqrt(Rs), numpy.sqrt(Rp) # the phase is not managed!
+            elif soe._f_refl in [5, 6] and reflectivity_table: # xraylib or dabax, interpolated in table
+                rs, rp = self._get_reflectivity_amplitudes_from_table(input_beam.get_column(-11), grazing_angle_mrad,
+                                                                      **params)
 
             elif soe._f_refl == 5: # xraylib
 
@@ -493,6 +448,31 @@ class S4MirrorElement(S4BeamlineElement):
     #
     # i/o utilities
     #
+    def _get_reflectivity_amplitudes_from_table(self, photon_energy_ev, grazing_angle_mrad, **params):
+        soe = self.get_optical_element()
+
+        good = numpy.isfinite(photon_energy_ev) & numpy.isfinite(grazing_angle_mrad)
+        if not numpy.any(good): return numpy.zeros_like(photon_energy_ev), numpy.zeros_like(photon_energy_ev)
+
+        table = CoatingReflectivityTable.initialize_from_coating(
+            coating_material=soe._coating,
+            coating_density=soe._coating_density,
+            roughness_rms_A=soe._coating_roughness,
+            method=0,  # 0=born & wolf, 1=parratt, 2=shadow3
+            library="xraylib" if soe._f_refl == 5 else "dabax",
+            dabax=soe._dabax,
+            tolerance=params.get("reflectivity_table_tolerance", 1e-4),
+            interpolation=params.get("reflectivity_table_interpolation", 1),
+            energy_range=[photon_energy_ev[good].min(), photon_energy_ev[good].max()],
+            angle_range_mrad=[grazing_angle_mrad[good].min(), grazing_angle_mrad[good].max()],
+            cache_dir=params.get("reflectivity_table_cache_dir", None),
+        )
+
+        rs = numpy.zeros_like(photon_energy_ev, dtype=complex)
+        rp = numpy.zeros_like(photon_energy_ev, dtype=complex)
+        rs[good], rp[good] = table.reflectivity_amplitudes(photon_energy_ev[good], grazing_angle_mrad[good])
+        return rs, rp
+
     def set_grazing_angle(self, theta_grazing, theta_azimuthal=None):
         """
         Sets the grazing angle.
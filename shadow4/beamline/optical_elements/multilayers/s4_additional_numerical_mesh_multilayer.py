@@ -5,9 +5,10 @@ from shadow4.beam.s4_beam import S4Beam
 from shadow4.beamline.optical_elements.multilayers.s4_multilayer import S4MultilayerElement, S4Multilayer
 from shadow4.beamline.optical_elements.multilayers.s4_numerical_mesh_multilayer import S4NumericalMeshMultilayer
 from shadow4.beamline.s4_beamline_element_movements import S4BeamlineElementMovements
+from shadow4.beamline.s4_optical_element_decorators import S4AdditionalNumericalMeshOpticalElementDecorator
 
 
-class S4AdditionalNumericalMeshMultilayer(S4NumericalMeshMultilayer):
+class S4AdditionalNumericalMeshMultilayer(S4NumericalMeshMultilayer, S4AdditionalNumericalMeshOpticalElementDecorator):
     """
     Constructor.
 
@@ -20,6 +21,10 @@ class S4AdditionalNumericalMeshMultilayer(S4NumericalMeshMultilayer):
         The numerical mesh to be added to the ideal multilayer.
     name : str, optional
         The name of the multilayer.
+    f_intercept : int, optional
+        The method to calculate the intercept with the surface:
+            - 0=numerical solution on the mesh resulting of adding the ideal surface to the numerical mesh,
+            - 1=exact intercept with the ideal surface plus correction iterations with the numerical mesh heights.
 
     Returns
     -------
@@ -28,7 +33,9 @@ class S4AdditionalNumericalMeshMultilayer(S4NumericalMeshMultilayer):
     def __init__(self,
                  ideal_multilayer : S4Multilayer = None,
                  numerical_mesh_multilayer : S4NumericalMeshMultilayer = None,
-                 name="Multilayer with Additional Numerical Mesh"):
+                 name="Multilayer with Additional Numerical Mesh",
+                 f_intercept=0, # 0=numerical solution on ideal+mesh, 1=ideal surface solution + mesh corrections
+                 ):
         """
 
         """
@@ -55,8 +62,11 @@ class S4AdditionalNumericalMeshMultilayer(S4NumericalMeshMultilayer):
         self.__ideal_multilayer          = ideal_multilayer
         self.__numerical_mesh_multilayer = numerical_mesh_multilayer
 
+        self._f_intercept = f_intercept
+
         self.__inputs = {
             "name": name,
+            "f_intercept": f_intercept,
             "ideal_multilayer": ideal_multilayer,
             "numerical_mesh_multilayer": numerical_mesh_multilayer,
         }
@@ -105,29 +115,11 @@ class S4AdditionalNumericalMeshMultilayer(S4NumericalMeshMultilayer):
         txt_pre = """
 
 from shadow4.beamline.optical_elements.multilayers.s4_additional_numerical_mesh_multilayer import S4AdditionalNumericalMeshMultilayer
-optical_element = S4AdditionalNumericalMeshMultilayer(name='{name:s}', ideal_multilayer=ideal_multilayer, numerical_mesh_multilayer=numerical_mesh_multilayer)
+optical_element = S4AdditionalNumericalMeshMultilayer(name='{name:s}', ideal_multilayer=ideal_multilayer, numerical_mesh_multilayer=numerical_mesh_multilayer, f_intercept={f_intercept:d})
     """
         txt += txt_pre.format(**self.__inputs)
         return txt
 
-    #
-    # overwrite this method combining ideal shape + error shape
-    #
-    def _apply_multilayer_reflection(self, beam):
-        # numerical_mesh    = self.__numerical_mesh_multilayer.get_optical_surface_instance()
-        numerical_mesh = self.get_optical_surface_instance()
-        ideal = self.__ideal_multilayer.get_optical_surface_instance()
-        # here sum ideal surface to numerical mesh, and obtain a new numerical mesh:
-        # numerical_mesh = add_mesh_to_ideal_surface(numerical_mesh, ideal_surface_ccc)
-        x, y = numerical_mesh.get_mesh_x_y()
-        X = numpy.outer(x, numpy.ones_like(y))
-        Y = numpy.outer(numpy.ones_like(x), y)
-        Z = ideal.surface_height(X,Y)
-        numerical_mesh.add_to_mesh(Z)
-        # ideal_surface_ccc = self.__ideal_multilayer.get_optical_surface_instance() # this mean that every S4Multilayer must inherit from S4OpticalElementDecorator
-        footprint, normal, _, _, _, _, _ = numerical_mesh.apply_specular_reflection_on_beam(beam)
-
-        return footprint, normal
 
 class S4AdditionalNumericalMeshMultilayerElement(S4MultilayerElement):
     """
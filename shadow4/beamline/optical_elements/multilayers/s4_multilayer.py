@@ -7,6 +7,7 @@ from syned.beamline.optical_elements.multilayers.multilayer import Multilayer
 from dabax.dabax_xraylib import DabaxXraylib
 
 from shadow4.physical_models.mlayer.mlayer import MLayer
+from shadow4.physical_models.prerefl.reflectivity_table import UserReflectivityTable
 from shadow4.beamline.s4_beamline_element import S4BeamlineElement
 from shadow4.beam.s4_beam import S4Beam
 from shadow4.beamline.s4_beamline_element_movements import S4BeamlineElementMovements
@@ -219,7 +220,16 @@ class S4MultilayerElement(S4BeamlineElement):
 
         Parameters
         ----------
-        **params
+        **params : generic parameters can be passed, in particular:
+        flag_lost_value : float, optional
+            value to flag lost rays (default=-1).
+        precull : boolean, optional
+            for toroids and meshes, discard the rays clearly missing the element before the intercept calculation
+            (default=False). The discarded rays are flagged as lost and left at z=0 with the incident direction (they
+            are not reflected as without the pre-cull): only the good rays are the same.
+        reflectivity_table_points : None or tuple, optional
+            for laterally graded multilayers, interpolate the reflectivity in a table of (n_energy, n_angle, n_y)
+            points instead of calculating it for every ray (default=None, no table). See MLayer.reflectivity().
 
         Returns
         -------
@@ -227,6 +237,8 @@ class S4MultilayerElement(S4BeamlineElement):
             (output_beam, footprint) instances of S4Beam.
         """
         flag_lost_value = params.get("flag_lost_value", -1)
+        precull = params.get("precull", False)
+        reflectivity_table_points = params.get("reflectivity_table_points", None)
 
         p = self.get_coordinates().p()
         q = self.get_coordinates().q()
@@ -262,7 +274,9 @@ class S4MultilayerElement(S4BeamlineElement):
         v_in = input_beam.get_columns([4,5,6])
 
         # footprint, normal = self.apply_local_reflection(input_beam)
-        footprint, normal = self.get_optical_element()._apply_multilayer_reflection(input_beam)
+        footprint, normal = self._apply_with_precull(soe._apply_multilayer_reflection, input_beam,
+                                                     soe.get_optical_surface_instance(), soe.get_boundary_shape(),
+                                                     flag_lost_value=flag_lost_value, precull=precull)
 
         if movements is not None:
             if movements.f_move:
@@ -299,9 +313,8 @@ class S4MultilayerElement(S4BeamlineElement):
 
         if soe._f_refl == 0: # prerefl
             preprocessor_file = soe._file_refl
-            pr = MLayer()
             if is_verbose(): print("Preprocessor file: ", preprocessor_file )
-            pr.read_preprocessor_file(preprocessor_file)
+            pr = MLayer.initialize_from_preprocessor_file(preprocessor_file)
 
             if is_verbose():
                 print("grazing angle mrad: ", grazing_angle_mrad)
@@ -310,90 +323,19 @@ class S4MultilayerElement(S4BeamlineElement):
             # grazing_angle_deg, photon_energy_ev
             Rs, Rp, phase_s, phase_p = pr.reflectivity(numpy.degrees(grazing_angle_mrad*1e-3),
                                                        input_beam.get_column(26),
-                                                       Y=footprint.get_column(2))
+                                                       Y=footprint.get_column(2),
+                                                       table_points=reflectivity_table_points)
             # from srxraylib.plot.gol import plot
             # plot(input_beam.get_column(26), Rs**2)
             footprint.apply_reflectivities(Rs, Rp)
             # todo: apply phases
 
-        elif soe._f_refl == 1:  # user angle, mrad ref
-
-            if is_verbose(): print("Reflectivity from file (mrad, refl): ", soe._file_refl)
-            values = numpy.loadtxt(soe._file_refl)
-
-            mirror_grazing_angles = values[:, 0]
-            mirror_reflectivities = values[:, 1]
-
-            if mirror_grazing_angles[-1] < mirror_grazing_angles[0]: # XOPPY MLayer gives angles in descendent order
-                mirror_grazing_angles = values[:, 0][::-1]
-                mirror_reflectivities = values[:, 1][::-1]
-
-            Rs = numpy.interp(grazing_angle_mrad,
-                              mirror_grazing_angles,
-                              mirror_reflectivities,
-                              left=mirror_reflectivities[0],
-                              right=mirror_reflectivities[-1])
-            Rp = Rs
-            footprint.apply_reflectivities(numpy.sqrt(Rs), numpy.sqrt(Rp))
-
-        elif soe._f_refl == 2:  # user energy
-
-            if is_verbose(): print("Reflectivity from file (eV, refl): ", soe._file_refl)
-            beam_energies = input_beam.get_photon_energy_eV()
-
-            values = numpy.loadtxt(soe._file_refl)
-
-            mirror_energies = values[:, 0]
-            mirror_reflectivities = values[:, 1]
-
-            Rs = numpy.interp(beam_energies,
-                              mirror_energies,
-                              mirror_reflectivities,
-                              left=mirror_reflectivities[0],
-                              right=mirror_reflectivities[-1])
-            Rp = Rs
-            footprint.apply_reflectivities(numpy.sqrt(Rs), numpy.sqrt(Rp))
-
-        elif soe._f_refl == 3:  # user 2D
-            if is_verbose(): print("Reflectivity from file (eV, mrad, refl): ", soe._file_refl)
-            values = numpy.loadtxt(soe._file_refl)
-
-            beam_energies = input_beam.get_photon_energy_eV()
-
-            mirror_energies       = values[:, 0]
-            mirror_grazing_angles = values[:, 1]
-            mirror_energies         = numpy.unique(mirror_energies)
-            mirror_grazing_angles   = numpy.unique(mirror_grazing_angles)
-            # if self.user_defined_angle_units  == 0: mirror_grazing_angles = numpy.degrees(1e-3*mirror_grazing_angles)
-            # if self.user_defined_energy_units == 1: mirror_energies *= 1e3 # KeV to eV
-
-            def get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities):
-                mirror_reflectivities = numpy.reshape(mirror_reflectivities, (mirror_energies.shape[0], mirror_grazing_angles.shape[0]))
-                from scipy.interpolate import  RectBivariateSpline
-                interpolator = RectBivariateSpline(mirror_energies, mirror_grazing_angles, mirror_reflectivities, kx=2, ky=2)
-
-                interpolated_weight = numpy.zeros(beam_energies.shape[0])
-                for energy, angle, i in zip(beam_energies, grazing_angle_mrad, range(interpolated_weight.shape[0])):
-                    interpolated_weight[i] = interpolator(energy, angle)
-                interpolated_weight[numpy.where(numpy.isnan(interpolated_weight))] = 0.0
-
-                return interpolated_weight
-
-            if values.shape[1] == 3:
-                mirror_reflectivities = values[:, 2]
-
-                Rs = get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities)
-                Rp = Rs
-                footprint.apply_reflectivities(numpy.sqrt(Rs), numpy.sqrt(Rp))
-                footprint.apply_reflectivities(numpy.sqrt(Rs), numpy.sqrt(Rp))
-
-            elif values.shape[1] == 4:
-                mirror_reflectivities_s = values[:, 2]
-                mirror_reflectivities_p = values[:, 3]
-
-                Rs = get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities_s)
-                Rp = get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities_p)
-
+        elif soe._f_refl in [1, 2, 3]:  # user file: 1=angle (mrad), 2=energy (eV), 3=2D energy (eV), angle (mrad)
+            kind = {1: "angle", 2: "energy", 3: "energy_angle"}[soe._f_refl]
+            if is_verbose(): print("Reflectivity from file (%s): " % kind, soe._file_refl)
+            table = UserReflectivityTable.initialize_from_file(soe._file_refl, kind=kind)
+            Rs, Rp = table.reflectivities(photon_energy_ev=input_beam.get_photon_energy_eV(),
+                                          grazing_angle_mrad=grazing_angle_mrad)
             footprint.apply_reflectivities(numpy.sqrt(Rs), numpy.sqrt(Rp))
 
         elif soe._f_refl == 4: # xraylib
@@ -415,7 +357,8 @@ class S4MultilayerElement(S4BeamlineElement):
             # grazing_angle_deg, photon_energy_ev
             Rs, Rp, phase_s, phase_p = pr.reflectivity(numpy.degrees(grazing_angle_mrad*1e-3),
                                                        input_beam.get_column(26),
-                                                       Y=footprint.get_column(2))
+                                                       Y=footprint.get_column(2),
+                                                       table_points=reflectivity_table_points)
             # from srxraylib.plot.gol import plot
             # plot(input_beam.get_column(26), Rs**2)
             footprint.apply_reflectivities(Rs, Rp)
@@ -441,7 +384,8 @@ class S4MultilayerElement(S4BeamlineElement):
             # grazing_angle_deg, photon_energy_ev
             Rs, Rp, phase_s, phase_p = pr.reflectivity(numpy.degrees(grazing_angle_mrad*1e-3),
                                                        input_beam.get_column(26),
-                                                       Y=footprint.get_column(2))
+                                                       Y=footprint.get_column(2),
+                                                       table_points=reflectivity_table_points)
             # from srxraylib.plot.gol import plot
             # plot(input_beam.get_column(26), Rs**2)
             footprint.apply_reflectivities(Rs, Rp)
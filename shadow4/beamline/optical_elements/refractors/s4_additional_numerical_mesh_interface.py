@@ -5,9 +5,10 @@ from shadow4.beam.s4_beam import S4Beam
 from shadow4.beamline.optical_elements.refractors.s4_interface import S4InterfaceElement, S4Interface
 from shadow4.beamline.optical_elements.refractors.s4_numerical_mesh_interface import S4NumericalMeshInterface
 from shadow4.beamline.s4_beamline_element_movements import S4BeamlineElementMovements
+from shadow4.beamline.s4_optical_element_decorators import S4AdditionalNumericalMeshOpticalElementDecorator
 
 
-class S4AdditionalNumericalMeshInterface(S4NumericalMeshInterface):
+class S4AdditionalNumericalMeshInterface(S4NumericalMeshInterface, S4AdditionalNumericalMeshOpticalElementDecorator):
     """
     Constructor.
 
@@ -20,6 +21,10 @@ class S4AdditionalNumericalMeshInterface(S4NumericalMeshInterface):
         The numerical mesh to be added to the ideal refractive interface.
     name : str, optional
         The name of the refractive interface.
+    f_intercept : int, optional
+        The method to calculate the intercept with the surface:
+            - 0=numerical solution on the mesh resulting of adding the ideal surface to the numerical mesh,
+            - 1=exact intercept with the ideal surface plus correction iterations with the numerical mesh heights.
 
     Returns
     -------
@@ -29,6 +34,7 @@ class S4AdditionalNumericalMeshInterface(S4NumericalMeshInterface):
                  ideal_interface : S4Interface = None,
                  numerical_mesh_interface : S4NumericalMeshInterface = None,
                  name="Refractive interface with Additional Numerical Mesh",
+                 f_intercept=0, # 0=numerical solution on ideal+mesh, 1=ideal surface solution + mesh corrections
                  ):
         """
 
@@ -56,8 +62,11 @@ class S4AdditionalNumericalMeshInterface(S4NumericalMeshInterface):
         self.__ideal_interface          = ideal_interface
         self.__numerical_mesh_interface = numerical_mesh_interface
 
+        self._f_intercept = f_intercept
+
         self.__inputs = {
             "name": name,
+            "f_intercept": f_intercept,
             "ideal_interface": ideal_interface,
             "numerical_mesh_interface": numerical_mesh_interface,
         }
@@ -104,35 +113,11 @@ class S4AdditionalNumericalMeshInterface(S4NumericalMeshInterface):
         txt_pre = """
 
 from shadow4.beamline.optical_elements.refractors.s4_additional_numerical_mesh_interface import S4AdditionalNumericalMeshInterface
-optical_element = S4AdditionalNumericalMeshInterface(name='{name:s}', ideal_interface=ideal_interface, numerical_mesh_interface=numerical_mesh_interface)
+optical_element = S4AdditionalNumericalMeshInterface(name='{name:s}', ideal_interface=ideal_interface, numerical_mesh_interface=numerical_mesh_interface, f_intercept={f_intercept:d})
     """
         txt += txt_pre.format(**self.__inputs)
         return txt
 
-    #
-    # overwrite this method combining ideal shape + error shape
-    #
-    def _apply_interface_refraction(self, beam,
-                                    refraction_index_object, refraction_index_image, mu_object,
-                                    apply_attenuation=1):
-
-        numerical_mesh = self.get_optical_surface_instance()
-        ideal = self.__ideal_interface.get_optical_surface_instance()
-        # here sum ideal surface to numerical mesh, and obtain a new numerical mesh:
-        # numerical_mesh = add_mesh_to_ideal_surface(numerical_mesh, ideal_surface_ccc)
-        x, y = numerical_mesh.get_mesh_x_y()
-        X = numpy.outer(x, numpy.ones_like(y))
-        Y = numpy.outer(numpy.ones_like(x), y)
-        Z = ideal.surface_height(X,Y)
-        numerical_mesh.add_to_mesh(Z)
-
-        footprint, normal = numerical_mesh.apply_refraction_on_beam(beam,
-                                                         refraction_index_object, refraction_index_image,
-                                                         apply_attenuation=apply_attenuation,
-                                                         linear_attenuation_coefficient=mu_object)
-
-        return footprint, normal
-
 
 class S4AdditionalNumericalMeshInterfaceElement(S4InterfaceElement):
     """
@@ -13,6 +13,7 @@ from shadow4.beamline.optical_elements.refractors.s4_conic_interface import S4Co
 from shadow4.beamline.s4_optical_element_decorators import S4RefractiveLensOpticalElementDecorator
 from shadow4.beamline.optical_elements.refractors.s4_lens import _get_lens_interfaces
 from shadow4.beamline.optical_elements.absorbers.s4_screen import S4Screen, S4ScreenElement
+from shadow4.tools.arrayofvectors import vector_refraction
 
 class S4CRL(CRL, S4RefractiveLensOpticalElementDecorator):
     """
@@ -321,26 +322,43 @@ optical_element = S4CRL(name='{name:s}',
         return txt
 
     def get_lens_interfaces(self):
-        single_lens_optical_surfaces = self.get_optical_surface_instance()
-        lens_interfaces              = numpy.full((self._n_lens, 2), None)
-        boundary_shape               = self.get_boundary_shape()
+        """
+        Returns the interfaces of all the lenses.
+
+        Returns
+        -------
+        numpy array
+            An array with shape (n_lens, 2) with the instances of S4ConicInterface of the first and second interface
+            of each lens.
+        """
+        lens_interfaces = numpy.full((self._n_lens, 2), None)
 
         for lens_index in range(self._n_lens):
             lens_interfaces[lens_index, 0], \
-            lens_interfaces[lens_index, 1] = \
-                _get_lens_interfaces(lens_optical_surfaces=single_lens_optical_surfaces,
-                                     boundary_shape=boundary_shape,
-                                     ri_calculation_mode=self._ri_calculation_mode,
-                                     refraction_index=self._refraction_index,
-                                     attenuation_coefficient=self._attenuation_coefficient,
-                                     prerefl_file=self._prerefl_file,
-                                     material=self.get_material(),
-                                     density=self._density,
-                                     dabax=self._dabax,
-                                     )
+            lens_interfaces[lens_index, 1] = self.get_single_lens_interfaces()
 
         return lens_interfaces
 
+    def get_single_lens_interfaces(self):
+        """
+        Returns the two interfaces of a single lens (all the lenses of the CRL are identical).
+
+        Returns
+        -------
+        tuple
+            (interface_1, interface_2) instances of S4ConicInterface.
+        """
+        return _get_lens_interfaces(lens_optical_surfaces=self.get_optical_surface_instance(),
+                                    boundary_shape=self.get_boundary_shape(),
+                                    ri_calculation_mode=self._ri_calculation_mode,
+                                    refraction_index=self._refraction_index,
+                                    attenuation_coefficient=self._attenuation_coefficient,
+                                    prerefl_file=self._prerefl_file,
+                                    material=self.get_material(),
+                                    density=self._density,
+                                    dabax=self._dabax,
+                                    )
+
 
 class S4CRLElement(S4BeamlineElement):
     """
@@ -401,18 +419,28 @@ class S4CRLElement(S4BeamlineElement):
 
         Parameters
         ----------
-        **params
+        **params : generic parameters can be passed, in particular:
+        flag_lost_value : float, optional
+            value to flag lost rays (default=-1).
+        fused : boolean, optional
+            if True (default), trace the whole lens stack with the fused kernel (see _trace_beam_fused). Otherwise,
+            or if the element has movements, each interface is traced as a S4ConicInterfaceElement.
+        store_footprints : boolean, optional
+            if False, the footprints are not created (the returned footprints are None). Default=True.
 
         Returns
         -------
         tuple
-            (output_beam, footprint) instances of S4Beam.
+            (output_beam, [footprint_first_interface, footprint_last_interface]) instances of S4Beam.
         """
+        flag_lost_value  = params.get("flag_lost_value", -1)
+        fused            = params.get("fused", True)
+        store_footprints = params.get("store_footprints", True)
+
         input_beam = self.get_input_beam().duplicate()
         movements  = self.get_movements()
         oe         = self.get_optical_element()
 
-        optical_surfaces = oe.get_lens_interfaces()
         p, q, angle_radial, angle_radial_out, angle_azimuthal = self.get_coordinates().get_positions()
         n_lens = oe.get_n_lens()
 
@@ -424,33 +452,214 @@ class S4CRLElement(S4BeamlineElement):
             beam1, footprint1 = beamline_element.trace_beam()
             beamline_element = S4ScreenElement(optical_element=S4Screen(), coordinates=coordinates_2, input_beam=beam1)
             beam2, footprint2 = beamline_element.trace_beam()
+        elif fused and (movements is None or not movements.f_move):
+            beam2, footprint1, footprint2 = self._trace_beam_fused(input_beam,
+                                                                   flag_lost_value=flag_lost_value,
+                                                                   store_footprints=store_footprints)
         else:
-            for lens_index in range(n_lens):
-                if lens_index==0: source_plane = p
-                else:             source_plane = oe.get_piling_thickness()
-                if lens_index==n_lens-1: image_plane = q
-                else:                    image_plane = 0.0
-
-                coordinates_1 = ElementCoordinates(p=source_plane, q=oe.get_thickness()*0.5, angle_radial=angle_radial, angle_radial_out=numpy.pi,          angle_azimuthal=angle_azimuthal)
-                coordinates_2 = ElementCoordinates(p=oe.get_thickness()*0.5, q=image_plane,  angle_radial=0.0,          angle_radial_out=angle_radial_out, angle_azimuthal=0.0)
-
-                beamline_element_1 = S4ConicInterfaceElement(optical_element=optical_surfaces[lens_index, 0], coordinates=coordinates_1, movements=movements, input_beam=input_beam)
-                if lens_index==0:
-                    beam1, footprint1 = beamline_element_1.trace_beam()
-                    n1, mu1, n2, mu2 = beamline_element_1.get_stored_optical_constants()
-                else:
-                    beam1, _          = beamline_element_1.trace_beam(reused_stored_optical_constants=(n1, mu1, n2, mu2))
-
-                beamline_element_2 = S4ConicInterfaceElement(optical_element=optical_surfaces[lens_index, 1], coordinates=coordinates_2, movements=movements, input_beam=beam1)
-                if lens_index==n_lens-1:
-                    beam2, footprint2 = beamline_element_2.trace_beam(reused_stored_optical_constants=(n2, mu2, n1, mu1))
-                else:
-                    beam2, _          = beamline_element_2.trace_beam(reused_stored_optical_constants=(n2, mu2, n1, mu1))
-
-                if lens_index < n_lens-1: input_beam = beam2.duplicate()
+            beam2, footprint1, footprint2 = self._trace_beam_per_interface(input_beam)
 
         return beam2, [footprint1, footprint2]
 
+    def _trace_beam_per_interface(self, input_beam):
+        # traces every interface as a S4ConicInterfaceElement (used with movements).
+        movements = self.get_movements()
+        oe        = self.get_optical_element()
+
+        optical_surfaces = oe.get_lens_interfaces()
+        p, q, angle_radial, angle_radial_out, angle_azimuthal = self.get_coordinates().get_positions()
+        n_lens = oe.get_n_lens()
+
+        for lens_index in range(n_lens):
+            if lens_index==0: source_plane = p
+            else:             source_plane = oe.get_piling_thickness()
+            if lens_index==n_lens-1: image_plane = q
+            else:                    image_plane = 0.0
+
+            coordinates_1 = ElementCoordinates(p=source_plane, q=oe.get_thickness()*0.5, angle_radial=angle_radial, angle_radial_out=numpy.pi,          angle_azimuthal=angle_azimuthal)
+            coordinates_2 = ElementCoordinates(p=oe.get_thickness()*0.5, q=image_plane,  angle_radial=0.0,          angle_radial_out=angle_radial_out, angle_azimuthal=0.0)
+
+            beamline_element_1 = S4ConicInterfaceElement(optical_element=optical_surfaces[lens_index, 0], coordinates=coordinates_1, movements=movements, input_beam=input_beam)
+            if lens_index==0:
+                beam1, footprint1 = beamline_element_1.trace_beam()
+                n1, mu1, n2, mu2 = beamline_element_1.get_stored_optical_constants()
+            else:
+                beam1, _          = beamline_element_1.trace_beam(reused_stored_optical_constants=(n1, mu1, n2, mu2))
+
+            beamline_element_2 = S4ConicInterfaceElement(optical_element=optical_surfaces[lens_index, 1], coordinates=coordinates_2, movements=movements, input_beam=beam1)
+            if lens_index==n_lens-1:
+                beam2, footprint2 = beamline_element_2.trace_beam(reused_stored_optical_constants=(n2, mu2, n1, mu1))
+            else:
+                beam2, _          = beamline_element_2.trace_beam(reused_stored_optical_constants=(n2, mu2, n1, mu1))
+
+            if lens_index < n_lens-1: input_beam = beam2.duplicate()
+
+        return beam2, footprint1, footprint2
+
+    def _trace_beam_fused(self, input_beam, flag_lost_value=-1, store_footprints=True):
+        """
+        Traces the input beam through the whole lens stack with a fused kernel.
+
+        It follows the same steps as tracing every interface with S4ConicInterfaceElement (change to the interface
+        reference frame, intercept, refraction, attenuation, boundaries and propagation to the image plane), but:
+            * the positions and directions are kept in the input reference frame. The reference frame of the current
+              interface is only stored as a rotation matrix and an offset, and the electric fields are rotated
+              once at the end.
+            * the two conic surfaces and the optical constants are calculated once and reused for all lenses.
+            * the attenuation, optical path and flags are accumulated in place, without beam copies.
+            * the footprints (first and last interface) are created only if store_footprints=True.
+
+        Parameters
+        ----------
+        input_beam : instance of S4Beam
+            The input beam (it is modified).
+        flag_lost_value : float, optional
+            value to flag lost rays.
+        store_footprints : boolean, optional
+            if False, the footprints are not created.
+
+        Returns
+        -------
+        tuple
+            (output_beam, footprint_first_interface, footprint_last_interface) instances of S4Beam (or None for
+            the footprints if store_footprints=False).
+        """
+        oe = self.get_optical_element()
+        p, q, angle_radial, angle_radial_out, angle_azimuthal = self.get_coordinates().get_positions()
+        n_lens = oe.get_n_lens()
+        half_thickness = oe.get_thickness() * 0.5
+        boundary_shape = oe.get_boundary_shape()
+
+        interface_1, interface_2 = oe.get_single_lens_interfaces()
+        surface_1 = interface_1.get_optical_surface_instance()
+        surface_2 = interface_2.get_optical_surface_instance()
+
+        rays = input_beam.rays
+        energy = input_beam.get_photon_energy_eV()
+        n1, n2 = interface_1.get_refraction_indices(energy)
+        mu1, mu2 = interface_1.get_attenuation_coefficients(energy) # in m^-1
+
+        x = rays[:, 0:3].T.copy()
+        v = rays[:, 3:6].T.copy()
+        flag = rays[:, 9].copy()
+        k_mod = rays[:, 10].copy()
+        optical_path = rays[:, 12].copy()
+        amplitude = numpy.ones(rays.shape[0])
+
+        boundary_beam = None if boundary_shape is None else S4Beam(N=rays.shape[0])
+
+        # the reference frame of the current interface: x_interface = rotation @ x + offset
+        rotation = numpy.eye(3)
+        offset = numpy.zeros(3)
+
+        footprint1 = None
+        footprint2 = None
+        for lens_index in range(n_lens):
+            source_plane = p if lens_index == 0 else oe.get_piling_thickness()
+            image_plane = q if lens_index == n_lens - 1 else 0.0
+
+            for interface_index, (surface, p_i, q_i, angle_radial_i, angle_radial_out_i, angle_azimuthal_i,
+                                  n_object, n_image, mu_object, mu_image) in enumerate((
+                    (surface_1, source_plane, half_thickness, angle_radial, numpy.pi, angle_azimuthal, n1, n2, mu1, mu2),
+                    (surface_2, half_thickness, image_plane, 0.0, angle_radial_out, 0.0, n2, n1, mu2, mu1))):
+
+                theta_grazing1 = numpy.pi / 2 - angle_radial_i
+                theta_grazing2 = numpy.pi / 2 - angle_radial_out_i
+
+                #
+                # put beam in interface reference system
+                #
+                matrix = _rotation_matrix(theta_grazing1, axis=1) @ _rotation_matrix(angle_azimuthal_i, axis=2)
+                rotation = matrix @ rotation
+                offset = matrix @ offset + numpy.array([0.0, -p_i * numpy.cos(theta_grazing1), p_i * numpy.sin(theta_grazing1)])
+
+                x1 = rotation @ x + offset[:, numpy.newaxis]
+                v1 = rotation @ v
+
+                #
+                # refract beam in the interface
+                #
+                reference_distance = -x1[1].mean() + x1[2].mean()
+                t, iflag = surface.calculate_intercept_and_choose_solution(x1, v1, reference_distance=reference_distance, method=0)
+                x2 = x1 + v1 * t
+                flag[iflag < 0] = -100
+                normal = surface.get_normal(x2)
+                v2 = vector_refraction(v1.T, normal.T, n_object, n_image, sgn=None).T
+
+                k_mod *= n_image / n_object
+                optical_path += t * n_object
+                amplitude *= numpy.sqrt(numpy.exp(-numpy.abs(t) * mu_object))
+
+                #
+                # apply boundaries
+                #
+                if boundary_beam is not None:
+                    boundary_beam.rays[:, 0] = x2[0]
+                    boundary_beam.rays[:, 1] = x2[1]
+                    boundary_beam.rays[:, 9] = flag
+                    boundary_beam.apply_boundaries_syned(boundary_shape, flag_lost_value=flag_lost_value)
+                    flag[:] = boundary_beam.rays[:, 9]
+
+                if store_footprints:
+                    if lens_index == 0 and interface_index == 0:
+                        footprint1 = _get_fused_beam(rays, x2, v2, flag, k_mod, optical_path, amplitude, rotation)
+                    if lens_index == n_lens - 1 and interface_index == 1:
+                        footprint2 = _get_fused_beam(rays, x2, v2, flag, k_mod, optical_path, amplitude, rotation)
+
+                x = rotation.T @ (x2 - offset[:, numpy.newaxis])
+                v = rotation.T @ v2
+
+                #
+                # from interface reference system to image plane
+                #
+                t_reflection = numpy.pi / 2 - theta_grazing2
+                vnimag = numpy.array([0.0, numpy.sin(t_reflection), numpy.cos(t_reflection)])
+                vzim = numpy.array([0.0, -numpy.cos(t_reflection), numpy.sin(t_reflection)])
+
+                normal_input = rotation.T @ vnimag
+                dist = (q_i - vnimag @ offset - normal_input @ x) / (normal_input @ v)
+                x += dist * v
+
+                optical_path += numpy.abs(dist) * n_image
+                amplitude *= numpy.sqrt(numpy.exp(-numpy.abs(dist) * mu_image))
+
+                matrix = numpy.array([[1.0, 0.0, 0.0], vnimag, vzim])
+                rotation = matrix @ rotation
+                offset = matrix @ (offset - vnimag * q_i)
+
+        output_beam = _get_fused_beam(rays, rotation @ x + offset[:, numpy.newaxis], rotation @ v,
+                                      flag, k_mod, optical_path, amplitude, rotation)
+
+        return output_beam, footprint1, footprint2
+
+
+def _rotation_matrix(theta, axis=1):
+    # the matrix of the rotation done by S4Beam.rotate()
+    costh = numpy.cos(theta)
+    sinth = numpy.sin(theta)
+    if axis == 1:
+        return numpy.array([[1.0, 0.0, 0.0], [0.0, costh, sinth], [0.0, -sinth, costh]])
+    elif axis == 2:
+        return numpy.array([[costh, 0.0, sinth], [0.0, 1.0, 0.0], [-sinth, 0.0, costh]])
+    elif axis == 3:
+        return numpy.array([[costh, sinth, 0.0], [-sinth, costh, 0.0], [0.0, 0.0, 1.0]])
+
+def _get_fused_beam(rays, x, v, flag, k_mod, optical_path, amplitude, rotation):
+    # creates a S4Beam with the positions and directions (in the current reference frame), the accumulated
+    # flags, wavenumbers, optical paths and attenuation; and the electric fields of the input rays rotated
+    # to the current reference frame.
+    beam = S4Beam(N=rays.shape[0])
+    out = beam.rays
+    out[:] = rays
+    out[:, 0:3] = x.T
+    out[:, 3:6] = v.T
+    out[:, 6:9] = (rotation @ rays[:, 6:9].T).T * amplitude[:, numpy.newaxis]
+    out[:, 15:18] = (rotation @ rays[:, 15:18].T).T * amplitude[:, numpy.newaxis]
+    out[:, 9] = flag
+    out[:, 10] = k_mod
+    out[:, 12] = optical_path
+    return beam
+
 
 if __name__ == "__main__":
     if False:
@@ -251,22 +251,18 @@ class S4Interface(Interface):
             refraction_index_object = self._r_ind_obj
             refraction_index_image  = self._r_ind_ima
         elif self._f_r_ind == 1:
-            preprefl1 = PreRefl()
-            preprefl1.read_preprocessor_file(self._file_r_ind_obj)
+            preprefl1 = PreRefl.initialize_from_preprocessor_file(self._file_r_ind_obj)
             refraction_index_object = (preprefl1.get_refraction_index(photon_energy_eV)).real
 
             refraction_index_image  = self._r_ind_ima * numpy.ones_like(refraction_index_object)
         elif self._f_r_ind == 2:
-            preprefl2 = PreRefl()
-            preprefl2.read_preprocessor_file(self._file_r_ind_ima)
+            preprefl2 = PreRefl.initialize_from_preprocessor_file(self._file_r_ind_ima)
             refraction_index_image = (preprefl2.get_refraction_index(photon_energy_eV)).real
 
             refraction_index_object = self._r_ind_obj * numpy.ones_like(refraction_index_image)
         elif self._f_r_ind == 3:
-            preprefl1 = PreRefl()
-            preprefl2 = PreRefl()
-            preprefl1.read_preprocessor_file(self._file_r_ind_obj)
-            preprefl2.read_preprocessor_file(self._file_r_ind_ima)
+            preprefl1 = PreRefl.initialize_from_preprocessor_file(self._file_r_ind_obj)
+            preprefl2 = PreRefl.initialize_from_preprocessor_file(self._file_r_ind_ima)
             refraction_index_object = (preprefl1.get_refraction_index(photon_energy_eV)).real
             refraction_index_image  = (preprefl2.get_refraction_index(photon_energy_eV)).real
 
@@ -347,20 +343,16 @@ class S4Interface(Interface):
             attenuation_coefficient_object = self._r_attenuation_obj # already in m^-1
             attenuation_coefficient_image  = self._r_attenuation_ima
         elif self._f_r_ind == 1:
-            preprefl1 = PreRefl()
-            preprefl1.read_preprocessor_file(self._file_r_ind_obj)
+            preprefl1 = PreRefl.initialize_from_preprocessor_file(self._file_r_ind_obj)
             attenuation_coefficient_object = (preprefl1.get_attenuation_coefficient(photon_energy_eV)) * 100 # in m^-1
             attenuation_coefficient_image  = self._r_attenuation_ima * numpy.ones_like(attenuation_coefficient_object)
         elif self._f_r_ind == 2:
-            preprefl2 = PreRefl()
-            preprefl2.read_preprocessor_file(self._file_r_ind_ima)
+            preprefl2 = PreRefl.initialize_from_preprocessor_file(self._file_r_ind_ima)
             attenuation_coefficient_image = (preprefl2.get_attenuation_coefficient(photon_energy_eV)) * 100
             attenuation_coefficient_object = self._r_attenuation_obj * numpy.ones_like(attenuation_coefficient_image)
         elif self._f_r_ind == 3:
-            preprefl1 = PreRefl()
-            preprefl2 = PreRefl()
-            preprefl1.read_preprocessor_file(self._file_r_ind_obj)
-            preprefl2.read_preprocessor_file(self._file_r_ind_ima)
+            preprefl1 = PreRefl.initialize_from_preprocessor_file(self._file_r_ind_obj)
+            preprefl2 = PreRefl.initialize_from_preprocessor_file(self._file_r_ind_ima)
             attenuation_coefficient_object = (preprefl1.get_attenuation_coefficient(photon_energy_eV)) * 100
             attenuation_coefficient_image  = (preprefl2.get_attenuation_coefficient(photon_energy_eV)) * 100
 
@@ -486,7 +478,13 @@ class S4InterfaceElement(S4BeamlineElement):
 
         Parameters
         ----------
-        **params
+        **params : generic parameters can be passed, in particular:
+        flag_lost_value : float, optional
+            value to flag lost rays (default=-1).
+        precull : boolean, optional
+            for toroids and meshes, discard the rays clearly missing the element before the intercept calculation
+            (default=False). The discarded rays are flagged as lost and left at z=0 with the incident direction (they
+            are not reflected as without the pre-cull): only the good rays are the same.
 
         Returns
         -------
@@ -494,6 +492,7 @@ class S4InterfaceElement(S4BeamlineElement):
             (output_beam, footprint) instances of S4Beam.
         """
         flag_lost_value = params.get("flag_lost_value", -1)
+        precull = params.get("precull", False)
         reused_stored_optical_constants = params.get("reused_stored_optical_constants", None)
 
         p = self.get_coordinates().p()
@@ -541,7 +540,10 @@ class S4InterfaceElement(S4BeamlineElement):
         # TODO (maybe): no check for total reflection is done...
         # TODO (maybe): implement correctly in shadow4 via Fresnel equations for the transmitted beam
 
-        footprint, normal = soe._apply_interface_refraction(input_beam, n1, n2, mu1, apply_attenuation=1)
+        footprint, normal = self._apply_with_precull(
+                                lambda beam, n1, n2, mu1: soe._apply_interface_refraction(beam, n1, n2, mu1, apply_attenuation=1),
+                                input_beam, soe.get_optical_surface_instance(), soe.get_boundary_shape(),
+                                flag_lost_value=flag_lost_value, precull=precull, ray_arrays=(n1, n2, mu1))
 
         #
         # apply mirror boundaries
@@ -389,7 +389,9 @@ class S4TransfocatorElement(S4BeamlineElement):
 
         Parameters
         ----------
-        **params
+        **params : generic parameters passed to S4CRLElement.trace_beam(), in particular:
+        fused : boolean, optional
+            if True (default), trace each CRL with the fused lens-stack kernel.
 
         Returns
         -------
@@ -404,7 +406,8 @@ class S4TransfocatorElement(S4BeamlineElement):
 
         for i, bel in enumerate(bel_list):
             bel.set_input_beam(input_beam=input_beam)
-            output_beam, footprint = bel.trace_beam()
+            # only the footprints of the last CRL are returned
+            output_beam, footprint = bel.trace_beam(**{**params, "store_footprints": (i == n - 1)})
             if is_debug(): print("Intensity after CRL index %d: %f" % (i, output_beam.intensity(nolost=1)))
             if i < (n - 1): input_beam = output_beam.duplicate()
 
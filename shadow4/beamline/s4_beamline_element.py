@@ -7,12 +7,21 @@ The S4 beamline element is a container with:
 - The S4 element movements (S4BeamlineElementMovements)
 - The S4 beam to be received by te element (S4Beam)
 
+It also implements a bounding-volume pre-cull used by the element trace paths: the rays that clearly miss the
+element are flagged as lost before the (expensive) intercept calculation with toroids and numerical meshes.
+
 """
+import numpy
+
+from syned.beamline.shape import Rectangle, Ellipse, TwoEllipses, Circle
 from syned.beamline.beamline_element import BeamlineElement
 from syned.beamline.optical_element import OpticalElement
 from syned.beamline.element_coordinates import ElementCoordinates
 from shadow4.beam.s4_beam import S4Beam
 from shadow4.beamline.s4_beamline_element_movements import S4BeamlineElementMovements
+from shadow4.optical_surfaces.s4_toroid import S4Toroid
+from shadow4.optical_surfaces.s4_mesh import S4Mesh
+from shadow4.tools.logger import is_verbose
 
 class S4BeamlineElement(BeamlineElement):
     """
@@ -153,3 +162,128 @@ class S4BeamlineElement(BeamlineElement):
         txt += "\ncoordinates = ElementCoordinates(p=%.10g, q=%.10g, angle_radial=%.10g, angle_azimuthal=%.10g, angle_radial_out=%.10g)" % \
                (coordinates.p(), coordinates.q(), coordinates.angle_radial(), coordinates.angle_azimuthal(), coordinates.angle_radial_out())
         return txt
+
+    #
+    # bounding-volume pre-cull
+    #
+    def _apply_with_precull(self, apply_function, beam, optical_surface, boundary_shape,
+                            flag_lost_value=-1, precull=False, ray_arrays=()):
+        """
+        Applies the optical surface to the beam (using apply_function) only for the rays that may hit the element.
+
+        The rays are intersected with the slab |z| <= sag bound (in the element frame) and the resulting segments
+        are tested against the bounding box of the boundary shape. The rays that clearly miss the element are not
+        sent to the intercept solver: they are flagged as lost and moved to the plane z=0, with the normal (0,0,1).
+        The pre-cull is only done for S4Toroid and S4Mesh surfaces (for conics, the intercept is cheaper than
+        the pre-cull) and if the element has no movements.
+
+        The good rays are the same as without the pre-cull, but the lost rays are not: the discarded rays keep
+        their incident direction (they are not reflected/diffracted/refracted) and their position at z=0 instead
+        of the intercept with the surface. Therefore the pre-cull is off by default (precull=False), to be used
+        when the lost rays are not needed. For S4Mesh surfaces, the intercept is solved for all the rays at once,
+        so the good rays agree within the tolerance of the solver (not bit by bit).
+
+        Parameters
+        ----------
+        apply_function : function
+            The function that receives a S4Beam (and the ray_arrays) and returns (footprint, normal), e.g.
+            _apply_mirror_reflection.
+        beam : instance of S4Beam
+            The beam in the element reference frame.
+        optical_surface : instance of S4OpticalSurface
+            The optical surface of the element.
+        boundary_shape : instance of syned.beamline.shape.BoundaryShape
+            The element boundaries.
+        flag_lost_value : float, optional
+            The value to flag the lost rays.
+        precull : boolean, optional
+            Set to True to do the pre-cull.
+        ray_arrays : tuple, optional
+            Other arguments of apply_function with one value per ray (e.g. refraction indices), or scalars. The
+            arrays are reduced to the rays sent to apply_function.
+
+        Returns
+        -------
+        tuple
+            (footprint, normal) The footprint beam and the array with the normal direction with shape (3, npoints).
+        """
+        candidates = None
+        if precull and isinstance(optical_surface, (S4Toroid, S4Mesh)):
+            movements = self.get_movements()
+            if movements is None or not movements.f_move:
+                candidates = self._get_precull_candidates(beam, optical_surface, boundary_shape)
+
+        if candidates is None or candidates.all():
+            return apply_function(beam, *ray_arrays)
+
+        if is_verbose(): print("Bounding-volume pre-cull: %d rays of %d sent to the intercept solver." %
+                               (candidates.sum(), candidates.size))
+
+        footprint = beam.duplicate()
+        rays = footprint.rays
+        normal = numpy.zeros((3, rays.shape[0]))
+        normal[2, :] = 1.0
+
+        missed = ~candidates
+        vz = rays[missed, 5]
+        t = numpy.zeros_like(vz)
+        t[vz != 0] = -rays[missed, 2][vz != 0] / vz[vz != 0]
+        rays[missed, 0] += rays[missed, 3] * t
+        rays[missed, 1] += rays[missed, 4] * t
+        rays[missed, 2] += rays[missed, 5] * t
+        rays[missed, 9] = flag_lost_value
+        rays[missed, 12] += t
+
+        if candidates.any():
+            footprint_candidates, normal_candidates = apply_function(beam.initialize_from_array(beam.rays[candidates]),
+                *[value if numpy.ndim(value) == 0 else numpy.asarray(value)[candidates] for value in ray_arrays])
+            rays[candidates] = footprint_candidates.rays
+            normal[:, candidates] = normal_candidates
+
+        return footprint, normal
+
+    @classmethod
+    def _get_precull_candidates(cls, beam, optical_surface, boundary_shape):
+        """
+        Returns the mask of the rays that may intercept the element inside the boundary shape.
+
+        Parameters
+        ----------
+        beam : instance of S4Beam
+            The beam in the element reference frame.
+        optical_surface : instance of S4OpticalSurface
+            The optical surface of the element.
+        boundary_shape : instance of syned.beamline.shape.BoundaryShape
+            The element boundaries.
+
+        Returns
+        -------
+        numpy array or None
+            The boolean mask (True for the candidate rays) or None if the pre-cull is not possible.
+        """
+        if isinstance(boundary_shape, Rectangle):
+            x_min, x_max, y_min, y_max = boundary_shape.get_boundaries()
+        elif isinstance(boundary_shape, Ellipse):
+            x_min, x_max, y_min, y_max = boundary_shape.get_boundaries()
+        elif isinstance(boundary_shape, Circle):
+            radius, x_center, y_center = boundary_shape.get_boundaries()
+            x_min, x_max, y_min, y_max = x_center - radius, x_center + radius, y_center - radius, y_center + radius
+        elif isinstance(boundary_shape, TwoEllipses): # the outer ellipse
+            _, _, _, _, x_min, x_max, y_min, y_max = boundary_shape.get_boundaries()
+        else:
+            return None
+
+        sag = optical_surface.get_height_bound(x_min, x_max, y_min, y_max)
+        if sag is None: return None
+
+        x, y, z, vx, vy, vz = beam.rays[:, 0:6].T
+        candidates = numpy.ones(x.size, dtype=bool)
+        good = vz != 0
+        # segment of the ray inside the slab -sag <= z <= sag
+        t1 = (-sag - z[good]) / vz[good]
+        t2 = ( sag - z[good]) / vz[good]
+        x1, x2 = x[good] + vx[good] * t1, x[good] + vx[good] * t2
+        y1, y2 = y[good] + vy[good] * t1, y[good] + vy[good] * t2
+        candidates[good] = (numpy.maximum(x1, x2) >= x_min) & (numpy.minimum(x1, x2) <= x_max) & \
+                           (numpy.maximum(y1, y2) >= y_min) & (numpy.minimum(y1, y2) <= y_max)
+        return candidates
@@ -13,7 +13,9 @@ S4OpticalElementDecorator-----
                                                                     |----- S4ToroidOpticalElementDecorator
                                                                     |----- S4ParaboloidOpticalElementDecorator
                                                                     |----- S4ConicOpticalElementDecorator
-                                                                    |----- S4NumericalMeshOpticalElementDecorator
+                                                                    |----- S4NumericalMeshOpticalElementDecorator---
+                                                                    |                                               |
+                                                                    |    S4AdditionalNumericalMeshOpticalElementDecorator
                                                                     |----- S4RefractiveLensOpticalElementDecorator
 
 
@@ -28,6 +30,10 @@ Basically it adds some methods:
 
 - get_optical_surface_instance: returns the S4 optical surface instance.
 
+The optical surface instance is memoized: it is recalculated only if the parameters defining the surface
+(as returned by _get_optical_surface_key) change. The derived classes implement the calculation in
+_calculate_optical_surface_instance. Use clear_optical_surface_cache to force a recalculation.
+
 """
 
 
@@ -43,6 +49,7 @@ from syned.beamline.shape import Toroid, Conic, NumericalMesh, Plane, Side
 
 from shadow4.optical_surfaces.s4_conic import S4Conic
 from shadow4.optical_surfaces.s4_mesh import S4Mesh
+from shadow4.optical_surfaces.s4_additional_mesh import S4AdditionalMesh
 from shadow4.optical_surfaces.s4_toroid import S4Toroid
 
 from shadow4.tools.logger import is_verbose, is_debug
@@ -53,7 +60,7 @@ class S4OpticalElementDecorator(object):
     """
 
     def __init__(self):
-        pass
+        self._optical_surface_cache = None
 
     def get_info(self):
         """
@@ -89,12 +96,50 @@ class S4OpticalElementDecorator(object):
         """
         Returns a object of type S4OpticalSurface.
 
+        The instance is created once and reused while the parameters defining the surface do not change.
+        Note that the returned instance is shared: use its duplicate() method before modifying it.
+
+        Returns
+        -------
+        instance of S4OpticalSurface (or list of instances for lenses).
+        """
+        key = self._get_optical_surface_key()
+        cache = getattr(self, "_optical_surface_cache", None)
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        out = self._calculate_optical_surface_instance()
+        self._optical_surface_cache = (key, out)
+        return out
+
+    def clear_optical_surface_cache(self):
+        """
+        Removes the memoized optical surface instance, so it will be recalculated in the next call to
+        get_optical_surface_instance(). It must be called after modifying in place data that is not
+        part of the surface shape parameters.
+        """
+        self._optical_surface_cache = None
+
+    def _calculate_optical_surface_instance(self):
+        """
+        Calculates the object of type S4OpticalSurface. To be implemented in the derived classes.
+
         Raises
         ------
         NotImplementedError.
         """
         raise NotImplementedError()
 
+    def _get_optical_surface_key(self):
+        """
+        Returns a hashable key with all the parameters defining the optical surface.
+
+        Returns
+        -------
+        tuple
+        """
+        return _get_parameters_key(self.get_surface_shape_instance())
+
 
     def interthickness(self):
         """
@@ -139,7 +184,7 @@ class S4PlaneOpticalElementDecorator(S4OpticalElementDecorator):
         """
         return Plane()
 
-    def get_optical_surface_instance(self):
+    def _calculate_optical_surface_instance(self):
         """
         Returns a shadow4 optical element object of type optical surface.
 
@@ -244,7 +289,7 @@ class S4SphereOpticalElementDecorator(S4CurvedOpticalElementDecorator):
                                                  is_cylinder=is_cylinder,
                                                  curved_surface_shape=curved_surface_shape)
 
-    def get_optical_surface_instance(self):
+    def _calculate_optical_surface_instance(self):
         """
         Returns a shadow4 optical element object of type optical surface.
 
@@ -326,7 +371,7 @@ class S4EllipsoidOpticalElementDecorator(S4CurvedOpticalElementDecorator):
 
         S4CurvedOpticalElementDecorator.__init__(self, surface_calculation, is_cylinder, curved_surface_shape)
 
-    def get_optical_surface_instance(self): # todo: update this one like hyperboloid
+    def _calculate_optical_surface_instance(self): # todo: update this one like hyperboloid
         """
         Returns a shadow4 optical element object of type optical surface.
 
@@ -409,7 +454,7 @@ class S4HyperboloidOpticalElementDecorator(S4CurvedOpticalElementDecorator):
 
         S4CurvedOpticalElementDecorator.__init__(self, surface_calculation, is_cylinder, curved_surface_shape)
 
-    def get_optical_surface_instance(self):
+    def _calculate_optical_surface_instance(self):
         """
         Returns a shadow4 optical element object of type optical surface.
 
@@ -481,7 +526,10 @@ class S4ToroidOpticalElementDecorator(S4CurvedOpticalElementDecorator):
 
         self._f_torus = f_torus
 
-    def get_optical_surface_instance(self):
+    def _get_optical_surface_key(self):
+        return (S4CurvedOpticalElementDecorator._get_optical_surface_key(self), self._f_torus)
+
+    def _calculate_optical_surface_instance(self):
         """
         Returns a shadow4 optical element object of type optical surface.
 
@@ -575,7 +623,7 @@ class S4ParaboloidOpticalElementDecorator(S4CurvedOpticalElementDecorator):
 
         S4CurvedOpticalElementDecorator.__init__(self, surface_calculation, is_cylinder, curved_surface_shape)
 
-    def get_optical_surface_instance(self):
+    def _calculate_optical_surface_instance(self):
         """
         Returns a shadow4 optical element object of type optical surface.
 
@@ -625,7 +673,7 @@ class S4ConicOpticalElementDecorator(S4CurvedOpticalElementDecorator):
             is_cylinder=False,
             curved_surface_shape=None if conic_coefficients is None else Conic(conic_coefficients=conic_coefficients))
 
-    def get_optical_surface_instance(self):
+    def _calculate_optical_surface_instance(self):
         """
         Returns a shadow4 optical element object of type optical surface.
 
@@ -662,7 +710,16 @@ class S4NumericalMeshOpticalElementDecorator(S4CurvedOpticalElementDecorator):
                                                  is_cylinder=False,
                                                  curved_surface_shape = NumericalMesh(xx, yy, zz, surface_data_file))
 
-    def get_optical_surface_instance(self):
+    def _get_optical_surface_key(self):
+        surface_shape = self.get_surface_shape_instance()
+        key = S4CurvedOpticalElementDecorator._get_optical_surface_key(self)
+        if not surface_shape.has_surface_data() and surface_shape.has_surface_data_file():
+            try:    stat = os.stat(surface_shape._surface_data_file)
+            except: stat = None
+            if stat is not None: key = (key, stat.st_mtime, stat.st_size) # reload if the file changes
+        return key
+
+    def _calculate_optical_surface_instance(self):
         """
         Returns a shadow4 optical element object of type optical surface.
 
@@ -684,6 +741,38 @@ class S4NumericalMeshOpticalElementDecorator(S4CurvedOpticalElementDecorator):
 
         return numerical_mesh
 
+class S4AdditionalNumericalMeshOpticalElementDecorator(S4NumericalMeshOpticalElementDecorator):
+    """
+    Adds get_optical_surface_instance() to the optical elements made of an ideal optical element plus a numerical
+    mesh (S4AdditionalNumericalMesh*). The element must implement get_ideal() and define the f_intercept flag
+    (in self._f_intercept).
+    """
+    def get_optical_surface_instance(self):
+        """
+        Returns a shadow4 optical element object of type optical surface.
+
+        The surface is kept until the memoized surfaces (of the numerical mesh and the ideal element) or
+        f_intercept change.
+
+        Returns
+        -------
+        instance of S4Mesh (for f_intercept=0) or S4AdditionalMesh (for f_intercept=1).
+        """
+        numerical_mesh = S4NumericalMeshOpticalElementDecorator.get_optical_surface_instance(self)
+        if self.get_ideal() is None:
+            return numerical_mesh
+
+        ideal = self.get_ideal().get_optical_surface_instance()
+        cache = getattr(self, "_additional_mesh_surface_cache", None)
+        if cache is None or cache[0] is not numerical_mesh or cache[1] is not ideal or cache[2] != self._f_intercept:
+            additional_mesh = S4AdditionalMesh(ideal_surface=ideal, residual_mesh=numerical_mesh)
+            if self._f_intercept == 1:
+                surface = additional_mesh
+            else: # new numerical mesh with the ideal surface added
+                surface = additional_mesh.get_summed_mesh()
+            self._additional_mesh_surface_cache = (numerical_mesh, ideal, self._f_intercept, surface)
+        return self._additional_mesh_surface_cache[3]
+
 ##################################################
 # LENS OPTICAL ELEMENTS
 ##################################################
@@ -799,7 +888,7 @@ class S4RefractiveLensOpticalElementDecorator(S4CurvedOpticalElementDecorator):
 
         return [conic_coefficients_1, conic_coefficients_2]
 
-    def get_optical_surface_instance(self):
+    def _calculate_optical_surface_instance(self):
         """
         Returns a shadow4 optical element object of type optical surface.
 
@@ -817,6 +906,24 @@ class S4RefractiveLensOpticalElementDecorator(S4CurvedOpticalElementDecorator):
         return [c1, c2]
 
 
+def _get_parameters_key(obj):
+    # returns a hashable key with the values of the parameters stored in a (syned) object
+    if obj is None or isinstance(obj, (int, float, complex, str, bool)):
+        return obj
+    elif isinstance(obj, numpy.ndarray):
+        return (obj.shape, obj.dtype.str, hash(numpy.ascontiguousarray(obj).tobytes()))
+    elif isinstance(obj, (list, tuple)):
+        return tuple(_get_parameters_key(item) for item in obj)
+    elif isinstance(obj, numpy.generic):
+        return obj.item()
+    elif hasattr(obj, "__dict__"):
+        return (obj.__class__.__name__,) + \
+               tuple((name, _get_parameters_key(value)) for name, value in sorted(vars(obj).items())
+                     if name != "_support_dictionary")
+    else:
+        return repr(obj)
+
+
 if __name__ == "__main__":
 
     p = S4PlaneOpticalElementDecorator()
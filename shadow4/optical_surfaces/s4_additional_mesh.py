@@ -0,0 +1,310 @@
+"""
+
+Defines the shadow4 AdditionalMesh class to deal with an ideal surface (conic or toroid) plus a small residual
+numerical mesh (e.g. height errors).
+
+The intercept is calculated by first solving exactly the intercept with the ideal surface, and then applying a
+few correction iterations against the residual height. The normal is the normal of the ideal surface corrected
+with the gradient of the residual mesh.
+
+"""
+import numpy
+
+from shadow4.optical_surfaces.s4_mesh import S4Mesh
+from shadow4.tools.logger import is_verbose, is_debug
+
+class S4AdditionalMesh(S4Mesh):
+    """
+    Class to manage an ideal optical surface with an additional numerical mesh (residual heights).
+
+    Parameters
+    ----------
+    ideal_surface : instance of S4Conic or S4Toroid
+        The ideal (base) surface. Its intercept is calculated with the closed-form solution.
+    residual_mesh : instance of S4Mesh
+        The numerical mesh with the residual heights to be added to the ideal surface.
+    iterations : int, optional
+        The maximum number of correction iterations.
+    tolerance : float, optional
+        The iterations stop when the largest change in the flight path is below this value (in m).
+
+    """
+    def __init__(self,
+                 ideal_surface=None,
+                 residual_mesh: S4Mesh = None,
+                 iterations: int = 3,
+                 tolerance: float = 1e-12,
+                 ):
+        S4Mesh.__init__(self)
+        self._ideal_surface = ideal_surface
+        self._residual_mesh = residual_mesh
+        self._iterations = iterations
+        self._tolerance = tolerance
+
+        if residual_mesh is not None:
+            self._mesh_x, self._mesh_y = residual_mesh.get_mesh_x_y()
+            self._mesh_z = residual_mesh.get_mesh_z()
+            self._surface = self.surface_height
+
+    #
+    # setters + getters
+    #
+
+    def get_ideal_surface(self):
+        """
+        Returns the ideal (base) surface.
+
+        Returns
+        -------
+        instance of S4Conic or S4Toroid
+        """
+        return self._ideal_surface
+
+    def get_residual_mesh(self):
+        """
+        Returns the mesh with the residual heights.
+
+        Returns
+        -------
+        instance of S4Mesh
+        """
+        return self._residual_mesh
+
+    def get_summed_mesh(self):
+        """
+        Returns a numerical mesh with the sum of the ideal surface heights and the residual heights, calculated
+        in the points of the residual mesh.
+
+        Returns
+        -------
+        instance of S4Mesh
+        """
+        mesh = self._residual_mesh.duplicate()
+        x, y = mesh.get_mesh_x_y()
+        X = numpy.outer(x, numpy.ones_like(y))
+        Y = numpy.outer(numpy.ones_like(x), y)
+        mesh.add_to_mesh(self._ideal_surface.surface_height(X, Y))
+        return mesh
+
+    #
+    # overloaded methods
+    #
+
+    def info(self):
+        """
+        Creates an info text.
+
+        Returns
+        -------
+        str
+        """
+        txt = "\nOE surface: ideal surface plus additional numerical mesh.\n"
+        txt += "    Intercept: ideal surface intercept plus up to %d correction iterations.\n" % self._iterations
+        txt += "\nIdeal surface:\n"
+        txt += self._ideal_surface.info()
+        txt += "\nAdditional numerical mesh:\n"
+        txt += self._residual_mesh.info()
+        return txt
+
+    def duplicate(self):
+        """
+        Duplicates an instance of S4AdditionalMesh
+
+        Returns
+        -------
+        instance of S4AdditionalMesh.
+        """
+        return S4AdditionalMesh(ideal_surface=self._ideal_surface.duplicate(),
+                                residual_mesh=self._residual_mesh.duplicate(),
+                                iterations=self._iterations,
+                                tolerance=self._tolerance)
+
+    def surface_height(self, x, y, **kwargs):
+        """
+        Calculates the surface heights (ideal plus residual).
+
+        Parameters
+        ----------
+        x : float or numpy 2D array (mesh)
+            The x coordinate(s).
+        y : float or numpy 2D array
+            The y coordinate(s).
+
+        Returns
+        -------
+        2D numpy array
+            the height mesh.
+        """
+        return self._ideal_surface.surface_height(x, y) + self._residual_mesh.surface_height(x, y)
+
+    def get_normal(self, x2: numpy.ndarray):
+        """
+        Calculates the normal vector (or stack of vectors) at a point on the surface.
+        It is the normal of the ideal surface corrected with the gradient of the residual mesh.
+        As in S4Mesh, the returned normal is upwards (normal_z > 0).
+
+        Parameters
+        ----------
+        x2 : numpy array
+            The coordinates vector(s) of shape [3, NRAYS].
+
+        Returns
+        -------
+        numpy array
+            The normal vector(s) of shape [3, NRAYS].
+
+        """
+        normal = self._ideal_surface.get_normal(x2)
+        normal *= numpy.where(normal[2, :] < 0, -1.0, 1.0)  # upwards normal, like in S4Mesh
+
+        dzdx, dzdy = self._residual_mesh.surface_slopes(x2[0, :], x2[1, :])
+
+        # for z = z_ideal(x,y) + h(x,y) the (non normalized) normal is (-dz_ideal/dx - dh/dx, -dz_ideal/dy - dh/dy, 1)
+        # and the derivatives of the ideal surface are -n_x/n_z and -n_y/n_z.
+        normal[0, :] -= normal[2, :] * dzdx
+        normal[1, :] -= normal[2, :] * dzdy
+
+        n2 = numpy.sqrt(normal[0, :] ** 2 + normal[1, :] ** 2 + normal[2, :] ** 2)
+        normal /= n2
+
+        return normal
+
+    def calculate_intercept_and_choose_solution(self, x1: numpy.ndarray, v1: numpy.ndarray,
+                                                reference_distance: float = 10.0, method: int = 0,
+                                                ):
+        """
+        Calculates the intercept point (or stack of points) for a given ray or stack of rays,
+        given a point XIN and director vector VIN.
+
+        The exact intercept with the ideal surface is used as a seed. Then, at each iteration, the residual
+        height h at the current intercept is considered locally constant, and the exact intercept of the
+        ideal surface is recalculated for the ray shifted by -h along z.
+
+        Parameters
+        ----------
+        XIN : numpy array
+            The coordinates of a point of origin of the ray: shape [3, NRAYS].
+        VIN : numpy array
+            The coordinates of a director vector the ray: shape [3, NRAYS].
+        reference_distance : float, optional
+            A reference distance (passed to the ideal surface solver).
+        method : int, optional
+            The method for choosing the solution (passed to the ideal surface solver).
+
+        Returns
+        -------
+        tuple
+            (answer, i_flag) The selected solution (time or flight path numpy array) and the flag numpy array.
+
+        """
+        t, i_flag = self._ideal_surface.calculate_intercept_and_choose_solution(x1, v1,
+                                                                                reference_distance=reference_distance,
+                                                                                method=method)
+
+        x1_shifted = x1.copy()
+        n_iterations = 0
+        for i in range(self._iterations):
+            h = self._residual_mesh.surface_height(x1[0, :] + v1[0, :] * t, x1[1, :] + v1[1, :] * t)
+            x1_shifted[2, :] = x1[2, :] - h
+            t_new, i_flag = self._ideal_surface.calculate_intercept_and_choose_solution(x1_shifted, v1,
+                                                                                    reference_distance=reference_distance,
+                                                                                    method=method)
+            delta = numpy.abs(t_new - t).max() if t.size > 0 else 0.0
+            t = t_new
+            n_iterations += 1
+            if is_debug(): print(">>>>> S4AdditionalMesh iteration %d: max change in flight path %g m" % (n_iterations, delta))
+            if delta <= self._tolerance: break
+
+        if is_verbose(): print("S4AdditionalMesh: intercept obtained after %d correction iterations." % n_iterations)
+
+        return t, i_flag
+
+    def calculate_intercept(self, XIN: numpy.ndarray, VIN: numpy.ndarray, keep=0):
+        """
+        Calculates the intercept point (or stack of points) for a given ray or stack of rays,
+        given a point XIN and director vector VIN.
+
+        Parameters
+        ----------
+        XIN : numpy array
+            The coordinates of a point of origin of the ray: shape [3, NRAYS].
+        VIN : numpy array
+            The coordinates of a director vector the ray: shape [3, NRAYS].
+
+        Returns
+        -------
+        tuple
+            (answer, i_flag) The selected solution (time or flight path numpy array) and the flag numpy array.
+
+        """
+        return self.calculate_intercept_and_choose_solution(XIN, VIN)
+
+    def get_height_bound(self, x_min, x_max, y_min, y_max, npoints=101):
+        """
+        Returns an upper bound of the absolute value of the surface height (sag) in a rectangular region: the sum
+        of the bounds of the ideal surface and of the residual mesh.
+
+        Parameters
+        ----------
+        x_min : float
+            The minimum x coordinate of the region.
+        x_max : float
+            The maximum x coordinate of the region.
+        y_min : float
+            The minimum y coordinate of the region.
+        y_max : float
+            The maximum y coordinate of the region.
+        npoints : int, optional
+            The number of sampled points in each direction (for the ideal surface).
+
+        Returns
+        -------
+        float or None
+            The height bound, or None if it cannot be calculated.
+        """
+        ideal = self._ideal_surface.get_height_bound(x_min, x_max, y_min, y_max, npoints=npoints)
+        residual = self._residual_mesh.get_height_bound(x_min, x_max, y_min, y_max, npoints=npoints)
+        if ideal is None or residual is None: return None
+        return ideal + residual
+
+    def add_to_mesh(self, z1):
+        """
+        Add a new numerical mesh to the residual mesh.
+
+        Parameters
+        ----------
+        z1 : int, float, or numpy array
+            The 2D Mesh (or the scalar value).
+
+        """
+        self._residual_mesh.add_to_mesh(z1)
+        self._mesh_z = self._residual_mesh.get_mesh_z()
+
+
+if __name__ == "__main__":
+    from shadow4.optical_surfaces.s4_conic import S4Conic
+
+    ideal = S4Conic.initialize_as_sphere_from_focal_distances(10.0, 10.0, 3e-3, cylindrical=1)
+
+    x = numpy.linspace(-0.01, 0.01, 21)
+    y = numpy.linspace(-0.2, 0.2, 401)
+    X = numpy.outer(x, numpy.ones_like(y))
+    Y = numpy.outer(numpy.ones_like(x), y)
+    residual = S4Mesh()
+    residual.load_surface_data_arrays(x, y, 5e-9 * numpy.sin(2 * numpy.pi * Y / 0.05))
+
+    sur = S4AdditionalMesh(ideal_surface=ideal, residual_mesh=residual)
+
+    nrays = 1000
+    x1 = numpy.zeros((3, nrays))
+    x1[0] = numpy.random.normal(0, 1e-3, nrays)
+    x1[1] = -10.0 * numpy.cos(3e-3)
+    x1[2] = 10.0 * numpy.sin(3e-3)
+    v1 = numpy.zeros((3, nrays))
+    v1[1] = numpy.cos(3e-3 + numpy.random.normal(0, 1e-5, nrays))
+    v1[2] = -numpy.sin(3e-3 + numpy.random.normal(0, 1e-5, nrays))
+
+    t, iflag = sur.calculate_intercept_and_choose_solution(x1, v1, reference_distance=10.0)
+    x2 = x1 + v1 * t
+    print("Max height residual [m]: ", numpy.abs(x2[2] - ideal.surface_height(x2[0], x2[1]) -
+                                           residual.surface_height(x2[0], x2[1])).max())
@@ -706,7 +706,6 @@ class S4Conic(S4OpticalSurface):
         t = self.choose_solution(t1, t2, reference_distance=reference_distance, method=method)
         return t, iflag
 
-    # todo: vectorize?
     def calculate_intercept(self, XIN, VIN):
         """
         Calculates the intercept point (or stack of points) for a given ray or stack of rays,
@@ -771,23 +770,19 @@ class S4Conic(S4OpticalSurface):
         TPAR2 = numpy.zeros_like(AA)
         IFLAG = numpy.ones_like(AA)
 
-        # TODO: remove loop!
-        for i in range(AA.size):
-            if numpy.abs(AA[i]) < 1e-15:
-                TPAR1[i] = - CC[i] / BB[i]
-                TPAR2[i] = TPAR1[i]
-            else:
-
-                DENOM = 0.5 / AA[i]
-                DETER = BB[i] ** 2 - CC[i] * AA[i] * 4
+        linear = numpy.abs(AA) < 1e-15
+        if linear.any():
+            TPAR1[linear] = - CC[linear] / BB[linear]
+            TPAR2[linear] = TPAR1[linear]
 
-                if DETER < 0.0:
-                    TPAR1[i] = 0.0
-                    TPAR2[i] = 0.0
-                    IFLAG[i] = -1
-                else:
-                    TPAR1[i] = -(BB[i] + numpy.sqrt(DETER)) * DENOM
-                    TPAR2[i] = -(BB[i] - numpy.sqrt(DETER)) * DENOM
+        quadratic = ~linear
+        if quadratic.any():
+            DENOM = 0.5 / AA[quadratic]
+            DETER = BB[quadratic] ** 2 - CC[quadratic] * AA[quadratic] * 4
+            SQRT_DETER = numpy.sqrt(numpy.where(DETER < 0.0, 0.0, DETER))
+            TPAR1[quadratic] = numpy.where(DETER < 0.0, 0.0, -(BB[quadratic] + SQRT_DETER) * DENOM)
+            TPAR2[quadratic] = numpy.where(DETER < 0.0, 0.0, -(BB[quadratic] - SQRT_DETER) * DENOM)
+            IFLAG[numpy.flatnonzero(quadratic)[DETER < 0.0]] = -1
 
         if TPAR2.size == 1:
             TPAR2 = numpy.asscalar(TPAR2)
@@ -824,11 +819,8 @@ class S4Conic(S4OpticalSurface):
         TPAR = numpy.zeros(TPAR1.size)
 
         if method == 0:
-            for i in range(TPAR1.size):
-                if ( numpy.abs(TPAR1[i]-reference_distance) <= numpy.abs(TPAR2[i]-reference_distance)):
-                   TPAR[i] = TPAR1[i]
-                else:
-                   TPAR[i] = TPAR2[i]
+            TPAR = numpy.where(numpy.abs(TPAR1 - reference_distance) <= numpy.abs(TPAR2 - reference_distance),
+                               TPAR1, TPAR2)
         elif method == 1:
             TPAR = TPAR1
         elif method == 2:
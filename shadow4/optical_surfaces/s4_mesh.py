@@ -2,6 +2,11 @@
 
 Defines the shadow4 Mesh class to deal with a numerical surfaces (defined by an array of points).
 
+The mesh files (SHADOW3 presurface and OASYS hdf5 formats) are cached after the first load in a binary sidecar
+file (<filename>.s4cache.npy, or in the temporary directory if the file directory is not writable). The cache
+is valid while the source file path, modification time and size do not change, and it is memory-mapped when
+loaded.
+
 """
 from typing import Callable, Tuple, List, Union
 from scipy.optimize import root
@@ -9,7 +14,10 @@ from scipy import interpolate
 
 from srxraylib.plot.gol import plot_surface
 import sys
+import os
 import time
+import zlib
+import tempfile
 import numpy
 
 from shadow4.optical_surfaces.s4_optical_surface import S4OpticalSurface
@@ -42,6 +50,7 @@ class S4Mesh(S4OpticalSurface):
                  mesh_z: numpy.ndarray = None):
         self.__x0 = None
         self.__v0 = None
+        self.__interpolating_agent = None
         self._surface = surface # Surface must be the function defining height(x,y)
         self._mesh_x  = mesh_x  # not used if surface is defined
         self._mesh_y  = mesh_y  # not used if surface is defined
@@ -102,18 +111,20 @@ class S4Mesh(S4OpticalSurface):
 
     def duplicate(self):
         """
-        Duplicates an instance of S4Toroid
+        Duplicates an instance of S4Mesh
 
         Returns
         -------
-        instance of S4Toroid.
+        instance of S4Mesh.
         """
-        return S4Mesh(
+        out = S4Mesh(
                       surface = self._surface,
-                      mesh_x = self._mesh_x,
-                      mesh_y = self._mesh_y,
-                      mesh_z = self._mesh_z,
+                      mesh_x = None if self._mesh_x is None else self._mesh_x.copy(),
+                      mesh_y = None if self._mesh_y is None else self._mesh_y.copy(),
+                      mesh_z = None if self._mesh_z is None else self._mesh_z.copy(),
                       )
+        out.__interpolating_agent = self.__interpolating_agent # the spline is not modified, it can be shared
+        return out
 
     def get_normal(self, x2: numpy.ndarray):
         """
@@ -254,10 +265,75 @@ class S4Mesh(S4OpticalSurface):
         """
         return self._surface(x, y)
 
+    def surface_slopes(self, x: Union[float, numpy.ndarray], y: Union[float, numpy.ndarray]):
+        """
+        Calculates the surface slopes (partial derivatives of the height).
+
+        Parameters
+        ----------
+        x : float or numpy array
+            The x coordinate(s).
+        y : float or numpy array
+            The y coordinate(s).
+
+        Returns
+        -------
+        tuple
+            (dz/dx, dz/dy) with the same shape as the inputs.
+
+        Notes
+        -----
+        If the surface has been created from a mesh, the derivatives of the interpolating spline are used.
+        Otherwise, they are approximated by finite differences.
+        """
+        if self.__interpolating_agent is not None:
+            return self.__interpolating_agent.ev(x, y, dx=1), self.__interpolating_agent.ev(x, y, dy=1)
+        else:
+            eps = 1e-7
+            z00 = self._surface(x, y)
+            return (self._surface(x + eps, y) - z00) / eps, (self._surface(x, y + eps) - z00) / eps
+
     #
     # Other calculations
     #
 
+    def get_height_bound(self, x_min, x_max, y_min, y_max, npoints=101):
+        """
+        Returns an upper bound of the absolute value of the surface height (sag) in a rectangular region.
+
+        If the surface is defined by the mesh, the bound is obtained from the mesh heights in the region (plus one
+        mesh point at each side): the maximum absolute height plus 10% of the peak-to-valley (margin for the
+        oscillations of the spline between the mesh points). Otherwise, the heights are sampled (see
+        S4OpticalSurface.get_height_bound()).
+
+        Parameters
+        ----------
+        x_min : float
+            The minimum x coordinate of the region.
+        x_max : float
+            The maximum x coordinate of the region.
+        y_min : float
+            The minimum y coordinate of the region.
+        y_max : float
+            The maximum y coordinate of the region.
+        npoints : int, optional
+            The number of sampled points in each direction (if the surface is not defined by the mesh).
+
+        Returns
+        -------
+        float or None
+            The height bound, or None if it cannot be calculated.
+        """
+        if self._mesh_x is None or self._mesh_y is None or self._mesh_z is None:
+            return super().get_height_bound(x_min, x_max, y_min, y_max, npoints=npoints)
+
+        i0, i1 = numpy.searchsorted(self._mesh_x, [x_min, x_max])
+        j0, j1 = numpy.searchsorted(self._mesh_y, [y_min, y_max])
+        Z = self._mesh_z[max(i0 - 1, 0):(i1 + 1), max(j0 - 1, 0):(j1 + 1)]
+        Z = Z[numpy.isfinite(Z)]
+        if Z.size == 0: return None
+        return numpy.abs(Z).max() + 0.1 * (Z.max() - Z.min())
+
     def add_to_mesh(self, z1: Union[int, float, numpy.ndarray]):
         """
         Add a new numerical mesh to the existing one.
@@ -284,7 +360,7 @@ class S4Mesh(S4OpticalSurface):
 
         self._calculate_surface_from_mesh()
 
-    def load_file(self, filename: str):
+    def load_file(self, filename: str, use_cache: bool = True):
         """
         Loads a numeric mesh from an text file (with the SHADOW3 presurface preprocessor format).
 
@@ -292,15 +368,18 @@ class S4Mesh(S4OpticalSurface):
         ----------
         filename : str
             The file name.
+        use_cache : boolean, optional
+            Use (and create if needed) the binary cache of the file.
         """
-        x, y, z = self._read_surface_error_file(filename)
+        if use_cache: x, y, z = self._read_surface_file_cached(filename, self._read_surface_error_file)
+        else:         x, y, z = self._read_surface_error_file(filename)
 
         self._mesh_x = x
         self._mesh_y = y
         self._mesh_z = z
         self._calculate_surface_from_mesh()
 
-    def load_h5file(self, filename: str):
+    def load_h5file(self, filename: str, use_cache: bool = True):
         """
         Loads a numeric mesh from an hdf5 file (with the standard OASYS surface description).
 
@@ -308,8 +387,11 @@ class S4Mesh(S4OpticalSurface):
         ----------
         filename : str
             The file name.
+        use_cache : boolean, optional
+            Use (and create if needed) the binary cache of the file.
         """
-        x, y, z = self._read_surface_error_h5file(filename)
+        if use_cache: x, y, z = self._read_surface_file_cached(filename, self._read_surface_error_h5file)
+        else:         x, y, z = self._read_surface_error_h5file(filename)
 
         self._mesh_x = x
         self._mesh_y = y
@@ -407,7 +489,69 @@ class S4Mesh(S4OpticalSurface):
         return x, y, Z.T.copy()
 
     @classmethod
-    def _read_surface_error_file(cls, filename: str): #copied from shadowOui util/shadow_util
+    def _read_surface_error_file(cls, filename: str):
+        # the file is a stream of numbers: nx, ny, y[ny], and for each x value: x, z[ny]
+        # (the line breaks do not matter), so it is parsed at once.
+        with open(filename, "r") as file:
+            tokens = file.read().split()
+
+        try:
+            n_x = int(tokens[0])
+            n_y = int(tokens[1])
+            if len(tokens) != 2 + n_y + n_x * (n_y + 1): raise ValueError("Unexpected number of values")
+            values = numpy.array(tokens[2:], dtype=float)
+        except ValueError:
+            return cls._read_surface_error_file_legacy(filename)
+
+        y_coords = values[0:n_y].copy()
+        xz = values[n_y:].reshape((n_x, n_y + 1))
+        return xz[:, 0].copy(), y_coords, xz[:, 1:].copy()
+
+    @classmethod
+    def _get_surface_file_cache_names(cls, filename: str):
+        abs_filename = os.path.abspath(filename)
+        return [abs_filename + ".s4cache.npy",
+                os.path.join(tempfile.gettempdir(), "shadow4_cache",
+                             "%08x_%s.s4cache.npy" % (zlib.crc32(abs_filename.encode()), os.path.basename(filename)))]
+
+    @classmethod
+    def _read_surface_file_cached(cls, filename: str, reader: Callable):
+        # cache layout (1D float64 array): [path crc32, mtime, size, nx, ny, x[nx], y[ny], z[nx*ny]]
+        stat = os.stat(filename)
+        key = numpy.array([zlib.crc32(os.path.abspath(filename).encode()), stat.st_mtime, stat.st_size], dtype=float)
+
+        cache_names = cls._get_surface_file_cache_names(filename)
+        for cache_name in cache_names:
+            try:
+                data = numpy.load(cache_name, mmap_mode='c') # copy-on-write: the cache file is never modified
+            except Exception:
+                continue
+            if data.ndim == 1 and data.size >= 5 and numpy.array_equal(data[0:3], key):
+                n_x, n_y = int(data[3]), int(data[4])
+                if data.size == 5 + n_x + n_y + n_x * n_y:
+                    if is_verbose(): print("S4Mesh: using cached mesh file: %s" % cache_name)
+                    return data[5:5 + n_x], data[5 + n_x:5 + n_x + n_y], data[5 + n_x + n_y:].reshape((n_x, n_y))
+
+        x, y, z = reader(filename)
+
+        data = numpy.concatenate((key, [x.size, y.size], x, y, numpy.asarray(z, dtype=float).ravel()))
+        for cache_name in cache_names:
+            try:
+                os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+                tmp_name = "%s.%d.tmp" % (cache_name, os.getpid())
+                with open(tmp_name, "wb") as f: numpy.save(f, data)
+                os.replace(tmp_name, cache_name) # atomic, for concurrent runs
+                if is_verbose(): print("S4Mesh: mesh file cached in: %s" % cache_name)
+                break
+            except OSError:
+                try:    os.remove(tmp_name)
+                except: pass
+                continue
+
+        return x, y, z
+
+    @classmethod
+    def _read_surface_error_file_legacy(cls, filename: str): #copied from shadowOui util/shadow_util
         file = open(filename, "r")
         rows = file.readlines()
 
@@ -10,7 +10,7 @@ import os
 import h5py
 import time
 
-from shadow4.tools.arrayofvectors import vector_reflection, vector_refraction, vector_scattering
+from shadow4.tools.arrayofvectors import vector_reflection, vector_refraction, vector_scattering, vector_grating_diffraction
 from shadow4.tools.arrayofvectors import vector_cross, vector_dot, vector_multiply_scalar, vector_sum, vector_diff
 from shadow4.tools.arrayofvectors import vector_modulus_square, vector_modulus, vector_norm, vector_rotate_around_axis
 from shadow4.tools.logger import is_verbose, is_debug
@@ -98,6 +98,62 @@ class S4OpticalSurface(object):
         """
         raise NotImplementedError("Subclasses should implement this!")
 
+    def get_height_bound(self, x_min, x_max, y_min, y_max, npoints=101):
+        """
+        Estimates an upper bound of the absolute value of the surface height (sag) in a rectangular region.
+
+        The heights are sampled in a grid, and the maximum absolute value is increased by 10% plus the largest
+        height difference between neighbouring grid points (a margin for the variation of the surface between the
+        sampled points). The result is kept in the instance (the surface instances are memoized by the optical
+        elements) and it is calculated again if the region or the scalar parameters of the surface change.
+
+        Parameters
+        ----------
+        x_min : float
+            The minimum x coordinate of the region.
+        x_max : float
+            The maximum x coordinate of the region.
+        y_min : float
+            The minimum y coordinate of the region.
+        y_max : float
+            The maximum y coordinate of the region.
+        npoints : int, optional
+            The number of sampled points in each direction.
+
+        Returns
+        -------
+        float or None
+            The height bound, or None if it cannot be calculated.
+
+        """
+        key = (x_min, x_max, y_min, y_max, npoints,
+               tuple(sorted((k, v) for k, v in vars(self).items() if isinstance(v, (bool, int, float, str)))))
+        cache = getattr(self, "_height_bound_cache", None)
+        if cache is not None and cache[0] == key: return cache[1]
+
+        x = numpy.linspace(x_min, x_max, npoints)
+        y = numpy.linspace(y_min, y_max, npoints)
+        X = numpy.outer(x, numpy.ones_like(y))
+        Y = numpy.outer(numpy.ones_like(x), y)
+        try:
+            with numpy.errstate(invalid='ignore'):
+                Z = numpy.asarray(self.surface_height(X, Y), dtype=float) * numpy.ones_like(X)
+        except Exception:
+            return None
+
+        finite = numpy.isfinite(Z)
+        if not finite.any():
+            bound = None
+        else:
+            with numpy.errstate(invalid='ignore'):
+                steps = numpy.concatenate((numpy.abs(numpy.diff(Z, axis=0)).ravel(),
+                                           numpy.abs(numpy.diff(Z, axis=1)).ravel()))
+            steps = steps[numpy.isfinite(steps)]
+            bound = 1.1 * numpy.abs(Z[finite]).max() + (steps.max() if steps.size > 0 else 0.0)
+
+        self._height_bound_cache = (key, bound)
+        return bound
+
     def calculate_intercept_on_beam(self, beam):
         """
         Computes the intersection of the incident beam (expressed in local coordinates to the beamline element) with
@@ -408,36 +464,19 @@ class S4OpticalSurface(object):
 
         if invert_normal: VNOR = vector_multiply_scalar(VNOR, -1.0) # outward normal
 
-
-
-        # versors
-        X_VRS = numpy.zeros((nrays,3))
-        X_VRS[:,0] = 1
-        Y_VRS = numpy.zeros((nrays, 3))
-        Y_VRS[:,1] = 1
-
         if f_ruling == 0:
-            G_FAC = vector_dot(VNOR, Y_VRS)
+            G_FAC = VNOR[:, 1] # dot product with the Y versor
             G_FAC = numpy.sqrt(1 - G_FAC**2)
         elif f_ruling == 1:
             G_FAC = 1.0
         elif f_ruling == 5:
-            G_FAC = vector_dot(VNOR, Y_VRS)
+            G_FAC = VNOR[:, 1] # dot product with the Y versor
             G_FAC = numpy.sqrt(1 - G_FAC**2)
 
         G_MODR = G_MOD * G_FAC
 
-        K_IN = vector_multiply_scalar(v1.T, kin)
-        K_IN_NOR = vector_multiply_scalar(VNOR, vector_dot(K_IN, VNOR) )
-        K_IN_PAR = vector_diff(K_IN, K_IN_NOR)
-
-        VTAN = vector_cross(VNOR, X_VRS)
-        GSCATTER = vector_multiply_scalar(VTAN, G_MODR)
-
-        K_OUT_PAR = vector_sum(K_IN_PAR, GSCATTER)
-        K_OUT_NOR = vector_multiply_scalar(VNOR,  numpy.sqrt(kin**2 - vector_modulus_square(K_OUT_PAR)))
-        K_OUT = vector_sum(K_OUT_PAR, K_OUT_NOR)
-        V_OUT = vector_norm(K_OUT)
+        # K_OUT_PAR = K_IN_PAR + G_MODR * (VNOR x X_VRS);  |K_OUT| = |K_IN|
+        V_OUT = vector_grating_diffraction(v1.T, kin, VNOR, G_MODR)
 
         # ;
         # ; writes the beam arrays
@@ -0,0 +1,463 @@
+"""
+Tabulated (energy x deviation angle) complex reflectivity amplitudes of a perfect crystal.
+
+The exact calculation (S4CrystalElement with reflectivity_table=False) calls crystalpy for every ray: the
+structure factors are evaluated for every photon energy and the dynamical theory equations are solved for
+every incident direction. Here the complex amplitudes rs and rp are calculated with crystalpy on a grid
+covering the energy and angle ranges of the beam, and then interpolated for every ray.
+
+The table axes are the photon energy E and the deviation angle from the (uncorrected) Bragg angle,
+    delta_theta = theta_H - theta_B(E),
+where theta_H is the glancing angle between the incident direction and the Bragg planes (sin(theta_H) = -k.H/|k||H|)
+and theta_B(E) = arcsin(lambda / 2 d). In these coordinates the diffraction profile (a few Darwin widths) is
+almost parallel to the energy axis, therefore the grid is only refined around the reflection in the angle axis.
+
+The amplitudes are calculated in a reference geometry: incident direction in the diffraction plane (the plane
+containing the surface normal and the Bragg normal) with grazing angle theta_H + asymmetry_angle with the
+surface. The out-of-plane components of the rays only enter through theta_H, which is exact for flat crystals
+and a very good approximation for the usual divergences and curvatures. The exact crystalpy path is kept
+(and is the default in S4CrystalElement) for validation.
+
+The grid is adaptive (see shadow4.tools.amplitude_table.AdaptiveAmplitudeTable). The initial grid in the angle
+axis includes points around the reflection (spaced a fraction of the Darwin width), so the reflection is never
+missed when the beam covers a large angular range.
+
+The tables are kept in a process-wide cache (keyed by the crystal setup, the diffraction theory, tolerance and
+interpolation order), and optionally in disk (cache_dir).
+
+Usage:
+    table = CrystalReflectivityTable.initialize_from_diffraction_setup(diffraction_setup,
+                        energy_range=[e_min, e_max], deviation_range=[d_min, d_max])
+    deviations = CrystalReflectivityTable.get_deviation_angles(diffraction_setup, photon_energy_ev, directions,
+                                                                bragg_normals)
+    rs, rp = table.reflectivity_amplitudes(photon_energy_ev, deviations)
+    clear_crystal_reflectivity_table_cache()
+
+"""
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from crystalpy.util.Vector import Vector
+from crystalpy.util.ComplexAmplitudePhoton import ComplexAmplitudePhoton
+from crystalpy.diffraction.PerfectCrystalDiffraction import PerfectCrystalDiffraction
+
+from shadow4.tools.logger import is_verbose
+from shadow4.tools.amplitude_table import AdaptiveAmplitudeTable
+
+class CrystalReflectivityTable(AdaptiveAmplitudeTable):
+    """
+    Table of complex reflectivity amplitudes (energy x deviation angle) of a perfect crystal, calculated with crystalpy.
+
+    Constructor.
+
+    Parameters
+    ----------
+    diffraction_setup : instance of crystalpy DiffractionSetupAbstract
+        The crystal setup (material, reflection, asymmetry, thickness, geometry and material constants library).
+    calculation_method : int, optional
+        The dynamical theory used by crystalpy: 0=Zachariasen, 1=Guigay.
+    is_thick : int, optional
+        For Guigay theory, 1=use the thick crystal approximation.
+    setup_key : tuple, optional
+        A key identifying the diffraction setup (for the caches). If None, it is created from the setup parameters
+        (see get_diffraction_setup_key).
+    tolerance : float, optional
+        The maximum allowed interpolation error (in the modulus of the complex amplitudes).
+    interpolation : int, optional
+        The interpolation order: 1=bilinear, 3=bicubic.
+    max_iterations : int, optional
+        The maximum number of refinements of the grid.
+    max_points : int, optional
+        The maximum number of points in each axis.
+
+    """
+    _cache = OrderedDict()
+    _cache_lock = threading.RLock()
+    _cache_maxsize = 32
+    _cache_file_prefix = "s4crystaltable"
+
+    def __init__(self,
+                 diffraction_setup=None,
+                 calculation_method=1,
+                 is_thick=0,
+                 setup_key=None,
+                 tolerance=1e-3,
+                 interpolation=1,
+                 max_iterations=14,
+                 max_points=4097,
+                 ):
+        AdaptiveAmplitudeTable.__init__(self, tolerance=tolerance, interpolation=interpolation,
+                                        max_iterations=max_iterations, max_points=max_points)
+
+        self._diffraction_setup = diffraction_setup
+        self._calculation_method = calculation_method
+        self._is_thick = is_thick
+        self._setup_key = setup_key
+        self._calculated_points = None # crystalpy results during the grid refinement: {(energy, deviation): (rs, rp)}
+
+    #
+    # public methods
+    #
+
+    @classmethod
+    def initialize_from_diffraction_setup(cls,
+                                          diffraction_setup,
+                                          calculation_method=1,
+                                          is_thick=0,
+                                          setup_key=None,
+                                          tolerance=1e-3,
+                                          interpolation=1,
+                                          energy_range=[8000.0, 8000.0],
+                                          deviation_range=[0.0, 0.0],
+                                          use_cache=True,
+                                          cache_dir=None,
+                                          ):
+        """
+        Returns a table covering the given energy and deviation angle ranges.
+
+        Parameters
+        ----------
+        diffraction_setup : instance of crystalpy DiffractionSetupAbstract
+            The crystal setup.
+        calculation_method : int, optional
+            The dynamical theory used by crystalpy: 0=Zachariasen, 1=Guigay.
+        is_thick : int, optional
+            For Guigay theory, 1=use the thick crystal approximation.
+        setup_key : tuple, optional
+            A key identifying the diffraction setup (for the caches). If None, it is created from the setup parameters.
+        tolerance : float, optional
+            The maximum allowed interpolation error (in the modulus of the complex amplitudes).
+        interpolation : int, optional
+            The interpolation order: 1=bilinear, 3=bicubic.
+        energy_range : list, optional
+            [min, max] photon energy in eV to be covered by the table.
+        deviation_range : list, optional
+            [min, max] deviation angle from the Bragg angle in rad to be covered by the table.
+        use_cache : boolean, optional
+            If True, the table is taken from (and stored in) the process-wide cache. A cached table not covering
+            the requested ranges is recalculated for the union of the ranges. The returned instance is shared and
+            must not be modified.
+        cache_dir : str, optional
+            If not None, the tables are also stored (and searched) in this directory.
+
+        Returns
+        -------
+        instance of CrystalReflectivityTable
+        """
+        table = CrystalReflectivityTable(diffraction_setup=diffraction_setup, calculation_method=calculation_method,
+                                         is_thick=is_thick, setup_key=setup_key, tolerance=tolerance,
+                                         interpolation=interpolation)
+        key = table.get_key()
+
+        if use_cache:
+            cached = cls._get_cached_table(key)
+            if cached is not None:
+                if cached.covers(energy_range, deviation_range): return cached
+                # extend the ranges of the cached table
+                energy_range, deviation_range = cached._get_union_ranges(energy_range, deviation_range)
+
+        if cache_dir is not None and table.load(cache_dir):
+            if table.covers(energy_range, deviation_range):
+                compute = False
+            else: # extend the ranges of the stored table
+                compute = True
+                energy_range, deviation_range = table._get_union_ranges(energy_range, deviation_range)
+        else:
+            compute = True
+
+        if compute:
+            table.calculate(energy_range, deviation_range)
+            if cache_dir is not None: table.save(cache_dir)
+
+        if use_cache: cls._set_cached_table(key, table)
+
+        return table
+
+    @classmethod
+    def get_diffraction_setup_key(cls, diffraction_setup):
+        """
+        Returns a key identifying a crystalpy diffraction setup, created from its parameters.
+
+        Parameters
+        ----------
+        diffraction_setup : instance of crystalpy DiffractionSetupAbstract
+            The crystal setup.
+
+        Returns
+        -------
+        tuple
+        """
+        return (diffraction_setup.__class__.__name__,
+                diffraction_setup.geometryType().description(),
+                diffraction_setup.crystalName(),
+                int(diffraction_setup.millerH()),
+                int(diffraction_setup.millerK()),
+                int(diffraction_setup.millerL()),
+                float(diffraction_setup.asymmetryAngle()),
+                float(diffraction_setup.azimuthalAngle()),
+                float(diffraction_setup.thickness()))
+
+    @classmethod
+    def get_deviation_angles(cls, diffraction_setup, photon_energy_ev, directions, bragg_normals):
+        """
+        Calculates the deviation angles from the (uncorrected) Bragg angle.
+
+        Parameters
+        ----------
+        diffraction_setup : instance of crystalpy DiffractionSetupAbstract
+            The crystal setup.
+        photon_energy_ev : numpy array
+            The photon energies in eV.
+        directions : numpy array
+            The directions of the incident rays, shape (3, NRAYS).
+        bragg_normals : numpy array
+            The Bragg normals (vector H, not necessarily normalized), shape (3, NRAYS).
+
+        Returns
+        -------
+        numpy array
+            The deviation angles theta_H - theta_B in rad.
+        """
+        directions = numpy.asarray(directions, dtype=float)
+        bragg_normals = numpy.asarray(bragg_normals, dtype=float)
+        sin_theta = -(directions * bragg_normals).sum(axis=0) / \
+                    numpy.sqrt((directions ** 2).sum(axis=0) * (bragg_normals ** 2).sum(axis=0))
+        return numpy.arcsin(numpy.clip(sin_theta, -1.0, 1.0)) - diffraction_setup.angleBragg(photon_energy_ev)
+
+    def get_key(self):
+        """
+        Returns the key identifying the table (used for the memory and disk caches).
+
+        Returns
+        -------
+        tuple
+        """
+        setup_key = self._setup_key if self._setup_key is not None else \
+            self.get_diffraction_setup_key(self._diffraction_setup)
+        return (tuple(setup_key), int(self._calculation_method), int(self._is_thick),
+                float(self._tolerance), int(self._interpolation))
+
+    def covers(self, energy_range, deviation_range):
+        """
+        Checks if the table covers the given ranges.
+
+        Parameters
+        ----------
+        energy_range : list
+            [min, max] photon energy in eV.
+        deviation_range : list
+            [min, max] deviation angle in rad.
+
+        Returns
+        -------
+        boolean
+        """
+        return self._covers_grid(energy_range, deviation_range)
+
+    def get_energies(self):
+        """
+        Returns the energy grid.
+
+        Returns
+        -------
+        numpy array
+            The photon energies in eV.
+        """
+        return self._x
+
+    def get_deviations(self):
+        """
+        Returns the grid of deviation angles.
+
+        Returns
+        -------
+        numpy array
+            The deviation angles from the Bragg angle in rad.
+        """
+        return self._y
+
+    def info(self):
+        """
+        Creates an info text.
+
+        Returns
+        -------
+        str
+        """
+        txt = "Crystal reflectivity table for setup %s (calculation method %d, is_thick %d)\n" % \
+              (repr(self.get_key()[0]), self._calculation_method, self._is_thick)
+        if self._x is not None:
+            txt += "    energy: %d points in [%g, %g] eV\n" % (self._x.size, self._x[0], self._x[-1])
+            txt += "    deviation angle: %d points in [%g, %g] urad\n" % (self._y.size, 1e6 * self._y[0], 1e6 * self._y[-1])
+            txt += "    interpolation order: %d, estimated error: %g (tolerance %g)\n" % \
+                   (self._interpolation, self._error, self._tolerance)
+        return txt
+
+    def calculate(self, energy_range, deviation_range, npoints=9):
+        """
+        Calculates the table on an adaptive grid covering the given ranges.
+
+        Parameters
+        ----------
+        energy_range : list
+            [min, max] photon energy in eV.
+        deviation_range : list
+            [min, max] deviation angle from the Bragg angle in rad.
+        npoints : int, optional
+            The initial number of points in each axis.
+        """
+        e_min, e_max = self._get_padded_range(energy_range, 1e-3 * max(abs(energy_range[1]), 1.0))
+
+        # reflection center and width at the central energy, to seed the angular grid
+        setup = self._diffraction_setup
+        energy = 0.5 * (e_min + e_max)
+        width = numpy.max(setup.darwinHalfwidth(energy)) / numpy.sqrt(numpy.abs(setup.asymmetryFactor(energy)))
+        center = setup.angleBraggCorrected(energy) - setup.angleBragg(energy)
+        d_min, d_max = self._get_padded_range(deviation_range, 20 * width)
+
+        self._calculated_points = {}
+        try:
+            self.calculate_on_grid([e_min, e_max], [d_min, d_max], npoints=npoints,
+                                   y_initial=center + width * numpy.linspace(-10, 10, 41))
+        finally:
+            self._calculated_points = None
+
+        if is_verbose(): print(self.info())
+
+    def reflectivity_amplitudes(self, photon_energy_ev, deviation_angle):
+        """
+        Interpolates the reflectivity amplitudes.
+
+        Parameters
+        ----------
+        photon_energy_ev : float or numpy array
+            The photon energy in eV.
+        deviation_angle : float or numpy array
+            The deviation angle from the Bragg angle in rad (see get_deviation_angles).
+
+        Returns
+        -------
+        tuple
+            (rs, rp) the s-polarized and p-pol amplitude reflectivities (complex).
+        """
+        energy, deviation = numpy.broadcast_arrays(numpy.asarray(photon_energy_ev, dtype=float),
+                                                   numpy.asarray(deviation_angle, dtype=float))
+        shape = energy.shape
+        energy = energy.ravel()
+        deviation = deviation.ravel()
+
+        if is_verbose() and not self.covers([energy.min(), energy.max()], [deviation.min(), deviation.max()]):
+            print("CrystalReflectivityTable: warning, values out of the table range are extrapolated.")
+
+        rs, rp = self._interpolate(energy, deviation)
+
+        return rs.reshape(shape), rp.reshape(shape)
+
+    #
+    # auxiliar methods
+    #
+    def _calculate_amplitudes(self, energies, deviations):
+        # crystalpy is evaluated only in the points not calculated in previous iterations of the grid refinement
+        E = numpy.outer(energies, numpy.ones_like(deviations)).ravel()
+        D = numpy.outer(numpy.ones_like(energies), deviations).ravel()
+        keys = list(zip(E.tolist(), D.tolist()))
+
+        if self._calculated_points is None:
+            missing = numpy.arange(E.size)
+        else:
+            missing = numpy.array([i for i, key in enumerate(keys) if key not in self._calculated_points], dtype=int)
+
+        rs = numpy.zeros(E.size, dtype=complex)
+        rp = numpy.zeros(E.size, dtype=complex)
+        if missing.size > 0:
+            rs[missing], rp[missing] = self._calculate_amplitudes_on_points(E[missing], D[missing])
+
+        if self._calculated_points is not None:
+            known = numpy.ones(E.size, dtype=bool)
+            known[missing] = False
+            for i in numpy.nonzero(known)[0]: rs[i], rp[i] = self._calculated_points[keys[i]]
+            for i in missing: self._calculated_points[keys[i]] = (rs[i], rp[i])
+
+        shape = (energies.size, deviations.size)
+        return rs.reshape(shape), rp.reshape(shape)
+
+    def _calculate_amplitudes_on_points(self, E, D):
+        setup = self._diffraction_setup
+        n = E.size
+
+        # reference geometry: surface normal along z, incident direction in the y-z plane
+        grazing_angle = setup.angleBragg(E) + D + setup.asymmetryAngle()
+        direction = Vector(numpy.zeros(n), numpy.cos(grazing_angle), -numpy.sin(grazing_angle))
+        surface_normal = Vector(numpy.zeros(n), numpy.zeros(n), numpy.ones(n))
+        bragg_normal = surface_normal.getVectorH(
+            surface_normal,
+            setup.dSpacingSI(),
+            asymmetry_angle=setup.asymmetryAngle(),
+            azimuthal_angle=setup.azimuthalAngle())
+
+        photons_in = ComplexAmplitudePhoton(
+            E,
+            direction,
+            Esigma=numpy.ones(n, dtype=complex),
+            Epi   =numpy.ones(n, dtype=complex),
+            )
+
+        perfect_crystal = PerfectCrystalDiffraction.initializeFromDiffractionSetupAndEnergy(
+            setup,
+            E,
+            geometry_type=None,
+            bragg_normal=bragg_normal,
+            surface_normal=surface_normal,
+            thickness=None,
+            d_spacing=None,
+            photon_in=photons_in,
+        )
+
+        photons_out = perfect_crystal.calculatePhotonOut(photons_in,
+                                                         apply_reflectivity=True,
+                                                         calculation_method=self._calculation_method,
+                                                         is_thick=self._is_thick,
+                                                         use_transfer_matrix=0
+                                                         )
+
+        return photons_out.getComplexAmplitudeS(), photons_out.getComplexAmplitudeP()
+
+def clear_crystal_reflectivity_table_cache():
+    """
+    Removes all the tables in the process-wide cache of crystal reflectivity tables.
+    """
+    CrystalReflectivityTable.clear_cache()
+
+
+if __name__ == "__main__":
+    import time
+    from crystalpy.diffraction.DiffractionSetupXraylib import DiffractionSetupXraylib
+    from crystalpy.diffraction.GeometryType import BraggDiffraction
+
+    diffraction_setup = DiffractionSetupXraylib(geometry_type=BraggDiffraction(), crystal_name="Si",
+                                                thickness=100e-6, miller_h=1, miller_k=1, miller_l=1,
+                                                asymmetry_angle=0.0, azimuthal_angle=0.0)
+
+    nrays = 5000
+    energies = numpy.random.uniform(7990.0, 8010.0, nrays)
+    deviations = numpy.random.uniform(-100e-6, 100e-6, nrays)
+
+    t0 = time.time()
+    table = CrystalReflectivityTable.initialize_from_diffraction_setup(diffraction_setup,
+                                    energy_range=[energies.min(), energies.max()],
+                                    deviation_range=[deviations.min(), deviations.max()])
+    t1 = time.time()
+    rs, rp = table.reflectivity_amplitudes(energies, deviations)
+    t2 = time.time()
+    rs0, rp0 = table._calculate_amplitudes(energies, numpy.zeros(1)) # just to time crystalpy on nrays points
+    t3 = time.time()
+    print(table.info())
+    print("Table: build %.3f s, interpolation %.3f s. Direct calculation: %.3f s" % (t1 - t0, t2 - t1, t3 - t2))
+
+    e_test = numpy.array([7995.0, 8000.0, 8005.0])
+    d_test = numpy.linspace(-100e-6, 100e-6, 1001)
+    rs, rp = table._interpolate(e_test, d_test, grid=True)
+    rs0, rp0 = table._calculate_amplitudes(e_test, d_test)
+    print("Max error rs: %g, rp: %g" % (numpy.abs(rs - rs0).max(), numpy.abs(rp - rp0).max()))
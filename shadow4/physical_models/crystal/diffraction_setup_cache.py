@@ -0,0 +1,272 @@
+"""
+Process-wide cache of crystalpy diffraction setups (DiffractionSetupXraylib, DiffractionSetupDabax,
+DiffractionSetupShadowPreprocessorV1 and V2).
+
+Creating a diffraction setup may be expensive (e.g. dabax file access or preprocessor file parsing), and the
+structure factors are evaluated again for every call. Many crystal elements share the same crystal (e.g. the two
+crystals of a double-crystal monochromator, channel-cuts, or energy scans), therefore:
+    * the setups are kept in a thread-safe LRU cache, keyed by the parameters defining the setup (material, Miller
+      indices, asymmetry, thickness, geometry, library and preprocessor file with its modification time). The key
+      is created by the caller (see S4CrystalElement._get_diffraction_setup_key).
+    * the structure factors (psiAll and psi0) of the cached setups are memoized per photon energy: an energy array
+      is reduced to its unique values and only the energies not seen before are evaluated.
+    * other values derived from the setup (e.g. the crystal alignment for a given energy) can be stored with the
+      setup (get_value).
+
+Usage:
+    setup = DIFFRACTION_SETUP_CACHE.get(key, factory)   # factory() returns the crystalpy setup to be cached.
+    value = DIFFRACTION_SETUP_CACHE.get_value(key, name, calculator)
+    clear_diffraction_setup_cache()
+
+Note that the cached setups are shared: they must not be modified by the callers.
+
+"""
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from shadow4.tools.logger import is_verbose
+
+class _StructureFactorMemo(object):
+    # memoizes psiAll(energy) and psi0(energy) of a crystalpy diffraction setup, per photon energy
+    def __init__(self, diffraction_setup, max_energies=100000):
+        self._psi_all = diffraction_setup.psiAll
+        self._max_energies = max_energies
+        self._values = {} # energy: (psi_0, psi_H, psi_H_bar)
+        self._lock = threading.RLock()
+
+    def psiAll(self, energy1, rel_angle=1.0):
+        if numpy.any(numpy.asarray(rel_angle) != 1.0): return self._psi_all(energy1, rel_angle=rel_angle)
+
+        energy = numpy.asarray(energy1, dtype=float)
+        unique_energies, inverse = numpy.unique(energy.ravel(), return_inverse=True)
+
+        with self._lock:
+            missing = numpy.array([e for e in unique_energies.tolist() if e not in self._values])
+        if missing.size > 0:
+            psi_0, psi_H, psi_H_bar = self._evaluate(missing)
+            with self._lock:
+                if len(self._values) + missing.size > self._max_energies: self._values.clear()
+                for i, e in enumerate(missing.tolist()): self._values[e] = (psi_0[i], psi_H[i], psi_H_bar[i])
+
+        with self._lock:
+            values = numpy.array([self._values.get(e, (numpy.nan, numpy.nan, numpy.nan))
+                                  for e in unique_energies.tolist()], dtype=complex).reshape((-1, 3))
+        if numpy.any(numpy.isnan(values)): # discarded by another thread: evaluate all
+            values = numpy.array(self._evaluate(unique_energies), dtype=complex).T
+
+        out = values[inverse]
+        if energy.ndim == 0: return out[0, 0], out[0, 1], out[0, 2]
+        return out[:, 0].reshape(energy.shape), out[:, 1].reshape(energy.shape), out[:, 2].reshape(energy.shape)
+
+    def _evaluate(self, energies):
+        # some setups only accept scalars or arrays with more than one element
+        values = self._psi_all(energies[0] if energies.size == 1 else energies)
+        return [numpy.broadcast_to(numpy.asarray(value, dtype=complex), energies.shape) for value in values]
+
+    def psi0(self, energy):
+        return self.psiAll(energy)[0]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def get_number_of_energies(self):
+        with self._lock:
+            return len(self._values)
+
+class DiffractionSetupCache(object):
+    """
+    Thread-safe LRU cache of crystalpy diffraction setups, with memoized structure factors.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of cached setups.
+    max_energies : int, optional
+        The maximum number of photon energies with memoized structure factors (per setup).
+    """
+    def __init__(self, maxsize=32, max_energies=100000):
+        self._maxsize = maxsize
+        self._max_energies = max_energies
+        self._entries = OrderedDict() # key: (setup, structure factor memo, dictionary of values)
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, factory):
+        """
+        Returns the diffraction setup for a key, creating it if it is not in the cache.
+
+        Parameters
+        ----------
+        key : tuple
+            The key identifying the setup.
+        factory : callable
+            The function creating the setup: factory() returns an instance of crystalpy DiffractionSetupAbstract.
+
+        Returns
+        -------
+        instance of crystalpy DiffractionSetupAbstract
+            The (shared) setup, with memoized structure factors.
+        """
+        return self._get_entry(key, factory)[0]
+
+    def get_value(self, key, name, calculator):
+        """
+        Returns a value derived from a cached setup (e.g. the alignment angles for a given energy), calculating it
+        if needed. The values are discarded with the setup.
+
+        Parameters
+        ----------
+        key : tuple
+            The key identifying the setup (the setup must have been created with get).
+        name : hashable
+            The name identifying the value.
+        calculator : callable
+            The function calculating the value: calculator() returns the value.
+
+        Returns
+        -------
+        object
+            The (shared) value.
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+        if entry is None: return calculator()
+
+        values = entry[2]
+        with self._lock:
+            if name in values: return values[name]
+        value = calculator()
+        with self._lock:
+            values[name] = value
+        return value
+
+    def clear(self):
+        """
+        Removes all the cached setups.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def get_maxsize(self):
+        """
+        Returns the maximum number of cached setups.
+
+        Returns
+        -------
+        int
+        """
+        return self._maxsize
+
+    def set_maxsize(self, maxsize):
+        """
+        Sets the maximum number of cached setups (the least recently used are discarded if needed).
+
+        Parameters
+        ----------
+        maxsize : int
+            The maximum number of cached setups.
+        """
+        with self._lock:
+            self._maxsize = maxsize
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def get_number_of_entries(self):
+        """
+        Returns the number of cached setups.
+
+        Returns
+        -------
+        int
+        """
+        with self._lock:
+            return len(self._entries)
+
+    def info(self):
+        """
+        Returns a text with information on the cache.
+
+        Returns
+        -------
+        str
+        """
+        with self._lock:
+            txt = "DiffractionSetupCache: %d entries (max %d), %d hits, %d misses\n" % \
+                  (len(self._entries), self._maxsize, self._hits, self._misses)
+            for key, entry in self._entries.items():
+                txt += "    %s: %d energies, %d values\n" % (repr(key), entry[1].get_number_of_energies(), len(entry[2]))
+        return txt
+
+    #
+    # auxiliar methods
+    #
+    def _get_entry(self, key, factory):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return self._entries[key]
+            self._misses += 1
+
+        if is_verbose(): print("DiffractionSetupCache: creating diffraction setup for %s" % repr(key))
+        setup = factory() # outside the lock, so other setups can be created in parallel
+
+        memo = _StructureFactorMemo(setup, max_energies=self._max_energies)
+        setup.psiAll = memo.psiAll # instance attributes: the methods of the crystalpy class are not modified
+        setup.psi0 = memo.psi0
+        entry = (setup, memo, {})
+
+        with self._lock:
+            if key in self._entries: # created by another thread
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self._entries[key] = entry
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+        return entry
+
+#
+# the process-wide cache for the crystalpy diffraction setups
+#
+DIFFRACTION_SETUP_CACHE = DiffractionSetupCache(maxsize=32)
+
+def clear_diffraction_setup_cache():
+    """
+    Removes all the setups in the process-wide cache of crystalpy diffraction setups.
+    """
+    DIFFRACTION_SETUP_CACHE.clear()
+
+
+if __name__ == "__main__":
+    import time
+    from crystalpy.diffraction.DiffractionSetupXraylib import DiffractionSetupXraylib
+    from crystalpy.diffraction.GeometryType import BraggDiffraction
+
+    factory = lambda: DiffractionSetupXraylib(geometry_type=BraggDiffraction(), crystal_name="Si", thickness=100e-6,
+                                              miller_h=1, miller_k=1, miller_l=1,
+                                              asymmetry_angle=0.0, azimuthal_angle=0.0)
+    key = ("xraylib", "Si", 1, 1, 1, 0.0, 100e-6, "Bragg")
+
+    energies = numpy.random.choice(numpy.linspace(7990.0, 8010.0, 201), 100000)
+
+    setup = factory()
+    t0 = time.time()
+    psi = setup.psiAll(energies)
+    t1 = time.time()
+    setup_cached = DIFFRACTION_SETUP_CACHE.get(key, factory)
+    psi_cached = setup_cached.psiAll(energies)
+    t2 = time.time()
+    psi_cached = setup_cached.psiAll(energies)
+    t3 = time.time()
+
+    assert (DIFFRACTION_SETUP_CACHE.get(key, factory) is setup_cached)
+    for i in range(3): assert (numpy.allclose(psi[i], psi_cached[i], rtol=1e-12, atol=0))
+    print("psiAll: direct %.3f s, memoized (first call) %.3f s, memoized (next calls) %.3f s" % (t1 - t0, t2 - t1, t3 - t2))
+    print(DIFFRACTION_SETUP_CACHE.info())
@@ -24,9 +24,12 @@ The stack is as follows: Vacuum+[Odd,Even]xn+Substrate
 >>> #      gamma = thickness_even / (thickness_even + thickness_odd)
 """
 
+import zlib
 import numpy
 import scipy.constants as codata
 from srxraylib.util.h5_simple_writer import H5SimpleWriter
+from shadow4.tools.file_cache import PREPROCESSOR_FILE_CACHE
+from shadow4.tools.logger import is_verbose
 
 tocm = codata.h * codata.c / codata.e*1e2 # 12398.419739640718e-8
 
@@ -37,6 +40,7 @@ class MLayer(object):
     Several ways of using MLayer:
     * ml = MLayer.pre_mlayer(<keywords>)
     * ml = MLayer(); ml.read_preprocessor_file('mymlayer.dat')
+    * ml = MLayer.initialize_from_preprocessor_file('mymlayer.dat') # cached
     * ml = MLayer.initialize_from_bilayer_stack(<keywords>)
 
     """
@@ -65,6 +69,35 @@ class MLayer(object):
         """
         return self.pre_mlayer_dict["tgrade"] > 0
 
+    @classmethod
+    def initialize_from_preprocessor_file(cls, filename, use_cache=True):
+        """
+        Creates a MLayer instance from a preprocessor (pre_mlayer) file.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the filename.
+        use_cache : boolean, optional
+            If True, the instance is taken from the process-wide cache of preprocessor files
+            (shadow4.tools.file_cache), and the file is only read if it has been modified. In this case the
+            returned instance is shared and must not be modified.
+
+        Returns
+        -------
+        instance of MLayer
+        """
+        if use_cache:
+            return PREPROCESSOR_FILE_CACHE.get(filename, cls._load_preprocessor_file, loader_name="MLayer")
+        else:
+            return cls._load_preprocessor_file(filename)
+
+    @classmethod
+    def _load_preprocessor_file(cls, filename):
+        out = MLayer()
+        out.read_preprocessor_file(filename)
+        return out
+
     def read_preprocessor_file(self, filename):
         """
         Reads a preprocessor (pre_mlayer) file. It has the same file format as in shadow3.
@@ -962,11 +995,17 @@ class MLayer(object):
 
     def scan(self, h5file="",
             energyN=51, energy1=5000.0, energy2=20000.0,
-            thetaN=1, theta1=0.75, theta2=0.75, verbose=0):
+            thetaN=1, theta1=0.75, theta2=0.75, verbose=0,
+            nprocesses=1, tile_size=None):
         """
         this method computes the multilayer reflectivity vs photon energy and/or angle.
         The reflectivity values are for amplitude.
 
+        For large scans, the (energy, angle) grid can be split in tiles (tile_size) computed in parallel (nprocesses).
+        In this case, if h5file is given, the tiles are written to the file (in the MLayer_scan entry) as they are
+        calculated, and a scan interrupted can be resumed by calling again scan() with the same inputs: only the
+        missing tiles are calculated.
+
         Parameters
         ----------
         energyN : int, optional
@@ -985,6 +1024,11 @@ class MLayer(object):
             Name of the h5 file to dump calculated data. Set to "" to avoid creating file.
         verbose : int, optional
             if verbose=1, and thetaN=angleN=1 a text with results is printed .
+        nprocesses : int or None, optional
+            The number of processes for calculating the tiles (None: the number of CPUs).
+        tile_size : int or None, optional
+            The number of points (in energy and angle) of the tiles. If None and nprocesses=1, the whole grid is
+            calculated at once (not tiled). If None and nprocesses != 1, 256 is used.
 
         Returns
         -------
@@ -1000,19 +1044,13 @@ class MLayer(object):
         energy_array = numpy.linspace(energy1, energy2, energyN)
         theta_array = numpy.linspace(theta1, theta2, thetaN)
 
-        ENERGY = numpy.outer(energy_array, numpy.ones_like(theta_array))
-        THETA = numpy.outer(numpy.ones_like(energy_array), theta_array)
-
-        ENERGY_flatten = ENERGY.flatten()
-        THETA_flatten = THETA.flatten()
-
-        sin_ref = numpy.sin(THETA_flatten * numpy.pi / 180)
-        COS_POLE = 1.0
-        k_what = 1
-        R_S, R_P, _, _ = self._reflec(ENERGY_flatten, sin_ref, COS_POLE, k_what)
-
-        R_S_array =   R_S.reshape((energyN, thetaN))
-        R_P_array =   R_P.reshape((energyN, thetaN))
+        tiled = nprocesses != 1 or tile_size is not None
+        if tiled:
+            R_S_array, R_P_array = self._scan_tiled(energy_array, theta_array, h5file=h5file,
+                                                    nprocesses=nprocesses,
+                                                    tile_size=256 if tile_size is None else tile_size)
+        else:
+            R_S_array, R_P_array = self._scan_grid(energy_array, theta_array)
 
         if verbose:
             if ((thetaN == 1) and (energyN == 1)):
@@ -1028,12 +1066,13 @@ class MLayer(object):
                 print("------------------------------------------------------------------------")
 
         if h5file != "":
-            h5_initialize = True
+            h5_initialize = not tiled # the tiled scan is already in the file
             try:
                 if h5_initialize:
                     h5w = H5SimpleWriter.initialize_file(h5file, creator="xoppy_multilayer.py")
                 else:
                     h5w = H5SimpleWriter(h5file, None)
+                    self._remove_h5_entry(h5file, "MLayer") # from a previous (resumed) run
                 h5_entry_name = "MLayer"
                 # s-pol
                 h5w.create_entry(h5_entry_name,nx_default="reflectivity-s")
@@ -1086,8 +1125,108 @@ class MLayer(object):
 
         return R_S_array, R_P_array, energy_array, theta_array
 
+    def _scan_grid(self, energy_array, theta_array):
+        ENERGY = numpy.outer(energy_array, numpy.ones_like(theta_array))
+        THETA = numpy.outer(numpy.ones_like(energy_array), theta_array)
+
+        ENERGY_flatten = ENERGY.flatten()
+        THETA_flatten = THETA.flatten()
+
+        sin_ref = numpy.sin(THETA_flatten * numpy.pi / 180)
+        COS_POLE = 1.0
+        k_what = 1
+        R_S, R_P, _, _ = self._reflec(ENERGY_flatten, sin_ref, COS_POLE, k_what)
+
+        return R_S.reshape(ENERGY.shape), R_P.reshape(ENERGY.shape)
+
+    def _get_scan_signature(self, energy_array, theta_array, tile_size):
+        # checksum of the multilayer parameters and scan grid (to check that a stored scan can be resumed)
+        checksum = zlib.crc32(numpy.ascontiguousarray(energy_array).tobytes())
+        checksum = zlib.crc32(numpy.ascontiguousarray(theta_array).tobytes(), checksum)
+        checksum = zlib.crc32(repr((tile_size, self.using_pre_mlayer)).encode(), checksum)
+        for key in sorted(self.pre_mlayer_dict.keys()):
+            value = self.pre_mlayer_dict[key]
+            if isinstance(value, numpy.ndarray):
+                checksum = zlib.crc32(key.encode() + numpy.ascontiguousarray(value).tobytes(), checksum)
+            else:
+                checksum = zlib.crc32((key + repr(value)).encode(), checksum)
+        return checksum
+
+    @classmethod
+    def _remove_h5_entry(cls, h5file, entry_name):
+        import h5py
+        with h5py.File(h5file, "a") as f:
+            if entry_name in f: del f[entry_name]
+
+    def _scan_tiled(self, energy_array, theta_array, h5file="", nprocesses=1, tile_size=256):
+        energyN, thetaN = energy_array.size, theta_array.size
+        tiles = [(i, j) for i in range(0, energyN, tile_size) for j in range(0, thetaN, tile_size)]
+
+        R_S_array = numpy.zeros((energyN, thetaN))
+        R_P_array = numpy.zeros((energyN, thetaN))
+        done = numpy.zeros((len(tiles)), dtype=bool)
+
+        f = None
+        if h5file != "":
+            import h5py
+            signature = self._get_scan_signature(energy_array, theta_array, tile_size)
+            f = h5py.File(h5file, "a")
+            group = f.get("MLayer_scan", None)
+            if group is not None and group.attrs.get("signature", None) == signature and \
+                    group["tiles_done"].shape == done.shape:
+                done[:] = group["tiles_done"][()]
+                R_S_array[:] = group["amplitude_s"][()]
+                R_P_array[:] = group["amplitude_p"][()]
+                if is_verbose(): print("MLayer.scan: resuming scan from file %s (%d of %d tiles already calculated)" %
+                                       (h5file, done.sum(), done.size))
+            else:
+                if group is not None: del f["MLayer_scan"]
+                group = f.create_group("MLayer_scan")
+                group.attrs["signature"] = signature
+                chunks = (min(tile_size, energyN), min(tile_size, thetaN))
+                group.create_dataset("energy", data=energy_array)
+                group.create_dataset("theta", data=theta_array)
+                group.create_dataset("amplitude_s", shape=(energyN, thetaN), dtype=float, chunks=chunks)
+                group.create_dataset("amplitude_p", shape=(energyN, thetaN), dtype=float, chunks=chunks)
+                group.create_dataset("tiles_done", data=done)
+                f.flush()
+
+        def store_tile(k, result):
+            i, j = tiles[k]
+            R_S, R_P = result
+            R_S_array[i:i + tile_size, j:j + tile_size] = R_S
+            R_P_array[i:i + tile_size, j:j + tile_size] = R_P
+            done[k] = True
+            if f is not None:
+                group["amplitude_s"][i:i + tile_size, j:j + tile_size] = R_S
+                group["amplitude_p"][i:i + tile_size, j:j + tile_size] = R_P
+                group["tiles_done"][k] = True
+                f.flush()
+            if is_verbose(): print("MLayer.scan: tile %d of %d done" % (done.sum(), done.size))
+
+        pending = [k for k in range(len(tiles)) if not done[k]]
+        get_tile_arrays = lambda k: (energy_array[tiles[k][0]:tiles[k][0] + tile_size],
+                                     theta_array[tiles[k][1]:tiles[k][1] + tile_size])
+        try:
+            if nprocesses == 1 or len(pending) <= 1:
+                for k in pending:
+                    store_tile(k, self._scan_grid(*get_tile_arrays(k)))
+            else:
+                from concurrent.futures import ProcessPoolExecutor, as_completed
+                with ProcessPoolExecutor(max_workers=nprocesses) as executor:
+                    futures = {executor.submit(_scan_grid_tile, self, *get_tile_arrays(k)): k for k in pending}
+                    try:
+                        for future in as_completed(futures):
+                            store_tile(futures[future], future.result())
+                    except BaseException: # e.g. KeyboardInterrupt: do not start the pending tiles
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+        finally:
+            if f is not None: f.close()
 
-    def reflectivity(self, grazing_angle_deg, photon_energy_ev, Y=0.0):
+        return R_S_array, R_P_array
+
+    def reflectivity(self, grazing_angle_deg, photon_energy_ev, Y=0.0, table_points=None):
         """
         Computes the reflectivity (in amplitude) as a function of the incident angle and photon energy.
 
@@ -1100,6 +1239,11 @@ class MLayer(object):
         Y : numpy array
             The array of coordinates along the Y direction (tangential). This is used only in the case of
             laterally graded multilayers.
+        table_points : None or tuple, optional
+            Only for laterally graded multilayers (igrade=2,3,4): if not None, the complex reflectivities are
+            calculated on a regular grid of (n_energy, n_angle, n_y) points covering the ranges of the input values
+            and then linearly interpolated for every ray. For the y axis the grid is made in the thickness factor
+            (which depends only on Y).
 
         Returns
         -------
@@ -1143,6 +1287,9 @@ class MLayer(object):
 
             raise Exception("Bad igrade value %d ." % igrade)
 
+        if table_points is not None and igrade in [2, 3, 4]:
+            return self._reflectivity_from_table(grazing_angle_deg, photon_energy_ev, TFACT, GFACT, table_points)
+
         sin_ref = numpy.sin(grazing_angle_deg * numpy.pi / 180)
         COS_POLE = 1.0
         R_S_array, R_P_array, phase_S, phase_P = self._reflec(photon_energy_ev, sin_ref, COS_POLE,
@@ -1150,78 +1297,85 @@ class MLayer(object):
 
         return R_S_array, R_P_array, phase_S, phase_P
 
-    def _interpolate_refraction_index(self, PHOT_ENER):
-        if isinstance(PHOT_ENER, float): PHOT_ENER = numpy.array([PHOT_ENER])
-        nn = PHOT_ENER.size
+    def _reflectivity_from_table(self, grazing_angle_deg, photon_energy_ev, TFACT, GFACT, table_points):
+        from scipy.interpolate import RegularGridInterpolator
+
+        values = numpy.broadcast_arrays(numpy.asarray(photon_energy_ev, dtype=float),
+                                        numpy.asarray(grazing_angle_deg, dtype=float),
+                                        numpy.asarray(TFACT, dtype=float))
+        shape = values[0].shape
+        values = [value.ravel() for value in values]
+
+        # regular grid (axes with a single value are not interpolated)
+        axes = []
+        for value, npoints in zip(values, table_points):
+            v_min, v_max = value.min(), value.max()
+            axes.append(numpy.array([v_min]) if v_max == v_min else numpy.linspace(v_min, v_max, max(npoints, 2)))
+
+        ENERGY, THETA, TFACT_GRID = numpy.meshgrid(*axes, indexing='ij')
+        R_S, R_P, phase_S, phase_P = self._reflec(ENERGY.ravel(), numpy.sin(numpy.radians(THETA.ravel())), 1.0,
+                                                  TFACT=TFACT_GRID.ravel(), GFACT=GFACT)
+        r_s = (R_S * numpy.exp(1j * phase_S)).reshape(ENERGY.shape)
+        r_p = (R_P * numpy.exp(1j * phase_P)).reshape(ENERGY.shape)
+
+        interpolated_axes = [i for i in range(3) if axes[i].size > 1]
+        index = tuple(slice(None) if i in interpolated_axes else 0 for i in range(3))
+        points = numpy.array([values[i] for i in interpolated_axes]).T
+
+        out = []
+        for r in [r_s, r_p]:
+            if len(interpolated_axes) == 0:
+                r_rays = numpy.full(values[0].size, r.ravel()[0])
+            else:
+                interpolator = RegularGridInterpolator([axes[i] for i in interpolated_axes], r[index],
+                                                       bounds_error=False, fill_value=None)
+                r_rays = interpolator(points)
+            out.append(r_rays.reshape(shape))
 
-        DELS = numpy.zeros(nn)
-        BETS = numpy.zeros(nn)
-        DELE = numpy.zeros(nn)
-        BETE = numpy.zeros(nn)
-        DELO = numpy.zeros(nn)
-        BETO = numpy.zeros(nn)
+        return numpy.abs(out[0]), numpy.abs(out[1]), numpy.angle(out[0]), numpy.angle(out[1])
 
-        is_monochromatic = numpy.all(PHOT_ENER == PHOT_ENER[0])
+    def _interpolate_refraction_index(self, PHOT_ENER):
+        if isinstance(PHOT_ENER, float): PHOT_ENER = numpy.array([PHOT_ENER])
+        PHOT_ENER = numpy.asarray(PHOT_ENER, dtype=float)
 
         if self.using_pre_mlayer == 1:
-            ENER = self.pre_mlayer_dict["energy"]
-            wnum = 2 * numpy.pi * ENER / tocm
-            QMIN = wnum[0]
-            QSTEP = wnum[1] - wnum[0]
-
-            DELTA_S = self.pre_mlayer_dict["delta_s"]
-            DELTA_E = self.pre_mlayer_dict["delta_e"]
-            DELTA_O = self.pre_mlayer_dict["delta_o"]
-            BETA_S = self.pre_mlayer_dict["beta_s"]
-            BETA_E = self.pre_mlayer_dict["beta_e"]
-            BETA_O = self.pre_mlayer_dict["beta_o"]
-
-            ELFACTOR = numpy.log10(1.0e4 / 30.0e0) / 300.0e0
-
-            if is_monochromatic: # just avoid the loop
-                i = 0
-                index1  = int(numpy.log10(PHOT_ENER[i]/ENER[0])/ELFACTOR)
-                DELS[:]  = DELTA_S[index1] + (DELTA_S[index1 + 1] - DELTA_S[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-                BETS[:]  =  BETA_S[index1] + ( BETA_S[index1 + 1] -  BETA_S[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-                DELE[:]  = DELTA_E[index1] + (DELTA_E[index1 + 1] - DELTA_E[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-                BETE[:]  =  BETA_E[index1] + ( BETA_E[index1 + 1] -  BETA_E[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-                DELO[:]  = DELTA_O[index1] + (DELTA_O[index1 + 1] - DELTA_O[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-                BETO[:]  =  BETA_O[index1] + ( BETA_O[index1 + 1] -  BETA_O[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
+            ENER = numpy.asarray(self.pre_mlayer_dict["energy"])
+
+            # linear interpolation in the (log-spaced) energy grid of the preprocessor file
+            index1 = numpy.searchsorted(ENER, PHOT_ENER, side='right') - 1
+            index1 = numpy.clip(index1, 0, ENER.size - 2)
+            weight = (PHOT_ENER - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
+
+            out = []
+            for key in ["delta_o", "beta_o", "delta_e", "beta_e", "delta_s", "beta_s"]:
+                values = numpy.asarray(self.pre_mlayer_dict[key])
+                out.append(values[index1] + (values[index1 + 1] - values[index1]) * weight)
+            DELO, BETO, DELE, BETE, DELS, BETS = out
+
+        elif self.using_pre_mlayer in [0, 2]: # not using preprocessor, using xraylib (0) or dabax (2)
+            if self.using_pre_mlayer == 0:
+                try: import xraylib
+                except: raise ImportError("xraylib not available")
+                refractive_index_re = lambda material, energy_kev, density: \
+                    numpy.array([xraylib.Refractive_Index_Re(material, e, density) for e in energy_kev])
+                refractive_index_im = lambda material, energy_kev, density: \
+                    numpy.array([xraylib.Refractive_Index_Im(material, e, density) for e in energy_kev])
             else:
-                for i in range(nn):
-                    index1  = int(numpy.log10(PHOT_ENER[i]/ENER[0])/ELFACTOR)
-                    DELS[i]  = DELTA_S[index1] + (DELTA_S[index1+1] - DELTA_S[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-                    BETS[i]  =  BETA_S[index1] + ( BETA_S[index1+1] -  BETA_S[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-                    DELE[i]  = DELTA_E[index1] + (DELTA_E[index1+1] - DELTA_E[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-                    BETE[i]  =  BETA_E[index1] + ( BETA_E[index1+1] -  BETA_E[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-                    DELO[i]  = DELTA_O[index1] + (DELTA_O[index1+1] - DELTA_O[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-                    BETO[i]  =  BETA_O[index1] + ( BETA_O[index1+1] -  BETA_O[index1]) * (PHOT_ENER[i] - ENER[index1]) / (ENER[index1 + 1] - ENER[index1])
-        elif self.using_pre_mlayer == 0: # not using preprocessor, using xraylib
-            try: import xraylib
-            except: "xraylib not available"
-            if is_monochromatic:
-                DELS[:]  = 1.0 - xraylib.Refractive_Index_Re(self.pre_mlayer_dict["materialS"], 1e-3 * PHOT_ENER[0], self.pre_mlayer_dict["densityS"])
-                BETS[:]  =       xraylib.Refractive_Index_Im(self.pre_mlayer_dict["materialS"], 1e-3 * PHOT_ENER[0], self.pre_mlayer_dict["densityS"])
-                DELE[:]  = 1.0 - xraylib.Refractive_Index_Re(self.pre_mlayer_dict["material1"], 1e-3 * PHOT_ENER[0], self.pre_mlayer_dict["density1"])
-                BETE[:]  =       xraylib.Refractive_Index_Im(self.pre_mlayer_dict["material1"], 1e-3 * PHOT_ENER[0], self.pre_mlayer_dict["density1"])
-                DELO[:]  = 1.0 - xraylib.Refractive_Index_Re(self.pre_mlayer_dict["material2"], 1e-3 * PHOT_ENER[0], self.pre_mlayer_dict["density2"])
-                BETO[:]  =       xraylib.Refractive_Index_Im(self.pre_mlayer_dict["material2"], 1e-3 * PHOT_ENER[0], self.pre_mlayer_dict["density2"])
-            else:
-                for i in range(nn):
-                    DELS[i]  = 1.0 - xraylib.Refractive_Index_Re(self.pre_mlayer_dict["materialS"], 1e-3 * PHOT_ENER[i], self.pre_mlayer_dict["densityS"])
-                    BETS[i]  =       xraylib.Refractive_Index_Im(self.pre_mlayer_dict["materialS"], 1e-3 * PHOT_ENER[i], self.pre_mlayer_dict["densityS"])
-                    DELE[i]  = 1.0 - xraylib.Refractive_Index_Re(self.pre_mlayer_dict["material1"], 1e-3 * PHOT_ENER[i], self.pre_mlayer_dict["density1"])
-                    BETE[i]  =       xraylib.Refractive_Index_Im(self.pre_mlayer_dict["material1"], 1e-3 * PHOT_ENER[i], self.pre_mlayer_dict["density1"])
-                    DELO[i]  = 1.0 - xraylib.Refractive_Index_Re(self.pre_mlayer_dict["material2"], 1e-3 * PHOT_ENER[i], self.pre_mlayer_dict["density2"])
-                    BETO[i]  =       xraylib.Refractive_Index_Im(self.pre_mlayer_dict["material2"], 1e-3 * PHOT_ENER[i], self.pre_mlayer_dict["density2"])
-        elif self.using_pre_mlayer == 2: # not using preprocessor, using dabax
-            DELS  = 1.0 - self.dabax.Refractive_Index_Re(self.pre_mlayer_dict["materialS"], 1e-3 * PHOT_ENER, self.pre_mlayer_dict["densityS"])
-            BETS  =       self.dabax.Refractive_Index_Im(self.pre_mlayer_dict["materialS"], 1e-3 * PHOT_ENER, self.pre_mlayer_dict["densityS"])
-            DELE  = 1.0 - self.dabax.Refractive_Index_Re(self.pre_mlayer_dict["material1"], 1e-3 * PHOT_ENER, self.pre_mlayer_dict["density1"])
-            BETE  =       self.dabax.Refractive_Index_Im(self.pre_mlayer_dict["material1"], 1e-3 * PHOT_ENER, self.pre_mlayer_dict["density1"])
-            DELO  = 1.0 - self.dabax.Refractive_Index_Re(self.pre_mlayer_dict["material2"], 1e-3 * PHOT_ENER, self.pre_mlayer_dict["density2"])
-            BETO  =       self.dabax.Refractive_Index_Im(self.pre_mlayer_dict["material2"], 1e-3 * PHOT_ENER, self.pre_mlayer_dict["density2"])
-
+                refractive_index_re = self.dabax.Refractive_Index_Re
+                refractive_index_im = self.dabax.Refractive_Index_Im
+
+            # the optical constants are calculated only for the different energies, then copied to all rays
+            unique_energies, inverse = numpy.unique(PHOT_ENER.ravel(), return_inverse=True)
+
+            out = []
+            for layer in ["2", "1", "S"]: # odd, even, substrate
+                material = self.pre_mlayer_dict["material" + layer]
+                density = self.pre_mlayer_dict["density" + layer]
+                delta = 1.0 - numpy.asarray(refractive_index_re(material, 1e-3 * unique_energies, density), dtype=float)
+                beta = numpy.asarray(refractive_index_im(material, 1e-3 * unique_energies, density), dtype=float)
+                out.append(numpy.broadcast_to(delta, unique_energies.shape)[inverse].reshape(PHOT_ENER.shape))
+                out.append(numpy.broadcast_to(beta, unique_energies.shape)[inverse].reshape(PHOT_ENER.shape))
+            DELO, BETO, DELE, BETE, DELS, BETS = out
 
         return DELO, BETO, DELE, BETE, DELS, BETS
 
@@ -1326,6 +1480,124 @@ class MLayer(object):
     @classmethod
     def _fresnel(cls, TFACT, GFACT, NPAIR, SIN_REF, COS_POLE, XLAM,
                 delo, dele, dels, beto, bete, bets, t_o, t_e, mlroughness1, mlroughness2):
+        #
+        # Multilayer reflectivity using the same recursion (and notation) as in _fresnel_legacy (the port of the
+        # shadow3 FRESNEL subroutine), but:
+        #   - s and p polarizations are computed together in a stacked complex array of shape (2, nrays).
+        #   - the layer phase factors a**4 = exp(-4 i pi f t / lambda) and the interface coefficients (including
+        #     the Nevot-Croce factor) are computed once for each different thickness and roughness values, and
+        #     reused for all the layers with the same values (all layers for a periodic stack).
+        #   - the recursion runs in place on preallocated arrays.
+        #
+        ci = 0.+1.0j
+
+        # ! (refraction index "odd,even,substrate")**2
+        ro2 = (1.0 - delo - ci * beto)**2
+        re2 = (1.0 - dele - ci * bete)**2
+        rs2 = (1.0 - dels - ci * bets)**2
+
+        # ! angles
+        SIN_REF2 = SIN_REF**2
+        COS_REF2 = 1.0 - SIN_REF2
+
+        fo = numpy.sqrt(ro2 - COS_REF2 + 0j)
+        fe = numpy.sqrt(re2 - COS_REF2 + 0j)
+        fv = numpy.sqrt(SIN_REF2 + 0j)
+        fs = numpy.sqrt(rs2 - COS_REF2 + 0j)
+
+        if NPAIR == 0: # now there is only substrate and vacuum
+            fe = fv
+            fo = fs
+
+        # ! Fresnel formulas "S" and "P" (in function of incidence angle and critical angle), stacked [s, p]
+        ffe = numpy.array(numpy.broadcast_arrays((fe - fo) / (fe + fo),
+                                                 (fe / re2 - fo / ro2) / (fe / re2 + fo / ro2)))
+        ffo = -ffe
+        ffv = numpy.array(numpy.broadcast_arrays((fv - fo) / (fv + fo),
+                                                 (fv - fo / ro2) / (fv + fo / ro2)))
+        ffs = numpy.array(numpy.broadcast_arrays((fe - fs) / (fe + fs),
+                                                 (fe / re2 - fs / rs2) / (fe / re2 + fs / rs2)))
+
+        shape = numpy.broadcast(ffe[0], ffv[0], ffs[0], XLAM, TFACT).shape
+
+        prefact = (8.*(numpy.pi**2.)) / (XLAM**2)
+
+        # !c Nevot-Croce roughness
+        # !c DO NOT include refraction index in the roughness formula
+        sigma_s2 = 0.0 # ! sigma_s**2.0 !roughn. substrate
+        sigma_v2 = 0.0 # ! sigma_v**2.0!roughn. vacuum
+
+        arg_oe = -prefact * fo * fe / (numpy.sqrt(ro2) * numpy.sqrt(re2)) # to be multiplied by sigma**2
+        phase_o = -4 * ci * numpy.pi * fo * TFACT * COS_POLE / XLAM # to be multiplied by the layer thickness
+        phase_e = -4 * ci * numpy.pi * fe * TFACT * COS_POLE / XLAM
+
+        # cached values (per thickness or roughness). For strongly depth-graded stacks the cache is not used.
+        use_cache = NPAIR > 0 and max(numpy.unique(t_o[0:NPAIR]).size, numpy.unique(t_e[0:NPAIR]).size,
+                                      numpy.unique(mlroughness1[0:NPAIR]).size,
+                                      numpy.unique(mlroughness2[0:NPAIR]).size) <= 16
+        cache = {}
+
+        def get_phase_factor(name, phase, thickness):
+            key = (name, thickness)
+            if key in cache: return cache[key]
+            value = numpy.exp(phase * thickness)
+            if use_cache: cache[key] = value
+            return value
+
+        def get_interface_coefficient(name, ff, sigma2):
+            key = (name, sigma2)
+            if key in cache: return cache[key]
+            value = ff * numpy.exp(arg_oe * sigma2) if sigma2 != 0.0 else ff
+            if use_cache: cache[key] = value
+            return value
+
+        r = numpy.zeros((2,) + shape, dtype=complex)
+        numerator = numpy.empty_like(r)
+        denominator = numpy.empty_like(r)
+
+        def add_interface(r, f, a4=None): # r = a4 * (r + f) / (r * f + 1)
+            numpy.add(r, f, out=numerator)
+            numpy.multiply(r, f, out=denominator)
+            numpy.add(denominator, 1.0, out=denominator)
+            numpy.divide(numerator, denominator, out=r)
+            if a4 is not None: r *= a4
+
+        # ! loop over the bilayers
+        # ! remember that "even" is the bottom sublayer
+        for j in range(NPAIR):
+            ao4 = get_phase_factor("o", phase_o, t_o[j])
+            ae4 = get_phase_factor("e", phase_e, t_e[j])
+
+            if j != 0:
+                add_interface(r, get_interface_coefficient("e", ffe, mlroughness1[j]**2), ae4)
+            else:
+                # ! layer on top of substrate
+                arg_s = fe * fs * sigma_s2 / (numpy.sqrt(re2) * numpy.sqrt(rs2))
+                add_interface(r, ffs * numpy.exp(-prefact * arg_s), ae4)
+
+            # ! odd layer (top sublayer)
+            add_interface(r, get_interface_coefficient("o", ffo, mlroughness2[j]**2), ao4)
+
+        # !
+        # ! vacuum interface
+        # !
+        arg_v = fo * fv * sigma_v2 / numpy.sqrt(ro2)
+        add_interface(r, ffv * numpy.exp(-prefact * arg_v))
+
+        # !
+        # ! calculate phases
+        # !
+        PHASES = numpy.arctan2(r[0].imag, r[0].real)
+        ans = numpy.abs(r[0])
+
+        PHASEP = numpy.arctan2(r[1].imag, r[1].real)
+        anp = numpy.abs(r[1])
+
+        return ans, anp, PHASES, PHASEP
+
+    @classmethod
+    def _fresnel_legacy(cls, TFACT, GFACT, NPAIR, SIN_REF, COS_POLE, XLAM,
+                delo, dele, dels, beto, bete, bets, t_o, t_e, mlroughness1, mlroughness2):
 
         # !C------------------------------------------------------------------------------
         # !C  subroutine FRESNEL
@@ -1537,10 +1809,43 @@ class MLayer(object):
         # print(">>>>>> fresnel output\n ans, anp, PHASES, PHASEP = ", ans, anp, PHASES, PHASEP)
         return ans, anp, PHASES, PHASEP
 
+def _scan_grid_tile(mlayer, energy_array, theta_array): # for the process pool in MLayer.scan
+    return mlayer._scan_grid(energy_array, theta_array)
+
 if __name__ == "__main__":
 
     from srxraylib.plot.gol import plot
 
+    if 1: # benchmark: multilayer engine (_fresnel) vs the legacy recursion (_fresnel_legacy)
+        import time
+        b = MLayer.initialize_from_bilayer_stack(
+                                          material_S="Si", density_S=None, roughness_S=0.0,
+                                          material_E="B4C", density_E=2.40, roughness_E=3.3,
+                                          material_O="Ru", density_O=9.40, roughness_O=3.1,
+                                          bilayer_pairs=300,
+                                          bilayer_thickness=33.1,
+                                          bilayer_gamma=0.483,
+                                          )
+        nrays = 100000
+        photon_energy = numpy.random.uniform(9000.0, 11000.0, nrays)
+        sin_ref = numpy.sin(numpy.radians(numpy.random.uniform(0.5, 1.5, nrays)))
+        DELO, BETO, DELE, BETE, DELS, BETS = b._interpolate_refraction_index(photon_energy)
+        t_e = b.pre_mlayer_dict["gamma1"] * b.pre_mlayer_dict["thick"]
+        t_o = (1.0 - b.pre_mlayer_dict["gamma1"]) * b.pre_mlayer_dict["thick"]
+        args = (1.0, 1.0, numpy.abs(b.pre_mlayer_dict["npair"]), sin_ref, 1.0, tocm / photon_energy * 1.0e8,
+                DELO, DELE, DELS, BETO, BETE, BETS, t_o, t_e,
+                b.pre_mlayer_dict["mlroughness1"], b.pre_mlayer_dict["mlroughness2"])
+        t0 = time.time()
+        rs0, rp0, phase_s0, phase_p0 = b._fresnel_legacy(*args)
+        t1 = time.time()
+        rs1, rp1, phase_s1, phase_p1 = b._fresnel(*args)
+        t2 = time.time()
+        print("%d rays, %d bilayers: legacy recursion %.3f s, multilayer engine %.3f s" %
+              (nrays, args[2], t1 - t0, t2 - t1))
+        print("max difference in complex amplitudes: s: %g, p: %g" %
+              (numpy.abs(rs0 * numpy.exp(1j * phase_s0) - rs1 * numpy.exp(1j * phase_s1)).max(),
+               numpy.abs(rp0 * numpy.exp(1j * phase_p0) - rp1 * numpy.exp(1j * phase_p1)).max()))
+
     if 1:
         a = MLayer.pre_mlayer(
             FILE="pre_mlayer.dat",
@@ -0,0 +1,257 @@
+"""
+Process-wide service for the optical constants (complex refraction index and attenuation coefficient) of materials
+calculated with xraylib or dabax.
+
+The optical elements (screens/filters, interfaces, lenses, CRLs, mirrors with external libraries) need the
+optical constants for every ray, but the beams are often monochromatic or have a limited number of different
+photon energies. Here:
+    * the constants are evaluated only once per distinct energy, and scattered back to the rays.
+    * the evaluated values are kept in a bounded cache shared by all elements and runs, keyed by
+      (quantity, library, material, density).
+    * by default, all the distinct energies are evaluated exactly. Optionally (max_unique_energies not None), for
+      continuous spectra with more distinct energies than max_unique_energies, the constants are evaluated in the
+      nodes of a fine logarithmic energy grid (relative step grid_relative_step, 1e-4 by default) and linearly
+      interpolated. The nodes are also cached. Note that the interpolation is not accurate near the absorption
+      edges (within one grid step).
+
+Usage:
+    n = OPTICAL_CONSTANTS.refraction_index(photon_energy_ev, material="Be", density=1.848)
+    mu = OPTICAL_CONSTANTS.attenuation_coefficient(photon_energy_ev, material="Be", density=1.848, library="dabax")
+    clear_optical_constants_cache()
+
+"""
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from shadow4.tools.logger import is_verbose
+
+class OpticalConstants(object):
+    """
+    Thread-safe, bounded cache of optical constants evaluated per distinct photon energy.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of cached (quantity, library, material, density) entries.
+    max_energies : int, optional
+        The maximum number of cached energies per entry (the entry is emptied if exceeded, and the energies of
+        larger arrays are evaluated without caching them).
+    max_unique_energies : None or int, optional
+        None: the constants are evaluated for all the distinct energies (default). Otherwise, if the number of
+        distinct energies is larger than this value, the constants are interpolated in a grid (faster, but
+        inaccurate near the absorption edges).
+    grid_relative_step : float, optional
+        The relative step (dE/E) of the logarithmic energy grid.
+    """
+    QUANTITIES = ["refraction_index", "attenuation_coefficient"]
+    LIBRARIES = ["xraylib", "dabax"]
+
+    def __init__(self, maxsize=64, max_energies=200000, max_unique_energies=None, grid_relative_step=1e-4):
+        self._maxsize = maxsize
+        self._max_energies = max_energies
+        self._max_unique_energies = max_unique_energies
+        self._grid_relative_step = grid_relative_step
+        self._entries = OrderedDict() # key: {energy: value}
+        self._lock = threading.RLock()
+
+    def refraction_index(self, photon_energy_ev, material="SiC", density=3.217, library="xraylib", dabax=None):
+        """
+        Returns the complex refraction index n = 1 - delta + i beta.
+
+        Parameters
+        ----------
+        photon_energy_ev : float or numpy array
+            The photon energy or array of energies in eV.
+        material : str, optional
+            The symbol/formula of the material.
+        density : float, optional
+            The material density in g/cm3.
+        library : str, optional
+            "xraylib" or "dabax".
+        dabax : None or instance of DabaxXraylib
+            A pointer to the dabax library (for library="dabax"). Use None for default.
+
+        Returns
+        -------
+        complex or numpy array
+            The complex refraction index (same shape as photon_energy_ev).
+        """
+        return self._get("refraction_index", photon_energy_ev, material, density, library, dabax)
+
+    def attenuation_coefficient(self, photon_energy_ev, material="SiC", density=3.217, library="xraylib", dabax=None):
+        """
+        Returns the linear attenuation coefficient (from the total cross section).
+
+        Parameters
+        ----------
+        photon_energy_ev : float or numpy array
+            The photon energy or array of energies in eV.
+        material : str, optional
+            The symbol/formula of the material.
+        density : float, optional
+            The material density in g/cm3.
+        library : str, optional
+            "xraylib" or "dabax".
+        dabax : None or instance of DabaxXraylib
+            A pointer to the dabax library (for library="dabax"). Use None for default.
+
+        Returns
+        -------
+        float or numpy array
+            The attenuation coefficient in cm^-1 (same shape as photon_energy_ev).
+        """
+        return self._get("attenuation_coefficient", photon_energy_ev, material, density, library, dabax)
+
+    def clear(self):
+        """
+        Removes all the cached values.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def get_number_of_entries(self):
+        """
+        Returns the number of cached (quantity, library, material, density) entries.
+
+        Returns
+        -------
+        int
+        """
+        with self._lock:
+            return len(self._entries)
+
+    def info(self):
+        """
+        Returns a text with information on the cache.
+
+        Returns
+        -------
+        str
+        """
+        with self._lock:
+            txt = "OpticalConstants: %d entries (max %d)\n" % (len(self._entries), self._maxsize)
+            for key, values in self._entries.items():
+                txt += "    %s: %d energies\n" % (repr(key), len(values))
+        return txt
+
+    #
+    # auxiliar methods
+    #
+    def _get(self, quantity, photon_energy_ev, material, density, library, dabax):
+        if library not in self.LIBRARIES: raise ValueError("library must be one of: %s" % repr(self.LIBRARIES))
+
+        energy = numpy.asarray(photon_energy_ev, dtype=float)
+        key = (quantity, self._get_library_id(library, dabax), material, float(density))
+        unique_energies, inverse = numpy.unique(energy.ravel(), return_inverse=True)
+
+        if self._max_unique_energies is None or unique_energies.size <= self._max_unique_energies:
+            values = self._get_values(key, unique_energies, dabax)
+        else: # linear interpolation in a logarithmic grid
+            log_step = numpy.log1p(self._grid_relative_step)
+            index = numpy.floor(numpy.log(unique_energies) / log_step)
+            nodes = numpy.unique(numpy.concatenate((index, index + 1)))
+            node_values = self._get_values(key, numpy.exp(nodes * log_step), dabax)
+            i = numpy.searchsorted(nodes, index)
+            e0, e1 = numpy.exp(index * log_step), numpy.exp((index + 1) * log_step)
+            w = (unique_energies - e0) / (e1 - e0)
+            values = (1 - w) * node_values[i] + w * node_values[i + 1]
+            if is_verbose(): print("OpticalConstants: %d energies interpolated in %d grid nodes (%s)" %
+                                   (unique_energies.size, nodes.size, repr(key)))
+
+        out = values[inverse].reshape(energy.shape)
+        if energy.ndim == 0: return out[()]
+        return out
+
+    def _get_values(self, key, energies, dabax):
+        with self._lock:
+            values = self._entries.get(key, None)
+            if values is None:
+                values = {}
+                self._entries[key] = values
+                while len(self._entries) > self._maxsize:
+                    self._entries.popitem(last=False)
+            self._entries.move_to_end(key)
+            missing = numpy.array([e for e in energies.tolist() if e not in values])
+
+        if missing.size > self._max_energies: # too many to be cached
+            return self._calculate(key, energies, dabax)
+
+        if missing.size > 0:
+            new_values = self._calculate(key, missing, dabax)
+            with self._lock:
+                if len(values) + missing.size > self._max_energies: values.clear()
+                values.update(zip(missing.tolist(), new_values.tolist()))
+
+        dtype = complex if key[0] == "refraction_index" else float
+        with self._lock:
+            out = [values.get(e, None) for e in energies.tolist()]
+        if any(value is None for value in out): # discarded by another thread
+            return self._calculate(key, energies, dabax)
+        return numpy.array(out, dtype=dtype)
+
+    @classmethod
+    def _get_library_id(cls, library, dabax):
+        if library == "dabax":
+            try:    return "dabax:%s:%s" % (dabax.get_file_f1f2(), dabax.get_file_CrossSec())
+            except: return "dabax"
+        return library
+
+    @classmethod
+    def _calculate(cls, key, energies, dabax):
+        quantity, library, material, density = key
+        if library == "xraylib":
+            try:    import xraylib
+            except: raise ImportError("xraylib not available")
+            if quantity == "refraction_index":
+                return numpy.array([xraylib.Refractive_Index(material, energy * 1e-3, density)
+                                    for energy in energies.tolist()], dtype=complex)
+            else:
+                return numpy.array([xraylib.CS_Total_CP(material, energy * 1e-3) * density
+                                    for energy in energies.tolist()], dtype=float)
+        else:
+            from dabax.dabax_xraylib import DabaxXraylib
+            dx = dabax if isinstance(dabax, DabaxXraylib) else DabaxXraylib()
+            if quantity == "refraction_index":
+                return numpy.broadcast_to(dx.Refractive_Index_Re(material, energies * 1e-3, density) +
+                                     1j * dx.Refractive_Index_Im(material, energies * 1e-3, density),
+                                          energies.shape).astype(complex)
+            else:
+                return numpy.broadcast_to(dx.CS_Total_CP(material, energies * 1e-3) * density,
+                                          energies.shape).astype(float)
+
+#
+# the process-wide service for the optical constants
+#
+OPTICAL_CONSTANTS = OpticalConstants()
+
+def clear_optical_constants_cache():
+    """
+    Removes all the values in the process-wide cache of optical constants.
+    """
+    OPTICAL_CONSTANTS.clear()
+
+
+if __name__ == "__main__":
+    import time
+    import xraylib
+
+    nrays = 1000000
+    for energies in [numpy.full(nrays, 8000.0),                         # monochromatic
+                     numpy.random.choice([8000.0, 8040.0, 8080.0], nrays), # a few lines
+                     numpy.random.uniform(5000.0, 15000.0, nrays)]:        # continuous spectrum
+        clear_optical_constants_cache()
+        t0 = time.time()
+        mu = OPTICAL_CONSTANTS.attenuation_coefficient(energies, material="Be", density=1.848)
+        n = OPTICAL_CONSTANTS.refraction_index(energies, material="Be", density=1.848)
+        t1 = time.time()
+        mu = OPTICAL_CONSTANTS.attenuation_coefficient(energies, material="Be", density=1.848)
+        t2 = time.time()
+        i = numpy.random.randint(0, nrays, 1000)
+        mu0 = numpy.array([xraylib.CS_Total_CP("Be", e * 1e-3) * 1.848 for e in energies[i]])
+        n0 = numpy.array([xraylib.Refractive_Index("Be", e * 1e-3, 1.848) for e in energies[i]])
+        print("%d distinct energies: first call %.3f s, cached %.3f s, max relative error mu: %g, n-1: %g" %
+              (numpy.unique(energies).size, t1 - t0, t2 - t1, numpy.abs(mu[i] / mu0 - 1).max(),
+               numpy.abs((n[i] - n0) / (1 - n0.real)).max()))
+    print(OPTICAL_CONSTANTS.info())
@@ -4,6 +4,8 @@ python version of the mirror reflectivity code and refractive index calculations
 import numpy
 import scipy.constants as codata
 from shadow4.tools.logger import is_verbose, is_debug, set_verbose
+from shadow4.tools.file_cache import PREPROCESSOR_FILE_CACHE
+from shadow4.physical_models.prerefl.optical_constants import OPTICAL_CONSTANTS
 
 tocm = codata.h * codata.c / codata.e * 1e2 # 12398.419739640718e-8
 
@@ -15,12 +17,42 @@ class PreRefl(object):
 
         Get reflectivities using one of these options:
         * Using preprocessor file: ref = PreRefl(); ref.read_preprocessor_file('myprerefl.dat') ; ref.get_refraction_index() ; ref;get_attenuation_coefficient().
+        * Using preprocessor file (cached): ref = PreRefl.initialize_from_preprocessor_file('myprerefl.dat').
         * PreRefl.get_refraction_index_external_xraylib(<kwds>) PreRefl.get_attenuation_coefficient_external_xraylib(<kwds>)
         * PreRefl.get_refraction_index_external_dabax(<kwds>) PreRefl.get_attenuation_coefficient_external_dabax(<kwds>)
 
         """
         self.prerefl_dict = None
 
+    @classmethod
+    def initialize_from_preprocessor_file(cls, filename, use_cache=True):
+        """
+        Creates a PreRefl instance from a preprocessor (prerefl) file.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the filename.
+        use_cache : boolean, optional
+            If True, the instance is taken from the process-wide cache of preprocessor files
+            (shadow4.tools.file_cache), and the file is only read if it has been modified. In this case the
+            returned instance is shared and must not be modified.
+
+        Returns
+        -------
+        instance of PreRefl
+        """
+        if use_cache:
+            return PREPROCESSOR_FILE_CACHE.get(filename, cls._load_preprocessor_file, loader_name="PreRefl")
+        else:
+            return cls._load_preprocessor_file(filename)
+
+    @classmethod
+    def _load_preprocessor_file(cls, filename):
+        out = PreRefl()
+        out.read_preprocessor_file(filename)
+        return out
+
     def read_preprocessor_file(self, filename):
         """
         Reads a preprocessor (prerefl) file. The same as in shadow3.
@@ -183,16 +215,27 @@ class PreRefl(object):
                                                      photon_energy_ev=10000.0,
                                                      material="SiC",
                                                      density=3.217,):
+        """
+        Standalone method to return the attenuation coefficient using xraylib.
 
-        try:    import xraylib
-        except: raise ImportError("xraylib not available")
+        The values are evaluated once per distinct photon energy and cached (see OPTICAL_CONSTANTS).
 
-        photon_energy_ev_array = numpy.array(photon_energy_ev)
-        attenuation_coefficient = numpy.zeros_like(photon_energy_ev_array, dtype=float)
+        Parameters
+        ----------
+        photon_energy_ev : float or numpy array
+            The photon energy or array of energies in eV.
+        material : str, optional
+            The symbol/formula of the material.
+        density : float, optional
+            The material density in g/cm3.
 
-        for i,photon_energy_ev in enumerate(photon_energy_ev_array):
-            attenuation_coefficient[i] = xraylib.CS_Total_CP(material, photon_energy_ev*1e-3) * density
-        return attenuation_coefficient
+        Returns
+        -------
+        float or numpy array
+            The array with attenuation coefficient in cm^-1.
+        """
+        return OPTICAL_CONSTANTS.attenuation_coefficient(photon_energy_ev, material=material, density=density,
+                                                         library="xraylib")
 
     @classmethod
     def get_attenuation_coefficient_external_dabax(self,
@@ -219,13 +262,8 @@ class PreRefl(object):
         float or numpy array
             The array with attenuation coefficient in cm^-1.
         """
-        from dabax.dabax_xraylib import DabaxXraylib
-        if isinstance(dabax, DabaxXraylib):
-            dx = dabax
-        else:
-            dx = DabaxXraylib()
-
-        return dx.CS_Total_CP(material, photon_energy_ev*1e-3) * density
+        return OPTICAL_CONSTANTS.attenuation_coefficient(photon_energy_ev, material=material, density=density,
+                                                         library="dabax", dabax=dabax)
 
     @classmethod
     def get_refraction_index_external_xraylib(self,
@@ -249,18 +287,8 @@ class PreRefl(object):
         float or numpy array
             The array with complex refraction index.
         """
-        try:    import xraylib
-        except: raise ImportError("xraylib not available")
-
-        if isinstance(photon_energy_ev, (float, int)):
-            return xraylib.Refractive_Index(material, photon_energy_ev * 1e-3, density)
-        else:
-            photon_energy_ev_array = numpy.array(photon_energy_ev)
-            refraction_index = numpy.zeros_like(photon_energy_ev_array, dtype=complex)
-
-            for i,photon_energy_ev in enumerate(photon_energy_ev_array):
-                refraction_index[i] = xraylib.Refractive_Index(material, photon_energy_ev * 1e-3, density)
-            return refraction_index
+        return OPTICAL_CONSTANTS.refraction_index(photon_energy_ev, material=material, density=density,
+                                                 library="xraylib")
 
     @classmethod
     def get_refraction_index_real_external_xraylib(cls,
@@ -315,15 +343,11 @@ class PreRefl(object):
         float or numpy array
             The array with complex refraction index.
         """
-        from dabax.dabax_xraylib import DabaxXraylib
-        if isinstance(dabax, DabaxXraylib): dx = dabax
-        else:                               dx = DabaxXraylib()
-
-        return dx.Refractive_Index_Re(material, photon_energy_ev * 1e-3, density) + \
-               1j * dx.Refractive_Index_Im(material, photon_energy_ev * 1e-3, density)
+        return OPTICAL_CONSTANTS.refraction_index(photon_energy_ev, material=material, density=density,
+                                                 library="dabax", dabax=dabax)
 
     @classmethod
-    def get_refraction_index_real_external_dabax(self,
+    def get_refraction_index_real_external_dabax(cls,
                                                  photon_energy_ev=10000.0,
                                                  material="SiC",
                                                  density=3.217,
@@ -347,11 +371,10 @@ class PreRefl(object):
         float or numpy array
             The array with the real part of the refraction index.
         """
-        from dabax.dabax_xraylib import DabaxXraylib
-        if isinstance(dabax, DabaxXraylib): dx = dabax
-        else:                               dx = DabaxXraylib()
-
-        return dx.Refractive_Index_Re(material, photon_energy_ev * 1e-3, density)
+        return cls.get_refraction_index_external_dabax(photon_energy_ev=photon_energy_ev,
+                                                       material=material,
+                                                       density=density,
+                                                       dabax=dabax).real
 
     def reflectivity_fresnel(self,
                              photon_energy_ev=10000.0,
@@ -454,15 +477,8 @@ class PreRefl(object):
         tuple
             (rs, rp, runp) the s-polarized, p-pol and unpolarized reflectivities
         """
-        try:    import xraylib
-        except: raise ImportError("xraylib not available")
-
-        photon_energy_ev_array = numpy.array(photon_energy_ev)
-        refraction_index_2 = numpy.zeros_like(photon_energy_ev_array, dtype=complex)
-
-        for i,photon_energy_ev in enumerate(photon_energy_ev_array):
-            refraction_index_2[i] = xraylib.Refractive_Index_Re(coating_material, photon_energy_ev*1e-3, coating_density) + \
-                                1j * xraylib.Refractive_Index_Im(coating_material, photon_energy_ev * 1e-3, coating_density)
+        refraction_index_2 = OPTICAL_CONSTANTS.refraction_index(photon_energy_ev, material=coating_material,
+                                                               density=coating_density, library="xraylib")
 
         refraction_index_1 = numpy.ones_like(refraction_index_2)
 
@@ -508,14 +524,8 @@ class PreRefl(object):
         tuple
             (rs, rp, runp) the s-polarized, p-pol and unpolarized reflectivities
         """
-        from dabax.dabax_xraylib import DabaxXraylib
-        if isinstance(dabax, DabaxXraylib):
-            dx = dabax
-        else:
-            dx = DabaxXraylib()
-
-        refraction_index_2 = dx.Refractive_Index_Re(coating_material, photon_energy_ev * 1e-3, coating_density) + \
-                                1j * dx.Refractive_Index_Im(coating_material, photon_energy_ev * 1e-3, coating_density)
+        refraction_index_2 = OPTICAL_CONSTANTS.refraction_index(photon_energy_ev, material=coating_material,
+                                                               density=coating_density, library="dabax", dabax=dabax)
 
         refraction_index_1 = numpy.ones_like(refraction_index_2)
 
@@ -0,0 +1,559 @@
+"""
+Tabulated (energy x grazing angle) Fresnel reflectivity amplitudes of a mirror coating.
+
+The direct calculation of the reflectivity with xraylib or dabax (PreRefl.reflectivity_amplitudes_fresnel_external_xraylib
+and PreRefl.reflectivity_amplitudes_fresnel_external_dabax) evaluates the optical constants for every ray. Here the
+complex amplitudes rs and rp (including the roughness Debye-Waller factor) are calculated on a grid covering the
+energy and angle ranges of the beam, and then interpolated for every ray.
+
+The table axes are the photon energy E and the product of energy and grazing angle E*theta (proportional to the
+momentum transfer). In these coordinates the edge of the total reflection (theta_c ~ 1/E) is parallel to the energy
+axis, therefore it does not force the refinement of the full grid.
+
+The grid is adaptive: the intervals are bisected until the interpolation error at the middle and center points
+is below a given tolerance (in absolute value of the complex amplitude). The grid, interpolation and caches are
+managed by the base class shadow4.tools.amplitude_table.AdaptiveAmplitudeTable.
+
+The tables are kept in a process-wide cache (keyed by library, coating, density, roughness, method, tolerance and
+interpolation order), and optionally in disk (cache_dir).
+
+This module also contains UserReflectivityTable, for the reflectivities given in user files (vs angle, energy, or
+energy and angle). The file is loaded and the interpolator built only once (using the process-wide cache of
+preprocessor files), and all the rays are interpolated in a single vectorized call.
+
+Usage:
+    table = CoatingReflectivityTable.initialize_from_coating(coating_material="Rh", coating_density=12.41,
+                        energy_range=[e_min, e_max], angle_range_mrad=[a_min, a_max])
+    rs, rp = table.reflectivity_amplitudes(photon_energy_ev, grazing_angle_mrad)
+    clear_reflectivity_table_cache()
+
+    table = UserReflectivityTable.initialize_from_file("reflectivity.dat", kind="energy_angle")
+    Rs, Rp = table.reflectivities(photon_energy_ev, grazing_angle_mrad)
+
+"""
+import threading
+from collections import OrderedDict
+
+import numpy
+from scipy.interpolate import RectBivariateSpline
+
+from shadow4.physical_models.prerefl.prerefl import PreRefl
+from shadow4.physical_models.prerefl.optical_constants import OPTICAL_CONSTANTS
+from shadow4.tools.logger import is_verbose
+from shadow4.tools.file_cache import PREPROCESSOR_FILE_CACHE
+from shadow4.tools.amplitude_table import AdaptiveAmplitudeTable
+
+class CoatingReflectivityTable(AdaptiveAmplitudeTable):
+    """
+    Table of Fresnel reflectivity amplitudes (energy x grazing angle) of a coating, calculated with xraylib or dabax.
+
+    Constructor.
+
+    Parameters
+    ----------
+    coating_material : str, optional
+        The symbol/formula of the coating material.
+    coating_density : float, optional
+        The density in g/cm3 of the coating material.
+    roughness_rms_A : float, optional
+        The roughness RMS in Angstroms.
+    method : int, optional
+        0=Born&Wolf, 1=Parratt, 2=shadow3 (see PreRefl.reflectivity_amplitudes_fresnel_external).
+    library : str, optional
+        "xraylib" or "dabax".
+    dabax : None or instance of DabaxXraylib
+        A pointer to the dabax library (for library="dabax"). Use None for default.
+    tolerance : float, optional
+        The maximum allowed interpolation error (in the modulus of the complex amplitudes).
+    interpolation : int, optional
+        The interpolation order: 1=bilinear, 3=bicubic.
+    max_iterations : int, optional
+        The maximum number of refinements of the grid.
+    max_points : int, optional
+        The maximum number of points in each axis.
+
+    """
+    _cache = OrderedDict()
+    _cache_lock = threading.RLock()
+    _cache_maxsize = 32
+    _cache_file_prefix = "s4refltable"
+
+    def __init__(self,
+                 coating_material="SiC",
+                 coating_density=3.217,
+                 roughness_rms_A=0.0,
+                 method=0,
+                 library="xraylib",
+                 dabax=None,
+                 tolerance=1e-4,
+                 interpolation=1,
+                 max_iterations=12,
+                 max_points=2049,
+                 ):
+        if library not in ["xraylib", "dabax"]: raise ValueError("library must be 'xraylib' or 'dabax'")
+        AdaptiveAmplitudeTable.__init__(self, tolerance=tolerance, interpolation=interpolation,
+                                        max_iterations=max_iterations, max_points=max_points)
+
+        self._coating_material = coating_material
+        self._coating_density = coating_density
+        self._roughness_rms_A = roughness_rms_A
+        self._method = method
+        self._library = library
+        self._dabax = dabax
+
+    #
+    # public methods
+    #
+
+    @classmethod
+    def initialize_from_coating(cls,
+                                coating_material="SiC",
+                                coating_density=3.217,
+                                roughness_rms_A=0.0,
+                                method=0,
+                                library="xraylib",
+                                dabax=None,
+                                tolerance=1e-4,
+                                interpolation=1,
+                                energy_range=[10000.0, 10000.0],
+                                angle_range_mrad=[3.0, 3.0],
+                                use_cache=True,
+                                cache_dir=None,
+                                ):
+        """
+        Returns a table covering the given energy and angle ranges.
+
+        Parameters
+        ----------
+        coating_material : str, optional
+            The symbol/formula of the coating material.
+        coating_density : float, optional
+            The density in g/cm3 of the coating material.
+        roughness_rms_A : float, optional
+            The roughness RMS in Angstroms.
+        method : int, optional
+            0=Born&Wolf, 1=Parratt, 2=shadow3.
+        library : str, optional
+            "xraylib" or "dabax".
+        dabax : None or instance of DabaxXraylib
+            A pointer to the dabax library (for library="dabax"). Use None for default.
+        tolerance : float, optional
+            The maximum allowed interpolation error (in the modulus of the complex amplitudes).
+        interpolation : int, optional
+            The interpolation order: 1=bilinear, 3=bicubic.
+        energy_range : list, optional
+            [min, max] photon energy in eV to be covered by the table.
+        angle_range_mrad : list, optional
+            [min, max] grazing angle in mrad to be covered by the table.
+        use_cache : boolean, optional
+            If True, the table is taken from (and stored in) the process-wide cache. A cached table not covering
+            the requested ranges is recalculated for the union of the ranges. The returned instance is shared and
+            must not be modified.
+        cache_dir : str, optional
+            If not None, the tables are also stored (and searched) in this directory.
+
+        Returns
+        -------
+        instance of CoatingReflectivityTable
+        """
+        table = CoatingReflectivityTable(coating_material=coating_material, coating_density=coating_density,
+                                         roughness_rms_A=roughness_rms_A, method=method, library=library,
+                                         dabax=dabax, tolerance=tolerance, interpolation=interpolation)
+        key = table.get_key()
+        product_range = cls._get_product_range(energy_range, angle_range_mrad)
+
+        if use_cache:
+            cached = cls._get_cached_table(key)
+            if cached is not None:
+                if cached.covers(energy_range, angle_range_mrad): return cached
+                # extend the ranges of the cached table
+                energy_range, product_range = cached._get_union_ranges(energy_range, product_range)
+
+        if cache_dir is not None and table.load(cache_dir):
+            if table._covers_grid(energy_range, product_range):
+                compute = False
+            else: # extend the ranges of the stored table
+                compute = True
+                energy_range, product_range = table._get_union_ranges(energy_range, product_range)
+        else:
+            compute = True
+
+        if compute:
+            table.calculate(energy_range, product_range=product_range)
+            if cache_dir is not None: table.save(cache_dir)
+
+        if use_cache: cls._set_cached_table(key, table)
+
+        return table
+
+    def get_key(self):
+        """
+        Returns the key identifying the table (used for the memory and disk caches).
+
+        Returns
+        -------
+        tuple
+        """
+        if self._library == "dabax":
+            try:    library = "dabax:%s" % self._dabax.get_file_f1f2()
+            except: library = "dabax"
+        else:
+            library = self._library
+        return (library, self._coating_material, float(self._coating_density), float(self._roughness_rms_A),
+                int(self._method), float(self._tolerance), int(self._interpolation))
+
+    def covers(self, energy_range, angle_range_mrad):
+        """
+        Checks if the table covers the given ranges.
+
+        Parameters
+        ----------
+        energy_range : list
+            [min, max] photon energy in eV.
+        angle_range_mrad : list
+            [min, max] grazing angle in mrad.
+
+        Returns
+        -------
+        boolean
+        """
+        return self._covers_grid(energy_range, self._get_product_range(energy_range, angle_range_mrad))
+
+    def get_energies(self):
+        """
+        Returns the energy grid.
+
+        Returns
+        -------
+        numpy array
+            The photon energies in eV.
+        """
+        return self._x
+
+    def get_products(self):
+        """
+        Returns the grid of the second axis (energy times grazing angle).
+
+        Returns
+        -------
+        numpy array
+            The products energy * grazing angle in eV mrad.
+        """
+        return self._y
+
+    def info(self):
+        """
+        Creates an info text.
+
+        Returns
+        -------
+        str
+        """
+        txt = "Reflectivity table (%s) for coating %s (density %g g/cm3, roughness %g A, method %d)\n" % \
+              (self._library, self._coating_material, self._coating_density, self._roughness_rms_A, self._method)
+        if self._x is not None:
+            txt += "    energy: %d points in [%g, %g] eV\n" % (self._x.size, self._x[0], self._x[-1])
+            txt += "    energy*angle: %d points in [%g, %g] eV mrad\n" % (self._y.size, self._y[0], self._y[-1])
+            txt += "    interpolation order: %d, estimated error: %g (tolerance %g)\n" % \
+                   (self._interpolation, self._error, self._tolerance)
+        return txt
+
+    def calculate(self, energy_range, angle_range_mrad=None, product_range=None, npoints=9):
+        """
+        Calculates the table on an adaptive grid covering the given ranges.
+
+        Parameters
+        ----------
+        energy_range : list
+            [min, max] photon energy in eV.
+        angle_range_mrad : list, optional
+            [min, max] grazing angle in mrad.
+        product_range : list, optional
+            [min, max] energy times grazing angle in eV mrad (used if angle_range_mrad is None).
+        npoints : int, optional
+            The initial number of points in each axis.
+        """
+        if angle_range_mrad is not None: product_range = self._get_product_range(energy_range, angle_range_mrad)
+        e_min, e_max = self._get_padded_range(energy_range, 1e-3 * max(abs(energy_range[1]), 1.0))
+        u_min, u_max = self._get_padded_range(product_range, 1e-3 * e_max)
+        u_min = max(u_min, 0.0)
+
+        self.calculate_on_grid([e_min, e_max], [u_min, u_max], npoints=npoints)
+
+        if is_verbose(): print(self.info())
+
+    def reflectivity_amplitudes(self, photon_energy_ev, grazing_angle_mrad):
+        """
+        Interpolates the reflectivity amplitudes.
+
+        Parameters
+        ----------
+        photon_energy_ev : float or numpy array
+            The photon energy in eV.
+        grazing_angle_mrad : float or numpy array
+            The grazing incident angle in mrad.
+
+        Returns
+        -------
+        tuple
+            (rs, rp) the s-polarized and p-pol amplitude reflectivities (complex).
+        """
+        energy, angle = numpy.broadcast_arrays(numpy.asarray(photon_energy_ev, dtype=float),
+                                               numpy.asarray(grazing_angle_mrad, dtype=float))
+        shape = energy.shape
+        energy = energy.ravel()
+        angle = angle.ravel()
+
+        if is_verbose() and not self.covers([energy.min(), energy.max()], [angle.min(), angle.max()]):
+            print("CoatingReflectivityTable: warning, values out of the table range are extrapolated.")
+
+        rs, rp = self._interpolate(energy, energy * angle)
+
+        return rs.reshape(shape), rp.reshape(shape)
+
+    #
+    # auxiliar methods
+    #
+    @classmethod
+    def _get_product_range(cls, energy_range, angle_range_mrad):
+        products = numpy.outer(energy_range, angle_range_mrad)
+        return [products.min(), products.max()]
+
+    def _calculate_refraction_index(self, energies):
+        return OPTICAL_CONSTANTS.refraction_index(energies, material=self._coating_material,
+                                                 density=self._coating_density,
+                                                 library=self._library, dabax=self._dabax)
+
+    def _calculate_amplitudes(self, energies, products):
+        refraction_index_2 = self._calculate_refraction_index(energies)
+        E = numpy.outer(energies, numpy.ones_like(products))
+        A = numpy.outer(1.0 / energies, products)
+        N2 = numpy.outer(refraction_index_2, numpy.ones_like(products))
+        return PreRefl.reflectivity_amplitudes_fresnel_external(photon_energy_ev=E,
+                                                                refraction_index_1=numpy.ones_like(N2),
+                                                                refraction_index_2=N2,
+                                                                grazing_angle_mrad=A,
+                                                                roughness_rms_A=self._roughness_rms_A,
+                                                                method=self._method)
+
+class UserReflectivityTable(object):
+    """
+    Table of reflectivities (intensity) given by the user in a text file, to be interpolated for every ray.
+
+    The accepted files (columns) are:
+        * kind="angle": grazing angle in mrad, reflectivity.
+        * kind="energy": photon energy in eV, reflectivity.
+        * kind="energy_angle": photon energy in eV, grazing angle in mrad, reflectivity (or s-reflectivity and
+          p-reflectivity). The grid is a mesh with the angle varying faster.
+    Other columns (e.g. phases or errors) are ignored, unless a column with the p-reflectivity is given in
+    initialize_from_file().
+
+    Constructor.
+
+    Parameters
+    ----------
+    kind : str, optional
+        "angle", "energy" or "energy_angle".
+    abscissas : list, optional
+        The abscissas: [angles] for kind="angle", [energies] for kind="energy", [energies, angles] for kind="energy_angle".
+    reflectivity_s : numpy array, optional
+        The s-polarized reflectivity (1D, or 2D of shape (number of energies, number of angles) for kind="energy_angle").
+    reflectivity_p : numpy array, optional
+        The p-polarized reflectivity (same shape as reflectivity_s). If None, the s-reflectivity is used.
+
+    """
+    KINDS = ["angle", "energy", "energy_angle"]
+
+    def __init__(self, kind="angle", abscissas=None, reflectivity_s=None, reflectivity_p=None):
+        if kind not in self.KINDS: raise ValueError("kind must be one of: %s" % repr(self.KINDS))
+
+        self._kind = kind
+        self._abscissas = abscissas
+        self._reflectivity_s = reflectivity_s
+        self._reflectivity_p = reflectivity_s if reflectivity_p is None else reflectivity_p
+        self._interpolators = None
+
+        if kind == "energy_angle" and abscissas is not None:
+            # the interpolators are built once
+            self._interpolators = [RectBivariateSpline(abscissas[0], abscissas[1], self._reflectivity_s, kx=2, ky=2)]
+            if reflectivity_p is not None:
+                self._interpolators.append(RectBivariateSpline(abscissas[0], abscissas[1], self._reflectivity_p, kx=2, ky=2))
+
+    @classmethod
+    def initialize_from_file(cls, filename, kind="angle", column_p=None, use_cache=True):
+        """
+        Creates a table from a user file.
+
+        Parameters
+        ----------
+        filename : str
+            The file name.
+        kind : str, optional
+            "angle", "energy" or "energy_angle".
+        column_p : int or None, optional
+            The index (starting from 0) of the column with the p-reflectivity. If None, the p-reflectivity is
+            the s-reflectivity, except for kind="energy_angle" files with exactly 4 columns, where the fourth
+            column is the p-reflectivity (as in the previous shadow4 versions).
+        use_cache : boolean, optional
+            If True, the instance is taken from the process-wide cache of preprocessor files
+            (shadow4.tools.file_cache), and the file is only read if it has been modified. In this case the
+            returned instance is shared and must not be modified.
+
+        Returns
+        -------
+        instance of UserReflectivityTable
+        """
+        if kind not in cls.KINDS: raise ValueError("kind must be one of: %s" % repr(cls.KINDS))
+        loader = lambda file: cls._load_file(file, kind, column_p=column_p)
+        if use_cache:
+            return PREPROCESSOR_FILE_CACHE.get(filename, loader,
+                                               loader_name="UserReflectivityTable.%s.%s" % (kind, repr(column_p)))
+        else:
+            return loader(filename)
+
+    def get_kind(self):
+        """
+        Returns the kind of table.
+
+        Returns
+        -------
+        str
+            "angle", "energy" or "energy_angle".
+        """
+        return self._kind
+
+    def is_polarized(self):
+        """
+        Checks if the table has different s- and p-reflectivities.
+
+        Returns
+        -------
+        boolean
+        """
+        return self._reflectivity_p is not self._reflectivity_s
+
+    def reflectivities(self, photon_energy_ev=None, grazing_angle_mrad=None):
+        """
+        Interpolates the reflectivities (intensity).
+
+        Parameters
+        ----------
+        photon_energy_ev : numpy array, optional
+            The photon energy in eV (not used for kind="angle").
+        grazing_angle_mrad : numpy array, optional
+            The grazing angle in mrad (not used for kind="energy").
+
+        Returns
+        -------
+        tuple
+            (Rs, Rp) the s-polarized and p-polarized reflectivities.
+        """
+        if self._kind == "angle":
+            return self._interpolate_1d(grazing_angle_mrad)
+        elif self._kind == "energy":
+            return self._interpolate_1d(photon_energy_ev)
+        else:
+            energy, angle = numpy.broadcast_arrays(numpy.asarray(photon_energy_ev, dtype=float),
+                                                   numpy.asarray(grazing_angle_mrad, dtype=float))
+            out = []
+            for interpolator in self._interpolators:
+                interpolated_weight = interpolator.ev(energy, angle)
+                interpolated_weight[numpy.isnan(interpolated_weight)] = 0.0
+                out.append(interpolated_weight)
+            return out[0], out[-1]
+
+    def reflectivity_amplitudes(self, photon_energy_ev=None, grazing_angle_mrad=None):
+        """
+        Interpolates the reflectivities and returns the amplitudes (square root, the phase is not managed).
+
+        Parameters
+        ----------
+        photon_energy_ev : numpy array, optional
+            The photon energy in eV (not used for kind="angle").
+        grazing_angle_mrad : numpy array, optional
+            The grazing angle in mrad (not used for kind="energy").
+
+        Returns
+        -------
+        tuple
+            (rs, rp) the s-polarized and p-polarized amplitude reflectivities.
+        """
+        Rs, Rp = self.reflectivities(photon_energy_ev=photon_energy_ev, grazing_angle_mrad=grazing_angle_mrad)
+        return numpy.sqrt(Rs), numpy.sqrt(Rp)
+
+    #
+    # auxiliar methods
+    #
+    def _interpolate_1d(self, x):
+        abscissas = self._abscissas[0]
+        Rs = numpy.interp(x, abscissas, self._reflectivity_s,
+                          left=self._reflectivity_s[0], right=self._reflectivity_s[-1])
+        if not self.is_polarized(): return Rs, Rs
+        Rp = numpy.interp(x, abscissas, self._reflectivity_p,
+                          left=self._reflectivity_p[0], right=self._reflectivity_p[-1])
+        return Rs, Rp
+
+    @classmethod
+    def _load_file(cls, filename, kind, column_p=None):
+        values = numpy.loadtxt(filename)
+
+        n_min = 2 if kind in ["angle", "energy"] else 3
+        if values.ndim != 2 or values.shape[1] < n_min:
+            raise Exception("File %s must have at least %d columns." % (filename, n_min))
+        if column_p is None and kind == "energy_angle" and values.shape[1] == 4: column_p = 3
+        if column_p is not None and not (n_min <= column_p < values.shape[1]):
+            raise Exception("Bad column %d for the p-reflectivity (file %s has %d columns)." %
+                            (column_p, filename, values.shape[1]))
+
+        if kind in ["angle", "energy"]:
+            x = values[:, 0]
+            reflectivity_s = values[:, 1]
+            reflectivity_p = None if column_p is None else values[:, column_p]
+            if x[-1] < x[0]: # XOPPY MLayer gives angles in descendent order
+                x = x[::-1]
+                reflectivity_s = reflectivity_s[::-1]
+                if reflectivity_p is not None: reflectivity_p = reflectivity_p[::-1]
+            return UserReflectivityTable(kind=kind, abscissas=[x], reflectivity_s=reflectivity_s,
+                                         reflectivity_p=reflectivity_p)
+        else:
+            energies = numpy.unique(values[:, 0])
+            angles = numpy.unique(values[:, 1])
+            shape = (energies.shape[0], angles.shape[0])
+            reflectivity_s = numpy.reshape(values[:, 2], shape)
+            reflectivity_p = None if column_p is None else numpy.reshape(values[:, column_p], shape)
+            return UserReflectivityTable(kind=kind, abscissas=[energies, angles], reflectivity_s=reflectivity_s,
+                                         reflectivity_p=reflectivity_p)
+
+def clear_reflectivity_table_cache():
+    """
+    Removes all the tables in the process-wide cache of coating reflectivity tables.
+    """
+    CoatingReflectivityTable.clear_cache()
+
+
+if __name__ == "__main__":
+    import os
+    import time
+    import tempfile
+
+    nrays = 200000
+    energies = numpy.random.uniform(7000.0, 9000.0, nrays)
+    angles = numpy.random.uniform(2.0, 5.0, nrays)
+
+    for interpolation in [1, 3]:
+        t0 = time.time()
+        table = CoatingReflectivityTable.initialize_from_coating(coating_material="Rh", coating_density=12.41,
+                                    roughness_rms_A=3.0, interpolation=interpolation,
+                                    energy_range=[energies.min(), energies.max()],
+                                    angle_range_mrad=[angles.min(), angles.max()],
+                                    cache_dir=os.path.join(tempfile.gettempdir(), "shadow4_cache"))
+        t1 = time.time()
+        rs, rp = table.reflectivity_amplitudes(energies, angles)
+        t2 = time.time()
+        rs0, rp0 = PreRefl.reflectivity_amplitudes_fresnel_external_xraylib(photon_energy_ev=energies,
+                                    coating_material="Rh", coating_density=12.41, grazing_angle_mrad=angles,
+                                    roughness_rms_A=3.0, method=0)
+        t3 = time.time()
+        print(table.info())
+        print("Table: build %.3f s, interpolation %.3f s. Direct calculation: %.3f s" % (t1 - t0, t2 - t1, t3 - t2))
+        print("Max error rs: %g, rp: %g" % (numpy.abs(rs - rs0).max(), numpy.abs(rp - rp0).max()))
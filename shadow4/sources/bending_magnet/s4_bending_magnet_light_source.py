@@ -3,7 +3,7 @@ Bending magnet light source.
 """
 import numpy
 
-from srxraylib.util.inverse_method_sampler import Sampler1D, Sampler2D
+from shadow4.tools.inverse_method_sampler import Sampler1D, Sampler2D
 
 import scipy.constants as codata
 
@@ -12,8 +12,11 @@ from syned.storage_ring.electron_beam import ElectronBeam
 from shadow4.sources.bending_magnet.s4_bending_magnet import S4BendingMagnet
 from shadow4.beam.s4_beam import S4Beam
 from shadow4.sources.s4_light_source import S4LightSource
+from shadow4.sources.electron_phase_space_sampler import sample_electron_phase_space
+from shadow4.sources.source_acceptance import get_interval_in_0_1, apply_ray_weights
 
 from shadow4.tools.arrayofvectors import vector_cross, vector_norm
+from shadow4.tools.disk_cache import RADIATION_CACHE
 from shadow4.tools.logger import is_verbose, is_debug
 
 from srxraylib.sources.srfunc import sync_f_sigma_and_pi
@@ -37,6 +40,8 @@ class S4BendingMagnetLightSource(S4LightSource):
         The number of rays.
     seed : int, optional
         The Monte Carlo seed.
+    acceptance : instance of SourceAcceptance, optional
+        The angular window accepted downstream (see set_acceptance()).
     """
     def __init__(self,
                  name="Undefined",
@@ -44,6 +49,7 @@ class S4BendingMagnetLightSource(S4LightSource):
                  magnetic_structure=None,
                  nrays=5000,
                  seed=12345,
+                 acceptance=None,
                  ):
         super().__init__(name,
                          electron_beam=electron_beam if not electron_beam is None else ElectronBeam(),
@@ -59,6 +65,33 @@ class S4BendingMagnetLightSource(S4LightSource):
         self.angle_array_mrad    = None
         self.photon_energy_array = None
 
+        self._acceptance = acceptance
+
+    def set_acceptance(self, acceptance=None):
+        """
+        Sets the angular window accepted downstream (importance sampling). The horizontal angle along the arc and the
+        vertical emission angle are sampled only inside the window, and the probability of the window is included as a
+        weight of the rays (the electric fields are scaled by its square root). The horizontal window is enlarged with
+        the interval of the emission cone (if sampled). The electron beam divergence is added after (use a window with
+        margins).
+
+        Parameters
+        ----------
+        acceptance : instance of SourceAcceptance, optional
+            The window (None to sample the full emission).
+        """
+        self._acceptance = acceptance
+
+    def get_acceptance(self):
+        """
+        Returns the angular window accepted downstream.
+
+        Returns
+        -------
+        None or instance of SourceAcceptance
+        """
+        return self._acceptance
+
     def get_beam(self, F_COHER=0,
                        psi_interval_in_units_one_over_gamma=None,
                        psi_interval_number_of_points=1001,
@@ -167,6 +200,9 @@ class S4BendingMagnetLightSource(S4LightSource):
         script += "\n\n\n#light source\nfrom shadow4.sources.bending_magnet.s4_bending_magnet_light_source import S4BendingMagnetLightSource"
         script += "\nlight_source = S4BendingMagnetLightSource(name='%s', electron_beam=electron_beam, magnetic_structure=source, nrays=%d, seed=%s)" % \
                                                           (self.get_name(),self.get_nrays(),self.get_seed())
+        if self._acceptance is not None:
+            script += self._acceptance.to_python_code()
+            script += "\nlight_source.set_acceptance(acceptance)"
 
         script += "\nbeam = light_source.get_beam()"
         return script
@@ -212,8 +248,54 @@ class S4BendingMagnetLightSource(S4LightSource):
             txt += "        Electron sigmaZ': %f urad\n"%(1e6*sigmas[3])
         txt += "Lorentz factor (gamma): %f\n"%electron_beam.gamma()
         txt += "\n" + magnetic_structure.get_info()
+        if self._acceptance is not None:
+            txt += "\n" + self._acceptance.get_info()
         return (txt)
 
+    @classmethod
+    def _calculate_pdf(cls, angle_array_mrad, photon_energy_array, ec_ev, e_gev, i_a):
+        """
+        Calculates the (psi, energy) distribution of the radiation for a horizontal divergence of 1 mrad.
+
+        Parameters
+        ----------
+        angle_array_mrad : numpy array
+            The vertical angles psi in mrad.
+        photon_energy_array : numpy array
+            The photon energies in eV.
+        ec_ev : float
+            The critical energy in eV.
+        e_gev : float
+            The electron energy in GeV.
+        i_a : float
+            The electron current in A.
+
+        Returns
+        -------
+        dict
+            {"fm_s": sigma distribution, "fm_p": pi distribution} 2D arrays (angle, energy) in photons/s/0.1%bw/mrad(psi).
+        """
+        # energy array
+        energy_ev = numpy.array(photon_energy_array)
+        eene = energy_ev / ec_ev
+
+        # angle array
+        codata_mee = 1e-6 * codata.m_e * codata.c ** 2 / codata.e
+        gamma = e_gev * 1e3 / codata_mee
+        angle_mrad = numpy.array(angle_array_mrad) * gamma / 1e3
+
+
+        eene2 = numpy.outer(numpy.ones_like(angle_mrad), eene)
+        angle_mrad2 = numpy.outer(angle_mrad, numpy.ones_like(eene))
+
+        a5_s, a5_p = sync_f_sigma_and_pi(angle_mrad2, eene2)
+
+        hdiv_mrad = 1
+        a8 = codata.e / numpy.power(codata_mee, 2) / codata.h * (9e-2 / 2 / numpy.pi)
+        fm_s = a5_s * eene2**2 * a8 * i_a * hdiv_mrad * e_gev**2
+        fm_p = a5_p * eene2**2 * a8 * i_a * hdiv_mrad * e_gev**2
+        return {"fm_s": fm_s, "fm_p": fm_p}
+
     def __calculate_rays(self,
                          F_COHER=0,
                          psi_interval_in_units_one_over_gamma=None,
@@ -266,6 +348,13 @@ class S4BendingMagnetLightSource(S4LightSource):
         rays = numpy.zeros((NRAYS, 18))
         anglev_sign = numpy.zeros(NRAYS)
 
+        # acceptance window (vertical): the psi values of the distribution inside the window
+        weight_v = None
+        if self._acceptance is not None and self._acceptance.is_vertical_limited():
+            v_min, v_max = self._acceptance.get_vertical_interval()
+            mask_v = ((angle_array_mrad * 1e-3 >= v_min) & (angle_array_mrad * 1e-3 <= v_max)).astype(float)
+            weight_v = 1.0
+
         # calculate the sampled_angle and sampled_photon_energy.
         # separate the calculation for monochromatic case (using Sampler1D for angles) and
         # polychromatic case (use Sampler2D for angles and energies).
@@ -318,7 +407,13 @@ class S4BendingMagnetLightSource(S4LightSource):
             sampler_angle = Sampler1D(angular_distribution_s + angular_distribution_p, angle_array_mrad * 1e-3)
 
             if is_verbose(): print("    calculate_rays: get_n_sampled_points (angle)")
-            sampled_angle = sampler_angle.get_n_sampled_points(NRAYS)
+            if weight_v is None:
+                sampled_angle = sampler_angle.get_n_sampled_points(NRAYS)
+            else:
+                pdf = angular_distribution_s + angular_distribution_p
+                weight_v = (pdf * mask_v).sum() / pdf.sum()
+                if weight_v <= 0: raise Exception("No emission inside the acceptance window.")
+                sampled_angle = Sampler1D(pdf * mask_v, angle_array_mrad * 1e-3).get_n_sampled_points(NRAYS)
             if sample_emission_cone_in_horizontal:
                 sampled_angle_horizontal = sampler_angle.get_n_sampled_points(NRAYS)
             else:
@@ -334,29 +429,21 @@ class S4BendingMagnetLightSource(S4LightSource):
                                                  self.get_magnetic_structure()._NG_E)
 
             t2 = time.time()
-            # energy array
-            energy_ev = numpy.array(photon_energy_array)
-            ec_ev = self.get_magnetic_structure().get_critical_energy(
-                self.get_electron_beam().energy())
-            eene = energy_ev / ec_ev
+            # the (psi, energy) distribution is read from the disk cache if it has been calculated before
+            pdf = RADIATION_CACHE.get("bending_magnet_pdf",
+                                      dict(angle_array_mrad=angle_array_mrad,
+                                           photon_energy_array=photon_energy_array,
+                                           ec_ev=self.get_magnetic_structure().get_critical_energy(
+                                               self.get_electron_beam().energy()),
+                                           e_gev=self.get_electron_beam().energy(),
+                                           i_a=self.get_electron_beam().current()),
+                                      self._calculate_pdf)
+            fm_s = pdf["fm_s"]
+            fm_p = pdf["fm_p"]
 
-            # angle array
             e_gev = self.get_electron_beam().energy()
             codata_mee = 1e-6 * codata.m_e * codata.c ** 2 / codata.e
             gamma = e_gev * 1e3 / codata_mee
-            angle_mrad = numpy.array(angle_array_mrad) * gamma / 1e3
-
-
-            eene2 = numpy.outer(numpy.ones_like(angle_mrad), eene)
-            angle_mrad2 = numpy.outer(angle_mrad, numpy.ones_like(eene))
-
-            a5_s, a5_p = sync_f_sigma_and_pi(angle_mrad2, eene2)
-
-            i_a = self.get_electron_beam().current()
-            hdiv_mrad = 1
-            a8 = codata.e / numpy.power(codata_mee, 2) / codata.h * (9e-2 / 2 / numpy.pi)
-            fm_s = a5_s * eene2**2 * a8 * i_a * hdiv_mrad * e_gev**2
-            fm_p = a5_p * eene2**2 * a8 * i_a * hdiv_mrad * e_gev**2
 
             fm = fm_s + fm_p
 
@@ -399,13 +486,25 @@ class S4BendingMagnetLightSource(S4LightSource):
 
 
             # sample_emission_cone_in_horizontal = 1 # use 0 to mimic shadow3 (it does not sample the cone in H)
+            if weight_v is not None:
+                # the (psi, energy) distribution inside the window, with constant weight
+                weight_v = (fm1 * mask_v[:, None]).sum() / fm1.sum()
+                if weight_v <= 0: raise Exception("No emission inside the acceptance window.")
+
             if sample_emission_cone_in_horizontal == 0:
-                sampler2 = Sampler2D(fm1, angle_array_mrad * 1e-3, photon_energy_array)
+                sampler2 = Sampler2D(fm1 if weight_v is None else fm1 * mask_v[:, None],
+                                     angle_array_mrad * 1e-3, photon_energy_array)
                 sampled_angle, sampled_photon_energy = sampler2.get_n_sampled_points(NRAYS)
                 sampled_angle_horizontal = numpy.zeros_like(sampled_angle)
-            else:
+            elif weight_v is None:
                 sampler2 = Sampler2D(fm1.T, photon_energy_array, angle_array_mrad * 1e-3)
                 sampled_photon_energy, sampled_angle, sampled_angle_horizontal = sampler2.get_n_sampled_points_x2(NRAYS)
+            else:
+                # the horizontal emission cone (not limited by the window) is sampled for the same photon energy
+                sampler2 = Sampler2D((fm1 * mask_v[:, None]).T, photon_energy_array, angle_array_mrad * 1e-3)
+                sampled_photon_energy, sampled_angle = sampler2.get_n_sampled_points(NRAYS)
+                sampled_angle_horizontal = Sampler2D(fm1.T, photon_energy_array, angle_array_mrad * 1e-3). \
+                    get_sampled_conditional(sampled_photon_energy, numpy.random.random(NRAYS))
 
             # Angle_array_mrad = numpy.outer(angle_array_mrad,numpy.ones_like(photon_energy_array))
             # Photon_energy_array = numpy.outer(numpy.ones_like(angle_array_mrad),photon_energy_array)
@@ -414,7 +513,17 @@ class S4BendingMagnetLightSource(S4LightSource):
 
         t4 = time.time()
 
-        ANGLE_array = numpy.random.random(NRAYS) * (HDIV1 + HDIV2) - HDIV2
+        if self._acceptance is not None and self._acceptance.is_horizontal_limited():
+            # acceptance window (horizontal): uniform in the part of the arc inside the window
+            h_min, h_max = self._acceptance.get_horizontal_interval()
+            if r_aladdin < 0: h_min, h_max = -h_max, -h_min
+            if sample_emission_cone_in_horizontal: # the window is enlarged with the interval of the emission cone
+                h_min, h_max = h_min - 1e-3 * angle_array_mrad[-1], h_max + 1e-3 * angle_array_mrad[-1]
+            u_min, weight_h = get_interval_in_0_1((h_min + HDIV2) / (HDIV1 + HDIV2), (h_max + HDIV2) / (HDIV1 + HDIV2))
+            ANGLE_array = (u_min + numpy.random.random(NRAYS) * weight_h) * (HDIV1 + HDIV2) - HDIV2
+        else:
+            weight_h = None
+            ANGLE_array = numpy.random.random(NRAYS) * (HDIV1 + HDIV2) - HDIV2
 
         # sample points in the electron phase space
         E_BEAM1_array = numpy.zeros(NRAYS)
@@ -423,80 +532,12 @@ class S4BendingMagnetLightSource(S4LightSource):
         E_BEAMZZZ_array = numpy.zeros(NRAYS)
 
         if self.get_magnetic_structure()._FLAG_EMITTANCE:
-            # sigma_x, sigma_xp, sigma_z, sigma_zp = self.get_electron_beam().get_sigmas_all()
-            moment_xx, moment_xxp, moment_xpxp, moment_zz, moment_zzp, moment_zpzp = self.get_electron_beam().get_moments_all()
-
-            # emittance loop
-
-            # unchanged values of the covariance matrix
-            meanX = [0, 0]
-            meanZ = [0, 0]
-            # rSigmaXp = sigma_xp
-            # rSigmaZp = sigma_zp
-            for itik in range(NRAYS):
-                EPSI_PATH = numpy.abs(r_aladdin) * ANGLE_array[itik]
-
-
-                # OBSOLETE PART USING THE WAIST POSITION. NOW WE USE THE MOMENTS <xx> <xx'> <x'x'>
-                # # ! C Compute the actual distance (EPSI_W*) from the orbital focus
-                # epsi_wX = self.get_magnetic_structure()._EPSI_DX + EPSI_PATH
-                # epsi_wZ = self.get_magnetic_structure()._EPSI_DZ + EPSI_PATH
-                #
-                # # ! calculation of the electrom beam moments at the current position
-                # # ! (sX,sZ) = (epsi_wx, epsi_wz):
-                # # ! <x2> = (sX * sigma_xp)^2+ sigma_x^2
-                # # ! <x x'> = (sX sigma_xp) sigma_xp
-                # # ! <x'2> = sigma_xp^2                 (same for Z)
-                # rSigmaX = numpy.sqrt( (epsi_wX**2) * (sigma_xp**2) + sigma_x**2 )
-                # rSigmaZ = numpy.sqrt( (epsi_wZ**2) * (sigma_zp**2) + sigma_z**2 )
-                #
-                # if rSigmaX * rSigmaXp != 0.0:
-                #     rhoX = epsi_wX * sigma_xp**2 / (rSigmaX * rSigmaXp)
-                # else:
-                #     rhoX = 0.0
-                #
-                # if rSigmaZ * rSigmaZp != 0.0:
-                #     rhoZ = epsi_wZ * sigma_zp**2 / (rSigmaZ * rSigmaZp)
-                # else:
-                #     rhoZ = 0.0
-                #
-                # covX = [[rSigmaX**2, rhoX * rSigmaX * rSigmaXp], [rhoX * rSigmaX * rSigmaXp, rSigmaXp**2]]
-                # covZ = [[rSigmaZ**2, rhoZ * rSigmaZ * rSigmaZp], [rhoZ * rSigmaZ * rSigmaZp, rSigmaZp**2]]
-
-                # new method
-                propagated_moment_xx   = moment_xx   + 2 * EPSI_PATH * moment_xxp + EPSI_PATH ** 2 * moment_xpxp
-                propagated_moment_xxp  = moment_xxp  + EPSI_PATH * moment_xpxp
-                propagated_moment_xpxp = moment_xpxp
-                propagated_moment_zz   = moment_zz   + 2 * EPSI_PATH * moment_zzp + EPSI_PATH ** 2 * moment_zpzp
-                propagated_moment_zzp  = moment_zzp  + EPSI_PATH * moment_zpzp
-                propagated_moment_zpzp = moment_zpzp
-
-                covX = [[propagated_moment_xx, propagated_moment_xxp],
-                        [propagated_moment_xxp, propagated_moment_xpxp]]
-
-                covZ = [[propagated_moment_zz, propagated_moment_zzp],
-                        [propagated_moment_zzp, propagated_moment_zpzp]]
-
-
-                # sampling using a multivariare (2) normal distribution
-                # multivariate_normal is very slow.
-                # See https://github.com/numpy/numpy/issues/14193 and shadow4-tests/shadow4tests/devel/check_multivariate_normal.py
-                # for acceleration recipee. For 5k rays this emittance loop passed from 31% to 8% of the total time.
-                # sampled_x, sampled_xp = numpy.random.multivariate_normal(meanX, covX, 1).T
-                # sampled_z, sampled_zp = numpy.random.multivariate_normal(meanZ, covZ, 1).T
-                sampled_x, sampled_xp = (meanX + numpy.linalg.cholesky(covX) @ numpy.random.standard_normal(len(meanX))).T
-                sampled_z, sampled_zp = (meanZ + numpy.linalg.cholesky(covZ) @ numpy.random.standard_normal(len(meanZ))).T
-
-                XXX = sampled_x
-                E_BEAM1 = sampled_xp
-
-                ZZZ = sampled_z
-                E_BEAM3 = sampled_zp
-
-                E_BEAM1_array[itik] = E_BEAM1
-                E_BEAM3_array[itik] = E_BEAM3
-                E_BEAMXXX_array[itik] = XXX
-                E_BEAMZZZ_array[itik] = ZZZ
+            # sampling using a multivariate (2) normal distribution with the moments <xx> <xx'> <x'x'> propagated to
+            # the ray position along the arc (EPSI_PATH = |R| * ANGLE). All rays are sampled at once (closed-form 2x2
+            # Cholesky factor), instead of numpy.linalg.cholesky ray by ray.
+            E_BEAMXXX_array, E_BEAM1_array, E_BEAMZZZ_array, E_BEAM3_array = \
+                sample_electron_phase_space(self.get_electron_beam(),
+                                            path_offsets=numpy.abs(r_aladdin) * ANGLE_array, nrays=NRAYS)
 
             if is_debug():
                 from srxraylib.plot.gol import plot_scatter
@@ -628,6 +669,10 @@ class S4BendingMagnetLightSource(S4LightSource):
 
         rays[:, 6:9] =  A_VEC
         rays[:, 15:18] = AP_VEC
+        if weight_h is not None or weight_v is not None:
+            weight = (1.0 if weight_h is None else weight_h) * (1.0 if weight_v is None else weight_v)
+            if is_verbose(): print("    calculate_rays: acceptance window, weight of the rays: %g" % weight)
+            apply_ray_weights(rays, weight)
 
         # set flag (col 10)
         rays[:, 9] = 1.0
@@ -0,0 +1,136 @@
+"""
+Vectorized sampling of the electron phase space (x, x', z, z') for the synchrotron sources.
+
+The electron beam moments <x^2>, <x x'>, <x'^2> (and the same for z) are given at the origin of the source. For a
+point of the electron trajectory at a path offset s from the origin, the moments are propagated in free space:
+    <x^2>(s) = <x^2> + 2 s <x x'> + s^2 <x'^2>
+    <x x'>(s) = <x x'> + s <x'^2>
+    <x'^2>(s) = <x'^2>
+and the (x, x') values are sampled from the bivariate normal distribution with this covariance matrix. Instead of
+calling numpy.random.multivariate_normal or numpy.linalg.cholesky for every ray, the Cholesky factor of the 2x2
+covariance matrix is written in closed form and all the rays are sampled at once:
+    L11 = sqrt(<x^2>), L21 = <x x'> / L11, L22 = sqrt(<x'^2> - L21^2)
+    x = L11 n1, x' = L21 n1 + L22 n2     with n1, n2 standard normal random numbers.
+Singular (e.g. zero emittance) covariance matrices are accepted.
+
+Usage:
+    x, xp, z, zp = sample_electron_phase_space(electron_beam, path_offsets=s_array)
+    x, xp = sample_bivariate_normal(moment_xx, moment_xxp, moment_xpxp, nrays)
+
+"""
+import numpy
+
+def sample_bivariate_normal(moment_ss, moment_sa, moment_aa, nrays=None, standard_normal=None):
+    """
+    Samples (s, a) pairs from bivariate normal distributions with zero mean and covariance
+    [[moment_ss, moment_sa], [moment_sa, moment_aa]].
+
+    Parameters
+    ----------
+    moment_ss : float or numpy array
+        The <s^2> moment (one value, or one per ray).
+    moment_sa : float or numpy array
+        The <s a> moment (one value, or one per ray).
+    moment_aa : float or numpy array
+        The <a^2> moment (one value, or one per ray).
+    nrays : int, optional
+        The number of samples. If None, it is the size of the moment arrays.
+    standard_normal : numpy array, optional
+        Standard normal random numbers with shape (2, nrays). If None, they are created with numpy.random.
+
+    Returns
+    -------
+    tuple
+        (s, a) numpy arrays.
+    """
+    moment_ss, moment_sa, moment_aa = numpy.broadcast_arrays(numpy.asarray(moment_ss, dtype=float),
+                                                             numpy.asarray(moment_sa, dtype=float),
+                                                             numpy.asarray(moment_aa, dtype=float))
+    if nrays is None: nrays = moment_ss.size
+    if standard_normal is None: standard_normal = numpy.random.standard_normal((2, nrays))
+
+    # closed-form Cholesky factor of the 2x2 covariance matrix (clipped for rounding errors and singular matrices)
+    l11 = numpy.sqrt(numpy.maximum(moment_ss, 0.0))
+    l21 = numpy.divide(moment_sa, l11, out=numpy.zeros_like(l11), where=(l11 > 0))
+    l22 = numpy.sqrt(numpy.maximum(moment_aa - l21 ** 2, 0.0))
+
+    s = l11 * standard_normal[0]
+    a = l21 * standard_normal[0] + l22 * standard_normal[1]
+    return s, a
+
+def sample_electron_phase_space(electron_beam, path_offsets=0.0, nrays=None, dispersion=True):
+    """
+    Samples the electron coordinates and directions (x, x', z, z') at given path offsets from the source origin.
+
+    Parameters
+    ----------
+    electron_beam : instance of ElectronBeam or S4ElectronBeam
+        The electron beam (the moments are given at the origin of the source).
+    path_offsets : float or numpy array, optional
+        The distance (in m) along the trajectory from the origin, one per ray (or a single value for all rays).
+    nrays : int, optional
+        The number of samples. If None, it is the size of path_offsets.
+    dispersion : boolean, optional
+        If True, the moments include the dispersion (see ElectronBeam.get_moments_all).
+
+    Returns
+    -------
+    tuple
+        (x, x', z, z') numpy arrays (in m and rad).
+    """
+    moment_xx, moment_xxp, moment_xpxp, moment_zz, moment_zzp, moment_zpzp = \
+        electron_beam.get_moments_all(dispersion=dispersion)
+
+    path_offsets = numpy.asarray(path_offsets, dtype=float)
+    if nrays is None: nrays = path_offsets.size
+    path_offsets = numpy.broadcast_to(path_offsets, (nrays,))
+
+    standard_normal = numpy.random.standard_normal((4, nrays))
+
+    x, xp = sample_bivariate_normal(moment_xx + 2 * path_offsets * moment_xxp + path_offsets ** 2 * moment_xpxp,
+                                    moment_xxp + path_offsets * moment_xpxp,
+                                    moment_xpxp,
+                                    nrays=nrays, standard_normal=standard_normal[0:2])
+    z, zp = sample_bivariate_normal(moment_zz + 2 * path_offsets * moment_zzp + path_offsets ** 2 * moment_zpzp,
+                                    moment_zzp + path_offsets * moment_zpzp,
+                                    moment_zpzp,
+                                    nrays=nrays, standard_normal=standard_normal[2:4])
+    return x, xp, z, zp
+
+
+if __name__ == "__main__":
+    import time
+    from shadow4.sources.s4_electron_beam import S4ElectronBeam
+
+    electron_beam = S4ElectronBeam(energy_in_GeV=6.0, energy_spread=0.001, current=0.2)
+    electron_beam.set_moments_horizontal(2.0e-10, 1.0e-11, 5.0e-11)
+    electron_beam.set_moments_vertical(4.0e-12, 0.0, 2.0e-12)
+
+    nrays = 1000000
+    path_offsets = numpy.random.uniform(-1.0, 1.0, nrays)
+
+    t0 = time.time()
+    x, xp, z, zp = sample_electron_phase_space(electron_beam, path_offsets=path_offsets)
+    t1 = time.time()
+    print("Vectorized sampling: %d rays in %.3f s" % (nrays, t1 - t0))
+
+    # ray-by-ray reference (as done before in the sources)
+    moment_xx, moment_xxp, moment_xpxp, moment_zz, moment_zzp, moment_zpzp = electron_beam.get_moments_all()
+    t0 = time.time()
+    for s in path_offsets[0:10000]:
+        covX = [[moment_xx + 2 * s * moment_xxp + s ** 2 * moment_xpxp, moment_xxp + s * moment_xpxp],
+                [moment_xxp + s * moment_xpxp, moment_xpxp]]
+        numpy.linalg.cholesky(covX) @ numpy.random.standard_normal(2)
+    t1 = time.time()
+    print("Ray-by-ray sampling (cholesky): %d rays in %.3f s (extrapolated)" % (nrays, (t1 - t0) * nrays / 10000))
+
+    # check the moments at a fixed path offset
+    for s in [-1.0, 0.0, 0.5]:
+        x, xp, z, zp = sample_electron_phase_space(electron_beam, path_offsets=s, nrays=nrays)
+        print("s=%4.1f m: <xx> %.4g (%.4g), <xx'> %.4g (%.4g), <x'x'> %.4g (%.4g), <zz> %.4g (%.4g), <zz'> %.4g (%.4g)" % (
+            s,
+            (x * x).mean(),   moment_xx + 2 * s * moment_xxp + s ** 2 * moment_xpxp,
+            (x * xp).mean(),  moment_xxp + s * moment_xpxp,
+            (xp * xp).mean(), moment_xpxp,
+            (z * z).mean(),   moment_zz + 2 * s * moment_zzp + s ** 2 * moment_zpzp,
+            (z * zp).mean(),  moment_zzp + s * moment_zpzp))
@@ -5,7 +5,9 @@ It contains an electron beam and a magnetic structure and some parameters like n
 """
 from syned.storage_ring.light_source import LightSource
 
-class S4LightSource(LightSource):
+from shadow4.sources.s4_light_source_decorators import S4BeamChunksDecorator
+
+class S4LightSource(LightSource, S4BeamChunksDecorator):
     """
     Constructor
 
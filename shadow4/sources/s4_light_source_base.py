@@ -3,7 +3,9 @@ Defines the a Base LightSource to support non-synchrotron sources.
 """
 from syned.storage_ring.empty_light_source import EmptyLightSource
 
-class S4LightSourceBase(EmptyLightSource):
+from shadow4.sources.s4_light_source_decorators import S4BeamChunksDecorator
+
+class S4LightSourceBase(EmptyLightSource, S4BeamChunksDecorator):
     """
     Abstract class to support non-synchrotron light sources (e.g. geometrical source)
 
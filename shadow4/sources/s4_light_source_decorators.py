@@ -0,0 +1,53 @@
+"""
+Defines the functionality shared by the shadow4 light sources.
+
+S4BeamChunksDecorator is inherited by S4LightSource (synchrotron sources) and S4LightSourceBase (geometrical and
+other non-synchrotron sources).
+"""
+import numpy
+
+class S4BeamChunksDecorator(object):
+    """
+    Adds get_beam_chunks() to a light source that implements get_beam(), get_nrays(), set_nrays(), get_seed() and
+    set_seed().
+    """
+    def get_beam_chunks(self, chunk_size=100000, **params):
+        """
+        Generator of the beam in chunks of rays (to limit the memory used when sampling many rays).
+
+        The total number of rays is get_nrays(). Every chunk is obtained with get_beam(**params) for chunk_size
+        rays and an independent seed (derived from get_seed() with numpy.random.SeedSequence), therefore the
+        concatenation of the chunks is statistically equivalent to a single beam with all the rays. The precomputed
+        quantities stored by the light source (e.g. the radiation of the synchrotron sources) are calculated once and
+        reused. The ray index (column 12) is continuous across the chunks.
+
+        Parameters
+        ----------
+        chunk_size : int, optional
+            The maximum number of rays of every chunk.
+        **params
+            Passed to get_beam().
+
+        Yields
+        ------
+        instance of S4Beam
+            The beam with the rays of a chunk.
+        """
+        nrays = self.get_nrays()
+        seed = self.get_seed()
+        nchunks = max(1, -(-nrays // chunk_size))
+        if seed == 0: # not seeded: the chunks continue the current random sequence
+            chunk_seeds = [0] * nchunks
+        else:
+            chunk_seeds = [int(s.generate_state(1)[0]) or 1 for s in numpy.random.SeedSequence(seed).spawn(nchunks)]
+
+        for i in range(nchunks):
+            self.set_nrays(min(chunk_size, nrays - i * chunk_size))
+            self.set_seed(chunk_seeds[i])
+            try:
+                beam = self.get_beam(**params)
+            finally:
+                self.set_nrays(nrays)
+                self.set_seed(seed)
+            beam.rays[:, 11] += i * chunk_size
+            yield beam
@@ -1,6 +1,15 @@
 """
 Defines the a LightSource with a beam defined in a HDF5 file.
+
+The beam is read when it is first needed, in chunks of rays (only the selected rays of every chunk are kept, so
+the full file is never loaded in memory). The rays can be selected with:
+    * an interval of ray indices (e.g. one slice of the file per worker process),
+    * only the good rays (flag > 0),
+    * a reproducible random subset of a given number of rays (with a seed).
 """
+import numpy
+import h5py
+
 from syned.storage_ring.empty_light_source import EmptyLightSource
 from shadow4.beam.s4_beam import S4Beam
 
@@ -18,13 +27,38 @@ class S4LightSourceFromFile(EmptyLightSource):
         A name or key to define the simulation within the H5 file.
     beam_name : str, optional
         A name or key to define the name of the beam with the simulation.
+    index_start : int, optional
+        The index (starting from 0) of the first ray of the file to be read.
+    index_end : int or None, optional
+        The index of the ray after the last one to be read (None for the end of the file).
+    good_rays_only : int, optional
+        Flag to read all rays (0) or only the good rays (1).
+    nrays : int, optional
+        If > 0, read only a random subset of nrays rays (of the rays selected by the other options).
+    seed : int, optional
+        The seed for the random subset (0 for a different subset every time).
+    chunk_size : int, optional
+        The number of rays of the file read at once.
+    read_only : int, optional
+        If 1, the rays stored in the class are read-only, and get_beam(copy=0) returns a new S4Beam sharing them
+        (so many get_beam() calls do not duplicate the rays and cannot modify them).
 
     """
-    def __init__(self, name="Undefined", file_name="", simulation_name='run001', beam_name='begin'):
+    def __init__(self, name="Undefined", file_name="", simulation_name='run001', beam_name='begin',
+                 index_start=0, index_end=None, good_rays_only=0, nrays=0, seed=0, chunk_size=1000000,
+                 read_only=0):
         super().__init__(name=name)
         self._file_name = file_name
         self._simulation_name = simulation_name
         self._beam_name = beam_name
+        self._index_start = index_start
+        self._index_end = index_end
+        self._good_rays_only = good_rays_only
+        self._nrays = nrays
+        self._seed = seed
+        self._chunk_size = chunk_size
+        self._read_only = read_only
+        self._beam = None # loaded when needed
 
         # support text containg name of variable, help text and unit. Will be stored in self._support_dictionary
         self._set_support_text([
@@ -32,20 +66,35 @@ class S4LightSourceFromFile(EmptyLightSource):
             ("file_name","HDF5 file name",""),
             ("simulation_name","name of simulation",""),
             ("beam_name", "name of the beam in a simulation", ""),
+            ("index_start", "index of the first ray to be read", ""),
+            ("index_end", "index of the ray after the last one to be read (None: end of file)", ""),
+            ("good_rays_only", "read only good rays (1) or all rays (0)", ""),
+            ("nrays", "number of rays of a random subset (0: all rays)", ""),
+            ("seed", "seed for the random subset", ""),
+            ("chunk_size", "number of rays read at once", ""),
+            ("read_only", "share the stored rays as read-only (1)", ""),
             ] )
 
-        ierr = self._load()
-        if ierr == 1: print("Error loading data in: %s::/%s/%s/" % (self._file_name, self._simulation_name, self._beam_name))
-
-
     def _load(self):
         try:
-            self._beam = S4Beam.load_h5(self._file_name, simulation_name=self._simulation_name, beam_name=self._beam_name)
+            self._beam = self.__create_beam(self.__read_rays())
+            if self._read_only: self._beam.rays.flags.writeable = False
             return 0
         except:
             self._beam = None
             return 1
 
+    def get_number_of_rays_in_file(self):
+        """
+        Returns the number of rays in the file (without reading them).
+
+        Returns
+        -------
+        int
+        """
+        with h5py.File(self._file_name, 'r') as f:
+            return self.__get_columns(f)[0].shape[0]
+
     def get_beam(self, copy=0):
         """
         Retirns the S4 beam.
@@ -53,7 +102,8 @@ class S4LightSourceFromFile(EmptyLightSource):
         Parameters
         ----------
         copy : int
-            Returns the beam stored in the class (0) or a copy of it (1).
+            Returns the beam stored in the class (0) or a copy of it (1). If read_only=1, for copy=0 a new S4Beam
+            sharing the stored (read-only) rays is returned.
 
         Returns
         -------
@@ -61,11 +111,36 @@ class S4LightSourceFromFile(EmptyLightSource):
             The S4 beam.
 
         """
-        if copy:
+        if self._beam is None:
+            ierr = self._load()
+            if ierr == 1: print("Error loading data in: %s::/%s/%s/" % (self._file_name, self._simulation_name, self._beam_name))
+
+        if self._beam is None:
+            return None
+        elif copy:
             return self._beam.duplicate()
+        elif self._read_only:
+            return self.__create_beam(self._beam.rays)
         else:
             return self._beam
 
+    def get_beam_chunks(self, chunk_size=None):
+        """
+        Generator of the selected rays of the file in chunks (read from the file when needed, not stored in the class).
+
+        Parameters
+        ----------
+        chunk_size : int, optional
+            The number of rays of the file read for every chunk (None to use the chunk_size of the class). The chunks
+            may have less rays if only the good rays or a random subset are selected.
+
+        Yields
+        ------
+        instance of S4Beam
+        """
+        for rays in self.__iterate_chunks(chunk_size=chunk_size):
+            yield self.__create_beam(rays)
+
     def to_python_code(self, **kwargs):
         """
         Returns the python code for calculating the geometrical source.
@@ -78,8 +153,14 @@ class S4LightSourceFromFile(EmptyLightSource):
         txt = ""
         txt += "\n#\n#\n#"
         txt += "\nfrom shadow4.sources.s4_light_source_from_file import S4LightSourceFromFile"
-        txt += "\nlight_source = S4LightSourceFromFile(name='%s', file_name='%s', simulation_name='%s', beam_name='%s')" % \
+        txt += "\nlight_source = S4LightSourceFromFile(name='%s', file_name='%s', simulation_name='%s', beam_name='%s'" % \
                (self.get_name(), self._file_name, self._simulation_name, self._beam_name)
+        if self._index_start != 0 or self._index_end is not None:
+            txt += ", index_start=%d, index_end=%s" % (self._index_start, repr(self._index_end))
+        if self._good_rays_only: txt += ", good_rays_only=1"
+        if self._nrays > 0: txt += ", nrays=%d, seed=%d" % (self._nrays, self._seed)
+        if self._read_only: txt += ", read_only=1"
+        txt += ")"
         txt += "\nbeam = light_source.get_beam()"
         return txt
 
@@ -102,11 +183,75 @@ class S4LightSourceFromFile(EmptyLightSource):
         -------
         str
         """
-        if self._beam is None:
+        beam = self.get_beam()
+        if beam is None:
             return "\n\nEmpty beam.\n\n"
         else:
             return "\n\nBeam from %s::/%s/%s/ with %d rays" % \
-                   (self._file_name, self._simulation_name, self._beam_name, self.get_beam().N)
+                   (self._file_name, self._simulation_name, self._beam_name, beam.N)
+
+    #
+    # auxiliar methods
+    #
+    @classmethod
+    def __create_beam(cls, rays):
+        # S4Beam with the given array (S4Beam(array=...) would copy it)
+        beam = S4Beam(N=0)
+        beam.rays = rays
+        return beam
+
+    def __get_columns(self, f):
+        group = f["%s/%s" % (self._simulation_name, self._beam_name)]
+        return [group[column_name] for column_name in S4Beam.column_short_names_with_column_number()[0:18]]
+
+    def __read_rays(self):
+        # all the selected rays in an array (n,18), filled chunk by chunk
+        return next(self.__iterate_chunks(load_all=True))
+
+    def __iterate_chunks(self, chunk_size=None, load_all=False):
+        # yields the selected rays (arrays (n,18)) reading the file in chunks of rays, or (load_all) only one array
+        # with all of them (allocated once)
+        if chunk_size is None: chunk_size = self._chunk_size
+        with h5py.File(self._file_name, 'r') as f:
+            columns = self.__get_columns(f)
+            n = columns[0].shape[0]
+            start = min(max(self._index_start, 0), n)
+            end = n if self._index_end is None else min(max(self._index_end, start), n)
+
+            indices = self.__get_selected_indices(columns, start, end, chunk_size)
+
+            if load_all: out = numpy.empty((end - start if indices is None else indices.size, 18))
+            i_out = 0
+            for i0 in range(start, end, chunk_size):
+                i1 = min(i0 + chunk_size, end)
+                if indices is None:
+                    local = None
+                else:
+                    local = indices[numpy.searchsorted(indices, i0):numpy.searchsorted(indices, i1)] - i0
+                    if local.size == 0: continue
+                n_chunk = i1 - i0 if local is None else local.size
+                rays = out[i_out:(i_out + n_chunk)] if load_all else numpy.empty((n_chunk, 18))
+                for i, column in enumerate(columns):
+                    rays[:, i] = column[i0:i1] if local is None else column[i0:i1][local]
+                i_out += n_chunk
+                if not load_all: yield rays
+
+            if load_all: yield out
+
+    def __get_selected_indices(self, columns, start, end, chunk_size):
+        # sorted indices of the selected rays in the file (None: all the rays in [start, end))
+        indices = None
+        if self._good_rays_only: # only the flag column is read
+            indices = numpy.concatenate([numpy.nonzero(columns[9][i0:min(i0 + chunk_size, end)] > 0)[0] + i0
+                                         for i0 in range(start, end, chunk_size)] + [numpy.zeros(0, dtype=int)])
+
+        if self._nrays > 0:
+            rng = numpy.random.default_rng(None if self._seed == 0 else self._seed)
+            if indices is None and self._nrays < end - start:
+                indices = numpy.sort(rng.choice(end - start, size=self._nrays, replace=False)) + start
+            elif indices is not None and self._nrays < indices.size:
+                indices = numpy.sort(rng.choice(indices, size=self._nrays, replace=False))
+        return indices
 
 if __name__ == "__main__":
     a = S4LightSourceFromFile(file_name="/nobackup/gurb1/srio/Oasys/tmp4.h5")
@@ -114,3 +259,27 @@ if __name__ == "__main__":
     print(a.info())
     print('beam: ', a.get_beam())
     print('script: ', a.to_python_code())
+
+    #
+    # partial and subsampled loading of a large file
+    #
+    import os
+    import time
+    import tempfile
+    from shadow4.sources.source_geometrical.source_geometrical import SourceGeometrical
+
+    file_name = os.path.join(tempfile.gettempdir(), "s4_light_source_from_file_test.h5")
+    beam = SourceGeometrical(nrays=2000000, seed=1).get_beam()
+    beam.rays[::3, 9] = -1 # some lost rays
+    beam.write_h5(file_name)
+
+    for kwargs in [{}, {"index_start": 500000, "index_end": 1000000}, {"good_rays_only": 1},
+                   {"nrays": 100000, "seed": 5}, {"good_rays_only": 1, "nrays": 100000, "seed": 5}]:
+        t0 = time.time()
+        light_source = S4LightSourceFromFile(file_name=file_name, chunk_size=250000, read_only=1, **kwargs)
+        b = light_source.get_beam()
+        print("%-45s %8d rays (%8d good) in %.3f s, shared: %s" % (kwargs, b.N, b.get_number_of_rays(nolost=1),
+              time.time() - t0, numpy.shares_memory(b.rays, light_source.get_beam().rays)))
+
+    print("chunks: ", [chunk.N for chunk in S4LightSourceFromFile(file_name=file_name).get_beam_chunks(600000)])
+    os.remove(file_name)
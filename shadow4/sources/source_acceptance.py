@@ -0,0 +1,223 @@
+"""
+Acceptance window for the importance sampling of the light sources.
+
+Most of the rays emitted by a source with a large divergence (bending magnet, wiggler, geometrical source) are lost
+in the first aperture of the beamline. If the angular window accepted downstream is known, the source can sample
+the emission angles only inside the window. The probability of the omitted emission is included as a statistical
+weight w (in [0,1]) of every ray, by scaling its electric fields by sqrt(w), so the intensity (|Es|^2 + |Ep|^2)
+summed over the rays (flux, power, histograms weighted with intensity) is the same (in average) as when sampling
+the full emission and stopping the rays outside the window. All the rays reach the aperture, therefore a given
+statistical accuracy is obtained with far less rays for narrow apertures.
+
+The window applies to the emission angles sampled by the source (small angle approximation: angles, direction
+cosines and slopes are not distinguished). For the synchrotron sources these are the angles before adding the
+electron beam divergence (and the horizontal emission cone of the bending magnet), and the source size is not
+considered: a margin must be added to the window to accept the rays scattered into the aperture by these terms.
+
+Usage:
+    acceptance = SourceAcceptance(h_min=-50e-6, h_max=50e-6)                          # explicit window in rad
+    acceptance = SourceAcceptance.initialize_from_screen_element(slit, margin_h=20e-6) # window of a slit
+    light_source.set_acceptance(acceptance)
+
+"""
+import numpy
+
+from syned.beamline.shape import Rectangle, Ellipse
+
+class SourceAcceptance(object):
+    """
+    Defines an angular window (rectangle in the horizontal and vertical angles) accepted downstream of a source.
+
+    Parameters
+    ----------
+    h_min : float or None, optional
+        The minimum horizontal angle in rad (None for no limit).
+    h_max : float or None, optional
+        The maximum horizontal angle in rad (None for no limit).
+    v_min : float or None, optional
+        The minimum vertical angle in rad (None for no limit).
+    v_max : float or None, optional
+        The maximum vertical angle in rad (None for no limit).
+    """
+    def __init__(self, h_min=None, h_max=None, v_min=None, v_max=None):
+        for a, b in ((h_min, h_max), (v_min, v_max)):
+            if a is not None and b is not None and a >= b:
+                raise Exception("Bad acceptance window: minimum (%g) >= maximum (%g)" % (a, b))
+        self._h_min = h_min
+        self._h_max = h_max
+        self._v_min = v_min
+        self._v_max = v_max
+
+    @classmethod
+    def initialize_from_screen_element(cls, screen_element, margin_h=0.0, margin_v=0.0):
+        """
+        Creates the acceptance window of the aperture of a screen (slit) placed downstream of the source.
+
+        The angular window is the aperture boundaries divided by the distance p from the source to the screen,
+        enlarged at each side by the given margins (e.g. source half size / p plus a few electron divergences).
+
+        Parameters
+        ----------
+        screen_element : instance of S4ScreenElement
+            The screen element (with an aperture with a Rectangle or Ellipse boundary).
+        margin_h : float, optional
+            The margin in rad added to both sides of the horizontal window.
+        margin_v : float, optional
+            The margin in rad added to both sides of the vertical window.
+
+        Returns
+        -------
+        instance of SourceAcceptance
+        """
+        p, _ = screen_element.get_coordinates().get_p_and_q()
+        oe = screen_element.get_optical_element()
+        shape = oe.get_boundary_shape()
+        if oe._i_stop: raise Exception("The acceptance window cannot be obtained from a beam stop.")
+        if not isinstance(shape, (Rectangle, Ellipse)):
+            raise Exception("The acceptance window needs an aperture with a Rectangle or Ellipse boundary.")
+        if p <= 0: raise Exception("The acceptance window needs a screen placed at a distance p > 0.")
+
+        x_min, x_max, z_min, z_max = shape.get_boundaries()
+        return SourceAcceptance(h_min=x_min / p - margin_h,
+                                h_max=x_max / p + margin_h,
+                                v_min=z_min / p - margin_v,
+                                v_max=z_max / p + margin_v)
+
+    def get_horizontal_interval(self):
+        """
+        Returns the horizontal window.
+
+        Returns
+        -------
+        tuple
+            (h_min, h_max) in rad (-inf or inf if not limited).
+        """
+        return (-numpy.inf if self._h_min is None else self._h_min), (numpy.inf if self._h_max is None else self._h_max)
+
+    def get_vertical_interval(self):
+        """
+        Returns the vertical window.
+
+        Returns
+        -------
+        tuple
+            (v_min, v_max) in rad (-inf or inf if not limited).
+        """
+        return (-numpy.inf if self._v_min is None else self._v_min), (numpy.inf if self._v_max is None else self._v_max)
+
+    def is_horizontal_limited(self):
+        """
+        Returns True if the horizontal angles are limited.
+
+        Returns
+        -------
+        boolean
+        """
+        return self._h_min is not None or self._h_max is not None
+
+    def is_vertical_limited(self):
+        """
+        Returns True if the vertical angles are limited.
+
+        Returns
+        -------
+        boolean
+        """
+        return self._v_min is not None or self._v_max is not None
+
+    def get_info(self):
+        """
+        Returns a text with the acceptance window.
+
+        Returns
+        -------
+        str
+        """
+        h_min, h_max = self.get_horizontal_interval()
+        v_min, v_max = self.get_vertical_interval()
+        txt = "Acceptance window (importance sampling, rays weighted via the electric fields):\n"
+        txt += "        Horizontal: [%g, %g] urad\n" % (1e6 * h_min, 1e6 * h_max)
+        txt += "        Vertical:   [%g, %g] urad\n" % (1e6 * v_min, 1e6 * v_max)
+        return txt
+
+    def to_python_code(self):
+        """
+        Returns the python code to create the acceptance window.
+
+        Returns
+        -------
+        str
+            The python code.
+        """
+        def _txt(value): return "None" if value is None else repr(float(value))
+        script = "\n# acceptance window"
+        script += "\nfrom shadow4.sources.source_acceptance import SourceAcceptance"
+        script += "\nacceptance = SourceAcceptance(h_min=%s, h_max=%s, v_min=%s, v_max=%s)" % \
+                  (_txt(self._h_min), _txt(self._h_max), _txt(self._v_min), _txt(self._v_max))
+        return script
+
+def get_interval_in_0_1(cdf_min, cdf_max):
+    """
+    Returns the interval of the uniform random numbers that are mapped inside the window by an inverse-cdf sampler.
+
+    Parameters
+    ----------
+    cdf_min : float or numpy array
+        The cdf at the lower limit of the window.
+    cdf_max : float or numpy array
+        The cdf at the upper limit of the window.
+
+    Returns
+    -------
+    tuple
+        (u_min, weight): the random numbers u in [0,1] are replaced by u_min + u * weight, weight is the probability
+        of the window.
+    """
+    u_min = numpy.clip(numpy.minimum(cdf_min, cdf_max), 0.0, 1.0)
+    u_max = numpy.clip(numpy.maximum(cdf_min, cdf_max), 0.0, 1.0)
+    return u_min, u_max - u_min
+
+def apply_ray_weights(rays, weights):
+    """
+    Includes the statistical weights of the rays in their intensity, by scaling the electric fields by sqrt(weights).
+
+    Parameters
+    ----------
+    rays : numpy array
+        The rays (npoints, 18), modified in place.
+    weights : float or numpy array
+        The weights in [0,1] (one value, or one per ray).
+
+    Returns
+    -------
+    numpy array
+        The rays.
+    """
+    weights = numpy.asarray(weights, dtype=float)
+    if weights.size > 0 and weights.max() <= 0: raise Exception("No emission inside the acceptance window.")
+    scale = numpy.sqrt(weights)
+    if scale.ndim > 0: scale = scale.reshape(-1, 1)
+    rays[:, 6:9]   *= scale
+    rays[:, 15:18] *= scale
+    return rays
+
+
+if __name__ == "__main__":
+    from syned.beamline.element_coordinates import ElementCoordinates
+    from shadow4.beamline.optical_elements.absorbers.s4_screen import S4Screen, S4ScreenElement
+    from shadow4.sources.source_geometrical.source_geometrical import SourceGeometrical
+
+    # a slit of 0.2 x 0.1 mm at 10 m of a source with 5 x 2 mrad divergence
+    slit = S4ScreenElement(optical_element=S4Screen(boundary_shape=Rectangle(-0.1e-3, 0.1e-3, -0.05e-3, 0.05e-3)),
+                           coordinates=ElementCoordinates(p=10.0, q=0.0))
+
+    for nrays, acceptance in [(1000000, None),
+                              (10000, SourceAcceptance.initialize_from_screen_element(slit, margin_h=2e-6, margin_v=2e-6))]:
+        light_source = SourceGeometrical(spatial_type="Rectangle", angular_distribution="Flat", nrays=nrays, seed=1,
+                                         acceptance=acceptance)
+        light_source.set_spatial_type_rectangle(width=20e-6, height=10e-6)
+        light_source.set_angular_distribution_flat(hdiv1=-2.5e-3, hdiv2=2.5e-3, vdiv1=-1e-3, vdiv2=1e-3)
+        slit.set_input_beam(light_source.get_beam())
+        beam, _ = slit.trace_beam()
+        print("nrays: %7d, acceptance window: %s, good rays after the slit: %5d, transmitted intensity: %f" %
+              (nrays, acceptance is not None, beam.get_number_of_rays(nolost=1), beam.intensity(nolost=1) / nrays))
@@ -1,9 +1,59 @@
 """
 Samplers for typical mathematical probability distributions (1D and 2D).
+
+The points are sampled from pseudo-random numbers (numpy.random), or from given uniform numbers in [0,1] (argument
+random_in_0_1), e.g. the quasi-random (low discrepancy) sequences returned by sample_uniform_in_0_1(). In this case
+every coordinate is obtained from a single uniform number (the Gaussian by the inverse of its cdf).
 """
+import warnings
 import numpy
+from scipy.special import ndtri
+from scipy.stats import qmc
 from syned.syned_object import SynedObject
 
+def sampling_mode_list():
+    """
+    Returns the list of options for the sampling mode.
+
+    Returns
+    -------
+    list
+        ["Pseudo random", "Sobol", "Halton"]
+    """
+    return ["Pseudo random", "Sobol", "Halton"]
+
+def sample_uniform_in_0_1(N, dimension=1, sampling_mode="Pseudo random", seed=None):
+    """
+    Returns points uniformly distributed in the unit hypercube [0,1)^dimension.
+
+    Parameters
+    ----------
+    N : int
+        The number of points.
+    dimension : int, optional
+        The dimension (number of coordinates of every point).
+    sampling_mode : str, optional
+        "Pseudo random" (numpy.random), "Sobol" or "Halton" (scrambled quasi-random sequences of scipy.stats.qmc,
+        the Sobol sequence has better properties if N is a power of 2).
+    seed : int, optional
+        The seed for the scrambling of the quasi-random sequences (None for a random scrambling).
+
+    Returns
+    -------
+    numpy array
+        The points with shape (dimension, N).
+    """
+    if sampling_mode == "Pseudo random":
+        return numpy.random.random((dimension, N))
+    elif sampling_mode == "Sobol":
+        with warnings.catch_warnings(): # the warning on the balance properties if N is not a power of 2
+            warnings.simplefilter("ignore", UserWarning)
+            return qmc.Sobol(d=dimension, scramble=True, seed=seed).random(N).T.copy()
+    elif sampling_mode == "Halton":
+        return qmc.Halton(d=dimension, scramble=True, seed=seed).random(N).T.copy()
+    else:
+        raise Exception("Wrong sampling mode: %s" % sampling_mode)
+
 class DistributionGeneric(SynedObject):
     """
     Base class for a mathematical distribution.
@@ -103,7 +153,7 @@ class Point2D(Distribution2D):
                     ("v_center"         , "v (center) ", "" ),
             ] )
 
-    def get_sampled_points(self,N):
+    def get_sampled_points(self, N, random_in_0_1=None):
         """
         Returns the sampled points.
 
@@ -115,6 +165,8 @@ class Point2D(Distribution2D):
         ----------
         N : int
             The number of points to be sampled.
+        random_in_0_1 : numpy array, optional
+            Not used.
 
         Returns
         -------
@@ -152,7 +204,7 @@ class Rectangle2D(Distribution2D):
                     ("v_max"         , "v (length) maximum (signed)  ", "" ),
             ] )
 
-    def get_sampled_points(self, N):
+    def get_sampled_points(self, N, random_in_0_1=None):
         """
         Returns the sampled points.
 
@@ -160,16 +212,20 @@ class Rectangle2D(Distribution2D):
         ----------
         N : int
             The number of points to be sampled.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (2, N). If None, pseudo-random numbers are used.
 
         Returns
         -------
         tuple
             (H,V) The arrays for the H and V.
         """
-        return Uniform1D.sample(N, self._h_min, self._h_max), Uniform1D.sample(N, self._v_min, self._v_max)
+        if random_in_0_1 is None: random_in_0_1 = (None, None)
+        return Uniform1D.sample(N, self._h_min, self._h_max, random_in_0_1=random_in_0_1[0]), \
+               Uniform1D.sample(N, self._v_min, self._v_max, random_in_0_1=random_in_0_1[1])
 
     @classmethod
-    def sample(cls, N, h_min, h_max, v_min, v_max):
+    def sample(cls, N, h_min, h_max, v_min, v_max, random_in_0_1=None):
         """
         Returns sampled points for a 2D rectangular distribution.
 
@@ -185,13 +241,15 @@ class Rectangle2D(Distribution2D):
             The minimum coordinate of the rectangle in the vertical direction
         v_max : float
             The maximum coordinate of the rectangle in the vertical direction
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (2, N). If None, pseudo-random numbers are used.
 
         Returns
         -------
         tuple
             (H,V) The arrays for the H and V.
         """
-        return Rectangle2D(h_min, h_max, v_min, v_max).get_sampled_points(N)
+        return Rectangle2D(h_min, h_max, v_min, v_max).get_sampled_points(N, random_in_0_1=random_in_0_1)
 
 
 class Ellipse2D(Distribution2D):
@@ -225,7 +283,7 @@ class Ellipse2D(Distribution2D):
         # return ["Point","Rectangle","Ellipse","Gaussian"]
         # return ["Flat","Uniform","Gaussian","Cone"]
 
-    def get_sampled_points(self, N):
+    def get_sampled_points(self, N, random_in_0_1=None):
         """
         Returns the sampled points.
 
@@ -233,6 +291,8 @@ class Ellipse2D(Distribution2D):
         ----------
         N : int
             The number of points to be sampled.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (2, N). If None, pseudo-random numbers are used.
 
         Returns
         -------
@@ -241,14 +301,18 @@ class Ellipse2D(Distribution2D):
         """
         # ! C Elliptical source **
         # ! C Uses a transformation algorithm to generate a uniform variate distribution
-        phi = numpy.pi * 2 * numpy.random.random(N)
-        radius = numpy.sqrt(numpy.random.random(N))
+        if random_in_0_1 is None:
+            phi = numpy.pi * 2 * numpy.random.random(N)
+            radius = numpy.sqrt(numpy.random.random(N))
+        else:
+            phi = numpy.pi * 2 * random_in_0_1[0]
+            radius = numpy.sqrt(random_in_0_1[1])
         x = 0.5 *(self._h_max+self._h_min) + 0.5 * (self._h_max-self._h_min) * radius * numpy.cos(phi)
         y = 0.5 *(self._v_max+self._v_min) + 0.5 * (self._v_max-self._v_min) * radius * numpy.sin(phi)
         return x,y
 
     @classmethod
-    def sample(cls, N, h_min, h_max, v_min, v_max):
+    def sample(cls, N, h_min, h_max, v_min, v_max, random_in_0_1=None):
         """
         Returns sampled points for a 2D ellipse distribution.
 
@@ -264,13 +328,15 @@ class Ellipse2D(Distribution2D):
             The minimum coordinate of the ellipse in the vertical direction
         v_max : float
             The maximum coordinate of the ellipse in the vertical direction
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (2, N). If None, pseudo-random numbers are used.
 
         Returns
         -------
         tuple
             (H,V) The arrays for the H and V.
         """
-        return Ellipse2D(h_min,h_max,v_min,v_max).get_sampled_points(N)
+        return Ellipse2D(h_min,h_max,v_min,v_max).get_sampled_points(N, random_in_0_1=random_in_0_1)
 
 class Gaussian2D(Distribution2D):
     """
@@ -293,7 +359,7 @@ class Gaussian2D(Distribution2D):
             ] )
 
 
-    def get_sampled_points(self, N):
+    def get_sampled_points(self, N, random_in_0_1=None):
         """
         Returns the sampled points.
 
@@ -301,16 +367,20 @@ class Gaussian2D(Distribution2D):
         ----------
         N : int
             The number of points to be sampled.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (2, N). If None, pseudo-random numbers are used.
 
         Returns
         -------
         tuple
             (H,V) The arrays for the H and V.
         """
-        return Gaussian1D.sample(N, self._sigma_h), Gaussian1D.sample(N, self._sigma_v)
+        if random_in_0_1 is None: random_in_0_1 = (None, None)
+        return Gaussian1D.sample(N, self._sigma_h, random_in_0_1=random_in_0_1[0]), \
+               Gaussian1D.sample(N, self._sigma_v, random_in_0_1=random_in_0_1[1])
 
     @classmethod
-    def sample(cls, N, sigma_h, sigma_v):
+    def sample(cls, N, sigma_h, sigma_v, random_in_0_1=None):
         """
         Returns sampled points for a 2D Gaussian distribution.
 
@@ -322,13 +392,15 @@ class Gaussian2D(Distribution2D):
             The Gaussian sigma in the horizontal direction.
         sigma_v : float
             The Gaussian sigma in the vertical direction.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (2, N). If None, pseudo-random numbers are used.
 
         Returns
         -------
         tuple
             (H,V) The arrays for the H and V.
         """
-        return Gaussian2D(sigma_h,sigma_v).get_sampled_points(N)
+        return Gaussian2D(sigma_h,sigma_v).get_sampled_points(N, random_in_0_1=random_in_0_1)
 
 
 #
@@ -391,7 +463,7 @@ class Uniform2D(Distribution2D):
                     ("v_max"         , "v (length) maximum (signed)  ", "" ),
             ] )
 
-    def get_sampled_points(self, N):
+    def get_sampled_points(self, N, random_in_0_1=None):
         """
         Returns the sampled points.
 
@@ -399,19 +471,22 @@ class Uniform2D(Distribution2D):
         ----------
         N : int
             The number of points to be sampled.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (2, N). If None, pseudo-random numbers are used.
 
         Returns
         -------
         tuple
             (H,V) The arrays for the H and V.
         """
+        if random_in_0_1 is None: random_in_0_1 = (numpy.random.random(N), numpy.random.random(N))
         # ! C   Uniform distribution ( Isotrope emitter )
         XMAX1 =   numpy.tan(self._h_min)
         XMAX2 =   numpy.tan(self._h_max)
         ZMAX1 =   numpy.tan(self._v_min)
         ZMAX2 =   numpy.tan(self._v_max)
-        XRAND = numpy.random.random(N) * (XMAX1 - XMAX2) + XMAX2
-        ZRAND = numpy.random.random(N) * (ZMAX1 - ZMAX2) + ZMAX2
+        XRAND = random_in_0_1[0] * (XMAX1 - XMAX2) + XMAX2
+        ZRAND = random_in_0_1[1] * (ZMAX1 - ZMAX2) + ZMAX2
         THETAR  = numpy.arctan(numpy.sqrt(XRAND**2 + ZRAND**2))
         PHIR = numpy.arctan2(ZRAND, XRAND)
         DIREC1  = numpy.cos(PHIR) * numpy.sin(THETAR)
@@ -419,7 +494,7 @@ class Uniform2D(Distribution2D):
         return DIREC1, DIREC3
 
     @classmethod
-    def sample(cls, N, h_min, h_max, v_min, v_max):
+    def sample(cls, N, h_min, h_max, v_min, v_max, random_in_0_1=None):
         """
         Returns sampled points for a 2D Uniform distribution.
 
@@ -435,13 +510,15 @@ class Uniform2D(Distribution2D):
             The minimum angular coordinate in the vertical direction.
         v_max : float
             The maximum angular coordinate in the vertical direction.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (2, N). If None, pseudo-random numbers are used.
 
         Returns
         -------
         tuple
             (H,V) The arrays for the H and V.
         """
-        return Uniform2D(h_min,h_max,v_min,v_max).get_sampled_points(N)
+        return Uniform2D(h_min,h_max,v_min,v_max).get_sampled_points(N, random_in_0_1=random_in_0_1)
 
 
 class Cone2D(Distribution2D):
@@ -464,7 +541,7 @@ class Cone2D(Distribution2D):
                     ("cone_min"         , "max angle for cone semiaperture  ", "" ),
             ] )
 
-    def get_sampled_points(self, N):
+    def get_sampled_points(self, N, random_in_0_1=None):
         """
         Returns the sampled points.
 
@@ -472,15 +549,18 @@ class Cone2D(Distribution2D):
         ----------
         N : int
             The number of points to be sampled.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (2, N). If None, pseudo-random numbers are used.
 
         Returns
         -------
         tuple
             (H,V) The arrays for the H and V.
         """
+        if random_in_0_1 is None: random_in_0_1 = (numpy.random.random(N), numpy.random.random(N))
         # ! C   Now generates a set of rays along a cone centered about the normal, plus a ray along the normal itself.
-        ANGLE = 2 * numpy.pi * numpy.random.random(N)
-        ANG_CONE = numpy.cos(self._cone_min) - numpy.random.random(N) * \
+        ANGLE = 2 * numpy.pi * random_in_0_1[0]
+        ANG_CONE = numpy.cos(self._cone_min) - random_in_0_1[1] * \
                                                (numpy.cos(self._cone_min)-numpy.cos(self._cone_max))
         ANG_CONE = numpy.arccos(ANG_CONE)
         DIREC1 = numpy.sin(ANG_CONE) * numpy.cos(ANGLE)
@@ -488,7 +568,7 @@ class Cone2D(Distribution2D):
         return DIREC1,DIREC3
 
     @classmethod
-    def sample(cls,N,cone_max=10e-6,cone_min=0.0):
+    def sample(cls,N,cone_max=10e-6,cone_min=0.0,random_in_0_1=None):
         def sample(cls, N, h_min, h_max, v_min, v_max):
             """
             Returns sampled points for a 2D Cone distribution.
@@ -507,7 +587,7 @@ class Cone2D(Distribution2D):
             tuple
                 (H,V) The arrays for the H and V.
             """
-        return Cone2D(cone_max=cone_max,cone_min=cone_min).get_sampled_points(N)
+        return Cone2D(cone_max=cone_max,cone_min=cone_min).get_sampled_points(N, random_in_0_1=random_in_0_1)
 
 
 #
@@ -533,7 +613,7 @@ class Uniform1D(Distribution1D):
                     ("x_max"         , "maximum (signed)", "" ),
             ] )
 
-    def get_sampled_points(self, N):
+    def get_sampled_points(self, N, random_in_0_1=None):
         """
         Returns the sampled points.
 
@@ -541,16 +621,19 @@ class Uniform1D(Distribution1D):
         ----------
         N : int
             The number of points to be sampled.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (N,). If None, pseudo-random numbers are used.
 
         Returns
         -------
         numpy array
             The arrays with the N sampled points.
         """
-        return numpy.random.random(N) * (self._x_max-self._x_min) + self._x_min
+        if random_in_0_1 is None: random_in_0_1 = numpy.random.random(N)
+        return random_in_0_1 * (self._x_max-self._x_min) + self._x_min
 
     @classmethod
-    def sample(cls, N=1000, x_min=-0.010, x_max=0.010):
+    def sample(cls, N=1000, x_min=-0.010, x_max=0.010, random_in_0_1=None):
         """
         Returns sampled points for a 1D Uniform distribution.
 
@@ -562,13 +645,15 @@ class Uniform1D(Distribution1D):
             The minimum coordinate.
         x_max : float, optional
             The maximum coordinate.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (N,). If None, pseudo-random numbers are used.
 
         Returns
         -------
         numpy array
             The arrays with the N sampled points.
         """
-        return Uniform1D(x_min=x_min, x_max=x_max).get_sampled_points(N)
+        return Uniform1D(x_min=x_min, x_max=x_max).get_sampled_points(N, random_in_0_1=random_in_0_1)
 
 class Gaussian1D(Distribution1D):
     """
@@ -591,7 +676,7 @@ class Gaussian1D(Distribution1D):
                     ("center"        , "center", "" ),
             ] )
 
-    def get_sampled_points(self, N):
+    def get_sampled_points(self, N, random_in_0_1=None):
         """
         Returns the sampled points.
 
@@ -599,16 +684,21 @@ class Gaussian1D(Distribution1D):
         ----------
         N : int
             The number of points to be sampled.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (N,), transformed with the inverse of the Gaussian cdf. If None,
+            pseudo-random normal numbers are used.
 
         Returns
         -------
         numpy array
             The arrays with the N sampled points.
         """
-        return numpy.random.normal(loc=self._center, scale=self._sigma, size=N)
+        if random_in_0_1 is None: return numpy.random.normal(loc=self._center, scale=self._sigma, size=N)
+        tiny = numpy.finfo(float).eps # avoid infinite values at 0 and 1
+        return self._center + self._sigma * ndtri(numpy.clip(random_in_0_1, tiny, 1.0 - tiny))
 
     @classmethod
-    def sample(cls, N=1000, sigma=0.25, center=0.0):
+    def sample(cls, N=1000, sigma=0.25, center=0.0, random_in_0_1=None):
         """
         Returns sampled points for a 1D Uniform distribution.
 
@@ -620,13 +710,15 @@ class Gaussian1D(Distribution1D):
             The sigma of the Gaussian.
         center : float, optional
             The center of the Gaussian.
+        random_in_0_1 : numpy array, optional
+            Uniform numbers in [0,1] with shape (N,). If None, pseudo-random normal numbers are used.
 
         Returns
         -------
         numpy array
             The arrays with the N sampled points.
         """
-        return Gaussian1D(sigma=sigma, center=center).get_sampled_points(N)
+        return Gaussian1D(sigma=sigma, center=center).get_sampled_points(N, random_in_0_1=random_in_0_1)
 
 if __name__=="__main__":
 
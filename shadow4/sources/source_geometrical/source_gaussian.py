@@ -12,6 +12,8 @@ import numpy
 from shadow4.beam.s4_beam import S4Beam
 from shadow4.sources.s4_light_source_base import S4LightSourceBase
 from shadow4.tools.arrayofvectors import vector_default_efields
+from shadow4.sources.source_geometrical.probability_distributions import Gaussian1D
+from shadow4.sources.source_geometrical.probability_distributions import sampling_mode_list, sample_uniform_in_0_1
 
 class SourceGaussian(S4LightSourceBase):
     """
@@ -38,7 +40,10 @@ class SourceGaussian(S4LightSourceBase):
     nrays : int, optional
         Number of rays generated using SourceGaussian.get_beam()
     seed : int, optional
-        Seed for the Monte Carlo generator.
+        Seed for the Monte Carlo generator (also used for the scrambling of the quasi-random sequences).
+    sampling_mode : str, optional
+        "Pseudo random" (numpy.random), "Sobol" or "Halton" (scrambled quasi-random sequences of scipy.stats.qmc,
+        the Gaussians are sampled with the inverse of the cdf).
     """
     def __init__(self,
                  name="Undefined",
@@ -51,6 +56,7 @@ class SourceGaussian(S4LightSourceBase):
                  sigmaZprime=1e-6,
                  real_space_center=None,
                  direction_space_center=None,
+                 sampling_mode="Pseudo random",
                  ):
         if real_space_center is None:
             real_space_center = [0.0, 0.0, 0.0]
@@ -66,6 +72,8 @@ class SourceGaussian(S4LightSourceBase):
         self._sigmaZprime = sigmaZprime
         self._real_space_center      = numpy.array(real_space_center)       # must be defined as numpy array to allow syned file i/o
         self._direction_space_center = numpy.array(direction_space_center)  # must be defined as numpy array to allow syned file i/o
+        if sampling_mode not in sampling_mode_list(): raise Exception("Wrong sampling mode: %s" % sampling_mode)
+        self._sampling_mode = sampling_mode
 
         if seed != 0:
             numpy.random.seed(seed)
@@ -79,6 +87,7 @@ class SourceGaussian(S4LightSourceBase):
             ("sigmaZprime","The divergence in Z direction in rad",""),
             ("real_space_center","The 3 coordinates of the center in real space",""),
             ("direction_space_center","The 2 coordinates of the center in divergence space (X,Z)",""),
+            ("sampling_mode",'options: "Pseudo random", "Sobol", "Halton"',""),
             ("name","A name",""),
             ("nrays"," Number of rays generated using SourceGaussian.get_beam(",""),
             ("seed","Seed for the Monte Carlo generator",""),
@@ -96,6 +105,7 @@ class SourceGaussian(S4LightSourceBase):
                                 sigmaZprime=1e-6,
                                 real_space_center=None,
                                 direction_space_center=None,
+                                sampling_mode="Pseudo random",
                                 ):
         """
         Creates a Gaussian source in 3D.
@@ -122,6 +132,8 @@ class SourceGaussian(S4LightSourceBase):
             Number of rays generated using SourceGaussian.get_beam()
         seed : int, optional
             Seed for the Monte Carlo generator.
+        sampling_mode : str, optional
+            "Pseudo random", "Sobol" or "Halton".
 
         Returns
         -------
@@ -138,6 +150,7 @@ class SourceGaussian(S4LightSourceBase):
                                 sigmaZprime            = sigmaZprime,
                                 real_space_center      = None,
                                 direction_space_center = None,
+                                sampling_mode          = sampling_mode,
                                 )
 
     @classmethod
@@ -265,47 +278,49 @@ class SourceGaussian(S4LightSourceBase):
         """
         return self._sigmaXprime, self._sigmaZprime
 
-    def _get_arrays_real_space(self):
+    def _get_arrays_real_space(self, random_in_0_1=(None, None, None)):
         if self._sigmaX > 0.0:
-            x = numpy.random.normal(self._real_space_center[0],self._sigmaX,self.get_number_of_points())
+            x = self.__sample_gaussian(self._real_space_center[0], self._sigmaX, random_in_0_1[0])
         else:
             x = numpy.zeros(self.get_number_of_points())
 
         if self._sigmaY > 0.0:
-            y = numpy.random.normal(self._real_space_center[1],self._sigmaY,self.get_number_of_points())
+            y = self.__sample_gaussian(self._real_space_center[1], self._sigmaY, random_in_0_1[1])
         else:
             y = numpy.zeros(self.get_number_of_points())
 
         if self._sigmaZ > 0.0:
-            z = numpy.random.normal(self._real_space_center[2],self._sigmaZ,self.get_number_of_points())
+            z = self.__sample_gaussian(self._real_space_center[2], self._sigmaZ, random_in_0_1[2])
         else:
             z = numpy.zeros(self.get_number_of_points())
         return x,y,z
 
-    def _get_arrays_direction_space(self):
+    def _get_arrays_direction_space(self, random_in_0_1=(None, None)):
         if self._sigmaXprime > 0:
-            x = numpy.random.normal(self._direction_space_center[0],self._sigmaXprime,self.get_number_of_points())
+            x = self.__sample_gaussian(self._direction_space_center[0], self._sigmaXprime, random_in_0_1[0])
         else:
             x = numpy.zeros(self.get_number_of_points())
 
         if self._sigmaZprime > 0:
-            z = numpy.random.normal(self._direction_space_center[1],self._sigmaZprime,self.get_number_of_points())
+            z = self.__sample_gaussian(self._direction_space_center[1], self._sigmaZprime, random_in_0_1[1])
         else:
             z = numpy.zeros(self.get_number_of_points())
         return x,z
 
+    def __sample_gaussian(self, center, sigma, random_in_0_1=None):
+        if random_in_0_1 is None: return numpy.random.normal(center, sigma, self.get_number_of_points())
+        return Gaussian1D.sample(self.get_number_of_points(), sigma=sigma, center=center, random_in_0_1=random_in_0_1)
 
-
-    def _get_volume_divergences(self):
+    def _get_volume_divergences(self, random_in_0_1=(None, None)):
         # Returns an array (3,npoints) with xp,yp,zp (first index 0,1,2, respectively) with the direction vectors
-        XP,ZP = self._get_arrays_direction_space()
+        XP,ZP = self._get_arrays_direction_space(random_in_0_1)
         YP = numpy.sqrt(1 - XP**2 - ZP**2 )
         tmp = numpy.vstack((XP.flatten(),YP.flatten(),ZP.flatten()))
         return tmp
 
-    def _get_volume_real_space(self):
+    def _get_volume_real_space(self, random_in_0_1=(None, None, None)):
         # Returns an array (3,npoints) with x,y,z (first index 0,1,2, respectively) with the spatial coordinates
-        X,Y,Z = self._get_arrays_real_space()
+        X,Y,Z = self._get_arrays_real_space(random_in_0_1)
         return numpy.vstack((X.flatten(),Y.flatten(),Z.flatten()))
 
     def _get_volume(self):
@@ -314,8 +329,15 @@ class SourceGaussian(S4LightSourceBase):
         if self.get_seed() != 0:
             numpy.random.seed(self.get_seed())
 
-        v1 = self._get_volume_real_space()
-        v2 = self._get_volume_divergences()
+        # uniform numbers for the quasi-random sampling modes, rows: x, y, z, x', z'
+        if self._sampling_mode == "Pseudo random":
+            rnd = [None] * 5
+        else:
+            rnd = sample_uniform_in_0_1(self.get_number_of_points(), 5, sampling_mode=self._sampling_mode,
+                                        seed=None if self.get_seed() == 0 else self.get_seed())
+
+        v1 = self._get_volume_real_space(rnd[0:3])
+        v2 = self._get_volume_divergences(rnd[3:5])
 
         V1x = v1[0,:].copy().flatten()
         V1y = v1[1,:].copy().flatten()
@@ -350,6 +372,8 @@ class SourceGaussian(S4LightSourceBase):
         txt += "   Direction space (divergences): \n"
         txt += "         Horizontal: sigmaXprime = %5.3f urad; FWHM X = %5.3f urad\n"%(1e6*self._sigmaXprime,1e6*f2dot35*self._sigmaXprime)
         txt += "         Vertical:   sigmaZprime = %5.3f urad; FWHM Z = %5.3f urad\n"%(1e6*self._sigmaZprime,1e6*f2dot35*self._sigmaZprime)
+        if self._sampling_mode != "Pseudo random":
+            txt += "   Sampling mode: %s\n" % self._sampling_mode
 
         return txt
 
@@ -3,14 +3,18 @@ Geometrical sources.
 """
 import numpy
 import scipy.constants as codata
+from scipy.special import ndtr
 
 from shadow4.beam.s4_beam import S4Beam
 
 from shadow4.sources.source_geometrical.probability_distributions import Rectangle2D, Ellipse2D, Gaussian2D
 from shadow4.sources.source_geometrical.probability_distributions import Flat2D, Uniform2D, Cone2D
+from shadow4.sources.source_geometrical.probability_distributions import Gaussian1D
+from shadow4.sources.source_geometrical.probability_distributions import sampling_mode_list, sample_uniform_in_0_1
 
-from srxraylib.util.inverse_method_sampler import Sampler1D
+from shadow4.tools.inverse_method_sampler import Sampler1D, SamplerDiscrete
 from shadow4.sources.s4_light_source_base import S4LightSourceBase
+from shadow4.sources.source_acceptance import get_interval_in_0_1, apply_ray_weights
 
 from shadow4.tools.arrayofvectors import vector_cross, vector_norm, vector_default_efields
 from shadow4.tools.logger import is_verbose, is_debug
@@ -34,7 +38,11 @@ class SourceGeometrical(S4LightSourceBase):
     nrays : int, optional
         The number of rays.
     seed : int, optional
-        The Monte Carlo seed.
+        The Monte Carlo seed (also used for the scrambling of the quasi-random sequences).
+    sampling_mode : str, optional
+        A keyword of "Pseudo random", "Sobol", "Halton" (see set_sampling_mode()).
+    acceptance : instance of SourceAcceptance, optional
+        The angular window accepted downstream (see set_acceptance()).
     """
     def __init__(self,
                     name="Undefined",
@@ -44,6 +52,8 @@ class SourceGeometrical(S4LightSourceBase):
                     depth_distribution="Off",
                     nrays=5000,
                     seed=1234567,
+                    sampling_mode="Pseudo random",
+                    acceptance=None,
                  ):
         super().__init__(name=name, nrays=nrays, seed=seed)
 
@@ -80,6 +90,8 @@ class SourceGeometrical(S4LightSourceBase):
         self.set_energy_distribution_by_name(energy_distribution) # see SourceGeometrical.energy_distribution_list()
         self.set_depth_distribution_by_name(depth_distribution)
         self.set_polarization(polarization_degree=1.0, phase_diff=0.0, coherent_beam=0)
+        self.set_sampling_mode(sampling_mode)
+        self.set_acceptance(acceptance)
 
         # support text containg name of variable, help text and unit. Will be stored in self._support_dictionary
         self._add_support_text([
@@ -87,6 +99,7 @@ class SourceGeometrical(S4LightSourceBase):
             ("angular_distribution", 'options: "Flat", "Uniform", "Gaussian", "Cone", "Collimated"',""),
             ("energy_distribution",  'options: "Single line", "Several lines", "Uniform", "Relative intensities", "Gaussian", "User defined"',""),
             ("depth_distribution",   'options: "Off", "Flat", "Uniform", "Gaussian", "Cone", "Collimated"',""),
+            ("sampling_mode",        'options: "Pseudo random", "Sobol", "Halton"',""),
             ("cone_max","for depth_distribution='Cone' maximum half-divergence",""),
             ("cone_min","for depth_distribution='Cone' minimum half-divergence",""),
             ("f_color ","1='Single line', 2='Several lines', 3='Uniform', 4='Relative intensities', 5='Gaussian', 6='User defined'",""),
@@ -606,6 +619,62 @@ class SourceGeometrical(S4LightSourceBase):
         """
         self.set_depth_distribution(2, value)
 
+    #
+    # sampling mode
+    #
+    @classmethod
+    def sampling_mode_list(cls):
+        """
+        Returns the list of options for the sampling mode.
+
+        Returns
+        -------
+        list
+            ["Pseudo random", "Sobol", "Halton"]
+        """
+        return sampling_mode_list()
+
+    def set_sampling_mode(self, sampling_mode="Pseudo random"):
+        """
+        Sets the sampling mode: the rays are sampled from pseudo-random numbers or from scrambled quasi-random
+        (low discrepancy) sequences, that converge faster (e.g. the rms sizes of the beam) with the number of rays.
+
+        Parameters
+        ----------
+        sampling_mode : str, optional
+            "Pseudo random" (numpy.random), "Sobol" or "Halton" (scipy.stats.qmc, scrambled using the seed). The
+            Sobol sequence has better properties if the number of rays is a power of 2.
+        """
+        if sampling_mode not in sampling_mode_list(): raise Exception("Wrong sampling mode: %s" % sampling_mode)
+        self._sampling_mode = sampling_mode
+
+    #
+    # acceptance window
+    #
+    def set_acceptance(self, acceptance=None):
+        """
+        Sets the angular window accepted downstream (importance sampling). The angles are sampled only inside the
+        window, and the probability of the angular distribution inside the window is included as a weight of the rays
+        (the electric fields are scaled by its square root). Implemented for the "Flat", "Uniform", "Gaussian" and
+        "Collimated" angular distributions.
+
+        Parameters
+        ----------
+        acceptance : instance of SourceAcceptance, optional
+            The window (None to sample the full angular distribution).
+        """
+        self._acceptance = acceptance
+
+    def get_acceptance(self):
+        """
+        Returns the angular window accepted downstream.
+
+        Returns
+        -------
+        None or instance of SourceAcceptance
+        """
+        return self._acceptance
+
     #
     # info
     #
@@ -700,6 +769,12 @@ class SourceGeometrical(S4LightSourceBase):
         else:
             txt += "Source rays have COHERENT phase\n"
 
+        if self._sampling_mode != "Pseudo random":
+            txt += "Sampling mode: %s (quasi-random)\n" % self._sampling_mode
+
+        if self._acceptance is not None:
+            txt += self._acceptance.get_info()
+
         return txt
 
     #
@@ -744,6 +819,13 @@ class SourceGeometrical(S4LightSourceBase):
 
         rays = self._sample_rays_default(N)
 
+        # uniform numbers for the quasi-random sampling modes, rows: (x, z), y, (x', z'), energy, phase
+        if self._sampling_mode == "Pseudo random":
+            rnd = None
+        else:
+            rnd = sample_uniform_in_0_1(N, 7, sampling_mode=self._sampling_mode,
+                                        seed=None if self.get_seed() == 0 else self.get_seed())
+
         if is_verbose(): print("    Spatial type: %s"%(self._spatial_type))
 
         #
@@ -756,17 +838,20 @@ class SourceGeometrical(S4LightSourceBase):
                                     -0.5*self._wxsou,
                                     +0.5*self._wxsou,
                                     -0.5*self._wzsou,
-                                    +0.5*self._wzsou)
+                                    +0.5*self._wzsou,
+                                    random_in_0_1=rnd if rnd is None else rnd[0:2])
         elif self._spatial_type == "Ellipse":
             rays[:,0],rays[:,2] = Ellipse2D.sample(N,
                                     -0.5*self._wxsou,
                                     +0.5*self._wxsou,
                                     -0.5*self._wzsou,
-                                    +0.5*self._wzsou)
+                                    +0.5*self._wzsou,
+                                    random_in_0_1=rnd if rnd is None else rnd[0:2])
         elif self._spatial_type == "Gaussian":
             rays[:,0],rays[:,2] = Gaussian2D.sample(N,
                                     self._sigmax,
-                                    self._sigmaz)
+                                    self._sigmaz,
+                                    random_in_0_1=rnd if rnd is None else rnd[0:2])
         else:
             raise Exception("Bad value of spatial_type")
 
@@ -778,9 +863,9 @@ class SourceGeometrical(S4LightSourceBase):
         if self._depth_distribution == "Off":
             pass
         elif self._depth_distribution == "Uniform":
-            rays[:,1] = (numpy.random.rand(N) - 0.5) * self._wysou
+            rays[:,1] = ((numpy.random.rand(N) if rnd is None else rnd[2]) - 0.5) * self._wysou
         elif self._depth_distribution == "Gaussian":
-            rays[:,1] = numpy.random.normal(loc=0.0, scale=self._wysou, size=N)
+            rays[:,1] = Gaussian1D.sample(N, sigma=self._wysou, center=0.0, random_in_0_1=rnd if rnd is None else rnd[2])
         else:
             raise Exception("Bad value of depth_distribution")
 
@@ -790,29 +875,39 @@ class SourceGeometrical(S4LightSourceBase):
         #
         if is_verbose(): print("   Angular distribution: %s"%(self._angular_distribution))
 
+        # acceptance window: the uniform numbers of the angles are mapped inside the window
+        rnd_angular = rnd if rnd is None else rnd[3:5]
+        if self._acceptance is not None:
+            if rnd_angular is None: rnd_angular = numpy.random.random((2, N))
+            rnd_angular, weight = self.__get_acceptance_random_in_0_1(rnd_angular)
+
         if self._angular_distribution == "Flat":
             rays[:,3],rays[:,5] = Flat2D.sample(N,
                                     self._hdiv1,
                                     self._hdiv2,
                                     self._vdiv1,
-                                    self._vdiv2)
+                                    self._vdiv2,
+                                    random_in_0_1=rnd_angular)
             rays[:,4] = numpy.sqrt(-rays[:,3]**2 - rays[:,5]**2 + 1.0)
         elif self._angular_distribution == "Uniform":
             rays[:,3],rays[:,5] = Uniform2D.sample(N,
                                     self._hdiv1,
                                     self._hdiv2,
                                     self._vdiv1,
-                                    self._vdiv2)
+                                    self._vdiv2,
+                                    random_in_0_1=rnd_angular)
             rays[:,4] = numpy.sqrt(-rays[:,3]**2 - rays[:,5]**2 + 1.0)
         elif self._angular_distribution == "Gaussian":
             rays[:,3],rays[:,5] = Gaussian2D.sample(N,
                                     self._sigdix,
-                                    self._sigdiz)
+                                    self._sigdiz,
+                                    random_in_0_1=rnd_angular)
             rays[:,4] = numpy.sqrt(-rays[:,3]**2 - rays[:,5]**2 + 1.0)
         elif self._angular_distribution == "Cone":
             rays[:,3],rays[:,5] = Cone2D.sample(N,
                                     self._cone_max,
-                                    self._cone_min)
+                                    self._cone_min,
+                                    random_in_0_1=rnd_angular)
             rays[:,4] = numpy.sqrt(-rays[:,3]**2 - rays[:,5]**2 + 1.0)
         else:
             raise Exception("Bad value of angular_distribution")
@@ -832,58 +927,42 @@ class SourceGeometrical(S4LightSourceBase):
                 rays[:,10] = self._wavelength_to_wavenumber(self._ph[0] * 1e-10)
         elif self._energy_distribution == "Several lines":
             values = numpy.array(self._ph)
-            n_test =   (numpy.random.random(N) * values.size).astype(int)
+            n_test =   ((numpy.random.random(N) if rnd is None else rnd[5]) * values.size).astype(int)
             sampled_values = values[n_test]
             if self._f_phot == 0:
                 rays[:,10] = self._energy_to_wavenumber(sampled_values)
             else:
                 rays[:,10] = self._wavelength_to_wavenumber(sampled_values * 1e-10)
         elif self._energy_distribution == "Relative intensities":
-            values = numpy.array(self._ph)
-            relative_intensities = numpy.array(self._rl)
             # ! C Normalize so that each energy has a probability and so that the sum
             # ! C of the probabilities of all the energies is 1.
-            relative_intensities /= relative_intensities.sum()
             # ! C Arrange the probabilities so that they comprise the (0,1) interval,
             # ! C e.g. (energy1,0.3), (energy2, 0.1), (energy3, 0.6) is translated to
             # ! C 0.0, 0.3, 0.4, 1.0. Then a random number falling in an interval
             # ! C assigned to a certain energy results in the ray being assigned that
             # ! C photon energy.
-
-            TMP_B = 0
-            for i in range(relative_intensities.size):
-                TMP_B += relative_intensities[i]
-                relative_intensities[i] = TMP_B
-
-            sampled_values = numpy.zeros(N)
-            for i in range(N):
-                DPS_RAN3 = numpy.random.random()
-                if (DPS_RAN3 > 0. and DPS_RAN3 <= relative_intensities[0]):
-                    sampled_values[i] = values[0]
-
-                for j in range(1,values.size):
-                    if (DPS_RAN3 > relative_intensities[j-1] and DPS_RAN3 <= relative_intensities[j]):
-                        sampled_values[i] = values[j]
+            sampler = SamplerDiscrete(self._rl, values=numpy.array(self._ph, dtype=float))
+            sampled_values = sampler.get_sampled(numpy.random.random(N) if rnd is None else rnd[5])
 
             if self._f_phot == 0:
                 rays[:,10] = self._energy_to_wavenumber(sampled_values)
             else:
                 rays[:,10] = self._wavelength_to_wavenumber(sampled_values * 1e-10)
         elif self._energy_distribution == "Uniform":
-            sampled_values = self._ph[0] + (self._ph[1]-self._ph[0]) * numpy.random.rand(N)
+            sampled_values = self._ph[0] + (self._ph[1]-self._ph[0]) * (numpy.random.rand(N) if rnd is None else rnd[5])
             if self._f_phot == 0:
                 rays[:,10] = self._energy_to_wavenumber(sampled_values)
             else:
                 rays[:,10] = self._wavelength_to_wavenumber(sampled_values * 1e-10)
         elif self._energy_distribution == "Gaussian":
-            sampled_values = numpy.random.normal(loc=self._ph[0], scale=self._ph[1], size=N)
+            sampled_values = Gaussian1D.sample(N, sigma=self._ph[1], center=self._ph[0], random_in_0_1=rnd if rnd is None else rnd[5])
             if self._f_phot == 0:
                 rays[:,10] = self._energy_to_wavenumber(sampled_values)
             else:
                 rays[:,10] = self._wavelength_to_wavenumber(sampled_values * 1e-10)
         elif self._energy_distribution == "User defined":
             sampler = Sampler1D(self._ph_spectrum_ordinates,self._ph_spectrum_abscissas)
-            sampled_values = sampler.get_n_sampled_points(N)
+            sampled_values = sampler.get_n_sampled_points(N) if rnd is None else sampler.get_sampled(rnd[5])
 
             if self._f_phot == 0:
                 rays[:,10] = self._energy_to_wavenumber(sampled_values)
@@ -905,12 +984,13 @@ class SourceGeometrical(S4LightSourceBase):
 
         rays[:, 6:9] = A_VEC
         rays[:, 15:18] = AP_VEC
+        if self._acceptance is not None: apply_ray_weights(rays, weight)
 
         # ! C Now the phases of A_VEC and AP_VEC.
         if self._f_foher == 1:
             PHASEX = 0.0
         else:
-            PHASEX = numpy.random.random(N) * 2 * numpy.pi
+            PHASEX = (numpy.random.random(N) if rnd is None else rnd[6]) * 2 * numpy.pi
 
         PHASEZ = PHASEX + self._pol_angle
 
@@ -939,6 +1019,8 @@ class SourceGeometrical(S4LightSourceBase):
 
         txt += "\nlight_source = SourceGeometrical(name='%s', nrays=%d, seed=%d)" % \
                (self.get_name(), self.get_nrays(), self.get_seed())
+        if self._sampling_mode != "Pseudo random":
+            txt += "\nlight_source.set_sampling_mode('%s')" % self._sampling_mode
 
         # spatial type
         if self._fsour == 0:  # point
@@ -1017,6 +1099,10 @@ class SourceGeometrical(S4LightSourceBase):
         txt += "\nlight_source.set_polarization(polarization_degree=%f, phase_diff=%f, coherent_beam=%s)" % \
                (self._pol_deg, self._pol_angle, self._f_foher)
 
+        if self._acceptance is not None:
+            txt += self._acceptance.to_python_code()
+            txt += "\nlight_source.set_acceptance(acceptance)"
+
         txt += "\nbeam = light_source.get_beam()"
 
         return txt
@@ -1024,6 +1110,39 @@ class SourceGeometrical(S4LightSourceBase):
     #
     # internal methods
     #
+    def __get_acceptance_random_in_0_1(self, random_in_0_1):
+        # maps the uniform numbers (2,N) of the angles into the acceptance window (the cdf of the angular distribution
+        # at the window limits). Returns the new numbers and the weight (probability of the window).
+        windows = [self._acceptance.get_horizontal_interval(), self._acceptance.get_vertical_interval()]
+        out = numpy.zeros_like(random_in_0_1)
+        weight = 1.0
+        for i in range(2):
+            a, b = windows[i]
+            if self._angular_distribution == "Flat":
+                x_min, x_max = [(self._hdiv1, self._hdiv2), (self._vdiv1, self._vdiv2)][i]
+                cdf_a, cdf_b = self.__cdf_uniform(a, x_min, x_max), self.__cdf_uniform(b, x_min, x_max)
+            elif self._angular_distribution == "Uniform": # uniform in slopes, from tan(max) (u=0) to tan(min) (u=1)
+                x_min, x_max = numpy.tan([(self._hdiv1, self._hdiv2), (self._vdiv1, self._vdiv2)][i])
+                a, b = numpy.tan(numpy.clip([a, b], -0.5 * numpy.pi, 0.5 * numpy.pi))
+                cdf_a, cdf_b = 1 - self.__cdf_uniform(a, x_min, x_max), 1 - self.__cdf_uniform(b, x_min, x_max)
+            elif self._angular_distribution == "Gaussian":
+                sigma = [self._sigdix, self._sigdiz][i]
+                if sigma > 0: cdf_a, cdf_b = ndtr(a / sigma), ndtr(b / sigma)
+                else:         cdf_a, cdf_b = self.__cdf_uniform(a, 0.0, 0.0), self.__cdf_uniform(b, 0.0, 0.0)
+            else:
+                raise Exception("Acceptance window not implemented for angular distribution: %s" %
+                                self._angular_distribution)
+            u_min, w = get_interval_in_0_1(cdf_a, cdf_b)
+            out[i] = u_min + random_in_0_1[i] * w
+            weight *= w
+        if is_verbose(): print("    Acceptance window: weight of the rays: %g" % weight)
+        return out, weight
+
+    @classmethod
+    def __cdf_uniform(cls, x, x_min, x_max):
+        if x_max == x_min: return float(x >= x_min) # collimated
+        return float(numpy.clip((x - x_min) / (x_max - x_min), 0.0, 1.0))
+
     def _set_energy_distribution_unit(self, name='eV'):
         if name == 'eV':
             self._f_phot = 0
@@ -1082,3 +1201,23 @@ if __name__ == "__main__":
     for i in [7,8,9,16,17,18]:
         print(i, beam.get_column(i))
 
+
+    #
+    # convergence of the rms sizes with the number of rays for the different sampling modes
+    #
+    import time
+    for sampling_mode in SourceGeometrical.sampling_mode_list():
+        txt = "%15s: " % sampling_mode
+        for nrays in [2**10, 2**13, 2**16]:
+            errors = []
+            t0 = time.time()
+            for seed in range(1, 11):
+                a = SourceGeometrical(spatial_type="Gaussian", angular_distribution="Gaussian", nrays=nrays, seed=seed,
+                                      sampling_mode=sampling_mode)
+                a.set_spatial_type_gaussian(sigma_h=10e-6, sigma_v=5e-6)
+                a.set_angular_distribution_gaussian(sigdix=1e-6, sigdiz=2e-6)
+                beam = a.get_beam()
+                errors.append(beam.get_column(1).std() / 10e-6 - 1)
+            txt += "nrays=%6d rms error=%8.2e (%.3f s)  " % (nrays, numpy.sqrt(numpy.mean(numpy.array(errors) ** 2)),
+                                                            time.time() - t0)
+        print(txt)
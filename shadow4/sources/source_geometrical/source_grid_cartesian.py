@@ -296,11 +296,18 @@ class SourceGridCartesian(S4LightSourceBase):
         ZZ = numpy.outer(numpy.ones_like(X),z)
         return numpy.vstack((XX.flatten(),YY.flatten(),ZZ.flatten()))
 
-    def get_volume(self):
+    def get_volume(self, index_start=0, index_end=None):
         """
         Returns an array (6, npoints) with x,y,z,xp,yp,zp (first index 0,1,2,3,4,5 respectively) with the
         spatial and direction coordinates.
 
+        Parameters
+        ----------
+        index_start : int, optional
+            The index of the first grid point (to calculate only a part of the volume).
+        index_end : int or None, optional
+            The index of the grid point after the last one (None for all the points).
+
         Returns
         -------
         numpy array
@@ -309,6 +316,11 @@ class SourceGridCartesian(S4LightSourceBase):
         v1 = self.get_volume_real_space()
         v2 = self.get_volume_divergences()
 
+        if index_start != 0 or index_end is not None: # only the points index_start...index_end-1
+            if index_end is None: index_end = self.get_number_of_points()
+            i_real, i_direction = numpy.divmod(numpy.arange(index_start, index_end), v2.shape[1])
+            return numpy.vstack((v1[:, i_real], v2[:, i_direction]))
+
         v1x = v1[0,:].copy().flatten()
         v1y = v1[1,:].copy().flatten()
         v1z = v1[2,:].copy().flatten()
@@ -369,28 +381,58 @@ class SourceGridCartesian(S4LightSourceBase):
         -------
         instance of S4Beam
 
+        """
+        return S4Beam.initialize_from_array(self.__get_rays(0, self.get_number_of_points()))
+
+    def get_beam_chunks(self, chunk_size=100000, **params):
+        """
+        Generator of the beam in chunks of rays (to limit the memory used for large grids).
+
+        The grid points of every chunk are calculated when the chunk is created (the full volume is not stored).
+        The grid points are the same as in get_beam() and, if the same random state is used, the concatenation of
+        the chunks is identical to the beam returned by get_beam().
+
+        Parameters
+        ----------
+        chunk_size : int, optional
+            The maximum number of rays of every chunk.
+        **params
+            Not used (get_beam() has no parameters).
+
+        Yields
+        ------
+        instance of S4Beam
+            The beam with the rays of a chunk.
         """
         N = self.get_number_of_points()
+        for i0 in range(0, N, chunk_size):
+            yield S4Beam.initialize_from_array(self.__get_rays(i0, min(i0 + chunk_size, N)))
+
+    def __get_rays(self, index_start, index_end):
+        # the rays for the grid points index_start...index_end-1
+        N = index_end - index_start
+        volume = self.get_volume(index_start, index_end)
         rays = numpy.zeros((N, 18))
-        rays[:, 0] = self.get_volume()[0, :]
-        rays[:, 1] = self.get_volume()[1, :]
-        rays[:, 2] = self.get_volume()[2, :]
-        rays[:, 3] = self.get_volume()[3, :]
-        rays[:, 4] = self.get_volume()[4, :]
-        rays[:, 5] = self.get_volume()[5, :]
+        rays[:, 0] = volume[0, :]
+        rays[:, 1] = volume[1, :]
+        rays[:, 2] = volume[2, :]
+        rays[:, 3] = volume[3, :]
+        rays[:, 4] = volume[4, :]
+        rays[:, 5] = volume[5, :]
         rays[:,9] = 1   # flag
         rays[:,10] = 2 * numpy.pi / (self._wavelength * 1e2) # wavenumber in cm**-1
-        rays[:,11] = numpy.arange(self.get_number_of_points(),dtype=float) # index
+        rays[:,11] = numpy.arange(index_start, index_end, dtype=float) # index
+
         if not self._coherent_beam:
             rays[:, 13] = numpy.random.random(N) * 2 * numpy.pi # Phase s
         rays[:, 14] = rays[:, 13] + numpy.radians(self._polarization_phase_deg) # Phase p
 
-        DIREC = rays[:,3:6]
+        DIREC = rays[:, 3:6]
         A_VEC, AP_VEC = vector_default_efields(DIREC, pol_deg=self._polarization_degree)
         rays[:, 6:9] = A_VEC
         rays[:, 15:18] = AP_VEC
 
-        return S4Beam.initialize_from_array(rays)
+        return rays
 
     def to_python_code(self):
         """
@@ -218,29 +218,20 @@ class SourceGridPolar(S4LightSourceBase):
 
         return numpy.array([0]), numpy.array([0])
 
-    def _get_volume(self):
+    def _get_volume(self, index_start=0, index_end=None):
         # Returns an array (6,npoints) with x,y,z,xp,yp,zp (first index 0,1,2,3,4,5 respectively) with the
-        # spatial and direction coordinates
+        # spatial and direction coordinates of the points index_start...index_end-1 (None: all the points)
         X, Y, Z = self._get_arrays_real_space()
         VX, VZ = self._get_arrays_direction_space()
 
-        npoint = self.get_number_of_points()
-        V1x = numpy.zeros(npoint)
-        V1y = numpy.zeros(npoint)
-        V1z = numpy.zeros(npoint)
-        V2x = numpy.zeros(npoint)
-        V2z = numpy.zeros(npoint)
-        V2y = numpy.zeros(npoint)
-
-        ij = -1
-        for i in range(self.get_number_of_points_real_space()):
-            for j in range(self.get_number_of_points_direction_space()):
-                ij += 1
-                V1x[ij] = X[i]
-                V1y[ij] = Y[i]
-                V1z[ij] = Z[i]
-                V2x[ij] = VX[j]
-                V2z[ij] = VZ[j]
+        if index_end is None: index_end = self.get_number_of_points()
+        # the point ij corresponds to the real space point i and the direction j
+        i, j = numpy.divmod(numpy.arange(index_start, index_end), self.get_number_of_points_direction_space())
+        V1x = X[i]
+        V1y = Y[i]
+        V1z = Z[i]
+        V2x = VX[j]
+        V2z = VZ[j]
 
         V1x += self._real_space_center[0]
         V1y += self._real_space_center[1]
@@ -300,10 +291,37 @@ class SourceGridPolar(S4LightSourceBase):
         instance of S4Beam
 
         """
+        return S4Beam.initialize_from_array(self.__get_rays(0, self.get_number_of_points()))
 
+    def get_beam_chunks(self, chunk_size=100000, **params):
+        """
+        Generator of the beam in chunks of rays (to limit the memory used for large grids).
+
+        The grid points of every chunk are calculated when the chunk is created (the full volume is not stored).
+        The grid points are the same as in get_beam() and, if the same random state is used, the concatenation of
+        the chunks is identical to the beam returned by get_beam().
+
+        Parameters
+        ----------
+        chunk_size : int, optional
+            The maximum number of rays of every chunk.
+        **params
+            Not used (get_beam() has no parameters).
+
+        Yields
+        ------
+        instance of S4Beam
+            The beam with the rays of a chunk.
+        """
         N = self.get_number_of_points()
+        for i0 in range(0, N, chunk_size):
+            yield S4Beam.initialize_from_array(self.__get_rays(i0, min(i0 + chunk_size, N)))
+
+    def __get_rays(self, index_start, index_end):
+        # the rays for the grid points index_start...index_end-1
+        N = index_end - index_start
+        volume = self._get_volume(index_start, index_end)
         rays = numpy.zeros((N, 18))
-        volume = self._get_volume()
         rays[:, 0] = volume[0, :]
         rays[:, 1] = volume[1, :]
         rays[:, 2] = volume[2, :]
@@ -312,7 +330,7 @@ class SourceGridPolar(S4LightSourceBase):
         rays[:, 5] = volume[5, :]
         rays[:,9] = 1   # flag
         rays[:,10] = 2 * numpy.pi / (self._wavelength * 1e2) # wavenumber in cm**-1
-        rays[:,11] = numpy.arange(self.get_number_of_points(),dtype=float) # index
+        rays[:,11] = numpy.arange(index_start, index_end, dtype=float) # index
 
         if not self._coherent_beam:
             rays[:, 13] = numpy.random.random(N) * 2 * numpy.pi # Phase s
@@ -323,7 +341,7 @@ class SourceGridPolar(S4LightSourceBase):
         rays[:, 6:9] = A_VEC
         rays[:, 15:18] = AP_VEC
 
-        return S4Beam.initialize_from_array(rays)
+        return rays
 
     def to_python_code(self):
         """
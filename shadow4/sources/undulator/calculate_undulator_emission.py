@@ -94,7 +94,7 @@ def _pysru_energy_radiated_approximation_and_farfield(omega=2.53465927101e17, el
     integrand[2] -= ( n_chap[0]*A2 - n_chap[1]*A1) * Alpha2
 
     for k in range(3):
-        E[k] = np.trapz(integrand[k], trajectory_t)
+        E[k] = _trapezoid(integrand[k], trajectory_t)
     E *= omega * 1j
 
     terme_bord = np.full((3), 0. + 1j * 0., dtype=complex)
@@ -109,6 +109,173 @@ def _pysru_energy_radiated_approximation_and_farfield(omega=2.53465927101e17, el
     E *= c6**0.5
     return E
 
+# batched version of _pysru_energy_radiated_approximation_and_farfield() for arrays of points x, y.
+# flag_matmul=0: the operations are the same (and in the same order) as for a single point, so the results are
+# identical.
+# flag_matmul=1: the integrand -n x (n x v) exp(i omega (t + X/c - n.r)) is written as (|n|^2 v - n (n.v)) exp(...),
+# so the trapezoidal integrals of the three components are obtained with one matrix product of the phase factors
+# (points x trajectory) by the trajectory velocities multiplied by the trapezoidal weights. It is faster, but the
+# results differ from the ones for a single point by the rounding.
+# Returns the complex field with shape (3, x.size).
+def _pysru_energy_radiated_approximation_and_farfield_array(omega=2.53465927101e17, electron_current=1.0,
+                                                            trajectory=None, x=0.00 , y=0.0, D=None, flag_matmul=0):
+
+    if trajectory is None: trajectory=np.zeros((11,10))
+
+    c6 = codata.e * electron_current * 1e-9 / (8.0 * np.pi ** 2 * codata.epsilon_0 * codata.c * codata.h)
+
+    if D is not None:
+        c6 /= D**2
+
+    x = np.asarray(x, dtype=float).reshape((-1, 1))
+    y = np.asarray(y, dtype=float).reshape((-1, 1))
+
+    if D is None: # in radian
+        n_chap = [x, y, 1.0 - 0.5 * (x**2 + y**2)]
+        X = np.sqrt(x ** 2 + y ** 2 )
+    else :  #in meters
+        X = np.sqrt(x**2 + y**2 + D**2)
+        n_chap = [x / X, y / X, D / X]
+
+    trajectory_t   = trajectory[0]
+    trajectory_x   = trajectory[1]
+    trajectory_y   = trajectory[2]
+    trajectory_z   = trajectory[3]
+    trajectory_v_x = trajectory[4]
+    trajectory_v_y = trajectory[5]
+    trajectory_v_z = trajectory[6]
+
+    # phase factors (points x trajectory), the phase is large: same operations as for a single point
+    Alpha2 = np.exp(
+        0. + 1j * omega * (trajectory_t + X / codata.c - n_chap[0] * trajectory_x
+                                           - n_chap[1] * trajectory_y - n_chap[2] * trajectory_z))
+
+    if flag_matmul:
+        n_chap = np.array([n_chap[0][:, 0], n_chap[1][:, 0], n_chap[2][:, 0]])
+        trajectory_v = trajectory[4:7] # v_x, v_y, v_z
+
+        # trapezoidal weights: sum(w * f) = numpy.trapezoid(f, t)
+        d = np.diff(trajectory_t)
+        w = np.zeros_like(trajectory_t)
+        w[:-1] += 0.5 * d
+        w[1:]  += 0.5 * d
+
+        S = Alpha2 @ (trajectory_v * w).T.astype(complex) # integrals of v_k exp(...), shape (x.size, 3)
+        E = (n_chap ** 2).sum(axis=0) * S.T - n_chap * (n_chap * S.T).sum(axis=0)
+        E *= omega * 1j
+
+        v_0, v_1 = trajectory_v[:, 0], trajectory_v[:, -1]
+        Alpha_1 = 1.0 / (1.0 - v_1 @ n_chap)
+        Alpha_0 = 1.0 / (1.0 - v_0 @ n_chap)
+        # n_y A3 - n_z A2, with A = n x v, at the trajectory ends
+        border_1 = n_chap[1] * (n_chap[0] * v_1[1] - n_chap[1] * v_1[0]) - n_chap[2] * (n_chap[2] * v_1[0] - n_chap[0] * v_1[2])
+        border_0 = n_chap[1] * (n_chap[0] * v_0[1] - n_chap[1] * v_0[0]) - n_chap[2] * (n_chap[2] * v_0[0] - n_chap[0] * v_0[2])
+
+        terme_bord = border_1 * Alpha_1 * Alpha2[:, -1] - border_0 * Alpha_0 * Alpha2[:, 0]
+    else:
+        A1 = ( n_chap[1] * trajectory_v_z - n_chap[2] * trajectory_v_y)
+        A2 = (-n_chap[0] * trajectory_v_z + n_chap[2] * trajectory_v_x)
+        A3 = ( n_chap[0] * trajectory_v_y - n_chap[1] * trajectory_v_x)
+
+        # trapezoidal integration as in numpy.trapezoid, with the real factors explicitly converted to complex (the
+        # implicit conversion of broadcasted operands is much slower)
+        d = np.diff(trajectory_t).astype(complex)
+        E = np.zeros((3, x.size), dtype=complex)
+        for k, integrand_k in enumerate([( n_chap[1]*A3 - n_chap[2]*A2),
+                                         (-n_chap[0]*A3 + n_chap[2]*A1),
+                                         ( n_chap[0]*A2 - n_chap[1]*A1)]):
+            integrand = np.zeros(A1.shape, dtype=complex)
+            integrand -= integrand_k.astype(complex) * Alpha2
+            tmp = integrand[:, 1:] + integrand[:, :-1]
+            np.multiply(d, tmp, out=tmp)
+            tmp /= 2.0
+            E[k] = tmp.sum(axis=-1)
+        E *= omega * 1j
+
+        Alpha_1 = (1.0 / (1.0 - n_chap[0][:, 0] * trajectory_v_x[-1]
+                          - n_chap[1][:, 0] * trajectory_v_y[-1] - n_chap[2][:, 0] * trajectory_v_z[-1]))
+        Alpha_0 = (1.0 / (1.0 - n_chap[0][:, 0] * trajectory_v_x[0]
+                          - n_chap[1][:, 0] * trajectory_v_y[0] - n_chap[2][:, 0] * trajectory_v_z[0]))
+
+        terme_bord = np.full((x.size,), 0. + 1j * 0., dtype=complex)
+        terme_bord += ((n_chap[1][:, 0] * A3[:, -1] - n_chap[2][:, 0] * A2[:, -1]) * Alpha_1 * Alpha2[:, -1])
+        terme_bord -= ((n_chap[1][:, 0] * A3[:, 0]  - n_chap[2][:, 0] * A2[:, 0])  * Alpha_0 * Alpha2[:, 0])
+    E += terme_bord
+    E *= c6**0.5
+    return E
+
+def _trapezoid(y, x):
+    # numpy.trapz was renamed numpy.trapezoid in numpy 2.0 (and removed in 2.4)
+    try:
+        return np.trapezoid(y, x)
+    except AttributeError:
+        return np.trapz(y, x)
+
+# far field (sigma and pi complex amplitudes in SHADOW units, and polarization) at a given photon energy for a grid
+# of points (theta, phi), calculated in blocks of block_size points to limit the memory (default: about 64 MB for
+# the complex arrays of block_size x trajectory points).
+def _undul_phot_farfield(omega, photon_energy, electron_current, trajectory, theta, phi, distance=100.0,
+                         block_size=None, flag_matmul=0):
+    if block_size is None: # number of complex temporary arrays of block_size x trajectory points
+        block_size = max(1, (64 * 1024 ** 2) // (trajectory.shape[1] * 16 * (3 if flag_matmul else 8)))
+
+    R = distance / np.cos(theta)
+    r = R * np.sin(theta)
+    X = numpy.outer(r, np.cos(phi)).flatten()
+    Y = numpy.outer(r, np.sin(phi)).flatten()
+
+    Efield = np.zeros((3, X.size), dtype=complex)
+    for i in range(0, X.size, block_size):
+        Efield[:, i:i + block_size] = _pysru_energy_radiated_approximation_and_farfield_array(
+                                                                                omega=omega,
+                                                                                electron_current=electron_current,
+                                                                                trajectory=trajectory,
+                                                                                x=X[i:i + block_size],
+                                                                                y=Y[i:i + block_size],
+                                                                                D=distance,
+                                                                                flag_matmul=flag_matmul)
+
+    # Conversion from pySRU units (photons/mm^2/0.1%bw) to SHADOW units (photons/rad^2/eV)
+    coeff = (distance * 1e3) ** 2  # photons/mm^2 -> photons/rad^2
+    coeff /= 1e-3 * photon_energy  # photons/o.1%bw -> photons/eV
+
+    shape = (theta.size, phi.size)
+    efield_x = (Efield[0] * numpy.sqrt(coeff)).reshape(shape)
+    efield_y = (Efield[1] * numpy.sqrt(coeff)).reshape(shape)
+    pol_deg = (numpy.abs(Efield[0]) / (numpy.abs(Efield[0]) + numpy.abs(Efield[1]))).reshape(shape) # SHADOW definition
+    return efield_x, efield_y, pol_deg
+
+# far field for all photon energies, optionally distributed in a pool of nprocesses processes
+def _undul_phot_farfield_energies(omega_array, E, electron_current, trajectory, theta, phi, distance=100.0,
+                                  block_size=None, nprocesses=1, flag_matmul=0):
+    EFIELD_X = np.zeros((omega_array.size, theta.size, phi.size), dtype=complex)
+    EFIELD_Y = np.zeros_like(EFIELD_X)
+    POL_DEG = np.zeros((omega_array.size, theta.size, phi.size))
+
+    def store(o, result):
+        EFIELD_X[o], EFIELD_Y[o], POL_DEG[o] = result
+
+    if nprocesses == 1 or omega_array.size <= 1:
+        for o in range(omega_array.size):
+            print("   Calculating energy %8.3f eV (%d of %d)" % (E[o], o + 1, omega_array.size))
+            store(o, _undul_phot_farfield(omega_array[o], E[o], electron_current, trajectory, theta, phi,
+                                          distance=distance, block_size=block_size, flag_matmul=flag_matmul))
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        print("   Calculating %d energies in %s processes" % (omega_array.size, repr(nprocesses)))
+        with ProcessPoolExecutor(max_workers=nprocesses) as executor:
+            futures = {executor.submit(_undul_phot_farfield, omega_array[o], E[o], electron_current, trajectory,
+                                       theta, phi, distance, block_size, flag_matmul): o
+                       for o in range(omega_array.size)}
+            try:
+                for future in as_completed(futures):
+                    store(futures[future], future.result())
+            except BaseException: # e.g. KeyboardInterrupt: do not start the pending energies
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    return EFIELD_X, EFIELD_Y, POL_DEG
+
 
 def _get_radiation_interpolated_cartesian(radiation, photon_energy, thetabm, phi,
                                           npointsx=100, npointsz=100, thetamax=None,
@@ -189,6 +356,9 @@ def _undul_phot(E_ENERGY,INTENSITY, LAMBDAU, NPERIODS, K, EMIN, EMAX, NG_E, MAXA
                 flag_backprop_recalculate_source=0,
                 flag_backprop_weight=0,
                 weight_ratio=0.5,
+                block_size=None,
+                nprocesses=1,
+                flag_matmul=0,
                 ):
     #
     # calculate trajectory
@@ -286,29 +456,9 @@ def _undul_phot(E_ENERGY,INTENSITY, LAMBDAU, NPERIODS, K, EMIN, EMAX, NG_E, MAXA
 
             POL_DEG[ie, :, :] = numpy.abs(tmp_x) / (numpy.abs(tmp_x) + numpy.abs(tmp_y))  # SHADOW definition
     else:
-        for o in range(omega_array.size):
-            print("   Calculating energy %8.3f eV (%d of %d)"%(E[o],o+1,omega_array.size))
-            for t in range(theta.size):
-                for p in range(phi.size):
-                    R = distance / np.cos(theta[t])
-                    r = R * np.sin(theta[t])
-                    X = r * np.cos(phi[p])
-                    Y = r * np.sin(phi[p])
-                    Efield = _pysru_energy_radiated_approximation_and_farfield(omega=omega_array[o],
-                                                                                  electron_current=INTENSITY,
-                                                                                  trajectory=T,
-                                                                                  x=X ,
-                                                                                  y=Y,
-                                                                                  D=distance)
-
-                    # Conversion from pySRU units (photons/mm^2/0.1%bw) to SHADOW units (photons/rad^2/eV)
-                    coeff = (distance * 1e3) ** 2  # photons/mm^2 -> photons/rad^2
-                    coeff /= 1e-3 * E[o]  # photons/o.1%bw -> photons/eV
-
-                    EFIELD_X[o, t, p] = Efield[0] * numpy.sqrt(coeff)
-                    EFIELD_Y[o, t, p] = Efield[1] * numpy.sqrt(coeff)
-                    POL_DEG [o, t, p] = numpy.abs(Efield[0]) / (numpy.abs(Efield[0]) + numpy.abs(Efield[1]))  # SHADOW definition
-
+        EFIELD_X, EFIELD_Y, POL_DEG = _undul_phot_farfield_energies(omega_array, E, INTENSITY, T, theta, phi,
+                                                                    distance=distance, block_size=block_size,
+                                                                    nprocesses=nprocesses, flag_matmul=flag_matmul)
 
     print("Done calculating radiation... (%f s)" % (time.time() - t0))
 
@@ -404,26 +554,9 @@ def _undul_phot(E_ENERGY,INTENSITY, LAMBDAU, NPERIODS, K, EMIN, EMAX, NG_E, MAXA
                     tmp_x.shape = (theta.size, phi.size)
                     EFIELD_X[ie, :, :] = tmp_x
             else:
-                for o in range(omega_array.size):
-                    print("   Calculating energy %8.3f eV (%d of %d)" % (E[o], o + 1, omega_array.size))
-                    for t in range(theta.size):
-                        for p in range(phi.size):
-                            R = distance / np.cos(theta[t])
-                            r = R * np.sin(theta[t])
-                            X = r * np.cos(phi[p])
-                            Y = r * np.sin(phi[p])
-                            Efield = _pysru_energy_radiated_approximation_and_farfield(omega=omega_array[o],
-                                                                                       electron_current=INTENSITY,
-                                                                                       trajectory=T,
-                                                                                       x=X,
-                                                                                       y=Y,
-                                                                                       D=distance)
-
-                            # Conversion from pySRU units (photons/mm^2/0.1%bw) to SHADOW units (photons/rad^2/eV)
-                            coeff = (distance * 1e3) ** 2  # photons/mm^2 -> photons/rad^2
-                            coeff /= 1e-3 * E[o]  # photons/o.1%bw -> photons/eV
-
-                            EFIELD_X[o, t, p] = Efield[0] * numpy.sqrt(coeff)
+                EFIELD_X = _undul_phot_farfield_energies(omega_array, E, INTENSITY, T, theta, phi,
+                                                         distance=distance, block_size=block_size,
+                                                         nprocesses=nprocesses, flag_matmul=flag_matmul)[0]
 
             print("Done re-calculating radiation... (%f s)" % (time.time() - t0))
             ca = EFIELD_X
@@ -516,6 +649,9 @@ def calculate_undulator_emission(electron_energy                  = 6.0,
                                  flag_backprop_recalculate_source = 0,
                                  flag_backprop_weight             = 0,
                                  weight_ratio                     = 0.5,
+                                 block_size                       = None,
+                                 nprocesses                       = 1,
+                                 flag_matmul                      = 0,
                                  ):
     """
     Calculate undulator emission (far field) and backpropagation to the center of the undulator using internal code.
@@ -559,6 +695,15 @@ def calculate_undulator_emission(electron_energy                  = 6.0,
         for code_undul_phot in ["internal", "pysru"] and flag_size=2: apply Gaussian weight to backprop amplitudes.
     weight_ratio: float, optional
         for flag_backprop_weight=1: the Gaussian sigma in units of r.max().
+    block_size: int or None, optional
+        The number of (theta, phi) points calculated at once in the far field (None: automatic, about 64 MB
+        for the complex arrays of points x trajectory points).
+    nprocesses: int or None, optional
+        The number of processes to calculate the far field for the different photon energies (1: no
+        parallelization, None: the number of processors).
+    flag_matmul: int, optional
+        A flag to calculate the far field integrals with a matrix product: 0=No (the results are identical to the
+        ones calculated point by point), 1=Yes (faster, the results differ by the rounding).
 
     Returns
     -------
@@ -584,6 +729,9 @@ def calculate_undulator_emission(electron_energy                  = 6.0,
                        flag_backprop_recalculate_source=flag_backprop_recalculate_source,
                        flag_backprop_weight=flag_backprop_weight,
                        weight_ratio=weight_ratio,
+                       block_size=block_size,
+                       nprocesses=nprocesses,
+                       flag_matmul=flag_matmul,
                        )
 
 if __name__ == "__main__":
@@ -7,7 +7,7 @@ The radiation divergences (far field) are computed in polar coordinates for a mo
 """
 import numpy
 
-from srxraylib.util.inverse_method_sampler import Sampler1D, Sampler2D, Sampler3D
+from shadow4.tools.inverse_method_sampler import Sampler1D, Sampler2D, SamplerGrid
 import scipy.constants as codata
 from scipy import interpolate
 import scipy.constants as codata
@@ -16,6 +16,7 @@ from syned.storage_ring.magnetic_structures.undulator import Undulator
 from syned.storage_ring.light_source import LightSource
 
 from shadow4.sources.s4_electron_beam import S4ElectronBeam
+from shadow4.sources.electron_phase_space_sampler import sample_bivariate_normal
 from shadow4.beam.s4_beam import S4Beam
 from shadow4.sources.undulator.calculate_undulator_emission import calculate_undulator_emission # SourceUndulatorFactory
 from shadow4.sources.undulator.calculate_undulator_emission_srw import calculate_undulator_emission_srw # SourceUndulatorFactorySrw
@@ -23,6 +24,7 @@ from shadow4.sources.undulator.calculate_undulator_emission_pysru import calcula
 from shadow4.sources.undulator.s4_undulator import S4Undulator
 from shadow4.sources.s4_light_source import S4LightSource
 from shadow4.tools.arrayofvectors import vector_cross, vector_norm
+from shadow4.tools.disk_cache import RADIATION_CACHE
 
 from shadow4.sources.undulator.s4_undulator_gaussian_light_source import S4UndulatorGaussianLightSource # to get q_a and q_s
 
@@ -67,6 +69,7 @@ class S4UndulatorLightSource(S4LightSource):
         self.__result_photon_size_distribution = None
         self.__result_photon_size_sigma = None
         # self.__result_photon_size_farfield = None
+        self.__result_sampler = None # (energy spread correction, SamplerGrid) for the current radiation
 
 
 
@@ -426,7 +429,8 @@ class S4UndulatorLightSource(S4LightSource):
         Calculates the radiation (emission) as a function of theta (elevation angle) and phi (azimuthal angle)
         This radiation will be sampled to create the source
 
-        It calls calculate_undulator_emission*
+        It calls calculate_undulator_emission*, or reads the result from the disk cache
+        (shadow4.tools.disk_cache.RADIATION_CACHE) if it has been calculated before with the same parameters.
 
         Sets the results in self.__result_radiation dictionary.
         """
@@ -434,8 +438,10 @@ class S4UndulatorLightSource(S4LightSource):
         undulator = self.get_magnetic_structure()
 
         self.__result_radiation = None
+        self.__result_sampler = None
         if undulator.code_undul_phot == 'internal':
-            undul_phot_dict = calculate_undulator_emission(
+            calculator = calculate_undulator_emission
+            parameters = dict(
                 electron_energy                  = syned_electron_beam.energy(),
                 electron_current                 = syned_electron_beam.current(),
                 undulator_period                 = undulator.period_length(),
@@ -456,7 +462,8 @@ class S4UndulatorLightSource(S4LightSource):
                 weight_ratio                     = undulator._weight_ratio,
             )
         elif undulator.code_undul_phot == 'pysru' or  undulator.code_undul_phot == 'pySRU':
-            undul_phot_dict = calculate_undulator_emission_pysru(
+            calculator = calculate_undulator_emission_pysru
+            parameters = dict(
                 electron_energy                  = syned_electron_beam.energy(),
                 electron_current                 = syned_electron_beam.current(),
                 undulator_period                 = undulator.period_length(),
@@ -477,7 +484,8 @@ class S4UndulatorLightSource(S4LightSource):
                 weight_ratio                     = undulator._weight_ratio,
                 )
         elif undulator.code_undul_phot == 'srw' or  undulator.code_undul_phot == 'SRW':
-            undul_phot_dict = calculate_undulator_emission_srw(
+            calculator = calculate_undulator_emission_srw
+            parameters = dict(
                 electron_energy             = syned_electron_beam.energy(),
                 electron_current            = syned_electron_beam.current(),
                 undulator_period            = undulator.period_length(),
@@ -499,6 +507,9 @@ class S4UndulatorLightSource(S4LightSource):
         else:
             raise Exception("Not implemented undul_phot code: "+undulator.code_undul_phot)
 
+        # the result is read from the disk cache if it has been calculated before with the same parameters
+        undul_phot_dict = RADIATION_CACHE.get(calculator.__name__, parameters, calculator)
+
         # add some info
         undul_phot_dict["code_undul_phot"] = undulator.code_undul_phot
         undul_phot_dict["info"] = self.info()
@@ -555,13 +566,9 @@ class S4UndulatorLightSource(S4LightSource):
             # now apply the electron spread correction
             s_phot_corrected *= q_s
 
-            cov = [[s_phot_corrected**2, 0], [0, s_phot_corrected**2]]
-            mean = [0.0,0.0]
-
-            tmp = numpy.random.multivariate_normal(mean, cov, NRAYS)
-            x_photon = tmp[:,0]
+            x_photon = numpy.random.normal(loc=0.0, scale=s_phot_corrected, size=NRAYS)
             y_photon = 0.0
-            z_photon = tmp[:,1]
+            z_photon = numpy.random.normal(loc=0.0, scale=s_phot_corrected, size=NRAYS)
 
             # for plot, a Gaussian
             x = numpy.linspace(-5 * s_phot, 5 * s_phot, 101)
@@ -699,22 +706,14 @@ class S4UndulatorLightSource(S4LightSource):
             if electron_beam_x_at_waist:
                 x_electron = numpy.random.normal(loc=0.0, scale=sigmas[0], size=NRAYS)
             else: # TODO: in fact, this is valid for all cases and not slower...
-                meanX = [0, 0]
-                covX = [[moment_xx, moment_xxp],
-                        [moment_xxp, moment_xpxp]]
-                x_electron, EBEAM1 = numpy.random.multivariate_normal(meanX, covX, NRAYS).T
-                print()
-                print(x_electron*1e-6)
+                x_electron, EBEAM1 = sample_bivariate_normal(moment_xx, moment_xxp, moment_xpxp, nrays=NRAYS)
 
 
             y_electron = 0.0
             if electron_beam_z_at_waist:
                 z_electron = numpy.random.normal(loc=0.0, scale=sigmas[2], size=NRAYS)
             else:
-                meanZ = [0, 0]
-                covZ = [[moment_yy, moment_yyp],
-                        [moment_yyp, moment_ypyp]]  # covariance
-                z_electron, EBEAM3 = numpy.random.multivariate_normal(meanZ, covZ, NRAYS).T
+                z_electron, EBEAM3 = sample_bivariate_normal(moment_yy, moment_yyp, moment_ypyp, nrays=NRAYS)
         else:
             x_electron = 0.0
             y_electron = 0.0
@@ -871,19 +870,37 @@ class S4UndulatorLightSource(S4LightSource):
 
         return rays
 
-    def _sample_photon_energy_theta_and_phi(self, NRAYS):
+    def __get_sampler(self, q_a=1.0):
+        # the sampler of (theta, phi) or (photon energy, theta, phi) is built once for every radiation result
+        if self.__result_sampler is not None and self.__result_sampler[0] == q_a: return self.__result_sampler[1]
 
-        #
-        # sample divergences
-        #
         theta         = self.__result_radiation["theta"]
         phi           = self.__result_radiation["phi"]
         photon_energy = self.__result_radiation["photon_energy"]
+        radiation     = self.__result_radiation["radiation"]
 
-        undulator = self.get_magnetic_structure()
+        # correct radiation for DxDz / DthetaDphi
+        tmp_theta = theta / theta.max()
+        tmp_theta += 1e-6 # to avoid zeros
 
+        if self.get_magnetic_structure().is_monochromatic():
+            sampler = SamplerGrid(radiation[0, :, :] * tmp_theta[:, None],
+                                  theta * q_a, # apply energy spread correction
+                                  phi)
+        else:
+            sampler = SamplerGrid(radiation * tmp_theta[None, :, None], photon_energy, theta, phi)
 
+        self.__result_sampler = (q_a, sampler)
+        return sampler
 
+    def _sample_photon_energy_theta_and_phi(self, NRAYS):
+
+        #
+        # sample divergences
+        #
+        photon_energy = self.__result_radiation["photon_energy"]
+
+        undulator = self.get_magnetic_structure()
 
         if undulator.is_monochromatic():
             # energy spread correction factor (for the moment for monochromatic only)
@@ -901,19 +918,7 @@ class S4UndulatorLightSource(S4LightSource):
                 if is_debug(): print(">>>>> NO energy spread correction")
 
             #2D case
-            tmp = self.__result_radiation["radiation"][0, :, :].copy()
-            tmp /= tmp.max()
-            # correct radiation for DxDz / DthetaDphi
-            tmp_theta = numpy.outer(theta, numpy.ones_like(phi))
-            tmp_theta /= tmp_theta.max()
-            tmp_theta += 1e-6 # to avoid zeros
-            tmp *= tmp_theta
-            # plot_image(tmp_theta,theta,phi,aspect='auto')
-
-            theta *= q_a # apply energy spread correction
-
-            s2d = Sampler2D(tmp, theta, phi)
-            sampled_theta, sampled_phi = s2d.get_n_sampled_points(NRAYS)
+            sampled_theta, sampled_phi = self.__get_sampler(q_a).get_n_sampled_points(NRAYS)
             sampled_photon_energy = numpy.ones(NRAYS) * self.get_magnetic_structure()._emin
         else:
             # energy spread correction factor (for the moment for monochromatic only)
@@ -921,16 +926,7 @@ class S4UndulatorLightSource(S4LightSource):
                 raise Exception("** Error ** Energy spread cannot be calculated for polychromatic sources")
 
             #3D case
-            tmp = self.__result_radiation["radiation"].copy()
-            tmp /= tmp.max()
-            # correct radiation for DxDz / DthetaDphi
-            tmp_theta = numpy.outer(theta, numpy.ones_like(phi))
-            tmp_theta /= tmp_theta.max()
-            tmp_theta += 1e-6 # to avoid zeros
-            for i in range(tmp.shape[0]):
-                tmp[i,:,:] *= tmp_theta
-            s3d = Sampler3D(tmp, photon_energy, theta, phi)
-            sampled_photon_energy,sampled_theta,sampled_phi = s3d.get_n_sampled_points(NRAYS)
+            sampled_photon_energy, sampled_theta, sampled_phi = self.__get_sampler(1.0).get_n_sampled_points(NRAYS)
 
         return sampled_photon_energy, sampled_theta, sampled_phi
 
@@ -41,6 +41,9 @@ class S4Wiggler(Wiggler):
         tends to overestimate the tails of the vertical angle. In this case, the number of points should be increased.
         However, with large number of points, the calculation time is very large, similar to the more accurate option
         flag_interpolaton=0.
+        Note that for flag_interpolation=0,1,2 the vertical divergence of all rays is sampled at once interpolating a
+        table of the inverse cdf (see VerticalDivergenceSampler), unless S4WigglerLightSource.get_beam() is called
+        with batched_sampling=False.
     flag_emittance : int, optional
         Flag: 0=Zero emittance (filament beam), 1=Use emittance.
     shift_x_flag : int, optional
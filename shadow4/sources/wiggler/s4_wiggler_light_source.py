@@ -5,9 +5,10 @@ Wiggler light source.
 # Wiggler code: computes wiggler radiation distributions and samples rays according to them.
 #
 # The radiation is calculating using sr-xraylib
+import os
 import numpy
 
-from srxraylib.util.inverse_method_sampler import Sampler1D, Sampler2D
+from shadow4.tools.inverse_method_sampler import Sampler1D, Sampler2D, Sampler1Dcdf
 from srxraylib.sources.srfunc import wiggler_trajectory, wiggler_spectrum, wiggler_cdf, sync_f
 
 import scipy
@@ -16,218 +17,20 @@ from scipy.interpolate import griddata, CloughTocher2DInterpolator, LinearNDInte
 import scipy.constants as codata
 
 from shadow4.sources.s4_electron_beam import S4ElectronBeam
+from shadow4.sources.electron_phase_space_sampler import sample_electron_phase_space
+from shadow4.sources.source_acceptance import get_interval_in_0_1, apply_ray_weights
 from shadow4.sources.s4_light_source import S4LightSource
 from shadow4.sources.wiggler.s4_wiggler import S4Wiggler
 from shadow4.beam.s4_beam import S4Beam
 from shadow4.tools.arrayofvectors import vector_cross, vector_norm
 from srxraylib.sources.srfunc import sync_f_sigma_and_pi, sync_f_sigma_and_pi_approx
+from shadow4.sources.wiggler.vertical_divergence_sampler import VerticalDivergenceSampler
+from shadow4.tools.disk_cache import RADIATION_CACHE
 from shadow4.tools.logger import is_verbose, is_debug
 
 import time
 
 
-
-
-###############################################
-
-class Sampler1Dcdf(object): # todo: move away
-
-    """
-    Constructor.
-
-    Parameters
-    ----------
-    pdf : numpy array
-        1D input probability distrubution function.
-    pdf_x : numpy array
-        the abscissas of the odf.
-    cdf_interpolation_factor : float, optional
-        interpolation factor for calculating the cdf (1 makes no interpolation)/
-
-    """
-    def __init__(self, cdf, pdf_x=None):
-
-        self._cdf = cdf
-        if pdf_x is None:
-            self._set_default_pdf_x()
-        else:
-            self._pdf_x = pdf_x
-        self._cdf_x = self._pdf_x.copy()
-        self._cdf_interpolation_factor = 1.0
-
-        if self._cdf_x.size != self._cdf_x.size:
-            raise Exception("Incompatible arrays.")
-
-    def abscissas(self):
-        """
-        Gets the abscissas array.
-
-        Returns
-        -------
-        numpy array
-            The abscissas array (referenced, not copied).
-        """
-        return self._pdf_x
-
-    def cdf(self):
-        """
-        Gets the cumulative distribution function (cdf).
-
-        Returns
-        -------
-        numpy array
-            The cdf (referenced, not copied).
-
-        """
-        return self._cdf
-
-    def cdf_abscissas(self):
-        """
-        Gets the abscissas of the cumulative distribution function (cdf).
-
-        Returns
-        -------
-        numpy array
-            The cdf abscissas (referenced, not copied).
-
-        """
-        return self._cdf_x
-
-    def get_sampled(self, random_in_0_1):
-        """
-        Return an array with sampled points.
-
-        Parameters
-        ----------
-        random_in_0_1  : float or numpy array
-            Points sampled in a uniform interval.
-
-        Returns
-        -------
-        numpy array
-            the points sampled with the current pdf. The number of points is equal to the dimension of random_in_0_1.
-
-        """
-        y = numpy.array(random_in_0_1)
-
-        if y.size > 1:
-            x_rand_array = numpy.zeros_like(random_in_0_1)
-            for i,cdf_rand in enumerate(random_in_0_1):
-                ival,idelta,pendent = self._get_index(cdf_rand)
-                x_rand_array[i] = self._pdf_x[ival] + idelta*(self._pdf_x[1]-self._pdf_x[0])
-            return x_rand_array
-        else:
-            ival,idelta,pendent = self._get_index(random_in_0_1)
-            return self._pdf_x[int(ival)] + idelta*(self._pdf_x[1]-self._pdf_x[0])
-
-    def get_sampled_and_histogram(self, random_in_0_1, bins=51, range=None):
-        """
-        Return an array with sampled points and the histogram.
-
-        Parameters
-        ----------
-        random_in_0_1  : float or numpy array
-            Points sampled in a uniform interval.
-        bins : int, optional
-            Number of bins
-        range : list or tuple
-            [min, max] the histogram limits.
-
-        Returns
-        -------
-        tuple
-            (s1, h, bin_edges)
-            s1: the points sampled with the current pdf. The number of points is equal to the dimension of random_in_0_1,
-            h: the array with the histogram values at the bin edges,
-            bin_edges: the bin edges.
-        """
-        s1 = self.get_sampled(random_in_0_1)
-        if range is None:
-            range = [self._pdf_x.min(),self._pdf_x.max()]
-        #
-        # histogram
-        #
-        h, bin_edges = numpy.array(numpy.histogram(s1,bins=bins,range=range))
-        return s1, h, bin_edges
-
-    def get_n_sampled_points(self, npoints, seed=None):
-        """
-        Returns a given number points sampled points sampled with the pdf.
-
-        Parameters
-        ----------
-        npoints : int
-            The number of points.
-        seed : int, optional
-            The seed (numpy generator is initialized with numpy.random.default_rng(seed))
-
-        Returns
-        -------
-        numpy array
-            The sampled points.
-
-        """
-        if not seed is None:
-            rng = numpy.random.default_rng(seed)
-            cdf_rand_array = rng.random(npoints)
-        else:
-            cdf_rand_array = numpy.random.random(npoints)
-
-        return self.get_sampled(cdf_rand_array)
-
-    def get_n_sampled_points_and_histogram(self, npoints, bins=51, range=None, seed=None):
-        """
-        Returns a given number points sampled points sampled with the pdf and the histogram.
-
-        Parameters
-        ----------
-        npoints : int
-            The number of points.
-        seed : int, optional
-            The seed (numpy generator is initialized with numpy.random.default_rng(seed))
-        bins : int, optional
-            Number of bins
-        range : list or tuple
-            [min, max] the histogram limits.
-
-        Returns
-        -------
-        tuple
-            (s1, h, bin_edges)
-            s1: the points sampled with the current pdf. The number of points is equal to the dimension of random_in_0_1,
-            h: the array with the histogram values at the bin edges,
-            bin_edges: the bin edges.
-
-        """
-        if not seed is None:
-            rng = numpy.random.default_rng(seed)
-            cdf_rand_array = rng.random(npoints)
-        else:
-            cdf_rand_array = numpy.random.random(npoints)
-        return self.get_sampled_and_histogram(cdf_rand_array,bins=bins,range=range)
-
-    def _set_default_pdf_x(self):
-        self._pdf_x = numpy.arange(self._pdf.size)
-
-    def _get_index(self,edge):
-        try:
-            ix = numpy.nonzero(self._cdf >= edge)[0][0]
-        except:
-            ix = 0
-
-        if ix > 0:
-            ix -= 1
-
-        if ix >= (self._cdf.size - 1):
-            pendent = 0.0
-            delta = 0.0
-        else:
-            pendent = self._cdf[ix + 1] - self._cdf[ix]
-            delta = (edge - self._cdf[ix]) / pendent
-
-        return ix//self._cdf_interpolation_factor,delta,pendent
-
-
 ################################################
 class S4WigglerLightSource(S4LightSource):
     """
@@ -245,6 +48,8 @@ class S4WigglerLightSource(S4LightSource):
         The number of rays.
     seed : int, optional
         The Monte Carlo seed.
+    acceptance : instance of SourceAcceptance, optional
+        The angular window accepted downstream (see set_acceptance()).
     """
     def __init__(self,
                  name="Undefined",
@@ -252,6 +57,7 @@ class S4WigglerLightSource(S4LightSource):
                  magnetic_structure=None,
                  nrays=5000,
                  seed=12345,
+                 acceptance=None,
                  ):
         super().__init__(name,
                          electron_beam=electron_beam if not electron_beam is None else S4ElectronBeam(),
@@ -263,6 +69,34 @@ class S4WigglerLightSource(S4LightSource):
         self.__result_trajectory = None
         self.__result_parameters = None
         self.__result_cdf = None
+        self.__vertical_divergence_sampler = None
+
+        self._acceptance = acceptance
+
+    def set_acceptance(self, acceptance=None):
+        """
+        Sets the angular window accepted downstream (importance sampling). The rays are sampled only in the parts of
+        the trajectory with horizontal angle inside the window, and with vertical emission angle inside the window
+        (this needs the batched sampling of the vertical divergence). The probability of the window is included as a
+        weight of the rays (the electric fields are scaled by its square root). The electron beam divergence is
+        added after (use a window with margins).
+
+        Parameters
+        ----------
+        acceptance : instance of SourceAcceptance, optional
+            The window (None to sample the full emission).
+        """
+        self._acceptance = acceptance
+
+    def get_acceptance(self):
+        """
+        Returns the angular window accepted downstream.
+
+        Returns
+        -------
+        None or instance of SourceAcceptance
+        """
+        return self._acceptance
 
 
     def get_trajectory(self):
@@ -282,39 +116,48 @@ class S4WigglerLightSource(S4LightSource):
         wiggler = self.get_magnetic_structure()
         electron_beam = self.get_electron_beam()
 
+        key_parameters = None
         if wiggler._magnetic_field_periodic == 1:
 
-            (traj, pars) = wiggler_trajectory(b_from=0,
-                                                     inData="",
-                                                     nPer=wiggler.number_of_periods(),
-                                                     nTrajPoints=wiggler._NG_J,
-                                                     ener_gev=electron_beam._energy_in_GeV,
-                                                     per=wiggler.period_length(),
-                                                     kValue=wiggler.K_vertical(),
-                                                     trajFile="",
-                                                     shift_x_flag=wiggler._shift_x_flag,
-                                                     shift_x_value=wiggler._shift_x_value,
-                                                     shift_betax_flag=wiggler._shift_betax_flag,
-                                                     shift_betax_value=wiggler._shift_betax_value, )
+            parameters = dict(b_from=0,
+                              inData="",
+                              nPer=wiggler.number_of_periods(),
+                              nTrajPoints=wiggler._NG_J,
+                              ener_gev=electron_beam._energy_in_GeV,
+                              per=wiggler.period_length(),
+                              kValue=wiggler.K_vertical(),
+                              trajFile="",
+                              shift_x_flag=wiggler._shift_x_flag,
+                              shift_x_value=wiggler._shift_x_value,
+                              shift_betax_flag=wiggler._shift_betax_flag,
+                              shift_betax_value=wiggler._shift_betax_value, )
 
         elif wiggler._magnetic_field_periodic == 0:
 
-            (traj, pars) = wiggler_trajectory(b_from=1,
-                                                     inData=wiggler._file_with_magnetic_field,
-                                                     nPer=1,
-                                                     nTrajPoints=wiggler._NG_J,
-                                                     ener_gev=electron_beam._energy_in_GeV,
-                                                     # per=self.syned_wiggler.period_length(),
-                                                     # kValue=self.syned_wiggler.K_vertical(),
-                                                     trajFile="",
-                                                     shift_x_flag       = wiggler._shift_x_flag     ,
-                                                     shift_x_value      = wiggler._shift_x_value    ,
-                                                     shift_betax_flag   = wiggler._shift_betax_flag ,
-                                                     shift_betax_value  = wiggler._shift_betax_value,)
+            parameters = dict(b_from=1,
+                              inData=wiggler._file_with_magnetic_field,
+                              nPer=1,
+                              nTrajPoints=wiggler._NG_J,
+                              ener_gev=electron_beam._energy_in_GeV,
+                              # per=self.syned_wiggler.period_length(),
+                              # kValue=self.syned_wiggler.K_vertical(),
+                              trajFile="",
+                              shift_x_flag       = wiggler._shift_x_flag     ,
+                              shift_x_value      = wiggler._shift_x_value    ,
+                              shift_betax_flag   = wiggler._shift_betax_flag ,
+                              shift_betax_value  = wiggler._shift_betax_value,)
+
+            # a modified magnetic field file must not use the cached trajectory
+            if os.path.isfile(wiggler._file_with_magnetic_field):
+                stat = os.stat(wiggler._file_with_magnetic_field)
+                key_parameters = {"file_mtime_ns": stat.st_mtime_ns, "file_size": stat.st_size}
 
+        # the trajectory is read from the disk cache if it has been calculated before with the same parameters
+        result = RADIATION_CACHE.get("wiggler_trajectory", parameters, self.__wiggler_trajectory,
+                                     key_parameters=key_parameters)
 
-        self.__result_trajectory = traj
-        self.__result_parameters = pars
+        self.__result_trajectory = result["trajectory"]
+        self.__result_parameters = result["parameters"]
 
 
     def __calculate_radiation(self):
@@ -324,14 +167,21 @@ class S4WigglerLightSource(S4LightSource):
         if self.__result_trajectory is None: self.__calculate_trajectory()
 
         #
-        # calculate cumulative distribution function
+        # calculate cumulative distribution function (or read it from the disk cache)
         #
-        self.__result_cdf = wiggler_cdf(self.__result_trajectory,
-                                        enerMin=wiggler._EMIN,
-                                        enerMax=wiggler._EMAX,
-                                        enerPoints=1 if wiggler.is_monochromatic() else wiggler._NG_E,
-                                        outFile="",
-                                        elliptical=False)
+        self.__result_cdf = RADIATION_CACHE.get("wiggler_cdf",
+                                                dict(traj=self.__result_trajectory,
+                                                     enerMin=wiggler._EMIN,
+                                                     enerMax=wiggler._EMAX,
+                                                     enerPoints=1 if wiggler.is_monochromatic() else wiggler._NG_E,
+                                                     outFile="",
+                                                     elliptical=False),
+                                                wiggler_cdf)
+
+    @classmethod
+    def __wiggler_trajectory(cls, **parameters):
+        (traj, pars) = wiggler_trajectory(**parameters)
+        return {"trajectory": traj, "parameters": pars}
 
 
     def __psi_max_estimation(self, RAD_MIN, photon_energy_over_critical_energy):
@@ -350,14 +200,28 @@ class S4WigglerLightSource(S4LightSource):
             psi_interval_in_units_one_over_gamma = 2
         return psi_interval_in_units_one_over_gamma
 
+    def __get_vertical_divergence_sampler(self, flag_interpolation, psi_interval_in_units_one_over_gamma,
+                                          psi_interval_number_of_points):
+        # the batched sampler is kept while the sampling parameters do not change (its table rows are reused).
+        key = (flag_interpolation, psi_interval_in_units_one_over_gamma, psi_interval_number_of_points)
+        if self.__vertical_divergence_sampler is None or self.__vertical_divergence_sampler[0] != key:
+            sampler = VerticalDivergenceSampler(method=flag_interpolation,
+                                                psi_interval_in_units_one_over_gamma=psi_interval_in_units_one_over_gamma,
+                                                psi_interval_number_of_points=psi_interval_number_of_points,
+                                                psi_interval_function=lambda eene: self.__psi_max_estimation(None, eene))
+            self.__vertical_divergence_sampler = (key, sampler)
+        return self.__vertical_divergence_sampler[1]
+
     def __calculate_rays(self, user_unit_to_m=1.0,
                          F_COHER=0,
                          psi_interval_in_units_one_over_gamma=None,
                          psi_interval_number_of_points=1001,
+                         batched_sampling=True,
                          ):
         # compute the rays in SHADOW matrix (shape (npoints,18) )
         # :param F_COHER: set this flag for coherent beam
         # :param user_unit_to_m: default 1.0 (m)
+        # :param batched_sampling: sample the vertical divergence of all rays at once (flag_interpolation=0,1,2)
         # :return: rays, a numpy.array((npoits,18))
         if self.__result_cdf is None:
             self.__calculate_radiation()
@@ -497,6 +361,16 @@ class S4WigglerLightSource(S4LightSource):
         # transversal angle x' and curvature
         #
         arg_y_array     = numpy.random.random(NRAYS)
+        weight_h = None
+        if self._acceptance is not None and self._acceptance.is_horizontal_limited():
+            # acceptance window (horizontal): sample only the trajectory segments with angle inside the window
+            h_min, h_max = self._acceptance.get_horizontal_interval()
+            segment_angle = 0.5 * (ANGLE[1:] + ANGLE[:-1])
+            segment_probability = numpy.diff(SEEDIN) * ((segment_angle >= h_min) & (segment_angle <= h_max))
+            weight_h = segment_probability.sum() / (SEEDIN[-1] - SEEDIN[0])
+            if weight_h <= 0: raise Exception("No emission inside the acceptance window.")
+            cdf_window = numpy.concatenate(([0.0], numpy.cumsum(segment_probability))) / segment_probability.sum()
+            arg_y_array = numpy.interp(arg_y_array, cdf_window, SEEDIN)
         Y_TRAJ_array    = SEED_Y(arg_y_array)
         X_TRAJ_array    = Y_X(Y_TRAJ_array)
         ANGLE_array     = Y_XPRI(Y_TRAJ_array)
@@ -521,67 +395,11 @@ class S4WigglerLightSource(S4LightSource):
 
         t2 = time.time()
         if wiggler._FLAG_EMITTANCE:
-            moment_xx, moment_xxp, moment_xpxp, moment_zz, moment_zzp, moment_zpzp = syned_electron_beam.get_moments_all()
-            sigmaX, sigmaXp, sigmaZ, sigmaZp = sigmas
-
-            meanX = [0, 0]
-            meanZ = [0, 0]
-            # rSigmaXp = sigmaXp
-            # rSigmaZp = sigmaZp
-
-            for itik in range(NRAYS):
-                EPSI_PATH = EPSI_PATH_array[itik] - PATH0  # now refer to wiggler's origin
-
-                # OBSOLETE PART USING THE WAIST POSITION. NOW WE USE THE MOMENTS <xx> <xx'> <x'x'>
-                # # ! C
-                # # ! C Compute the actual distance (EPSI_W*) from the orbital focus
-                # # ! C
-                # EPSI_WX = EPSI_DX + EPSI_PATH
-                # EPSI_WZ = EPSI_DZ + EPSI_PATH
-                #
-                # rSigmaX = numpy.sqrt((EPSI_WX ** 2) * (sigmaXp ** 2) + sigmaX ** 2)
-                # rSigmaZ = numpy.sqrt((EPSI_WZ ** 2) * (sigmaZp ** 2) + sigmaZ ** 2)
-                # rhoX = EPSI_WX * sigmaXp ** 2 / (rSigmaX * rSigmaXp)
-                # rhoZ = EPSI_WZ * sigmaZp ** 2 / (rSigmaZ * rSigmaZp)
-                # covX = [[sigmaX ** 2, rhoX * sigmaX * sigmaXp],
-                #         [rhoX * sigmaX * sigmaXp, sigmaXp ** 2]]  # diagonal covariance
-                #
-                # covZ = [[sigmaZ ** 2, rhoZ * sigmaZ * sigmaZp],
-                #         [rhoZ * sigmaZ * sigmaZp, sigmaZp ** 2]]  # diagonal covariance
-
-                # new method
-                propagated_moment_xx   = moment_xx   + 2 * EPSI_PATH * moment_xxp + EPSI_PATH ** 2 * moment_xpxp
-                propagated_moment_xxp  = moment_xxp  + EPSI_PATH * moment_xpxp
-                propagated_moment_xpxp = moment_xpxp
-                propagated_moment_zz   = moment_zz   + 2 * EPSI_PATH * moment_zzp + EPSI_PATH ** 2 * moment_zpzp
-                propagated_moment_zzp  = moment_zzp  + EPSI_PATH * moment_zpzp
-                propagated_moment_zpzp = moment_zpzp
-
-                covX = [[propagated_moment_xx, propagated_moment_xxp],
-                        [propagated_moment_xxp, propagated_moment_xpxp]]
-
-                covZ = [[propagated_moment_zz, propagated_moment_zzp],
-                        [propagated_moment_zzp, propagated_moment_zpzp]]
-
-                # sampling using a multivariate (2) normal distribution
-                # multivariate_normal is very slow.
-                # See https://github.com/numpy/numpy/issues/14193 and shadow4-tests/shadow4tests/devel/check_multivariate_normal.py
-                # for acceleration recipee. For 5k rays this emittance loop passed from 31% to 8% of the total time.
-                # sampled_x, sampled_xp = numpy.random.multivariate_normal(meanX, covX, 1).T
-                # sampled_z, sampled_zp = numpy.random.multivariate_normal(meanZ, covZ, 1).T
-                sampled_x, sampled_xp = (meanX + numpy.linalg.cholesky(covX) @ numpy.random.standard_normal(len(meanX))).T
-                sampled_z, sampled_zp = (meanZ + numpy.linalg.cholesky(covZ) @ numpy.random.standard_normal(len(meanZ))).T
-
-                XXX = sampled_x
-                ZZZ = sampled_z
-
-                E_BEAM1 = sampled_xp
-                E_BEAM3 = sampled_zp
-
-                E_BEAM1_array[itik] = E_BEAM1
-                E_BEAM3_array[itik] = E_BEAM3
-                E_BEAMXXX_array[itik] = XXX
-                E_BEAMZZZ_array[itik] = ZZZ
+            # sampling using a multivariate (2) normal distribution with the moments <xx> <xx'> <x'x'> propagated to
+            # the ray position along the trajectory (EPSI_PATH, now referred to the wiggler's origin). All rays are
+            # sampled at once (closed-form 2x2 Cholesky factor), instead of numpy.linalg.cholesky ray by ray.
+            E_BEAMXXX_array, E_BEAM1_array, E_BEAMZZZ_array, E_BEAM3_array = \
+                sample_electron_phase_space(syned_electron_beam, path_offsets=EPSI_PATH_array - PATH0, nrays=NRAYS)
 
         t3 = time.time()
 
@@ -672,189 +490,213 @@ class S4WigglerLightSource(S4LightSource):
         else:
             raise Exception("Bad flag_interpolation value.")
 
-        if wiggler._flag_interpolation in [1, -1]:
-            # basically create the cdf vs angle and energy. Note that the limits of the angle are different for each energy.
-            eene = sampled_energies / critical_energy_array
-
-            e_over_ec_array_points = 4 if wiggler._NG_E==1 else wiggler._NG_E
-            e_over_ec_array = numpy.linspace(eene.min(), eene.max(), e_over_ec_array_points)
-
-            CDF1 = numpy.zeros((angle_array_reduced.size, e_over_ec_array.size))
-            FM1 = numpy.zeros((angle_array_reduced.size, e_over_ec_array.size)) # todo: delete?
-            # PSI1 = numpy.zeros(e_over_ec_array_points)
-            for i in range(e_over_ec_array.size):
-                psi1 = self.__psi_max_estimation(RAD_MIN_global, e_over_ec_array[i])
-                if (psi1 - psi_interval_in_units_one_over_gamma) > 1e-3:
-                    print("Warning: bad sampling psi1=%f > psi_interval_in_units_one_over_gamma=%f" % (psi1, psi_interval_in_units_one_over_gamma))
-                fm_s, fm_p = sync_f_sigma_and_pi_approx(numpy.linspace(-0.5 * psi1, 0.5 * psi1, psi_interval_number_of_points),
-                                                 e_over_ec_array[i])
-                cte = e_over_ec_array[i] ** 2 * a8 * syned_electron_beam._current * hdiv_mrad * syned_electron_beam._energy_in_GeV ** 2
-
-                fm_i = (fm_s + fm_p) * cte
-
-                i1D =  Sampler1D(fm_i, angle_array_reduced)
-                CDF1[:, i] = i1D.cdf()
-                FM1[:, i] = fm_i # todo: delete?
-                # PSI1[i] = psi1
-
-            if False:
-                from srxraylib.plot.gol import plot, plot_image
-                plot(e_over_ec_array, PSI1, xtitle='E/Ec', ytitle='Psi * gamma limit', title='limits for psi', show=0)
-
-                plot_image(CDF1, angle_array_normalized, e_over_ec_array,
-                           xtitle='normalized reduced angle theta*gamma/psi1',
-                           ytitle='reduced energy', title='CDF1', aspect='auto', show=0)
-
-                plot_image(FM1, angle_array_reduced, e_over_ec_array,
-                           title='intensity', xtitle='reduced angle', ytitle='reduced energy', aspect='auto', show=0)
-
-
-            # define interpolartors
-            AA = numpy.outer(angle_array_normalized, numpy.ones_like(e_over_ec_array))
-            EE = numpy.outer(numpy.ones_like(angle_array_reduced), e_over_ec_array)
-            Pi = numpy.array([AA.flatten(), EE.flatten()]).transpose()
-            # interpolator_PSI1 = interp1d(e_over_ec_array, PSI1, kind='cubic')
-            interpolator_cdf = LinearNDInterpolator(Pi, CDF1.flatten(), fill_value=0.0, rescale=True)
-
-
-        #@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
-        t44 = time.time()
-        sampled_theta_array = numpy.zeros(NRAYS)
-
         t111 = 0
         t222 = 0
-        for itik in range(NRAYS):
-            # #
-            # # directions
-            # #
-            #
-            # #     ! C Note. The angle of emission IN PLANE is the same as the one used
-            # #     ! C before. This will give rise to a source curved along the orbit.
-            # #     ! C The elevation angle is instead characteristic of the SR distribution.
-            # #     ! C The electron beam emittance is included at this stage. Note that if
-            # #     ! C EPSI = 0, we'll have E_BEAM = 0.0, with no changes.
-
-            # #     ! C In the case of SR, we take into account the fact that the electron
-            # #     ! C trajectory is not orthogonal to the field. This will give a correction
-            # #     ! C to the photon energy.  We can write it as a correction to the
-            # #     ! C magnetic field strength; this will linearly shift the critical energy
-            # #     ! C and, with it, the energy of the emitted photon.
-
-            sampled_photon_energy = sampled_energies[itik]
-            critical_energy = critical_energy_array[itik]
+        weight_v = None
+        if self._acceptance is not None and self._acceptance.is_vertical_limited() and \
+                not (batched_sampling and wiggler._flag_interpolation in [0, 1, 2]):
+            raise Exception("Vertical acceptance window only implemented for batched sampling (flag_interpolation=0,1,2).")
+
+        if batched_sampling and wiggler._flag_interpolation in [0, 1, 2]:
+            # all rays are sampled at once, interpolating a table of the inverse cdf vs (E/Ec, random number)
+            t44 = time.time()
+            sampler = self.__get_vertical_divergence_sampler(wiggler._flag_interpolation,
+                                                             psi_interval_in_units_one_over_gamma,
+                                                             psi_interval_number_of_points)
+            random_in_0_1 = numpy.random.random(NRAYS)
+            if self._acceptance is not None and self._acceptance.is_vertical_limited():
+                # acceptance window (vertical): random numbers between the cdf values of the window limits
+                v_min, v_max = self._acceptance.get_vertical_interval()
+                u_min, weight_v = get_interval_in_0_1(
+                    sampler.get_cdf(sampled_energies / critical_energy_array, v_min * gamma),
+                    sampler.get_cdf(sampled_energies / critical_energy_array, v_max * gamma))
+                random_in_0_1 = u_min + random_in_0_1 * weight_v
+            sampled_theta_array = sampler.get_sampled(sampled_energies / critical_energy_array,
+                                                      random_in_0_1) / gamma
+        else:
             if wiggler._flag_interpolation in [1, -1]:
-                # get sampled values by interpolation
-                e_index = numpy.argwhere((e_over_ec_array - sampled_photon_energy / critical_energy) > 0)
-                cdf_interpolated = interpolator_cdf(angle_array_normalized, sampled_photon_energy / critical_energy)
-                s = Sampler1Dcdf(cdf_interpolated, angle_array_normalized)
-                r = numpy.random.random()
-                sampled_theta1 = s.get_sampled(r)
+                # basically create the cdf vs angle and energy. Note that the limits of the angle are different for each energy.
+                eene = sampled_energies / critical_energy_array
 
+                e_over_ec_array_points = 4 if wiggler._NG_E==1 else wiggler._NG_E
+                e_over_ec_array = numpy.linspace(eene.min(), eene.max(), e_over_ec_array_points)
 
+                CDF1 = numpy.zeros((angle_array_reduced.size, e_over_ec_array.size))
+                FM1 = numpy.zeros((angle_array_reduced.size, e_over_ec_array.size)) # todo: delete?
+                # PSI1 = numpy.zeros(e_over_ec_array_points)
+                for i in range(e_over_ec_array.size):
+                    psi1 = self.__psi_max_estimation(RAD_MIN_global, e_over_ec_array[i])
+                    if (psi1 - psi_interval_in_units_one_over_gamma) > 1e-3:
+                        print("Warning: bad sampling psi1=%f > psi_interval_in_units_one_over_gamma=%f" % (psi1, psi_interval_in_units_one_over_gamma))
+                    fm_s, fm_p = sync_f_sigma_and_pi_approx(numpy.linspace(-0.5 * psi1, 0.5 * psi1, psi_interval_number_of_points),
+                                                     e_over_ec_array[i])
+                    cte = e_over_ec_array[i] ** 2 * a8 * syned_electron_beam._current * hdiv_mrad * syned_electron_beam._energy_in_GeV ** 2
 
-                ########################
-                # interpolated_psi1 = interpolator_PSI1(sampled_photon_energy / critical_energy)
-                RAD_MIN = RAD_MIN_array[itik]  # numpy.abs(R_MAGNET)
-                eene = sampled_photon_energy / critical_energy
-                interpolated_psi1 = self.__psi_max_estimation(RAD_MIN, eene)
-                ########################
+                    fm_i = (fm_s + fm_p) * cte
 
-                sampled_theta1 *= interpolated_psi1 / gamma
-                sampled_theta = sampled_theta1
+                    i1D =  Sampler1D(fm_i, angle_array_reduced)
+                    CDF1[:, i] = i1D.cdf()
+                    FM1[:, i] = fm_i # todo: delete?
+                    # PSI1[i] = psi1
 
-            if wiggler._flag_interpolation in [0, -1]:
-                # builds the sampler and the interpolator for each ray. This is very slow...
-                RAD_MIN = RAD_MIN_array[itik]  # numpy.abs(R_MAGNET)
+                if False:
+                    from srxraylib.plot.gol import plot, plot_image
+                    plot(e_over_ec_array, PSI1, xtitle='E/Ec', ytitle='Psi * gamma limit', title='limits for psi', show=0)
 
-                # if RAD_MIN > 1e6:
-                #     RAD_MIN = 1e6
-                #     RAD_MIN_array[itik] = 1e6
-                #     print(">>>>>>>>>>>>> RESET RAD_MIN", itik)
-                eene = sampled_photon_energy / critical_energy
+                    plot_image(CDF1, angle_array_normalized, e_over_ec_array,
+                               xtitle='normalized reduced angle theta*gamma/psi1',
+                               ytitle='reduced energy', title='CDF1', aspect='auto', show=0)
 
-                fm_s , fm_p = sync_f_sigma_and_pi(angle_array_mrad * 1e-3 * syned_electron_beam.gamma(), eene)
-                cte = eene ** 2 * a8 * syned_electron_beam._current * hdiv_mrad * syned_electron_beam._energy_in_GeV ** 2
-                fm_s *= cte
-                fm_p *= cte
+                    plot_image(FM1, angle_array_reduced, e_over_ec_array,
+                               title='intensity', xtitle='reduced angle', ytitle='reduced energy', aspect='auto', show=0)
 
-                fm = fm_s + fm_p
-                fm.shape = -1
-                fm_s.shape = -1
 
-                samplerAng = Sampler1D(fm, angle_array_mrad * 1e-3)
+                # define interpolartors
+                AA = numpy.outer(angle_array_normalized, numpy.ones_like(e_over_ec_array))
+                EE = numpy.outer(numpy.ones_like(angle_array_reduced), e_over_ec_array)
+                Pi = numpy.array([AA.flatten(), EE.flatten()]).transpose()
+                # interpolator_PSI1 = interp1d(e_over_ec_array, PSI1, kind='cubic')
+                interpolator_cdf = LinearNDInterpolator(Pi, CDF1.flatten(), fill_value=0.0, rescale=True)
 
-                if fm.min() == fm.max():  # typically when the trajectory is flat or RAD_MIN is very high
-                    print("Warning: cannot compute divergence for ray index %d (energy=%f eV, RAD_MIN: %f)" %
-                          (itik, sampled_photon_energy, RAD_MIN))
-                    sampled_theta = 0
-                else:
-                    ARG_ENER = numpy.random.random()
-                    sampled_theta = samplerAng.get_sampled(ARG_ENER)
 
+            #@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
+            t44 = time.time()
+            sampled_theta_array = numpy.zeros(NRAYS)
 
-                if False:
-                    from srxraylib.plot.gol import plot
-                    plot(a*1e-3, samplerAng.cdf(),
-                         [sampled_theta, sampled_theta], [0.5, 0.6],
-                         title="Energy: %f" % sampled_photon_energy)
-
-                if wiggler._flag_interpolation in [-1]:
-                    # display both cdf and result
-                    PSI1 = numpy.zeros(e_over_ec_array_points)
-                    for i in range(e_over_ec_array.size):
-                        PSI1[i] = self.__psi_max_estimation(RAD_MIN_global, e_over_ec_array[i])
-
-                    from srxraylib.plot.gol import plot
-                    plot(e_over_ec_array, PSI1,
-                         [sampled_photon_energy / critical_energy, sampled_photon_energy / critical_energy], [interpolated_psi1, interpolated_psi1],
-                         xtitle='E/Ec', ytitle='Psi * gamma limit', marker=[None,'o'], show=0)
-
-                    plot(angle_array_normalized * interpolated_psi1,
-                         cdf_interpolated,
-                         [sampled_theta1 * gamma, sampled_theta1 * gamma], [0.5, 0.6],
-                         angle_array_reduced, samplerAng.cdf(),
-                         [sampled_theta * gamma, sampled_theta * gamma], [0.6, 0.7],
-                         title="Energy: %f, E/Ec: %f" % (sampled_photon_energy, sampled_photon_energy / critical_energy),
-                         marker=['+', None, None, None],
-                         legend=['new','new','old','old'])
-
-            if wiggler._flag_interpolation in [2]: #
-                RAD_MIN = RAD_MIN_array[itik]  # numpy.abs(R_MAGNET)
-                eene = sampled_photon_energy / critical_energy
-
-                if True:
+            t111 = 0
+            t222 = 0
+            for itik in range(NRAYS):
+                # #
+                # # directions
+                # #
+                #
+                # #     ! C Note. The angle of emission IN PLANE is the same as the one used
+                # #     ! C before. This will give rise to a source curved along the orbit.
+                # #     ! C The elevation angle is instead characteristic of the SR distribution.
+                # #     ! C The electron beam emittance is included at this stage. Note that if
+                # #     ! C EPSI = 0, we'll have E_BEAM = 0.0, with no changes.
+
+                # #     ! C In the case of SR, we take into account the fact that the electron
+                # #     ! C trajectory is not orthogonal to the field. This will give a correction
+                # #     ! C to the photon energy.  We can write it as a correction to the
+                # #     ! C magnetic field strength; this will linearly shift the critical energy
+                # #     ! C and, with it, the energy of the emitted photon.
+
+                sampled_photon_energy = sampled_energies[itik]
+                critical_energy = critical_energy_array[itik]
+                if wiggler._flag_interpolation in [1, -1]:
+                    # get sampled values by interpolation
+                    e_index = numpy.argwhere((e_over_ec_array - sampled_photon_energy / critical_energy) > 0)
+                    cdf_interpolated = interpolator_cdf(angle_array_normalized, sampled_photon_energy / critical_energy)
+                    s = Sampler1Dcdf(cdf_interpolated, angle_array_normalized)
+                    r = numpy.random.random()
+                    sampled_theta1 = s.get_sampled(r)
+
+
+
+                    ########################
+                    # interpolated_psi1 = interpolator_PSI1(sampled_photon_energy / critical_energy)
+                    RAD_MIN = RAD_MIN_array[itik]  # numpy.abs(R_MAGNET)
+                    eene = sampled_photon_energy / critical_energy
+                    interpolated_psi1 = self.__psi_max_estimation(RAD_MIN, eene)
+                    ########################
+
+                    sampled_theta1 *= interpolated_psi1 / gamma
+                    sampled_theta = sampled_theta1
+
+                if wiggler._flag_interpolation in [0, -1]:
                     # builds the sampler and the interpolator for each ray. This is very slow...
-                    psi1 = self.__psi_max_estimation(RAD_MIN, eene)
-                    if (psi1 - psi_interval_in_units_one_over_gamma) > 1e-3:
-                        print("Warning: bad sampling ray index %d: psi1=%f > psi_interval_in_units_one_over_gamma=%f" % (
-                        itik, psi1, psi_interval_in_units_one_over_gamma))
+                    RAD_MIN = RAD_MIN_array[itik]  # numpy.abs(R_MAGNET)
 
-                    angle_array_reduced = numpy.linspace(-0.5 * psi1, 0.5 * psi1, psi_interval_number_of_points)
+                    # if RAD_MIN > 1e6:
+                    #     RAD_MIN = 1e6
+                    #     RAD_MIN_array[itik] = 1e6
+                    #     print(">>>>>>>>>>>>> RESET RAD_MIN", itik)
+                    eene = sampled_photon_energy / critical_energy
 
-                    tmp000 = time.time()
-                    fm_s, fm_p = sync_f_sigma_and_pi_approx(angle_array_reduced, eene)
-                    t111 += time.time() - tmp000
-                    tmp000 = time.time()
+                    fm_s , fm_p = sync_f_sigma_and_pi(angle_array_mrad * 1e-3 * syned_electron_beam.gamma(), eene)
+                    cte = eene ** 2 * a8 * syned_electron_beam._current * hdiv_mrad * syned_electron_beam._energy_in_GeV ** 2
+                    fm_s *= cte
+                    fm_p *= cte
 
                     fm = fm_s + fm_p
+                    fm.shape = -1
+                    fm_s.shape = -1
 
-                    samplerAng = Sampler1D(fm, angle_array_reduced)
+                    samplerAng = Sampler1D(fm, angle_array_mrad * 1e-3)
 
-                    if fm.min() == fm.max(): # typically when the trajectory is flat or RAD_MIN is very high
+                    if fm.min() == fm.max():  # typically when the trajectory is flat or RAD_MIN is very high
                         print("Warning: cannot compute divergence for ray index %d (energy=%f eV, RAD_MIN: %f)" %
                               (itik, sampled_photon_energy, RAD_MIN))
-                        sampled_theta = 0.0
+                        sampled_theta = 0
                     else:
                         ARG_ENER = numpy.random.random()
-                        sampled_theta = samplerAng.get_sampled(ARG_ENER) / gamma
-
-                    t222 += time.time() - tmp000
-
-            if numpy.isnan(sampled_theta):
-                print("Warning: sampled vertical psi for ray index %d changed from nan to 0." % itik)
-                sampled_theta = 0
-            sampled_theta_array[itik] = sampled_theta
-        # end loop
+                        sampled_theta = samplerAng.get_sampled(ARG_ENER)
+
+
+                    if False:
+                        from srxraylib.plot.gol import plot
+                        plot(a*1e-3, samplerAng.cdf(),
+                             [sampled_theta, sampled_theta], [0.5, 0.6],
+                             title="Energy: %f" % sampled_photon_energy)
+
+                    if wiggler._flag_interpolation in [-1]:
+                        # display both cdf and result
+                        PSI1 = numpy.zeros(e_over_ec_array_points)
+                        for i in range(e_over_ec_array.size):
+                            PSI1[i] = self.__psi_max_estimation(RAD_MIN_global, e_over_ec_array[i])
+
+                        from srxraylib.plot.gol import plot
+                        plot(e_over_ec_array, PSI1,
+                             [sampled_photon_energy / critical_energy, sampled_photon_energy / critical_energy], [interpolated_psi1, interpolated_psi1],
+                             xtitle='E/Ec', ytitle='Psi * gamma limit', marker=[None,'o'], show=0)
+
+                        plot(angle_array_normalized * interpolated_psi1,
+                             cdf_interpolated,
+                             [sampled_theta1 * gamma, sampled_theta1 * gamma], [0.5, 0.6],
+                             angle_array_reduced, samplerAng.cdf(),
+                             [sampled_theta * gamma, sampled_theta * gamma], [0.6, 0.7],
+                             title="Energy: %f, E/Ec: %f" % (sampled_photon_energy, sampled_photon_energy / critical_energy),
+                             marker=['+', None, None, None],
+                             legend=['new','new','old','old'])
+
+                if wiggler._flag_interpolation in [2]: #
+                    RAD_MIN = RAD_MIN_array[itik]  # numpy.abs(R_MAGNET)
+                    eene = sampled_photon_energy / critical_energy
+
+                    if True:
+                        # builds the sampler and the interpolator for each ray. This is very slow...
+                        psi1 = self.__psi_max_estimation(RAD_MIN, eene)
+                        if (psi1 - psi_interval_in_units_one_over_gamma) > 1e-3:
+                            print("Warning: bad sampling ray index %d: psi1=%f > psi_interval_in_units_one_over_gamma=%f" % (
+                            itik, psi1, psi_interval_in_units_one_over_gamma))
+
+                        angle_array_reduced = numpy.linspace(-0.5 * psi1, 0.5 * psi1, psi_interval_number_of_points)
+
+                        tmp000 = time.time()
+                        fm_s, fm_p = sync_f_sigma_and_pi_approx(angle_array_reduced, eene)
+                        t111 += time.time() - tmp000
+                        tmp000 = time.time()
+
+                        fm = fm_s + fm_p
+
+                        samplerAng = Sampler1D(fm, angle_array_reduced)
+
+                        if fm.min() == fm.max(): # typically when the trajectory is flat or RAD_MIN is very high
+                            print("Warning: cannot compute divergence for ray index %d (energy=%f eV, RAD_MIN: %f)" %
+                                  (itik, sampled_photon_energy, RAD_MIN))
+                            sampled_theta = 0.0
+                        else:
+                            ARG_ENER = numpy.random.random()
+                            sampled_theta = samplerAng.get_sampled(ARG_ENER) / gamma
+
+                        t222 += time.time() - tmp000
+
+                if numpy.isnan(sampled_theta):
+                    print("Warning: sampled vertical psi for ray index %d changed from nan to 0." % itik)
+                    sampled_theta = 0
+                sampled_theta_array[itik] = sampled_theta
+            # end loop
 
         ANGLEV = sampled_theta_array + E_BEAM3_array
         ANGLEX = ANGLE_array + E_BEAM1_array
@@ -927,6 +769,10 @@ class S4WigglerLightSource(S4LightSource):
 
         rays[:,6:9] =  A_VEC
         rays[:,15:18] = AP_VEC
+        if weight_h is not None or weight_v is not None:
+            weight = (1.0 if weight_h is None else weight_h) * (1.0 if weight_v is None else weight_v)
+            if is_verbose(): print("    calculate_rays: acceptance window, mean weight of the rays: %g" % numpy.mean(weight))
+            apply_ray_weights(rays, weight)
 
         #
         # ! C
@@ -999,7 +845,7 @@ class S4WigglerLightSource(S4LightSource):
     ############################################################################
     #
     ############################################################################
-    def get_beam(self, F_COHER=0, psi_interval_in_units_one_over_gamma=None):
+    def get_beam(self, F_COHER=0, psi_interval_in_units_one_over_gamma=None, batched_sampling=True):
         """
         Creates the beam as emitted by the wiggler.
 
@@ -1009,6 +855,9 @@ class S4WigglerLightSource(S4LightSource):
             A flag to indicate that the phase for the s-component is set to zero (coherent_beam=1) or is random for incoherent.
         psi_interval_in_units_one_over_gamma : None or float, optional
             The interval of psi*gamma for sampling rays.
+        batched_sampling : boolean, optional
+            For flag_interpolation=0,1,2, sample the vertical divergence of all rays at once using a table of the
+            inverse cdf vs (E/Ec, random number) (default). If False, build a sampler for each ray (slow).
 
         Returns
         -------
@@ -1023,6 +872,7 @@ class S4WigglerLightSource(S4LightSource):
             F_COHER                              = F_COHER,
             psi_interval_in_units_one_over_gamma = psi_interval_in_units_one_over_gamma,
             psi_interval_number_of_points        = self.get_magnetic_structure()._psi_interval_number_of_points,
+            batched_sampling                     = batched_sampling,
         ))
 
         return beam
@@ -1082,6 +932,8 @@ class S4WigglerLightSource(S4LightSource):
         txt += "Lorentz factor (gamma): %f\n"%electron_beam.gamma()
 
         txt += "\n\n" + magnetic_structure.get_info()
+        if self._acceptance is not None:
+            txt += "\n" + self._acceptance.get_info()
         return (txt)
 
     def to_python_code(self, **kwargs):
@@ -1107,6 +959,9 @@ class S4WigglerLightSource(S4LightSource):
         script += "\n\n\n#light source\nfrom shadow4.sources.wiggler.s4_wiggler_light_source import S4WigglerLightSource"
         script += "\nlight_source = S4WigglerLightSource(name='%s',electron_beam=electron_beam,magnetic_structure=source,nrays=%d,seed=%s)" % \
                                                           (self.get_name(),self.get_nrays(),self.get_seed())
+        if self._acceptance is not None:
+            script += self._acceptance.to_python_code()
+            script += "\nlight_source.set_acceptance(acceptance)"
         #
         # script += "\n\n\n#beamline\nfrom shadow4.beamline.s4_beamline import S4Beamline"
         # script += "\nbeamline = S4Beamline(light_source=light_source)"
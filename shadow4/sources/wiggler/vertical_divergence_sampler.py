@@ -0,0 +1,237 @@
+"""
+Batched sampler of the vertical divergence (psi) of the synchrotron radiation emitted by the wiggler.
+
+The angular distribution of the radiation emitted at a point of the electron trajectory depends (in reduced units
+gamma*psi) only on the ratio of the photon energy to the local critical energy (E/Ec). Instead of building a
+sampler for every ray, here:
+    * a table with the inverse cumulative distribution function (quantiles of gamma*psi) is computed once for a
+      set of nodes in log(E/Ec) (nodes_per_decade nodes per decade, on a fixed grid, so the rows are reused).
+    * all the rays are sampled with a single vectorized bilinear interpolation of the table in (log(E/Ec), random
+      number in [0,1]). The random numbers of the table are denser close to 0 and 1 to sample correctly the tails.
+
+Usage:
+    sampler = VerticalDivergenceSampler(method=0, psi_interval_in_units_one_over_gamma=10.0)
+    gamma_psi = sampler.get_sampled(e_over_ec_array, numpy.random.random(e_over_ec_array.size))
+
+"""
+import numpy
+
+from srxraylib.sources.srfunc import sync_f_sigma_and_pi, sync_f_sigma_and_pi_approx
+
+from shadow4.tools.logger import is_verbose
+
+class VerticalDivergenceSampler(object):
+    """
+    Samples the vertical divergence of the wiggler radiation for arrays of E/Ec.
+
+    Parameters
+    ----------
+    method : int, optional
+        0: accurate (Bessel functions) distribution in the fixed interval psi_interval_in_units_one_over_gamma.
+        1 or 2: approximated (Kv approximated) distribution in an interval depending on E/Ec (psi_interval_function).
+    psi_interval_in_units_one_over_gamma : float, optional
+        The interval of gamma*psi (used for method=0, and for checking the interval in method=1,2).
+    psi_interval_number_of_points : int, optional
+        The number of points in gamma*psi to calculate the distributions.
+    psi_interval_function : callable, optional
+        A function returning the interval of gamma*psi for a given E/Ec (used for method=1,2).
+    nodes_per_decade : int, optional
+        The number of nodes per decade of E/Ec in the table.
+    cdf_points : int, optional
+        The number of points of the random variable in [0,1] in the table.
+    """
+    def __init__(self,
+                 method=0,
+                 psi_interval_in_units_one_over_gamma=10.0,
+                 psi_interval_number_of_points=1001,
+                 psi_interval_function=None,
+                 nodes_per_decade=50,
+                 cdf_points=2001,
+                 ):
+        if method not in [0, 1, 2]: raise ValueError("Bad method for VerticalDivergenceSampler: %s" % repr(method))
+        if method in [1, 2] and psi_interval_function is None:
+            raise ValueError("psi_interval_function is needed for method=%d" % method)
+
+        self._method = method
+        self._psi_interval_in_units_one_over_gamma = psi_interval_in_units_one_over_gamma
+        self._psi_interval_number_of_points = psi_interval_number_of_points
+        self._psi_interval_function = psi_interval_function
+        self._nodes_per_decade = nodes_per_decade
+        self._cdf_points = cdf_points
+
+        self._rows = {} # node index: quantiles of gamma*psi
+
+    def get_sampled(self, e_over_ec, random_in_0_1):
+        """
+        Returns the sampled gamma*psi values.
+
+        Parameters
+        ----------
+        e_over_ec : numpy array
+            The ratio photon energy over critical energy for each ray.
+        random_in_0_1 : numpy array
+            Random numbers uniformly distributed in [0,1] (one per ray).
+
+        Returns
+        -------
+        numpy array
+            The sampled psi in units of 1/gamma (zero for the rays that cannot be sampled, e.g. flat trajectory).
+        """
+        e_over_ec = numpy.asarray(e_over_ec, dtype=float)
+        random_in_0_1 = numpy.asarray(random_in_0_1, dtype=float)
+        out = numpy.zeros_like(e_over_ec)
+
+        good = numpy.isfinite(e_over_ec) & (e_over_ec > 0)
+        if is_verbose() and numpy.any(~good):
+            print("Warning: cannot compute divergence for %d rays (bad E/Ec). Vertical psi set to 0." % (~good).sum())
+        if not numpy.any(good): return out
+
+        log_e = numpy.log10(e_over_ec[good]) * self._nodes_per_decade
+        node_min = int(numpy.floor(log_e.min()))
+        node_max = max(int(numpy.ceil(log_e.max())), node_min + 1)
+        quantiles = self.get_table(node_min, node_max)
+
+        # bilinear interpolation in (log(E/Ec), random number)
+        s = log_e - node_min
+        j = numpy.clip(numpy.floor(s).astype(int), 0, quantiles.shape[0] - 2)
+        w = s - j
+
+        r = self._get_table_abscissas_index(numpy.clip(random_in_0_1[good], 0.0, 1.0))
+        k = numpy.clip(numpy.floor(r).astype(int), 0, self._cdf_points - 2)
+        u = r - k
+
+        out[good] = (1 - w) * ((1 - u) * quantiles[j, k]     + u * quantiles[j, k + 1]) + \
+                         w  * ((1 - u) * quantiles[j + 1, k] + u * quantiles[j + 1, k + 1])
+        return out
+
+    def get_cdf(self, e_over_ec, gamma_psi, iterations=32):
+        """
+        Returns the cumulative probability of given values of gamma*psi (the inverse of get_sampled(), by bisection).
+
+        Parameters
+        ----------
+        e_over_ec : numpy array
+            The ratio photon energy over critical energy for each ray.
+        gamma_psi : float or numpy array
+            The psi values in units of 1/gamma (one value, or one per ray).
+        iterations : int, optional
+            The number of bisection iterations.
+
+        Returns
+        -------
+        numpy array
+            The random numbers in [0,1] that get_sampled() transforms in gamma_psi (for the rays that cannot be sampled
+            psi is zero, and the cdf is 0 or 1).
+        """
+        e_over_ec = numpy.asarray(e_over_ec, dtype=float)
+        gamma_psi = numpy.broadcast_to(numpy.asarray(gamma_psi, dtype=float), e_over_ec.shape)
+        out = (gamma_psi >= 0).astype(float)
+
+        good = numpy.isfinite(e_over_ec) & (e_over_ec > 0)
+        low = numpy.zeros(good.sum())
+        high = numpy.ones(good.sum())
+        for i in range(iterations):
+            middle = 0.5 * (low + high)
+            below = self.get_sampled(e_over_ec[good], middle) < gamma_psi[good]
+            low = numpy.where(below, middle, low)
+            high = numpy.where(below, high, middle)
+        out[good] = 0.5 * (low + high)
+        return out
+
+    def get_table(self, node_min, node_max):
+        """
+        Returns the table of quantiles for the nodes node_min...node_max (node i is E/Ec = 10**(i/nodes_per_decade)).
+
+        Parameters
+        ----------
+        node_min : int
+            The first node index.
+        node_max : int
+            The last node index.
+
+        Returns
+        -------
+        numpy array
+            The quantiles of gamma*psi with shape (node_max - node_min + 1, cdf_points).
+        """
+        nodes = numpy.arange(node_min, node_max + 1)
+        missing = [node for node in nodes.tolist() if node not in self._rows]
+        if len(missing) > 0:
+            if is_verbose(): print("VerticalDivergenceSampler: calculating %d rows (method %d)" % (len(missing), self._method))
+            for node in missing: self._rows[node] = self._calculate_row(10 ** (node / self._nodes_per_decade))
+        return numpy.array([self._rows[node] for node in nodes.tolist()])
+
+    def get_psi_interval(self, e_over_ec):
+        """
+        Returns the interval of gamma*psi used for a given E/Ec.
+
+        Parameters
+        ----------
+        e_over_ec : float
+            The ratio photon energy over critical energy.
+
+        Returns
+        -------
+        float
+        """
+        if self._method == 0: return self._psi_interval_in_units_one_over_gamma
+        else:                 return self._psi_interval_function(e_over_ec)
+
+    #
+    # auxiliar methods
+    #
+
+    # The table abscissas (random numbers in [0,1]) are r = (1 - cos(pi t)) / 2 with t uniform in [0,1], so the
+    # intervals are smaller near 0 and 1 and the linear interpolation does not spread the tails of the distribution.
+    def _get_table_abscissas(self):
+        return 0.5 * (1.0 - numpy.cos(numpy.pi * numpy.linspace(0.0, 1.0, self._cdf_points)))
+
+    def _get_table_abscissas_index(self, random_in_0_1):
+        return numpy.arccos(1.0 - 2.0 * random_in_0_1) / numpy.pi * (self._cdf_points - 1)
+
+    def _calculate_row(self, e_over_ec):
+        psi1 = self.get_psi_interval(e_over_ec)
+        if self._method != 0 and (psi1 - self._psi_interval_in_units_one_over_gamma) > 1e-3:
+            print("Warning: bad sampling psi1=%f > psi_interval_in_units_one_over_gamma=%f" %
+                  (psi1, self._psi_interval_in_units_one_over_gamma))
+
+        angle_array_reduced = numpy.linspace(-0.5 * psi1, 0.5 * psi1, self._psi_interval_number_of_points)
+        if self._method == 0: fm_s, fm_p = sync_f_sigma_and_pi(angle_array_reduced, e_over_ec)
+        else:                 fm_s, fm_p = sync_f_sigma_and_pi_approx(angle_array_reduced, e_over_ec)
+        fm = numpy.asarray(fm_s + fm_p, dtype=float).reshape(-1)
+
+        random_in_0_1 = self._get_table_abscissas()
+        if not numpy.all(numpy.isfinite(fm)) or fm.min() == fm.max(): # typically when the trajectory is flat
+            return numpy.zeros_like(random_in_0_1)
+
+        # cdf (trapezoidal integration) and its inverse using only the strictly increasing part
+        cdf = numpy.concatenate(([0.0], numpy.cumsum(0.5 * (fm[1:] + fm[:-1]))))
+        cdf /= cdf[-1]
+        increasing = numpy.nonzero(numpy.diff(cdf) > 0)[0]
+        indices = numpy.concatenate((increasing, [increasing[-1] + 1]))
+        return numpy.interp(random_in_0_1, cdf[indices], angle_array_reduced[indices])
+
+
+if __name__ == "__main__":
+    import time
+    from srxraylib.util.inverse_method_sampler import Sampler1D
+
+    psi_interval = 40.0
+    sampler = VerticalDivergenceSampler(method=0, psi_interval_in_units_one_over_gamma=psi_interval)
+
+    nrays = 1000000
+    e_over_ec = 10 ** numpy.random.uniform(-3, 1, nrays)
+    t0 = time.time()
+    gamma_psi = sampler.get_sampled(e_over_ec, numpy.random.random(nrays))
+    t1 = time.time()
+    print("Batched sampler: %d rays in %.3f s" % (nrays, t1 - t0))
+
+    # check against the exact distribution and a ray-by-ray sampler for some values of E/Ec
+    angle_array_reduced = numpy.linspace(-0.5 * psi_interval, 0.5 * psi_interval, 1001)
+    for eene in [1e-3, 0.1, 0.37, 1.0, 5.0]:
+        fm_s, fm_p = sync_f_sigma_and_pi(angle_array_reduced, eene)
+        fm = fm_s + fm_p
+        reference = Sampler1D(fm, angle_array_reduced).get_n_sampled_points(200000)
+        batched = sampler.get_sampled(numpy.full(200000, eene), numpy.random.random(200000))
+        print("E/Ec=%g: std of gamma*psi: exact %.4f, ray by ray %.4f, batched %.4f" %
+              (eene, numpy.sqrt((angle_array_reduced ** 2 * fm).sum() / fm.sum()), reference.std(), batched.std()))
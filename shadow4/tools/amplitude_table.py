@@ -0,0 +1,334 @@
+"""
+Base class for tables of complex amplitudes (s- and p-polarization) calculated on an adaptive 2D grid and
+interpolated for every ray.
+
+The derived classes define the physics (the calculation of the amplitudes on a grid, method _calculate_amplitudes)
+and the axes of the table. This base class manages:
+    * the adaptive grid: the intervals are bisected until the interpolation error at the middle and center points
+      is below a given tolerance (in absolute value of the complex amplitude). The error of interpolating every
+      grid point from its neighbours is also checked, to refine the kinks not seen at the midpoints.
+    * the bilinear (hand-written, vectorized) or bicubic (scipy RectBivariateSpline) interpolation.
+    * the process-wide LRU cache of tables (each derived class has its own cache, keyed by get_key()).
+    * the optional storage of the tables in disk (npz files in a cache directory).
+
+Used by shadow4.physical_models.prerefl.reflectivity_table.CoatingReflectivityTable (mirror coatings) and
+shadow4.physical_models.crystal.crystal_reflectivity_table.CrystalReflectivityTable (perfect crystals).
+
+"""
+import os
+import zlib
+import threading
+from collections import OrderedDict
+
+import numpy
+from scipy.interpolate import RectBivariateSpline
+
+from shadow4.tools.logger import is_verbose, is_debug
+
+class AdaptiveAmplitudeTable(object):
+    """
+    Base class for tables of complex amplitudes (rs, rp) on an adaptive grid (x, y).
+
+    Constructor.
+
+    Parameters
+    ----------
+    tolerance : float, optional
+        The maximum allowed interpolation error (in the modulus of the complex amplitudes).
+    interpolation : int, optional
+        The interpolation order: 1=bilinear, 3=bicubic.
+    max_iterations : int, optional
+        The maximum number of refinements of the grid.
+    max_points : int, optional
+        The maximum number of points in each axis.
+
+    """
+    _cache = OrderedDict()  # the derived classes must define their own cache
+    _cache_lock = threading.RLock()
+    _cache_maxsize = 32
+    _cache_file_prefix = "s4table"
+
+    def __init__(self,
+                 tolerance=1e-4,
+                 interpolation=1,
+                 max_iterations=12,
+                 max_points=2049,
+                 ):
+        if interpolation not in [1, 3]: raise ValueError("interpolation must be 1 (bilinear) or 3 (bicubic)")
+
+        self._tolerance = tolerance
+        self._interpolation = interpolation
+        self._max_iterations = max_iterations
+        self._max_points = max_points
+
+        self._x = None
+        self._y = None
+        self._rs = None
+        self._rp = None
+        self._interpolators = None
+        self._error = None
+
+    #
+    # methods to be defined in the derived classes
+    #
+    def get_key(self):
+        """
+        Returns the key identifying the table (used for the memory and disk caches).
+
+        Returns
+        -------
+        tuple
+        """
+        raise NotImplementedError()
+
+    def _calculate_amplitudes(self, x, y):
+        # returns the complex amplitudes (rs, rp) in the grid defined by the 1D arrays x and y,
+        # with shape (x.size, y.size)
+        raise NotImplementedError()
+
+    #
+    # public methods
+    #
+    @classmethod
+    def clear_cache(cls):
+        """
+        Removes all the tables in the process-wide cache.
+        """
+        with cls._cache_lock:
+            cls._cache.clear()
+
+    def get_amplitudes(self):
+        """
+        Returns the tabulated amplitudes.
+
+        Returns
+        -------
+        tuple
+            (rs, rp) complex numpy arrays of shape (number of x points, number of y points).
+        """
+        return self._rs, self._rp
+
+    def get_error(self):
+        """
+        Returns the estimated interpolation error (the maximum found in the last refinement of the grid).
+
+        Returns
+        -------
+        float
+        """
+        return self._error
+
+    def calculate_on_grid(self, x_range, y_range, npoints=9, x_initial=None, y_initial=None):
+        """
+        Calculates the table on an adaptive grid covering the given ranges.
+
+        Parameters
+        ----------
+        x_range : list
+            [min, max] values of the first axis.
+        y_range : list
+            [min, max] values of the second axis.
+        npoints : int, optional
+            The initial number of (equispaced) points in each axis.
+        x_initial : numpy array, optional
+            Additional points of the initial grid of the first axis (e.g. to resolve narrow features).
+        y_initial : numpy array, optional
+            Additional points of the initial grid of the second axis.
+        """
+        x = numpy.linspace(x_range[0], x_range[1], npoints)
+        y = numpy.linspace(y_range[0], y_range[1], npoints)
+        if x_initial is not None:
+            x = numpy.union1d(x, numpy.asarray(x_initial)[(x_initial > x_range[0]) & (x_initial < x_range[1])])
+        if y_initial is not None:
+            y = numpy.union1d(y, numpy.asarray(y_initial)[(y_initial > y_range[0]) & (y_initial < y_range[1])])
+
+        name = self.__class__.__name__
+        for iteration in range(self._max_iterations + 1):
+            rs, rp = self._calculate_amplitudes(x, y)
+            self._set_table(x, y, rs, rp)
+
+            # error at the middle of the intervals (for all the grid values of the other axis) and at the cell centers
+            x_mid = 0.5 * (x[1:] + x[:-1])
+            y_mid = 0.5 * (y[1:] + y[:-1])
+            error_xm = self._get_error(x_mid, y)
+            error_ym = self._get_error(x, y_mid)
+            error_c = self._get_error(x_mid, y_mid)
+            # the error at a cell center is attributed to the axis with the largest error at the cell edges
+            edge_x = numpy.maximum(error_xm[:, 1:], error_xm[:, :-1])
+            edge_y = numpy.maximum(error_ym[1:, :], error_ym[:-1, :])
+            error_x = numpy.maximum(error_xm.max(axis=1), numpy.where(edge_x >= edge_y, error_c, 0.0).max(axis=1))
+            error_y = numpy.maximum(error_ym.max(axis=0), numpy.where(edge_x < edge_y, error_c, 0.0).max(axis=0))
+            # the midpoints may miss kinks (e.g. edges of total reflection): use also the error of interpolating
+            # every grid point from its two neighbours (scaled to the current interval length)
+            error_x = numpy.maximum(error_x, self._get_second_difference_error(x, rs, rp, axis=0))
+            error_y = numpy.maximum(error_y, self._get_second_difference_error(y, rs, rp, axis=1))
+            self._error = max(error_x.max(), error_y.max())
+
+            if is_debug(): print(">>>> %s iteration %d: %d x %d points, error %g" %
+                                 (name, iteration, x.size, y.size, self._error))
+
+            if self._error <= self._tolerance: break
+            if iteration == self._max_iterations: break
+
+            # bisect the intervals with large errors
+            bad_x = x_mid[error_x > self._tolerance]
+            bad_y = y_mid[error_y > self._tolerance]
+            if x.size + bad_x.size > self._max_points: bad_x = numpy.zeros(0)
+            if y.size + bad_y.size > self._max_points: bad_y = numpy.zeros(0)
+            if bad_x.size == 0 and bad_y.size == 0: break
+            x = numpy.union1d(x, bad_x)
+            y = numpy.union1d(y, bad_y)
+
+        if self._error > self._tolerance and is_verbose():
+            print("%s: tolerance %g not reached (error %g) with %d x %d points." %
+                  (name, self._tolerance, self._error, x.size, y.size))
+
+    def save(self, cache_dir):
+        """
+        Saves the table in a directory (the file name is obtained from the table key).
+
+        Parameters
+        ----------
+        cache_dir : str
+            The directory name.
+
+        Returns
+        -------
+        boolean
+            True if success.
+        """
+        filename = self._get_cache_filename(cache_dir)
+        tmp_name = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(tmp_name, "wb") as f:
+                numpy.savez(f, key=numpy.array(repr(self.get_key())), x=self._x, y=self._y,
+                            rs=self._rs, rp=self._rp, error=self._error)
+            os.replace(tmp_name, filename) # atomic, for concurrent runs
+            if is_verbose(): print("%s: table saved in: %s" % (self.__class__.__name__, filename))
+            return True
+        except OSError:
+            try:    os.remove(tmp_name)
+            except: pass
+            return False
+
+    def load(self, cache_dir):
+        """
+        Loads the table from a directory, if it has been saved there (with the same key).
+
+        Parameters
+        ----------
+        cache_dir : str
+            The directory name.
+
+        Returns
+        -------
+        boolean
+            True if the table has been loaded.
+        """
+        filename = self._get_cache_filename(cache_dir)
+        try:
+            with numpy.load(filename) as data:
+                if str(data["key"]) != repr(self.get_key()): return False
+                x, y, rs, rp, error = data["x"], data["y"], data["rs"], data["rp"], float(data["error"])
+        except Exception:
+            return False
+
+        self._set_table(x, y, rs, rp)
+        self._error = error
+        if is_verbose(): print("%s: table loaded from: %s" % (self.__class__.__name__, filename))
+        return True
+
+    #
+    # auxiliar methods
+    #
+    @classmethod
+    def _get_padded_range(cls, value_range, min_width):
+        v_min, v_max = float(value_range[0]), float(value_range[1])
+        pad = 0.5 * max(min_width - (v_max - v_min), 0.0)
+        return v_min - pad, v_max + pad
+
+    @classmethod
+    def _get_cached_table(cls, key):
+        with cls._cache_lock:
+            cached = cls._cache.get(key, None)
+            if cached is not None: cls._cache.move_to_end(key)
+            return cached
+
+    @classmethod
+    def _set_cached_table(cls, key, table):
+        with cls._cache_lock:
+            cls._cache[key] = table
+            cls._cache.move_to_end(key)
+            while len(cls._cache) > cls._cache_maxsize:
+                cls._cache.popitem(last=False)
+
+    def _covers_grid(self, x_range, y_range):
+        if self._x is None: return False
+        return self._x[0] <= x_range[0] and x_range[1] <= self._x[-1] and \
+               self._y[0] <= y_range[0] and y_range[1] <= self._y[-1]
+
+    def _get_union_ranges(self, x_range, y_range):
+        return [min(x_range[0], self._x[0]), max(x_range[1], self._x[-1])], \
+               [min(y_range[0], self._y[0]), max(y_range[1], self._y[-1])]
+
+    def _get_cache_filename(self, cache_dir):
+        return os.path.join(cache_dir, "%s_%08x.npz" % (self._cache_file_prefix, zlib.crc32(repr(self.get_key()).encode())))
+
+    def _set_table(self, x, y, rs, rp):
+        self._x = x
+        self._y = y
+        self._rs = rs
+        self._rp = rp
+        if self._interpolation == 3 and x is not None:
+            self._interpolators = [RectBivariateSpline(x, y, array, kx=3, ky=3)
+                                   for array in [rs.real, rs.imag, rp.real, rp.imag]]
+        else:
+            self._interpolators = None
+
+    def _interpolate(self, x, y, grid=False):
+        # grid=True: evaluation on the grid defined by the 1D arrays x and y (with increasing values)
+        if self._interpolation == 3:
+            i_rs_re, i_rs_im, i_rp_re, i_rp_im = self._interpolators
+            if grid:
+                return i_rs_re(x, y) + 1j * i_rs_im(x, y), \
+                       i_rp_re(x, y) + 1j * i_rp_im(x, y)
+            else:
+                return i_rs_re.ev(x, y) + 1j * i_rs_im.ev(x, y), \
+                       i_rp_re.ev(x, y) + 1j * i_rp_im.ev(x, y)
+
+        # bilinear interpolation (linear extrapolation outside the table)
+        i_x = numpy.clip(numpy.searchsorted(self._x, x) - 1, 0, self._x.size - 2)
+        i_y = numpy.clip(numpy.searchsorted(self._y, y) - 1, 0, self._y.size - 2)
+        w_x = (x - self._x[i_x]) / (self._x[i_x + 1] - self._x[i_x])
+        w_y = (y - self._y[i_y]) / (self._y[i_y + 1] - self._y[i_y])
+        if grid:
+            i_x, w_x = i_x[:, None], w_x[:, None]
+            i_y, w_y = i_y[None, :], w_y[None, :]
+
+        out = []
+        for table in [self._rs, self._rp]:
+            out.append((1 - w_x) * ((1 - w_y) * table[i_x, i_y] + w_y * table[i_x, i_y + 1]) +
+                       w_x * ((1 - w_y) * table[i_x + 1, i_y] + w_y * table[i_x + 1, i_y + 1]))
+        return out[0], out[1]
+
+    @classmethod
+    def _get_second_difference_error(cls, grid, rs, rp, axis=0):
+        # error of the linear interpolation of the point i from the points i-1 and i+1, divided by 2 (the error
+        # for half interval at a kink; it would be 4 for a smooth function), attributed to the intervals (i-1, i)
+        # and (i, i+1).
+        error = numpy.zeros(grid.size - 1)
+        if grid.size < 3: return error
+        w = ((grid[1:-1] - grid[:-2]) / (grid[2:] - grid[:-2]))[:, None]
+        d2 = 0.0
+        for table in [rs, rp]:
+            if axis == 1: table = table.T
+            d2 = numpy.maximum(d2, numpy.abs(table[1:-1] - (1 - w) * table[:-2] - w * table[2:]).max(axis=1))
+        error[:-1] = 0.5 * d2
+        error[1:] = numpy.maximum(error[1:], 0.5 * d2)
+        return error
+
+    def _get_error(self, x, y):
+        rs, rp = self._calculate_amplitudes(x, y)
+        rs_i, rp_i = self._interpolate(x, y, grid=True)
+        return numpy.maximum(numpy.abs(rs_i - rs), numpy.abs(rp_i - rp))
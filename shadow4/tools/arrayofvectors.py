@@ -3,10 +3,22 @@
 
 Set of functions to make operations with an array of 3D vectors, v[n_vectors,3]
 
+Most functions accept an optional out= array to store the result and avoid allocating new arrays. Some fused
+kernels (e.g. vector_cross_norm, vector_grating_diffraction) combine several operations in a single call.
+If numexpr is installed, it is used by the fused kernels for large arrays.
+
 """
 import numpy
 
-def vector_cross(u ,v):
+try:
+    import numexpr
+    NUMEXPR_INSTALLED = True
+except ImportError:
+    NUMEXPR_INSTALLED = False
+
+NUMEXPR_MIN_SIZE = 100000 # numexpr is only used for arrays larger than this
+
+def vector_cross(u ,v, out=None):
     """
 
     Calculate the vector cross product.
@@ -17,6 +29,8 @@ def vector_cross(u ,v):
         input vector 1.
     v : numpy array shape (n_vectors,3)
         input vector 2.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
 
     Returns
     -------
@@ -27,10 +41,14 @@ def vector_cross(u ,v):
     # w = u X v
     # u = array (npoints,vector_index)
 
-    w = numpy.zeros_like(u)
-    w[: ,0] = u[: ,1] * v[: ,2] - u[: ,2] * v[: ,1]
-    w[: ,1] = u[: ,2] * v[: ,0] - u[: ,0] * v[: ,2]
-    w[: ,2] = u[: ,0] * v[: ,1] - u[: ,1] * v[: ,0]
+    w0 = u[: ,1] * v[: ,2] - u[: ,2] * v[: ,1]
+    w1 = u[: ,2] * v[: ,0] - u[: ,0] * v[: ,2]
+    w2 = u[: ,0] * v[: ,1] - u[: ,1] * v[: ,0]
+
+    w = numpy.empty_like(u) if out is None else out # the components are stored at the end (out can be u or v)
+    w[: ,0] = w0
+    w[: ,1] = w1
+    w[: ,2] = w2
 
     return w
 
@@ -55,7 +73,7 @@ def vector_modulus(u):
 def vector_modulus_square(u):
     return ( u[: ,0 ]**2 + u[: ,1 ]**2 + u[: ,2 ]**2)
 
-def vector_norm(u):
+def vector_norm(u, out=None):
     """
 
     Calculate the normalized vector.
@@ -64,6 +82,8 @@ def vector_norm(u):
     ----------
     u : numpy array shape (n_vectors,3)
         input vector.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
 
     Returns
     -------
@@ -72,13 +92,10 @@ def vector_norm(u):
 
     """
     # w = u / |u|
-    u_norm = numpy.zeros_like(u)
     uu = numpy.sqrt( u[: ,0 ]**2 + u[: ,1 ]**2 + u[: ,2 ]**2)
-    for i in range(3):
-        u_norm[: ,i] = uu
-    return u / u_norm
+    return numpy.divide(u, uu[:, numpy.newaxis], out=out)
 
-def vector_dot(u, v):
+def vector_dot(u, v, out=None):
     """
 
     Calculate the dot product of two vectors.
@@ -89,6 +106,8 @@ def vector_dot(u, v):
         input vector 1.
     v : numpy array shape (n_vectors,3)
         input vector 2.
+    out : numpy array shape (n_vectors), optional
+        If given, the result is stored in this array.
 
     Returns
     -------
@@ -97,10 +116,13 @@ def vector_dot(u, v):
 
     """
     # w = u . v
-    return u[: ,0] * v[: ,0] + u[: ,1] * v[: ,1] + u[: ,2] * v[: ,2]
+    w = numpy.multiply(u[: ,0], v[: ,0], out=out)
+    w += u[: ,1] * v[: ,1]
+    w += u[: ,2] * v[: ,2]
+    return w
 
 
-def vector_sum(u, v):
+def vector_sum(u, v, out=None):
     """
 
     Calculate the sum of two vectors.
@@ -111,6 +133,8 @@ def vector_sum(u, v):
         input vector 1.
     v : numpy array shape (n_vectors,3)
         input vector 2.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
 
     Returns
     -------
@@ -119,12 +143,9 @@ def vector_sum(u, v):
 
     """
     # w = u + v
-    w = numpy.zeros_like(u)
-    for i in range(3):
-        w[: ,i] = u[: ,i] + v[: ,i]
-    return w
+    return numpy.add(u, v, out=out)
 
-def vector_multiply_scalar(u, k):
+def vector_multiply_scalar(u, k, out=None):
     """
 
     Calculate the product of a vector by a scalar.
@@ -135,6 +156,8 @@ def vector_multiply_scalar(u, k):
         input vector 1.
     k : numpy array shape (n_vectors)
         scalar values to multiply by.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
 
     Returns
     -------
@@ -143,17 +166,14 @@ def vector_multiply_scalar(u, k):
 
     """
 
-    kk = numpy.array(k)
+    kk = numpy.asarray(k)
 
     if kk.size == 1:
-        return u * kk
+        return numpy.multiply(u, kk.reshape(-1)[0], out=out)
     else:
-        w = numpy.zeros_like(u)
-        for i in range(3):
-            w[: ,i] = u[: ,i] * kk
-        return w
+        return numpy.multiply(u, kk[:, numpy.newaxis], out=out)
 
-def vector_add_scalar(u, k):
+def vector_add_scalar(u, k, out=None):
     """
 
     Calculate the sum of a vector and a scalar constant.
@@ -164,6 +184,8 @@ def vector_add_scalar(u, k):
         input vector 1.
     k : numpy array shape (n_vectors)
         scalar values to be added.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
 
     Returns
     -------
@@ -171,18 +193,15 @@ def vector_add_scalar(u, k):
         Result vector.
 
     """
-    kk = numpy.array(k)
+    kk = numpy.asarray(k)
 
     if kk.size == 1:
-        return u + kk
+        return numpy.add(u, kk.reshape(-1)[0], out=out)
     else:
-        w = numpy.zeros_like(u)
-        for i in range(3):
-            w[: ,i] = u[: ,i] + kk
-        return w
+        return numpy.add(u, kk[:, numpy.newaxis], out=out)
 
 
-def vector_diff(u, v):
+def vector_diff(u, v, out=None):
     """
 
     Calculate the difference of two vectors u - v.
@@ -193,6 +212,8 @@ def vector_diff(u, v):
         input vector 1.
     v : numpy array shape (n_vectors,3)
         input vector 2.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
 
     Returns
     -------
@@ -201,12 +222,9 @@ def vector_diff(u, v):
 
     """
     # w = u - v
-    w = numpy.zeros_like(u)
-    for i in range(3):
-        w[: ,i] = u[: ,i] - v[: ,i]
-    return w
+    return numpy.subtract(u, v, out=out)
 
-def vector_reflection(v1, normal): # copied from s4_conic()
+def vector_reflection(v1, normal, out=None): # copied from s4_conic()
     """
 
     Calculate the reflection of a vector (ray) on a surface.
@@ -217,6 +235,8 @@ def vector_reflection(v1, normal): # copied from s4_conic()
         Incident unit vector.
     normal : array of 3D vectors, shape: (n_vectors,3)
         Normal unit vector at the interface.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
 
     Returns
     -------
@@ -226,9 +246,12 @@ def vector_reflection(v1, normal): # copied from s4_conic()
 
     # \vec{r} = \vec{i} - 2 (\vec{i} \vec{n}) \vec{n}
     normal_norm = vector_norm(normal)
-    return v1 - 2 * vector_multiply_scalar( normal_norm, vector_dot(v1, normal_norm))
+    tmp = vector_dot(v1, normal_norm)
+    tmp *= 2
+    vector_multiply_scalar(normal_norm, tmp, out=normal_norm)
+    return numpy.subtract(v1, normal_norm, out=out)
 
-def vector_refraction(vin, normal, n1, n2, sgn=1, do_check=0):
+def vector_refraction(vin, normal, n1, n2, sgn=1, do_check=0, out=None):
     """
 
     Calculate the refraction (transmission) vector using Snell's Law in vector form.
@@ -247,6 +270,8 @@ def vector_refraction(vin, normal, n1, n2, sgn=1, do_check=0):
         +1 or -1 to play and adjust the directions.
     do_check : int
         A flag to display incident and refracted angles.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
 
     Returns
     -------
@@ -264,12 +289,13 @@ def vector_refraction(vin, normal, n1, n2, sgn=1, do_check=0):
     vin_norm = vector_norm(vin)
     normal_norm = vector_norm(normal)
 
-    n_cross_vin = vector_cross(normal_norm, vin_norm)
-    n_opp_cross_vin = vector_cross(normal_norm * (-1), vin_norm)
-
-    sq2 = 1 - vector_dot(n_cross_vin, n_cross_vin) *  (n1 / n2) ** 2
-    # vout = (n1/n2) * vector_cross(normal_norm,n_opp_cross_vin) - vector_multiply_scalar(normal_norm, numpy.sqrt(sq2))
-    vout = vector_multiply_scalar(vector_cross(normal_norm, n_opp_cross_vin), (n1 / n2)) - vector_multiply_scalar(normal_norm, sgn * numpy.sqrt(sq2))
+    # for unit vectors:  n x (-n x vin) = vin - (n.vin) n  and  |n x vin|^2 = 1 - (n.vin)^2
+    ratio = n1 / n2
+    cos1 = vector_dot(vin_norm, normal_norm)
+    sq2 = 1 - (1 - cos1 ** 2) * ratio ** 2
+    # vout = (n1/n2) * (vin - (n.vin) n) - sgn * sqrt(sq2) n
+    vout = vector_multiply_scalar(vin_norm, ratio, out=out)
+    vout -= vector_multiply_scalar(normal_norm, ratio * cos1 + sgn * numpy.sqrt(sq2), out=normal_norm if not do_check else None)
 
     if do_check:
         theta1 = numpy.arccos( vector_dot(vin_norm, normal_norm) * (-1))
@@ -279,7 +305,7 @@ def vector_refraction(vin, normal, n1, n2, sgn=1, do_check=0):
         print(">>>>> theta2 check: ", numpy.degrees(numpy.arcsin(n1/n2*numpy.sin(theta1))))
     return vout
 
-def vector_scattering(K_IN, H, NORMAL):
+def vector_scattering(K_IN, H, NORMAL, out=None):
     """
 
     Calculate the scattering of a wavevector.
@@ -298,24 +324,112 @@ def vector_scattering(K_IN, H, NORMAL):
         The diffraction vector.
     NORMAL : numpy array of 3D vectors, shape: (n_vectors,3)
         The normal vector.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
 
     Returns
     -------
     numpy array
         The diffracted wavevector with shape (n_vectors,3).
     """
-    H_perp = vector_multiply_scalar(NORMAL, vector_dot(H, NORMAL))
-    H_par = vector_diff(H, H_perp)
-
-    K_IN_perp = vector_multiply_scalar(NORMAL, vector_dot(K_IN, NORMAL))
-    K_IN_par = vector_diff(K_IN, K_IN_perp)
+    # K_OUT_par = (K_IN + H) - ((K_IN + H).NORMAL) NORMAL
+    k2 = vector_modulus_square(K_IN)
+    K_OUT = vector_sum(K_IN, H, out=out)
+    tmp = vector_dot(K_OUT, NORMAL)
+    for i in range(3):
+        K_OUT[:, i] -= tmp * NORMAL[:, i]
 
-    K_OUT_par = vector_sum(K_IN_par, H_par)
-    K_OUT_perp = vector_multiply_scalar(NORMAL, numpy.sqrt(vector_modulus_square(K_IN) - vector_modulus_square(K_OUT_par)))
-    K_OUT = vector_sum(K_OUT_par, K_OUT_perp)
+    # K_OUT_perp = sqrt(|K_IN|^2 - |K_OUT_par|^2) NORMAL
+    k2 -= vector_modulus_square(K_OUT)
+    numpy.sqrt(k2, out=k2)
+    for i in range(3):
+        K_OUT[:, i] += k2 * NORMAL[:, i]
     return K_OUT
 
-def vector_rotate_around_axis(u, rotation_axis, angle):
+def vector_cross_norm(u, v, out=None):
+    """
+
+    Calculate the normalized vector cross product (fused vector_norm(vector_cross(u, v))).
+
+    Parameters
+    ----------
+    u : numpy array shape (n_vectors,3)
+        input vector 1.
+    v : numpy array shape (n_vectors,3)
+        input vector 2.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
+
+    Returns
+    -------
+     numpy array shape (n_vectors,3)
+        Result unit vector.
+
+    """
+    w = vector_cross(u, v, out=out)
+    return vector_norm(w, out=w)
+
+def vector_grating_diffraction(v_in, k_modulus, normal, g_modulus, out=None):
+    """
+
+    Calculate the direction diffracted by a grating ruled along X (fused kernel):
+
+        - K_OUT_PARALLEL = K_IN_PARALLEL + G_MOD * TANGENT, with TANGENT = NORMAL x (1,0,0)
+
+        - |K_OUT| = |K_IN|
+
+    and returns K_OUT normalized.
+
+    Parameters
+    ----------
+    v_in  : numpy array of 3D vectors, shape: (n_vectors,3)
+        Incident unit vector.
+    k_modulus : numpy array shape (n_vectors)
+        The modulus of the incident wavevector (2 pi / wavelength).
+    normal : numpy array of 3D vectors, shape: (n_vectors,3)
+        The (outward) unit normal vector.
+    g_modulus : float or numpy array shape (n_vectors)
+        The modulus of the grating vector (2 pi order * ruling density), in the same units as k_modulus.
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
+
+    Returns
+    -------
+    numpy array
+        The unit vector along the diffracted direction with shape (n_vectors,3).
+    """
+    nx, ny, nz = normal[:, 0], normal[:, 1], normal[:, 2]
+    vx, vy, vz = v_in[:, 0], v_in[:, 1], v_in[:, 2]
+
+    if out is None: out = numpy.empty_like(v_in)
+
+    if NUMEXPR_INSTALLED and vx.size >= NUMEXPR_MIN_SIZE:
+        k = k_modulus
+        g = g_modulus
+        # the tangent versor NORMAL x (1,0,0) is (0, nz, -ny)
+        c = numexpr.evaluate("k * (vx * nx + vy * ny + vz * nz)")
+        kx = numexpr.evaluate("k * vx - c * nx")
+        ky = numexpr.evaluate("k * vy - c * ny + g * nz")
+        kz = numexpr.evaluate("k * vz - c * nz - g * ny")
+        kn = numexpr.evaluate("sqrt(k ** 2 - kx ** 2 - ky ** 2 - kz ** 2)")
+        kk = numexpr.evaluate("sqrt((kx + kn * nx) ** 2 + (ky + kn * ny) ** 2 + (kz + kn * nz) ** 2)")
+        out[:, 0] = numexpr.evaluate("(kx + kn * nx) / kk")
+        out[:, 1] = numexpr.evaluate("(ky + kn * ny) / kk")
+        out[:, 2] = numexpr.evaluate("(kz + kn * nz) / kk")
+    else:
+        c = k_modulus * (vx * nx + vy * ny + vz * nz)
+        kx = k_modulus * vx - c * nx
+        ky = k_modulus * vy - c * ny + g_modulus * nz
+        kz = k_modulus * vz - c * nz - g_modulus * ny
+        kn = numpy.sqrt(k_modulus ** 2 - kx ** 2 - ky ** 2 - kz ** 2)
+        out[:, 0] = kx + kn * nx
+        out[:, 1] = ky + kn * ny
+        out[:, 2] = kz + kn * nz
+        vector_norm(out, out=out)
+
+    return out
+
+def vector_rotate_around_axis(u, rotation_axis, angle, out=None):
     """Rotates the vector around an axis. It uses the Rodrigues formula [rf]_
 
     Parameters
@@ -326,6 +440,9 @@ def vector_rotate_around_axis(u, rotation_axis, angle):
     angle : float
         Rotation angle in radiants.
 
+    out : numpy array shape (n_vectors,3), optional
+        If given, the result is stored in this array (it can be one of the inputs).
+
     Returns
     -------
     Vector instance
@@ -351,15 +468,15 @@ def vector_rotate_around_axis(u, rotation_axis, angle):
 
     unit_rotation_axis = vector_norm(rotation_axis1)
 
-    rotated_vector = vector_multiply_scalar(u, numpy.cos(angle))
-
+    scalar_factor = vector_dot(u, unit_rotation_axis) * (1.0 - numpy.cos(angle))
     tmp_vector = vector_cross(unit_rotation_axis, u)
-    tmp_vector = vector_multiply_scalar(tmp_vector, numpy.sin(angle))
-    rotated_vector = vector_sum(rotated_vector, tmp_vector)
+    vector_multiply_scalar(tmp_vector, numpy.sin(angle), out=tmp_vector)
 
-    scalar_factor = vector_dot(u, unit_rotation_axis) * (1.0 - numpy.cos(angle))
-    tmp_vector = vector_multiply_scalar(unit_rotation_axis, scalar_factor)
-    rotated_vector = vector_sum(rotated_vector, tmp_vector)
+    rotated_vector = vector_multiply_scalar(u, numpy.cos(angle), out=out) # u is not used after this (out can be u)
+    rotated_vector += tmp_vector
+
+    vector_multiply_scalar(unit_rotation_axis, scalar_factor, out=unit_rotation_axis)
+    rotated_vector += unit_rotation_axis
 
     return rotated_vector
 
@@ -480,4 +597,24 @@ if __name__ == "__main__":
     axis = numpy.zeros((11, 3))
     axis[:,0] = 1
     print(axis.shape)
-    print(vector_rotate_around_axis(u, axis, numpy.radians(10) ))
\ No newline at end of file
+    print(vector_rotate_around_axis(u, axis, numpy.radians(10) ))
+    # fused kernels
+    u = numpy.random.normal(size=(1000, 3))
+    v = numpy.random.normal(size=(1000, 3))
+    assert (numpy.abs(vector_cross_norm(u, v) - vector_norm(vector_cross(u, v))).max() < 1e-12)
+
+    # grating: same as vector_scattering with H = G_MOD * (NORMAL x X)
+    v_in = numpy.zeros((1000, 3))
+    v_in[:, 1] = numpy.cos(0.02)
+    v_in[:, 2] = -numpy.sin(0.02)
+    normal = numpy.zeros((1000, 3))
+    normal[:, 2] = 1.0
+    normal = vector_norm(normal + numpy.random.normal(size=(1000, 3)) * 1e-4)
+    k_modulus = numpy.ones(1000) * 5e9
+    x_vrs = numpy.zeros((1000, 3))
+    x_vrs[:, 0] = 1.0
+    H = vector_multiply_scalar(vector_cross(normal, x_vrs), -3.8e6)
+    v_out1 = vector_norm(vector_scattering(vector_multiply_scalar(v_in, k_modulus), H, normal))
+    v_out2 = vector_grating_diffraction(v_in, k_modulus, normal, -3.8e6)
+    print("\ngrating diffraction, max difference: ", numpy.abs(v_out1 - v_out2).max())
+    assert (numpy.abs(v_out1 - v_out2).max() < 1e-12)
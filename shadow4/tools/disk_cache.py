@@ -0,0 +1,376 @@
+"""
+
+Persistent (on-disk) cache of the precomputed radiation of the synchrotron sources (undulator, wiggler and
+bending magnet).
+
+The results of a calculation (a dictionary with numpy arrays, numbers, strings, None or other dictionaries) are
+stored in HDF5 files in a cache directory. The files are content-addressed: the file name is obtained from a hash
+of the name of the calculation and all its input parameters (electron beam, magnetic structure, grids...), so
+a new source object with the same parameters (e.g., only the number of rays or the seed are changed) reuses the
+stored result instead of computing it again. The key also includes the versions of shadow4 and srxraylib and a hash
+of the source file of the calculator, so the stored results are not reused after the code is changed.
+
+    * The files are written in a temporary file and then renamed (atomic), so concurrent runs can share the cache.
+    * The total size of the cache directory is bounded: the least recently used files (by modification time,
+      updated when a file is read) are removed.
+    * The cache can be disabled (RADIATION_CACHE.set_enabled(False)), then the calculations are always done.
+
+Usage:
+    result = RADIATION_CACHE.get("calculation_name", parameters, calculator) # calculator(**parameters) returns a dict
+    clear_radiation_cache()                                                   # removes all the files.
+
+"""
+import os
+import tempfile
+import threading
+import hashlib
+import inspect
+
+import numpy
+import h5py
+
+from shadow4.tools.logger import is_verbose
+
+class DiskCache(object):
+    """
+    Content-addressed cache of dictionaries stored in HDF5 files.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        The cache directory (default: shadow4_cache/radiation in the system temporary directory).
+    max_size : int, optional
+        The maximum size in bytes of the files in the cache directory.
+    enabled : boolean, optional
+        If False, the cache is not used.
+    """
+    _version = 1 # change it when the stored calculations change, to invalidate the old files
+
+    def __init__(self, cache_dir=None, max_size=500 * 1024 ** 2, enabled=True):
+        self._cache_dir = cache_dir if cache_dir is not None else \
+            os.path.join(tempfile.gettempdir(), "shadow4_cache", "radiation")
+        self._max_size = max_size
+        self._enabled = enabled
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, name, parameters, calculator, key_parameters=None):
+        """
+        Returns the result of a calculation, reading it from the cache if it has been stored there.
+
+        Parameters
+        ----------
+        name : str
+            The name of the calculation (used in the key and in the file name).
+        parameters : dict
+            The input parameters of the calculation (numbers, strings, None, booleans, numpy arrays, lists or tuples).
+        calculator : callable
+            The function doing the calculation: calculator(**parameters) returns a dictionary.
+        key_parameters : dict, optional
+            Other values identifying the calculation, used in the key but not passed to the calculator (e.g. the
+            modification time and size of an input file).
+
+        Returns
+        -------
+        dict
+            The result of the calculation (a new object, it can be modified by the caller).
+        """
+        if not self._enabled: return calculator(**parameters)
+
+        key = self.get_key(name, parameters if key_parameters is None else {**key_parameters, **parameters},
+                           calculator=calculator)
+        filename = self._get_filename(name, key)
+
+        result = self._load(filename, key)
+        with self._lock:
+            if result is None: self._misses += 1
+            else:              self._hits += 1
+        if result is not None:
+            if is_verbose(): print("DiskCache: %s loaded from: %s" % (name, filename))
+            return result
+
+        result = calculator(**parameters)
+        if self._save(filename, key, result):
+            if is_verbose(): print("DiskCache: %s saved in: %s" % (name, filename))
+            self._evict()
+        return result
+
+    def get_key(self, name, parameters, calculator=None):
+        """
+        Returns the key identifying a calculation (a text with the name, the parameters, the cache version, the
+        versions of shadow4 and srxraylib and a hash of the source file of the calculator).
+        The numpy arrays are represented by their dtype, shape and a hash of their values.
+
+        Parameters
+        ----------
+        name : str
+            The name of the calculation.
+        parameters : dict
+            The input parameters of the calculation.
+        calculator : callable, optional
+            The function doing the calculation.
+
+        Returns
+        -------
+        str
+        """
+        return repr((self._version, _get_package_versions(), _get_source_hash(calculator), name,
+                     tuple((k, self._get_hashable(parameters[k])) for k in sorted(parameters))))
+
+    def clear(self):
+        """
+        Removes all the files in the cache directory.
+        """
+        with self._lock:
+            for filename, _, _ in self._get_files():
+                try:    os.remove(filename)
+                except OSError: pass
+            self._hits = 0
+            self._misses = 0
+
+    def is_enabled(self):
+        """
+        Returns if the cache is enabled.
+
+        Returns
+        -------
+        boolean
+        """
+        return self._enabled
+
+    def set_enabled(self, enabled=True):
+        """
+        Enables or disables the cache (if disabled, the calculations are always done and nothing is stored).
+
+        Parameters
+        ----------
+        enabled : boolean, optional
+            The flag.
+        """
+        self._enabled = enabled
+
+    def get_cache_dir(self):
+        """
+        Returns the cache directory.
+
+        Returns
+        -------
+        str
+        """
+        return self._cache_dir
+
+    def set_cache_dir(self, cache_dir):
+        """
+        Sets the cache directory (it is created when the first file is stored).
+
+        Parameters
+        ----------
+        cache_dir : str
+            The directory name.
+        """
+        self._cache_dir = cache_dir
+
+    def get_max_size(self):
+        """
+        Returns the maximum size in bytes of the cache directory.
+
+        Returns
+        -------
+        int
+        """
+        return self._max_size
+
+    def set_max_size(self, max_size):
+        """
+        Sets the maximum size in bytes of the cache directory (the least recently used files are removed if needed).
+
+        Parameters
+        ----------
+        max_size : int
+            The maximum size in bytes.
+        """
+        self._max_size = max_size
+        self._evict()
+
+    def info(self):
+        """
+        Returns a text with information on the cache.
+
+        Returns
+        -------
+        str
+        """
+        files = self._get_files()
+        with self._lock:
+            txt = "DiskCache: %s (%s)\n" % (self._cache_dir, "enabled" if self._enabled else "disabled")
+            txt += "    %d files, %d bytes (max %d), %d hits, %d misses\n" % \
+                   (len(files), sum([f[2] for f in files]), self._max_size, self._hits, self._misses)
+            for filename, _, size in files:
+                txt += "    %s: %d bytes\n" % (os.path.basename(filename), size)
+        return txt
+
+    #
+    # auxiliar methods
+    #
+    @classmethod
+    def _get_hashable(cls, value):
+        if isinstance(value, dict):
+            return tuple((k, cls._get_hashable(value[k])) for k in sorted(value))
+        elif isinstance(value, (list, tuple)):
+            return tuple(cls._get_hashable(v) for v in value)
+        elif isinstance(value, numpy.ndarray):
+            value = numpy.ascontiguousarray(value)
+            return ("ndarray", value.dtype.str, value.shape, hashlib.sha256(value.tobytes()).hexdigest())
+        elif isinstance(value, numpy.generic):
+            return value.item()
+        elif value is None or isinstance(value, (bool, int, float, complex, str)):
+            return value
+        else:
+            raise TypeError("DiskCache: parameter not supported in key: %s" % repr(type(value)))
+
+    def _get_filename(self, name, key):
+        return os.path.join(self._cache_dir, "%s_%s.h5" % (name, hashlib.sha256(key.encode()).hexdigest()[0:32]))
+
+    def _get_files(self):
+        # list of (filename, modification time, size) of the cache files
+        files = []
+        try:
+            names = os.listdir(self._cache_dir)
+        except OSError:
+            return files
+        for name in names:
+            if not name.endswith(".h5"): continue
+            filename = os.path.join(self._cache_dir, name)
+            try:
+                stat = os.stat(filename)
+            except OSError: # removed by another process
+                continue
+            files.append((filename, stat.st_mtime, stat.st_size))
+        return files
+
+    def _evict(self):
+        # removes the least recently used files until the size of the cache is below the maximum
+        with self._lock:
+            files = self._get_files()
+            size = sum([f[2] for f in files])
+            for filename, _, file_size in sorted(files, key=lambda f: f[1]):
+                if size <= self._max_size: break
+                try:
+                    os.remove(filename)
+                    if is_verbose(): print("DiskCache: removed file: %s" % filename)
+                except OSError:
+                    pass
+                size -= file_size
+
+    def _load(self, filename, key):
+        try:
+            with h5py.File(filename, "r") as f:
+                if f.attrs["shadow4_cache_key"] != key: return None # hash collision
+                result = self._read_group(f["result"])
+            os.utime(filename) # for the LRU eviction
+        except Exception:
+            return None
+        return result
+
+    def _save(self, filename, key, result):
+        tmp_name = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with h5py.File(tmp_name, "w") as f:
+                f.attrs["shadow4_cache_key"] = key
+                self._write_group(f.create_group("result"), result)
+            os.replace(tmp_name, filename) # atomic, for concurrent runs
+            return True
+        except (OSError, TypeError, ValueError) as e:
+            if is_verbose(): print("DiskCache: cannot store file %s: %s" % (filename, repr(e)))
+            try:    os.remove(tmp_name)
+            except OSError: pass
+            return False
+
+    @classmethod
+    def _write_group(cls, group, dictionary):
+        for k, v in dictionary.items():
+            if isinstance(v, dict):
+                cls._write_group(group.create_group(k), v)
+            elif v is None:
+                group.attrs[k] = h5py.Empty("f8")
+            elif isinstance(v, str):
+                group.attrs[k] = v
+            else:
+                v = numpy.asarray(v)
+                if v.dtype.kind not in "biufc": raise TypeError("DiskCache: value not supported for key %s" % k)
+                group.create_dataset(k, data=v)
+
+    @classmethod
+    def _read_group(cls, group):
+        out = {}
+        for k, v in group.attrs.items():
+            out[k] = None if isinstance(v, h5py.Empty) else v
+        for k, v in group.items():
+            if isinstance(v, h5py.Group): out[k] = cls._read_group(v)
+            else:                         out[k] = v[()]
+        return out
+
+#
+# code versions used in the keys
+#
+_PACKAGE_VERSIONS = None
+
+def _get_package_versions():
+    # the installed versions of the packages doing the calculations
+    global _PACKAGE_VERSIONS
+    if _PACKAGE_VERSIONS is None:
+        from importlib.metadata import version
+        versions = []
+        for package in ["shadow4", "srxraylib"]:
+            try:    versions.append((package, version(package)))
+            except Exception: versions.append((package, None))
+        _PACKAGE_VERSIONS = tuple(versions)
+    return _PACKAGE_VERSIONS
+
+def _get_source_hash(calculator):
+    # hash of the source file where the calculator is defined (changes in the development versions are not
+    # reflected in the package version)
+    if calculator is None: return None
+    try:
+        with open(inspect.getsourcefile(inspect.unwrap(calculator)), "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (TypeError, OSError):
+        return None
+
+#
+# the process-wide cache for the radiation of the synchrotron sources
+#
+RADIATION_CACHE = DiskCache()
+
+def clear_radiation_cache():
+    """
+    Removes all the files in the cache directory of the radiation of the synchrotron sources.
+    """
+    RADIATION_CACHE.clear()
+
+
+if __name__ == "__main__":
+    import time
+
+    cache = DiskCache(cache_dir=os.path.join(tempfile.gettempdir(), "shadow4_cache", "disk_cache_test"),
+                      max_size=2 * 1024 ** 2)
+    cache.clear()
+
+    def calculator(n=10, x0=0.0, label="test"):
+        time.sleep(0.5)
+        x = numpy.linspace(x0, 1, n)
+        return {"x": x, "y": numpy.exp(1j * x), "n": n, "label": label, "nothing": None, "sub": {"sum": x.sum()}}
+
+    for i in range(2):
+        t0 = time.time()
+        result = cache.get("test", {"n": 1000, "x0": 0.5, "label": "a"}, calculator)
+        print("call %d: %.3f s" % (i, time.time() - t0))
+    reference = calculator(n=1000, x0=0.5, label="a")
+    assert (numpy.array_equal(result["y"], reference["y"]) and result["n"] == 1000 and result["label"] == "a")
+    assert (result["nothing"] is None and result["sub"]["sum"] == reference["sub"]["sum"])
+
+    for n in range(20): cache.get("test", {"n": 10000 * (n + 1)}, lambda **kw: {"x": numpy.zeros(kw["n"])})
+    print(cache.info())
+    cache.clear()
@@ -0,0 +1,174 @@
+"""
+
+Process-wide cache of objects loaded from files (e.g., the PreRefl and MLayer preprocessor files).
+
+The entries are keyed by (loader name, absolute file path, modification time, file size), therefore a file that
+has been modified is loaded again. The cache is thread-safe and keeps a bounded number of entries, discarding
+the least recently used (LRU) ones.
+
+Usage:
+    obj = PREPROCESSOR_FILE_CACHE.get(filename, loader)  # loader(filename) returns the object to be cached.
+    clear_preprocessor_file_cache()                      # explicit cleaning (e.g. to release memory).
+
+Note that the cached objects are shared: they must not be modified by the callers.
+
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from shadow4.tools.logger import is_verbose
+
+class FileCache(object):
+    """
+    Thread-safe LRU cache of objects loaded from files.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of cached objects.
+    """
+    def __init__(self, maxsize=64):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, filename, loader, loader_name=None):
+        """
+        Returns the object loaded from a file, using the cached one if the file has not changed.
+
+        Parameters
+        ----------
+        filename : str
+            The file name.
+        loader : callable
+            The function that loads the file: loader(filename) returns the object.
+        loader_name : str, optional
+            A name to identify the loader in the cache key (default: the loader qualified name).
+
+        Returns
+        -------
+        object
+            The (shared) object returned by the loader.
+        """
+        if loader_name is None: loader_name = getattr(loader, "__qualname__", repr(loader))
+
+        abs_filename = os.path.abspath(filename)
+        stat = os.stat(abs_filename) # raises if the file does not exist, as the loader would do
+        key = (loader_name, abs_filename, stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return self._entries[key]
+            self._misses += 1
+
+        if is_verbose(): print("FileCache: loading file %s" % abs_filename)
+        obj = loader(filename) # outside the lock, so other files can be loaded in parallel
+
+        with self._lock:
+            # remove older versions of the same file
+            for old_key in [k for k in self._entries if k[0:2] == key[0:2] and k != key]:
+                del self._entries[old_key]
+            self._entries[key] = obj
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+        return obj
+
+    def clear(self):
+        """
+        Removes all the cached objects.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def get_maxsize(self):
+        """
+        Returns the maximum number of cached objects.
+
+        Returns
+        -------
+        int
+        """
+        return self._maxsize
+
+    def set_maxsize(self, maxsize):
+        """
+        Sets the maximum number of cached objects (the least recently used are discarded if needed).
+
+        Parameters
+        ----------
+        maxsize : int
+            The maximum number of cached objects.
+        """
+        with self._lock:
+            self._maxsize = maxsize
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def get_number_of_entries(self):
+        """
+        Returns the number of cached objects.
+
+        Returns
+        -------
+        int
+        """
+        with self._lock:
+            return len(self._entries)
+
+    def info(self):
+        """
+        Returns a text with information on the cache.
+
+        Returns
+        -------
+        str
+        """
+        with self._lock:
+            txt = "FileCache: %d entries (max %d), %d hits, %d misses\n" % \
+                  (len(self._entries), self._maxsize, self._hits, self._misses)
+            for key in self._entries:
+                txt += "    %s: %s\n" % (key[0], key[1])
+        return txt
+
+#
+# the process-wide cache for the preprocessor files
+#
+PREPROCESSOR_FILE_CACHE = FileCache(maxsize=64)
+
+def clear_preprocessor_file_cache():
+    """
+    Removes all the objects in the process-wide cache of preprocessor files.
+    """
+    PREPROCESSOR_FILE_CACHE.clear()
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    filename = os.path.join(tempfile.gettempdir(), "file_cache_test.txt")
+    with open(filename, "w") as f: f.write("1 2 3")
+
+    loader = lambda file: open(file).read().split()
+    a = PREPROCESSOR_FILE_CACHE.get(filename, loader, loader_name="test")
+    b = PREPROCESSOR_FILE_CACHE.get(filename, loader, loader_name="test")
+    assert (a is b)
+
+    time.sleep(0.01)
+    with open(filename, "w") as f: f.write("1 2 3 4")
+    c = PREPROCESSOR_FILE_CACHE.get(filename, loader, loader_name="test")
+    assert (len(c) == 4)
+    print(PREPROCESSOR_FILE_CACHE.info())
+
+    clear_preprocessor_file_cache()
+    assert (PREPROCESSOR_FILE_CACHE.get_number_of_entries() == 0)
+    os.remove(filename)
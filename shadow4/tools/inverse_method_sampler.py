@@ -0,0 +1,550 @@
+"""
+Vectorized samplers of tabulated probability distributions (inverse method).
+
+The samplers Sampler1D, Sampler2D and Sampler3D of srxraylib (srxraylib.util.inverse_method_sampler) look for the
+interval of the cumulative distribution function (cdf) of every random number in a python loop. Here they are
+subclassed with the same interface and the same results, but all the points are sampled at once:
+    * the cdf interval is found with numpy.searchsorted (on the running maximum of the cdf, that gives the same
+      interval as the first cdf value >= (or >) the random number, also for non-monotonic cdfs).
+    * the conditional (2D and 3D) distributions are sampled grouping the points by row of the cdf table.
+    * the sampled value is linearly interpolated in the interval, as in srxraylib.
+
+Also defined here:
+    * Sampler1Dcdf: a Sampler1D with a given cdf (moved from the wiggler source).
+    * SamplerDiscrete: samples a set of values (e.g. photon energies of spectral lines) with given relative
+      intensities.
+    * SamplerGrid: samples a pdf in a grid of any dimension with a single cumulative index over all the cells
+      (the table is built once, then every point costs one binary search and no copies of the pdf).
+
+Usage:
+    sampler = Sampler1D(pdf, pdf_x)
+    x = sampler.get_n_sampled_points(1000000)
+    sampler = SamplerDiscrete([1.0, 0.5, 0.1], values=[8047.8, 8027.8, 8905.3])
+    energies = sampler.get_n_sampled_points(1000000)
+
+"""
+import numpy
+
+from srxraylib.util.inverse_method_sampler import Sampler1D as _Sampler1D
+from srxraylib.util.inverse_method_sampler import Sampler2D as _Sampler2D
+from srxraylib.util.inverse_method_sampler import Sampler3D as _Sampler3D
+
+class Sampler1D(_Sampler1D):
+    """
+    Constructor. Vectorized version of srxraylib Sampler1D.
+
+    Parameters
+    ----------
+    pdf : numpy array
+        1D input probability distrubution function.
+    pdf_x : numpy array
+        the abscissas of the odf.
+    cdf_interpolation_factor : float, optional
+        interpolation factor for calculating the cdf (1 makes no interpolation)/
+
+    """
+    def get_sampled(self, random_in_0_1):
+        """
+        Return an array with sampled points.
+
+        Parameters
+        ----------
+        random_in_0_1  : float or numpy array
+            Points sampled in a uniform interval.
+
+        Returns
+        -------
+        float or numpy array
+            the points sampled with the current pdf. The number of points is equal to the dimension of random_in_0_1.
+
+        """
+        y = numpy.asarray(random_in_0_1, dtype=float)
+        ix, delta = _get_index(self._cdf, y.reshape(-1))
+        ix = (ix // self._cdf_interpolation_factor).astype(int)
+        x = self._pdf_x[ix] + delta * (self._pdf_x[1] - self._pdf_x[0])
+        if y.ndim == 0: return x[0]
+        return x.reshape(y.shape)
+
+class Sampler1Dcdf(Sampler1D):
+    """
+    Constructor. A Sampler1D defined by the cumulative distribution function (cdf) instead of the pdf.
+
+    Parameters
+    ----------
+    cdf : numpy array
+        1D input cumulative distrubution function (non-decreasing, from 0 to 1).
+    pdf_x : numpy array
+        the abscissas of the cdf.
+
+    """
+    def __init__(self, cdf, pdf_x=None):
+        self._cdf = cdf
+        if pdf_x is None:
+            self._pdf_x = numpy.arange(self._cdf.size)
+        else:
+            self._pdf_x = pdf_x
+        self._pdf = None
+        self._cdf_x = self._pdf_x.copy()
+        self._cdf_interpolation_factor = 1
+
+        if self._cdf_x.size != self._cdf.size:
+            raise Exception("Incompatible arrays.")
+
+class Sampler2D(_Sampler2D):
+    """
+    Constructor. Vectorized version of srxraylib Sampler2D.
+
+    Parameters
+    ----------
+    pdf : numpy array
+        the 2D pdf.
+    pdf_x0 : numpy array
+        A 1D array with the abscissas for axis 0.
+    pdf_x1 : numpy array
+        A 1D array with the abscissas for axis 1.
+    """
+    def get_sampled(self, random0, random1):
+        """
+        Samples a point or multiple points in 2D (two coordinates) following the given pdf.
+
+        Parameters
+        ----------
+        random0 : float or numpy array
+            The 1D array with values unifiormly samples in [0,1]
+        random1 : float or numpy array
+            The 1D array with values unifiormly samples in [0,1]
+
+        Returns
+        -------
+        tuple
+            (x,y) the coordinates x (float or array) and y (float or array) of the sampled point(s).
+
+        """
+        y0 = numpy.asarray(random0, dtype=float)
+        ival, x0 = self._sample0(y0.reshape(-1))
+        x1 = self._sample1(numpy.asarray(random1, dtype=float).reshape(-1), ival + 1)
+        if y0.ndim == 0: return x0[0], x1[0]
+        return x0, x1
+
+    def get_sampled_x2(self, random0, random10, random11):
+        """
+        Samples a point or multiple points in 2D (two coordinates) following the given pdf.
+        It samples one point in axis 0 and two points on the axis 1.
+
+        Parameters
+        ----------
+        random0 : float or numpy array
+            The 1D array with values unifiormly samples in [0,1]
+        random10 : float or numpy array
+            The 1D array with values unifiormly samples in [0,1]
+        random11 : float or numpy array
+            The 1D array with values unifiormly samples in [0,1]
+
+        Returns
+        -------
+        tuple
+            (x, y0, y1) the coordinates x (float or array) on the axis 0 and and y0, y1 (float or array) of the sampled
+            point(s) in axis 1.
+
+        """
+        y0 = numpy.asarray(random0, dtype=float)
+        ival, x0 = self._sample0(y0.reshape(-1))
+        x10 = self._sample1(numpy.asarray(random10, dtype=float).reshape(-1), ival + 1)
+        x11 = self._sample1(numpy.asarray(random11, dtype=float).reshape(-1), ival + 1)
+        if y0.ndim == 0: return x0[0], x10[0], x11[0]
+        return x0, x10, x11
+
+    def get_sampled_conditional(self, x0, random1):
+        """
+        Samples the coordinate on the axis 1 for given coordinates on the axis 0 (e.g. sampled before with another
+        sampler defined on the same grid). It uses the same row of the pdf as get_sampled() for these coordinates.
+
+        Parameters
+        ----------
+        x0 : float or numpy array
+            The coordinates on the axis 0.
+        random1 : float or numpy array
+            The 1D array with values unifiormly samples in [0,1]
+
+        Returns
+        -------
+        float or numpy array
+            The sampled coordinates on the axis 1.
+        """
+        x0 = numpy.asarray(x0, dtype=float)
+        ival = numpy.floor((x0.reshape(-1) - self._pdf_x0[0]) / (self._pdf_x0[1] - self._pdf_x0[0])).astype(int)
+        ival = numpy.clip(ival, 0, self._pdf_x0.size - 2)
+        x1 = self._sample1(numpy.asarray(random1, dtype=float).reshape(-1), ival + 1)
+        if x0.ndim == 0: return x1[0]
+        return x1
+
+    def _cdf_calculate(self):
+        pdf2 = numpy.asarray(self._pdf)
+        pdf1 = pdf2.sum(axis=1)
+
+        cdf2 = numpy.cumsum(pdf2, axis=1)
+        cdf2 = cdf2 - cdf2[:, 0:1]
+        with numpy.errstate(divide="ignore", invalid="ignore"): # rows with zero probability (never sampled)
+            cdf2 = cdf2 / cdf2.max(axis=1, keepdims=True)
+
+        cdf1 = numpy.cumsum(pdf1)
+        cdf1 -= cdf1[0]
+        cdf1 /= cdf1.max()
+
+        return cdf2, cdf1
+
+    def _sample0(self, edge):
+        ival, delta = _get_index(self._cdf1, edge, side="left")
+        return ival, self._pdf_x0[ival] + delta * (self._pdf_x0[1] - self._pdf_x0[0])
+
+    def _sample1(self, edge, index0):
+        ival, delta = _get_index_in_rows(self._cdf2, index0, edge, side="left")
+        return self._pdf_x1[ival] + delta * (self._pdf_x1[1] - self._pdf_x1[0])
+
+class Sampler3D(_Sampler3D):
+    """
+    Constructor. Vectorized version of srxraylib Sampler3D.
+
+    Parameters
+    ----------
+    pdf : numpy array
+        The 3D pdf.
+    pdf_x0 : numpy array
+        The abscissas for axis 0.
+    pdf_x1 : numpy array
+        The abscissas for axis 1.
+    pdf_x2 : numpy array
+        The abscissas for axis 2.
+
+    """
+    def get_sampled(self, random0, random1, random2):
+        """
+        Get sampled 3D points.
+
+        Parameters
+        ----------
+        random0 : float or numpy array
+            The points or points sampled uniformly in a [0,1] interval.
+        random1 : float or numpy array
+            The points or points sampled uniformly in a [0,1] interval.
+        random2 : float or numpy array
+            The points or points sampled uniformly in a [0,1] interval.
+
+        Returns
+        -------
+        tuple
+            (x0,x1,x2) the coordinates (float or array) of the sampled points.
+
+        """
+        y0 = numpy.asarray(random0, dtype=float)
+        y1 = numpy.asarray(random1, dtype=float).reshape(-1)
+        y2 = numpy.asarray(random2, dtype=float).reshape(-1)
+
+        ival, delta = _get_index(self._cdf1, y0.reshape(-1), side="right")
+        x0 = self._pdf_x0[ival] + delta * (self._pdf_x0[1] - self._pdf_x0[0])
+
+        ival1, delta1 = _get_index_in_rows(self._cdf2, ival + 1, y1, side="right")
+        x1 = self._pdf_x1[ival1] + delta1 * (self._pdf_x1[1] - self._pdf_x1[0])
+
+        n1 = self._cdf3.shape[1]
+        ival2, delta2 = _get_index_in_rows(self._cdf3.reshape((-1, self._cdf3.shape[2])),
+                                           (ival + 1) * n1 + (ival1 + 1), y2, side="right")
+        x2 = self._pdf_x2[ival2] + delta2 * (self._pdf_x2[1] - self._pdf_x2[0])
+
+        if y0.ndim == 0: return x0[0], x1[0], x2[0]
+        return x0, x1, x2
+
+    def _cdf_calculate(self):
+        pdf3 = numpy.asarray(self._pdf)
+        pdf2 = pdf3.sum(axis=2)
+        pdf1 = pdf2.sum(axis=1)
+
+        cdf3 = numpy.cumsum(pdf3, axis=2)
+        cdf3 = cdf3 - cdf3[:, :, 0:1]
+        cdf3 = cdf3 / cdf3.max(axis=2, keepdims=True)
+
+        cdf2 = numpy.cumsum(pdf2, axis=1)
+        cdf2 = cdf2 - cdf2[:, 0:1]
+        with numpy.errstate(divide="ignore", invalid="ignore"): # rows with zero probability (never sampled)
+            cdf2 = cdf2 / cdf2.max(axis=1, keepdims=True)
+
+        cdf1 = numpy.cumsum(pdf1)
+        cdf1 -= cdf1[0]
+        cdf1 /= cdf1.max()
+
+        return cdf3, cdf2, cdf1
+
+class SamplerDiscrete(object):
+    """
+    Constructor. Samples a discrete set of values with given relative intensities (probabilities).
+
+    Parameters
+    ----------
+    weights : numpy array
+        The relative intensities (not necessarily normalized).
+    values : numpy array, optional
+        The values to be sampled (default: the indices of weights).
+
+    """
+    def __init__(self, weights, values=None):
+        self._weights = numpy.asarray(weights, dtype=float).reshape(-1)
+        if values is None:
+            self._values = numpy.arange(self._weights.size)
+        else:
+            self._values = numpy.asarray(values).reshape(-1)
+
+        if self._values.size != self._weights.size: raise Exception("Incompatible arrays.")
+        if numpy.any(self._weights < 0) or self._weights.sum() <= 0: raise Exception("Bad relative intensities.")
+
+        self._cdf = numpy.cumsum(self._weights / self._weights.sum())
+
+    def values(self):
+        """
+        Gets the values array.
+
+        Returns
+        -------
+        numpy array
+            The values (referenced, not copied).
+        """
+        return self._values
+
+    def cdf(self):
+        """
+        Gets the cumulative distribution function (cdf): the probability of the values up to (and including) each one.
+
+        Returns
+        -------
+        numpy array
+            The cdf (referenced, not copied).
+        """
+        return self._cdf
+
+    def get_sampled(self, random_in_0_1):
+        """
+        Return an array with sampled values. A random number r gives the value i if cdf[i-1] < r <= cdf[i].
+
+        Parameters
+        ----------
+        random_in_0_1  : float or numpy array
+            Points sampled in a uniform interval.
+
+        Returns
+        -------
+        float or numpy array
+            The sampled values. The number of points is equal to the dimension of random_in_0_1.
+
+        """
+        index = numpy.searchsorted(self._cdf, random_in_0_1, side="left")
+        return self._values[numpy.minimum(index, self._cdf.size - 1)]
+
+    def get_n_sampled_points(self, npoints, seed=None):
+        """
+        Returns a given number points sampled points sampled with the relative intensities.
+
+        Parameters
+        ----------
+        npoints : int
+            The number of points.
+        seed : int, optional
+            The seed (numpy generator is initialized with numpy.random.default_rng(seed))
+
+        Returns
+        -------
+        numpy array
+            The sampled values.
+
+        """
+        if not seed is None:
+            rng = numpy.random.default_rng(seed)
+            cdf_rand_array = rng.random(npoints)
+        else:
+            cdf_rand_array = numpy.random.random(npoints)
+
+        return self.get_sampled(cdf_rand_array)
+
+class SamplerGrid(object):
+    """
+    Constructor. Samples a pdf tabulated in a regular grid of any dimension (e.g. the undulator radiation vs
+    (photon energy, theta, phi)) using a single cumulative index over all the cells of the grid.
+
+    The table is calculated once, and a point is sampled by finding its cell (numpy.searchsorted in the flattened
+    cdf) and a uniform position inside the cell. The distribution is the same as for the srxraylib samplers
+    (Sampler1D, Sampler2D, Sampler3D): the cell [x[i-1], x[i]] along every axis has the probability
+    P(i0) P(i1|i0) P(i2|i0,i1)... calculated from the pdf values at the upper nodes.
+
+    Parameters
+    ----------
+    pdf : numpy array
+        The pdf (with ndim dimensions, non-negative).
+    *pdf_x : numpy arrays
+        The abscissas for every axis (ndim 1D arrays). An axis with a single point is not sampled (constant value).
+
+    """
+    def __init__(self, pdf, *pdf_x):
+        pdf = numpy.asarray(pdf, dtype=float)
+        if len(pdf_x) != pdf.ndim: raise Exception("Incompatible arrays.")
+        for i, x in enumerate(pdf_x):
+            if numpy.asarray(x).size != pdf.shape[i]: raise Exception("Incompatible arrays.")
+
+        # lower and upper edges of the cells for every axis
+        self._lower = []
+        self._upper = []
+        for x in pdf_x:
+            x = numpy.asarray(x, dtype=float).reshape(-1)
+            if x.size == 1:
+                self._lower.append(x)
+                self._upper.append(x)
+            else:
+                self._lower.append(x[:-1])
+                self._upper.append(x[1:])
+
+        # probability of the cells: product of the conditional probabilities (as in the srxraylib samplers)
+        weights = numpy.ones([1] * pdf.ndim)
+        for axis in range(pdf.ndim):
+            marginal = pdf.sum(axis=tuple(range(axis + 1, pdf.ndim)), keepdims=True) if axis < pdf.ndim - 1 else pdf
+            marginal = marginal[tuple(slice(0 if pdf.shape[i] == 1 else 1, None) for i in range(axis + 1)) +
+                                (slice(None),) * (pdf.ndim - axis - 1)]
+            total = marginal.sum(axis=axis, keepdims=True)
+            weights = weights * numpy.divide(marginal, total, out=numpy.zeros_like(marginal), where=(total > 0))
+
+        self._shape = weights.shape[0:pdf.ndim]
+        self._cdf = numpy.cumsum(weights.reshape(-1))
+        if not self._cdf[-1] > 0: raise Exception("Bad pdf (no positive values).")
+        self._cdf /= self._cdf[-1]
+
+    def get_sampled(self, random_cell, random_jitter):
+        """
+        Returns the sampled points.
+
+        Parameters
+        ----------
+        random_cell : numpy array
+            Random numbers uniformly distributed in [0,1] (one per point) to sample the cells.
+        random_jitter : numpy array
+            Random numbers uniformly distributed in [0,1] with shape (ndim, npoints), to sample the positions in
+            the cells.
+
+        Returns
+        -------
+        tuple
+            (x0, x1, ...) the coordinates (numpy arrays) of the sampled points.
+
+        """
+        index = numpy.minimum(numpy.searchsorted(self._cdf, random_cell, side="right"), self._cdf.size - 1)
+        indices = numpy.unravel_index(index, self._shape)
+        return tuple(self._lower[i][indices[i]] + random_jitter[i] * (self._upper[i][indices[i]] - self._lower[i][indices[i]])
+                     for i in range(len(self._shape)))
+
+    def get_n_sampled_points(self, npoints, seed=None):
+        """
+        Returns a given number of sampled points.
+
+        Parameters
+        ----------
+        npoints : int
+            The number of points.
+        seed : int, optional
+            The seed (numpy generator is initialized with numpy.random.default_rng(seed))
+
+        Returns
+        -------
+        tuple
+            (x0, x1, ...) the coordinates (numpy arrays) of the sampled points.
+
+        """
+        if not seed is None:
+            rng = numpy.random.default_rng(seed)
+            random_cell, random_jitter = rng.random(npoints), rng.random((len(self._shape), npoints))
+        else:
+            random_cell, random_jitter = numpy.random.random(npoints), numpy.random.random((len(self._shape), npoints))
+
+        return self.get_sampled(random_cell, random_jitter)
+
+#
+# auxiliar functions
+#
+def _get_index(cdf, edge, side="left"):
+    # vectorized srxraylib _get_index: ix is the first index with cdf >= edge (side="left") or cdf > edge
+    # (side="right"), minus one (0 if not found), and delta is the fractional position of edge in [cdf[ix], cdf[ix+1]].
+    cdf = numpy.asarray(cdf, dtype=float)
+    monotonic = numpy.maximum.accumulate(numpy.where(numpy.isnan(cdf), -numpy.inf, cdf))
+    ix = numpy.searchsorted(monotonic, edge, side=side)
+    return _get_delta(cdf, ix, edge)
+
+def _get_index_in_rows(cdf, rows, edge, side="left"):
+    # as _get_index, using for each point the given row of the 2D cdf (points grouped by row)
+    cdf = numpy.asarray(cdf, dtype=float)
+    ix = numpy.zeros(edge.size, dtype=int)
+    order = numpy.argsort(rows, kind="stable")
+    sorted_rows = rows[order]
+    row_values, row_starts = numpy.unique(sorted_rows, return_index=True)
+    row_ends = numpy.append(row_starts[1:], sorted_rows.size)
+    for row, i0, i1 in zip(row_values.tolist(), row_starts.tolist(), row_ends.tolist()):
+        monotonic = numpy.maximum.accumulate(numpy.where(numpy.isnan(cdf[row]), -numpy.inf, cdf[row]))
+        ix[order[i0:i1]] = numpy.searchsorted(monotonic, edge[order[i0:i1]], side=side)
+    return _get_delta(cdf, ix, edge, rows=rows)
+
+def _get_delta(cdf, ix, edge, rows=None):
+    # cdf is 1D (one cdf for all points, rows=None) or 2D (row "rows" for each point)
+    n = cdf.shape[-1]
+    ix = numpy.where(ix >= n, 0, ix)   # not found
+    ix = numpy.where(ix > 0, ix - 1, ix)
+    ix1 = numpy.minimum(ix + 1, n - 1)
+    if rows is None:
+        cdf0, cdf1 = cdf[ix], cdf[ix1]
+    else:
+        cdf0, cdf1 = cdf[rows, ix], cdf[rows, ix1]
+    pendent = cdf1 - cdf0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        delta = numpy.where(pendent != 0, (edge - cdf0) / pendent, 0.0)
+    delta = numpy.where(ix >= n - 1, 0.0, delta)
+    return ix, delta
+
+
+if __name__ == "__main__":
+    import time
+    import srxraylib.util.inverse_method_sampler as reference
+
+    numpy.random.seed(1)
+    x = numpy.linspace(-5, 5, 501)
+    pdf = numpy.exp(-x ** 2 / 2) + 0.2 * numpy.exp(-(x - 2) ** 2 / 0.1)
+    y = numpy.random.random(200000)
+    t0 = time.time()
+    s_reference = reference.Sampler1D(pdf, x).get_sampled(y)
+    t1 = time.time()
+    s = Sampler1D(pdf, x).get_sampled(y)
+    t2 = time.time()
+    print("Sampler1D: srxraylib %.3f s, vectorized %.3f s, max difference %g" % (t1 - t0, t2 - t1, numpy.abs(s - s_reference).max()))
+
+    pdf2 = numpy.outer(numpy.exp(-x[::10] ** 2 / 2), numpy.exp(-x ** 2 / 8)) * (1 + 0.5 * numpy.sin(x))
+    y0, y1 = numpy.random.random(100000), numpy.random.random(100000)
+    t0 = time.time()
+    s_reference = reference.Sampler2D(pdf2, x[::10], x).get_sampled(y0, y1)
+    t1 = time.time()
+    s = Sampler2D(pdf2, x[::10], x).get_sampled(y0, y1)
+    t2 = time.time()
+    print("Sampler2D: srxraylib %.3f s, vectorized %.3f s, max difference %g, %g" % (t1 - t0, t2 - t1,
+          numpy.abs(s[0] - s_reference[0]).max(), numpy.abs(s[1] - s_reference[1]).max()))
+
+    pdf3 = pdf2[:, :, None] * numpy.exp(-x[::20] ** 2 / 4)[None, None, :]
+    y2 = numpy.random.random(100000)
+    t0 = time.time()
+    s_reference = reference.Sampler3D(pdf3, x[::10], x, x[::20]).get_sampled(y0, y1, y2)
+    t1 = time.time()
+    s = Sampler3D(pdf3, x[::10], x, x[::20]).get_sampled(y0, y1, y2)
+    t2 = time.time()
+    print("Sampler3D: srxraylib %.3f s, vectorized %.3f s, max difference %g, %g, %g" % (t1 - t0, t2 - t1,
+          numpy.abs(s[0] - s_reference[0]).max(), numpy.abs(s[1] - s_reference[1]).max(),
+          numpy.abs(s[2] - s_reference[2]).max()))
+
+    t0 = time.time()
+    s_grid = SamplerGrid(pdf3, x[::10], x, x[::20]).get_n_sampled_points(100000)
+    t1 = time.time()
+    print("SamplerGrid: %.3f s, mean and std (Sampler3D): %s" % (t1 - t0,
+          repr([(s_grid[i].mean(), s[i].mean(), s_grid[i].std(), s[i].std()) for i in range(3)])))
+
+    t0 = time.time()
+    energies = SamplerDiscrete([1.0, 0.5, 0.1], values=[8047.8, 8027.8, 8905.3]).get_n_sampled_points(1000000)
+    t1 = time.time()
+    print("SamplerDiscrete: %.3f s, fractions: %s" % (t1 - t0, repr([(energies == e).mean() for e in [8047.8, 8027.8, 8905.3]])))
@@ -0,0 +1,206 @@
+"""
+Regression tests of the vectorized kernels of shadow4.tools.arrayofvectors against the reference (component by
+component) implementations: the results must be identical, except for the kernels evaluated in closed form
+(refraction, scattering, grating diffraction), that must agree to rounding.
+"""
+import numpy
+import pytest
+
+from shadow4.tools import arrayofvectors as aov
+
+#
+# reference implementations
+#
+def _ref_vector_cross(u, v):
+    w = numpy.zeros_like(u)
+    w[:, 0] = u[:, 1] * v[:, 2] - u[:, 2] * v[:, 1]
+    w[:, 1] = u[:, 2] * v[:, 0] - u[:, 0] * v[:, 2]
+    w[:, 2] = u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0]
+    return w
+
+def _ref_vector_norm(u):
+    u_norm = numpy.zeros_like(u)
+    uu = numpy.sqrt(u[:, 0]**2 + u[:, 1]**2 + u[:, 2]**2)
+    for i in range(3):
+        u_norm[:, i] = uu
+    return u / u_norm
+
+def _ref_vector_dot(u, v):
+    return u[:, 0] * v[:, 0] + u[:, 1] * v[:, 1] + u[:, 2] * v[:, 2]
+
+def _ref_vector_sum(u, v):
+    w = numpy.zeros_like(u)
+    for i in range(3):
+        w[:, i] = u[:, i] + v[:, i]
+    return w
+
+def _ref_vector_diff(u, v):
+    w = numpy.zeros_like(u)
+    for i in range(3):
+        w[:, i] = u[:, i] - v[:, i]
+    return w
+
+def _ref_vector_multiply_scalar(u, k):
+    kk = numpy.array(k)
+    if kk.size == 1:
+        return u * kk
+    w = numpy.zeros_like(u)
+    for i in range(3):
+        w[:, i] = u[:, i] * kk
+    return w
+
+def _ref_vector_add_scalar(u, k):
+    kk = numpy.array(k)
+    if kk.size == 1:
+        return u + kk
+    w = numpy.zeros_like(u)
+    for i in range(3):
+        w[:, i] = u[:, i] + kk
+    return w
+
+def _ref_vector_reflection(v1, normal):
+    normal_norm = _ref_vector_norm(normal)
+    return v1 - 2 * _ref_vector_multiply_scalar(normal_norm, _ref_vector_dot(v1, normal_norm))
+
+def _ref_vector_refraction(vin, normal, n1, n2, sgn=1):
+    if sgn is None: sgn = -numpy.sign(_ref_vector_dot(vin, normal))
+    vin_norm = _ref_vector_norm(vin)
+    normal_norm = _ref_vector_norm(normal)
+    n_cross_vin = _ref_vector_cross(normal_norm, vin_norm)
+    n_opp_cross_vin = _ref_vector_cross(normal_norm * (-1), vin_norm)
+    sq2 = 1 - _ref_vector_dot(n_cross_vin, n_cross_vin) * (n1 / n2) ** 2
+    return _ref_vector_multiply_scalar(_ref_vector_cross(normal_norm, n_opp_cross_vin), (n1 / n2)) - \
+           _ref_vector_multiply_scalar(normal_norm, sgn * numpy.sqrt(sq2))
+
+def _ref_vector_scattering(K_IN, H, NORMAL):
+    H_perp = _ref_vector_multiply_scalar(NORMAL, _ref_vector_dot(H, NORMAL))
+    H_par = _ref_vector_diff(H, H_perp)
+    K_IN_perp = _ref_vector_multiply_scalar(NORMAL, _ref_vector_dot(K_IN, NORMAL))
+    K_IN_par = _ref_vector_diff(K_IN, K_IN_perp)
+    K_OUT_par = _ref_vector_sum(K_IN_par, H_par)
+    K_OUT_perp = _ref_vector_multiply_scalar(NORMAL, numpy.sqrt(aov.vector_modulus_square(K_IN) -
+                                                                aov.vector_modulus_square(K_OUT_par)))
+    return _ref_vector_sum(K_OUT_par, K_OUT_perp)
+
+def _ref_vector_rotate_around_axis(u, rotation_axis, angle):
+    rotation_axis1 = numpy.zeros_like(u)
+    rotation_axis1[:] = rotation_axis
+    unit_rotation_axis = _ref_vector_norm(rotation_axis1)
+    rotated_vector = _ref_vector_multiply_scalar(u, numpy.cos(angle))
+    tmp_vector = _ref_vector_cross(unit_rotation_axis, u)
+    tmp_vector = _ref_vector_multiply_scalar(tmp_vector, numpy.sin(angle))
+    rotated_vector = _ref_vector_sum(rotated_vector, tmp_vector)
+    scalar_factor = _ref_vector_dot(u, unit_rotation_axis) * (1.0 - numpy.cos(angle))
+    tmp_vector = _ref_vector_multiply_scalar(unit_rotation_axis, scalar_factor)
+    return _ref_vector_sum(rotated_vector, tmp_vector)
+
+def _ref_grating_diffraction(v_in, k_modulus, normal, g_modulus):
+    # as in S4OpticalSurface.apply_grating_diffraction_on_beam before the fused kernel
+    x_vrs = numpy.zeros_like(v_in)
+    x_vrs[:, 0] = 1
+    K_IN = _ref_vector_multiply_scalar(v_in, k_modulus)
+    K_IN_NOR = _ref_vector_multiply_scalar(normal, _ref_vector_dot(K_IN, normal))
+    K_IN_PAR = _ref_vector_diff(K_IN, K_IN_NOR)
+    GSCATTER = _ref_vector_multiply_scalar(_ref_vector_cross(normal, x_vrs), g_modulus)
+    K_OUT_PAR = _ref_vector_sum(K_IN_PAR, GSCATTER)
+    K_OUT_NOR = _ref_vector_multiply_scalar(normal, numpy.sqrt(k_modulus**2 - aov.vector_modulus_square(K_OUT_PAR)))
+    return _ref_vector_norm(_ref_vector_sum(K_OUT_PAR, K_OUT_NOR))
+
+#
+# inputs
+#
+def _vectors(n=1000, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return rng.normal(size=(n, 3)), rng.normal(size=(n, 3)), rng.uniform(0.5, 2.0, n)
+
+def _incident_and_normal(n=1000, seed=0):
+    rng = numpy.random.default_rng(seed)
+    v_in = numpy.zeros((n, 3))
+    v_in[:, 1] = numpy.cos(0.02)
+    v_in[:, 2] = -numpy.sin(0.02)
+    v_in = aov.vector_norm(v_in + rng.normal(size=(n, 3)) * 1e-4)
+    normal = numpy.zeros((n, 3))
+    normal[:, 2] = 1.0
+    normal = aov.vector_norm(normal + rng.normal(size=(n, 3)) * 1e-3)
+    return v_in, normal
+
+#
+# tests
+#
+@pytest.mark.parametrize("function, reference", [(aov.vector_cross, _ref_vector_cross),
+                                                 (aov.vector_dot,   _ref_vector_dot),
+                                                 (aov.vector_sum,   _ref_vector_sum),
+                                                 (aov.vector_diff,  _ref_vector_diff)])
+def test_binary_kernels(function, reference):
+    u, v, _ = _vectors()
+    expected = reference(u, v)
+    numpy.testing.assert_array_equal(function(u, v), expected)
+    out = numpy.zeros_like(expected)
+    assert function(u, v, out=out) is out
+    numpy.testing.assert_array_equal(out, expected)
+    if expected.ndim == 2: # the result can be stored in the inputs
+        u1, v1 = u.copy(), v.copy()
+        numpy.testing.assert_array_equal(function(u1, v1, out=u1), expected)
+        u1, v1 = u.copy(), v.copy()
+        numpy.testing.assert_array_equal(function(u1, v1, out=v1), expected)
+
+@pytest.mark.parametrize("function, reference", [(aov.vector_multiply_scalar, _ref_vector_multiply_scalar),
+                                                 (aov.vector_add_scalar,      _ref_vector_add_scalar)])
+def test_scalar_kernels(function, reference):
+    u, _, k = _vectors()
+    for scalar in [k, 2.5, numpy.array([2.5])]:
+        expected = reference(u, scalar)
+        numpy.testing.assert_array_equal(function(u, scalar), expected)
+        u1 = u.copy()
+        numpy.testing.assert_array_equal(function(u1, scalar, out=u1), expected)
+
+def test_norm():
+    u, _, _ = _vectors()
+    numpy.testing.assert_array_equal(aov.vector_norm(u), _ref_vector_norm(u))
+    u1 = u.copy()
+    numpy.testing.assert_array_equal(aov.vector_norm(u1, out=u1), _ref_vector_norm(u))
+    numpy.testing.assert_array_equal(aov.vector_cross_norm(u, u[::-1]),
+                                     _ref_vector_norm(_ref_vector_cross(u, u[::-1])))
+
+def test_reflection():
+    v_in, normal = _incident_and_normal()
+    expected = _ref_vector_reflection(v_in, normal)
+    normal0 = normal.copy()
+    numpy.testing.assert_array_equal(aov.vector_reflection(v_in, normal), expected)
+    numpy.testing.assert_array_equal(normal, normal0) # the inputs are not modified
+
+@pytest.mark.parametrize("axis", [[1, 0, 0], "array"])
+def test_rotate_around_axis(axis):
+    u, v, _ = _vectors()
+    rotation_axis = v if isinstance(axis, str) else axis
+    expected = _ref_vector_rotate_around_axis(u, rotation_axis, 0.3)
+    numpy.testing.assert_array_equal(aov.vector_rotate_around_axis(u, rotation_axis, 0.3), expected)
+    u1 = u.copy()
+    numpy.testing.assert_array_equal(aov.vector_rotate_around_axis(u1, rotation_axis, 0.3, out=u1), expected)
+
+@pytest.mark.parametrize("sgn", [1, None])
+def test_refraction(sgn):
+    v_in, normal = _incident_and_normal()
+    n1, n2 = numpy.ones(v_in.shape[0]), numpy.linspace(1 - 1e-5, 1.5, v_in.shape[0])
+    expected = _ref_vector_refraction(v_in, normal, n1, n2, sgn=sgn)
+    normal0 = normal.copy()
+    numpy.testing.assert_allclose(aov.vector_refraction(v_in, normal, n1, n2, sgn=sgn), expected,
+                                  rtol=0, atol=1e-14)
+    numpy.testing.assert_array_equal(normal, normal0) # the inputs are not modified
+
+def test_scattering():
+    v_in, normal = _incident_and_normal()
+    k_in = v_in * 5e8
+    h = numpy.zeros_like(v_in)
+    h[:, 1] = -1e7
+    expected = _ref_vector_scattering(k_in, h, normal)
+    assert numpy.isfinite(expected).all()
+    numpy.testing.assert_allclose(aov.vector_scattering(k_in, h, normal), expected, rtol=1e-13, atol=1e-6)
+
+@pytest.mark.parametrize("n", [1000, aov.NUMEXPR_MIN_SIZE])
+def test_grating_diffraction(n):
+    v_in, normal = _incident_and_normal(n=n)
+    k_modulus = numpy.full(n, 5e9)
+    g_modulus = numpy.full(n, -3.8e6)
+    numpy.testing.assert_allclose(aov.vector_grating_diffraction(v_in, k_modulus, normal, g_modulus),
+                                  _ref_grating_diffraction(v_in, k_modulus, normal, g_modulus), rtol=0, atol=1e-13)
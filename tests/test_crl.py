@@ -0,0 +1,104 @@
+"""
+Regression tests of the fused lens-stack kernel (S4CRLElement._trace_beam_fused) against tracing every interface
+as a S4ConicInterfaceElement (fused=False): the beams and footprints must agree to rounding.
+
+For paraboloids at normal incidence, the intercept with the conic is ill-conditioned (the quadratic coefficient
+vanishes): the flight paths inside the lenses (and therefore the optical paths and the attenuation) change by up to
+a few percent, and the positions by ~1e-11 m, when the input positions are shifted by 1e-12 m. In this case, the
+differences between both methods must be smaller than this sensitivity of the per-interface method.
+"""
+import warnings
+import numpy
+import pytest
+
+from syned.beamline.shape import Circle, Rectangle
+from syned.beamline.element_coordinates import ElementCoordinates
+
+from shadow4.sources.source_geometrical.source_geometrical import SourceGeometrical
+from shadow4.beamline.optical_elements.refractors.s4_crl import S4CRL, S4CRLElement
+from shadow4.beamline.optical_elements.refractors.s4_transfocator import S4Transfocator, S4TransfocatorElement
+
+pytest.importorskip("xraylib")
+
+
+def _get_beam(nrays=1000):
+    light_source = SourceGeometrical(nrays=nrays, seed=5676561)
+    light_source.set_spatial_type_gaussian(sigma_h=1e-4, sigma_v=1e-4)
+    light_source.set_angular_distribution_cone(cone_max=1e-5, cone_min=0.0)
+    light_source.set_energy_distribution_uniform(value_min=13000.0, value_max=15000.0, unit='eV')
+    return light_source.get_beam()
+
+def _assert_same_beams(beam0, beam1, beam_shifted=None):
+    numpy.testing.assert_array_equal(beam0.rays[:, 9], beam1.rays[:, 9])
+    good = beam0.rays[:, 9] > 0
+    assert good.sum() > 0
+    rays0, rays1 = beam0.rays[good], beam1.rays[good]
+    if beam_shifted is None:
+        numpy.testing.assert_allclose(rays1, rays0, rtol=1e-9, atol=1e-12)
+    else: # ill-conditioned intercept: compare with the sensitivity of the per-interface method
+        sensitivity = numpy.nanmax(numpy.abs(beam_shifted.rays[good] - rays0), axis=0)
+        difference = numpy.nanmax(numpy.abs(rays1 - rays0), axis=0)
+        tolerance = sensitivity + 1e-9 * numpy.nanmax(numpy.abs(rays0), axis=0) + 1e-12
+        assert (difference <= tolerance).all(), (difference, sensitivity)
+
+def _trace(beamline_element, shift=None):
+    with warnings.catch_warnings(): # rays missing a lens without boundaries
+        warnings.simplefilter("ignore", RuntimeWarning)
+        beam0, footprints0 = beamline_element.trace_beam(fused=False)
+        beam1, footprints1 = beamline_element.trace_beam(fused=True)
+        if shift is None: return beam0, footprints0, beam1, footprints1, [None, None, None]
+
+        input_beam = beamline_element.get_input_beam()
+        shifted_beam = input_beam.duplicate()
+        shifted_beam.rays[:, [0, 2]] += shift
+        beamline_element.set_input_beam(shifted_beam)
+        beam_shifted, footprints_shifted = beamline_element.trace_beam(fused=False)
+        beamline_element.set_input_beam(input_beam)
+    return beam0, footprints0, beam1, footprints1, [beam_shifted] + footprints_shifted
+
+@pytest.mark.parametrize("surface_shape", [1, 2])
+@pytest.mark.parametrize("convex_to_the_beam", [0, 1])
+@pytest.mark.parametrize("cylinder_angle", [0, 1, 2])
+@pytest.mark.parametrize("boundary_shape", [None, Circle(radius=2e-4), Rectangle(-1.5e-4, 1.5e-4, -2e-4, 2e-4)])
+def test_fused_crl(surface_shape, convex_to_the_beam, cylinder_angle, boundary_shape):
+    optical_element = S4CRL(n_lens=5, piling_thickness=6.25e-4, boundary_shape=boundary_shape,
+                            material='Al', density=2.6989, thickness=2.5e-5, surface_shape=surface_shape,
+                            convex_to_the_beam=convex_to_the_beam, cylinder_angle=cylinder_angle,
+                            ri_calculation_mode=2, radius=2e-4)
+    beamline_element = S4CRLElement(optical_element=optical_element,
+                                    coordinates=ElementCoordinates(p=10.0, q=1.0, angle_radial_out=numpy.pi),
+                                    input_beam=_get_beam())
+    beam0, footprints0, beam1, footprints1, shifted = _trace(beamline_element,
+                                                             shift=1e-12 if surface_shape == 2 else None)
+    for b0, b1, b_shifted in zip([beam0] + footprints0, [beam1] + footprints1, shifted):
+        _assert_same_beams(b0, b1, b_shifted)
+
+@pytest.mark.parametrize("surface_shape", [1, 2])
+def test_fused_crl_tilted(surface_shape):
+    optical_element = S4CRL(n_lens=5, piling_thickness=6.25e-4, boundary_shape=Circle(radius=2e-4),
+                            material='Al', density=2.6989, thickness=2.5e-5, surface_shape=surface_shape,
+                            convex_to_the_beam=0, cylinder_angle=0, ri_calculation_mode=2, radius=2e-4)
+    beamline_element = S4CRLElement(optical_element=optical_element,
+                                    coordinates=ElementCoordinates(p=10.0, q=1.0, angle_radial=0.05,
+                                                                   angle_radial_out=numpy.pi - 0.05),
+                                    input_beam=_get_beam())
+    beam0, footprints0, beam1, footprints1, _ = _trace(beamline_element)
+    for b0, b1 in zip([beam0] + footprints0, [beam1] + footprints1):
+        _assert_same_beams(b0, b1)
+
+def test_fused_transfocator():
+    optical_element = S4Transfocator(n_lens=[3, 4], piling_thickness=[6.25e-4, 6.25e-4],
+                                     boundary_shape=Circle(radius=2e-4),
+                                     material=['Al', 'Be'], density=[2.6989, 1.848], thickness=[2.5e-5, 3e-5],
+                                     surface_shape=[1, 1], convex_to_the_beam=[0, 1], cylinder_angle=[0, 0],
+                                     ri_calculation_mode=[2, 2], prerefl_file=[None, None],
+                                     refraction_index=[1.0, 1.0], attenuation_coefficient=[0.0, 0.0],
+                                     radius=[2e-4, 3e-4], conic_coefficients1=[None, None],
+                                     conic_coefficients2=[None, None], empty_space_after_last_interface=[0.1, 0.0])
+    beamline_element = S4TransfocatorElement(optical_element=optical_element,
+                                             coordinates=ElementCoordinates(p=10.0, q=1.0,
+                                                                            angle_radial_out=numpy.pi),
+                                             input_beam=_get_beam())
+    beam0, footprints0, beam1, footprints1, _ = _trace(beamline_element)
+    for b0, b1 in zip([beam0] + footprints0, [beam1] + footprints1):
+        _assert_same_beams(b0, b1)
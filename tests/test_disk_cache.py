@@ -0,0 +1,35 @@
+"""
+Tests of the disk cache of the radiation: the stored results must be reused only by the same code.
+"""
+import numpy
+
+from shadow4.tools import disk_cache
+from shadow4.tools.disk_cache import DiskCache
+
+
+def _calculator(n=10):
+    return {"x": numpy.linspace(0, 1, n)}
+
+def test_key_includes_code_versions():
+    key = DiskCache().get_key("test", {"n": 10}, calculator=_calculator)
+    assert repr(disk_cache._get_package_versions()) in key
+    assert "shadow4" in key and "srxraylib" in key
+    assert disk_cache._get_source_hash(_calculator) in key
+
+def test_code_change_invalidates_the_stored_results(tmp_path, monkeypatch):
+    calls = []
+    def calculator(n=10):
+        calls.append(n)
+        return _calculator(n)
+
+    cache = DiskCache(cache_dir=str(tmp_path))
+    for i in range(2): cache.get("test", {"n": 10}, calculator)
+    assert len(calls) == 1
+
+    monkeypatch.setattr(disk_cache, "_get_source_hash", lambda calculator: "modified source")
+    cache.get("test", {"n": 10}, calculator)
+    assert len(calls) == 2
+
+    monkeypatch.setattr(disk_cache, "_get_package_versions", lambda: (("shadow4", "next"), ("srxraylib", "next")))
+    cache.get("test", {"n": 10}, calculator)
+    assert len(calls) == 3
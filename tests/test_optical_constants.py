@@ -0,0 +1,38 @@
+"""
+Regression tests of the optical constants service: by default, the values must be identical to the ones
+calculated energy by energy, also for continuous spectra across an absorption edge.
+"""
+import numpy
+import pytest
+
+from shadow4.physical_models.prerefl.optical_constants import OpticalConstants
+
+xraylib = pytest.importorskip("xraylib")
+
+
+def _continuous_spectrum_across_the_edge(nrays=20000):
+    # Fe K edge at 7112 eV
+    return numpy.random.default_rng(0).uniform(7000.0, 7200.0, nrays)
+
+def test_continuous_spectrum_is_exact():
+    energies = _continuous_spectrum_across_the_edge()
+    optical_constants = OpticalConstants()
+    mu = optical_constants.attenuation_coefficient(energies, material="Fe", density=7.874)
+    n = optical_constants.refraction_index(energies, material="Fe", density=7.874)
+    assert numpy.unique(energies).size > 5000
+    numpy.testing.assert_array_equal(mu, [xraylib.CS_Total_CP("Fe", e * 1e-3) * 7.874 for e in energies])
+    numpy.testing.assert_array_equal(n, [xraylib.Refractive_Index("Fe", e * 1e-3, 7.874) for e in energies])
+
+def test_cache_limit_is_exact():
+    energies = _continuous_spectrum_across_the_edge(nrays=2000)
+    optical_constants = OpticalConstants(max_energies=1000)
+    for i in range(2): # the second call reads the cache (if the energies were cached)
+        mu = optical_constants.attenuation_coefficient(energies, material="Fe", density=7.874)
+        numpy.testing.assert_array_equal(mu, [xraylib.CS_Total_CP("Fe", e * 1e-3) * 7.874 for e in energies])
+
+def test_grid_interpolation_on_request():
+    energies = _continuous_spectrum_across_the_edge()
+    mu = OpticalConstants(max_unique_energies=5000).attenuation_coefficient(energies, material="Fe", density=7.874)
+    mu0 = numpy.array([xraylib.CS_Total_CP("Fe", e * 1e-3) * 7.874 for e in energies])
+    away_from_the_edge = numpy.abs(energies - 7112.0) > 2.0
+    numpy.testing.assert_allclose(mu[away_from_the_edge], mu0[away_from_the_edge], rtol=1e-4)
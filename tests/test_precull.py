@@ -0,0 +1,63 @@
+"""
+Regression tests of the bounding-volume pre-cull (S4BeamlineElement._apply_with_precull): the good rays traced
+with precull=True must be the same as the ones traced with precull=False (identical for toroids, within the
+tolerance of the intercept solver for meshes, as it solves all the rays of the beam together).
+"""
+import numpy
+import pytest
+
+from syned.beamline.shape import Rectangle
+from syned.beamline.element_coordinates import ElementCoordinates
+
+from shadow4.sources.source_geometrical.source_geometrical import SourceGeometrical
+from shadow4.beamline.optical_elements.refractors.s4_numerical_mesh_interface import S4NumericalMeshInterface, \
+    S4NumericalMeshInterfaceElement
+from shadow4.beamline.optical_elements.mirrors.s4_toroid_mirror import S4ToroidMirror, S4ToroidMirrorElement
+
+
+def _get_beam(nrays=2000, emin=8000.0, emax=12000.0):
+    light_source = SourceGeometrical(nrays=nrays, seed=3)
+    light_source.set_spatial_type_rectangle(width=1e-4, height=1e-4)
+    light_source.set_angular_distribution_flat(hdiv1=-2e-3, hdiv2=2e-3, vdiv1=-2e-3, vdiv2=2e-3)
+    light_source.set_energy_distribution_uniform(value_min=emin, value_max=emax, unit='eV')
+    return light_source.get_beam()
+
+def _trace(beamline_element, precull):
+    beam, footprint = beamline_element.trace_beam(precull=precull)
+    return beam, footprint
+
+def _assert_same_good_rays(beamline_element, rtol=0.0, atol=0.0):
+    beam0, footprint0 = _trace(beamline_element, False)
+    beam1, footprint1 = _trace(beamline_element, True)
+    good0 = beam0.rays[:, 9] > 0
+    good1 = beam1.rays[:, 9] > 0
+    assert good0.sum() > 0 and (~good0).sum() > 0 # some rays are culled
+    numpy.testing.assert_array_equal(good0, good1)
+    numpy.testing.assert_allclose(beam1.rays[good1], beam0.rays[good0], rtol=rtol, atol=atol)
+    numpy.testing.assert_allclose(footprint1.rays[good1], footprint0.rays[good0], rtol=rtol, atol=atol)
+
+@pytest.mark.parametrize("f_r_ind", [0, 4, 6])
+def test_precull_interface_with_energy_dependent_optical_constants(f_r_ind):
+    x = numpy.linspace(-2e-3, 2e-3, 21)
+    y = numpy.linspace(-2e-3, 2e-3, 31)
+    zz = 1e-6 * numpy.outer(x ** 2, numpy.ones_like(y)) / 4e-6 # (nx, ny)
+    optical_element = S4NumericalMeshInterface(name="interface",
+                                               boundary_shape=Rectangle(-1e-3, 1e-3, -1e-3, 1e-3),
+                                               material_object="Be", material_image="Be",
+                                               density_object=1.848, density_image=1.848,
+                                               f_r_ind=f_r_ind,
+                                               r_ind_obj=1.0, r_ind_ima=1.0 - 5e-6,
+                                               xx=x, yy=y, zz=zz.T.copy())
+    beamline_element = S4NumericalMeshInterfaceElement(optical_element=optical_element,
+                                                       coordinates=ElementCoordinates(p=1.0, q=1.0),
+                                                       input_beam=_get_beam())
+    _assert_same_good_rays(beamline_element, rtol=1e-8, atol=1e-10)
+
+def test_precull_toroid_mirror():
+    optical_element = S4ToroidMirror(boundary_shape=Rectangle(-0.005, 0.005, -0.05, 0.05),
+                                     min_radius=0.1, maj_radius=100.0)
+    beamline_element = S4ToroidMirrorElement(optical_element=optical_element,
+                                             coordinates=ElementCoordinates(p=10.0, q=10.0,
+                                                                            angle_radial=numpy.radians(89.8)),
+                                             input_beam=_get_beam(nrays=5000))
+    _assert_same_good_rays(beamline_element)
@@ -0,0 +1,47 @@
+"""
+Regression tests of the undulator far field calculated in blocks of points
+(_pysru_energy_radiated_approximation_and_farfield_array): by default, the results must be identical to the ones
+calculated point by point (_pysru_energy_radiated_approximation_and_farfield).
+"""
+import numpy
+import pytest
+
+from shadow4.sources.undulator import calculate_undulator_emission as cue
+
+
+def _per_point_array(omega=2.53465927101e17, electron_current=1.0, trajectory=None, x=0.00, y=0.0, D=None,
+                     flag_matmul=0):
+    x = numpy.asarray(x, dtype=float).ravel()
+    y = numpy.asarray(y, dtype=float).ravel()
+    E = numpy.zeros((3, x.size), dtype=complex)
+    for i in range(x.size):
+        E[:, i] = cue._pysru_energy_radiated_approximation_and_farfield(omega=omega,
+                                                                        electron_current=electron_current,
+                                                                        trajectory=trajectory, x=x[i], y=y[i], D=D)
+    return E
+
+def _calculate(**kwargs):
+    return cue.calculate_undulator_emission(electron_energy=6.0, electron_current=0.2, undulator_period=0.025,
+                                            undulator_nperiods=10, K=1.68, photon_energy=5591.0, EMAX=5700.0,
+                                            NG_E=2, MAXANGLE=30e-6, number_of_points=11, NG_P=7,
+                                            number_of_trajectory_points=20, flag_size=2, distance=100.0,
+                                            magnification=0.01, flag_backprop_recalculate_source=1,
+                                            flag_backprop_weight=1, **kwargs)
+
+@pytest.fixture(scope="module")
+def per_point():
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(cue, "_pysru_energy_radiated_approximation_and_farfield_array", _per_point_array)
+        return _calculate()
+
+@pytest.mark.parametrize("block_size", [None, 1, 5])
+def test_farfield_identical_to_per_point(per_point, block_size):
+    out = _calculate(block_size=block_size)
+    assert out.keys() == per_point.keys()
+    for key in out.keys():
+        assert numpy.array_equal(out[key], per_point[key]), key
+
+def test_farfield_matmul(per_point):
+    out = _calculate(flag_matmul=1)
+    for key in out.keys():
+        numpy.testing.assert_allclose(out[key], per_point[key], rtol=1e-10, atol=0, err_msg=key)